@@ -28,10 +28,16 @@ except ImportError as e:
 
 # --- 导入 SD API 助手 ---
 try:
-    from .sd_api_helper import call_sd_webui_api
+    from .sd_api_helper import call_sd_webui_api, get_sd_current_model, get_sd_options, set_sd_options, get_sd_progress, get_sd_task_progress, interrupt_sd_webui
 except ImportError as e:
     logger.critical(f"错误：无法从 .sd_api_helper 导入: {e}", exc_info=True)
     def call_sd_webui_api(*args, **kwargs): return None, "错误: SD API 助手未加载"
+    def get_sd_current_model(*args, **kwargs): return None, "错误: SD API 助手未加载"
+    def get_sd_options(*args, **kwargs): return None, "错误: SD API 助手未加载"
+    def set_sd_options(*args, **kwargs): return False, "错误: SD API 助手未加载"
+    def get_sd_progress(*args, **kwargs): return None, "错误: SD API 助手未加载"
+    def get_sd_task_progress(*args, **kwargs): return None, "错误: SD API 助手未加载"
+    def interrupt_sd_webui(*args, **kwargs): return False, "错误: SD API 助手未加载"
 
 # --- 导入 ComfyUI API 助手 ---
 try:
@@ -40,6 +46,14 @@ except ImportError as e:
     logger.critical(f"错误：无法从 .comfyui_api_helper 导入: {e}", exc_info=True)
     def call_comfyui_api(*args, **kwargs): return None, "错误: ComfyUI API 助手未加载"
 
+# --- 导入 ComfyUI WebSocket 长连接管理 ---
+try:
+    from .comfyui_ws_client import get_comfyui_ws_client, close_all_comfyui_ws_clients
+except ImportError as e:
+    logger.critical(f"错误：无法从 .comfyui_ws_client 导入: {e}", exc_info=True)
+    def get_comfyui_ws_client(*args, **kwargs): return None
+    def close_all_comfyui_ws_clients(*args, **kwargs): return None
+
 # --- 导入 GPT-SoVITS API 助手 ---
 try:
     from .gptsovits_api_helper import call_gptsovits_api
@@ -65,7 +79,15 @@ __all__ = [
     'get_google_models',
     'call_novelai_image_api',
     'call_sd_webui_api',
+    'get_sd_current_model',
+    'get_sd_options',
+    'set_sd_options',
+    'get_sd_progress',
+    'get_sd_task_progress',
+    'interrupt_sd_webui',
     'call_comfyui_api', # 导出 ComfyUI 助手
+    'get_comfyui_ws_client',
+    'close_all_comfyui_ws_clients',
     'call_gptsovits_api',
     'call_openai_non_stream',
     'stream_openai_response',
@@ -3,7 +3,7 @@ import requests # 功能性备注: 导入 requests 库用于 HTTP 请求
 import json # 功能性备注: 导入 json 库用于处理 JSON 数据
 import time # 功能性备注: 导入 time 库用于延时和时间戳
 import uuid # 功能性备注: 导入 uuid 库用于生成唯一 ID
-import websocket # 功能性备注: 导入 websocket-client 库用于 WebSocket 通信
+from concurrent.futures import TimeoutError as FutureTimeoutError # 功能性备注: 等待 WebSocket 结果超时
 from urllib.parse import urlparse, urljoin # 功能性备注: 导入 URL 处理函数
 import traceback # 功能性备注: 保留用于错误处理
 import os # 功能性备注: 导入 os 库用于路径操作
@@ -12,11 +12,15 @@ import copy # 功能性备注: 导入 copy 库用于深拷贝
 from pathlib import Path # 功能性备注: 导入 Path 对象用于路径处理
 import logging # 功能性备注: 导入日志模块
 
+from .comfyui_ws_client import get_comfyui_ws_client # 功能性备注: 导入共享 WebSocket 长连接客户端
+
 # 功能性备注: 获取当前模块的 logger 实例
 logger = logging.getLogger(__name__)
 
 # 功能性备注: 定义调试日志的基础目录
 DEBUG_LOG_DIR = Path("debug_logs") / "api_requests"
+# 功能性备注: 等待结果时检查停止信号的间隔 (秒)
+STOP_CHECK_INTERVAL = 0.5
 
 def _save_debug_input(api_type, payload, identifier):
     """保存调试输入文件 (移除敏感信息)"""
@@ -108,9 +112,122 @@ def _set_node_input(node_data, input_name, value):
     logger.warning(f"    - 无法设置节点输入 '{input_name}'，节点数据无效或缺少 'inputs' 键。 Node Data: {str(node_data)[:100]}...") # 逻辑备注
     return False
 
-def call_comfyui_api(comfyui_url, workflow_dict, expected_output_node_title="SaveOutputImage", client_id=None, save_debug=False):
+def _get_prompt_history(history_endpoint, prompt_id):
+    """查询一次指定 prompt 的历史记录，返回其信息字典，未找到或出错时返回 None"""
+    history_response = None
+    try:
+        history_response = requests.get(history_endpoint, timeout=10)
+        history_response.raise_for_status()
+        return history_response.json().get(prompt_id)
+    except Exception as hist_e:
+        logger.debug(f"查询 Prompt {prompt_id} 历史记录失败: {hist_e}") # 逻辑备注
+        return None
+    finally:
+        if history_response:
+            try: history_response.close()
+            except Exception: pass
+
+def _download_output_images(view_endpoint, images_to_download):
+    """通过 /view 下载输出节点 images 列表中的图片，返回 (图片 bytes 列表, 下载错误列表)"""
+    image_data_list = [] # 功能性备注: 下载成功的图片数据
+    download_errors = [] # 功能性备注: 用于存储下载过程中发生的错误
+    # 功能性备注: 遍历每个图片信息并尝试下载
+    for img_info in images_to_download:
+        filename = img_info.get('filename')
+        subfolder = img_info.get('subfolder')
+        img_type = img_info.get('type', 'output') # 功能性备注: 获取图片类型（通常是 'output' 或 'temp'）
+
+        # 逻辑备注: 必须要有文件名才能下载
+        if filename:
+            logger.info(f"  > 准备下载图片: filename={filename}, subfolder={subfolder}, type={img_type}") # 功能性备注: 记录准备下载
+            img_download_error = None # 功能性备注: 初始化单张图片下载错误信息
+            img_response = None # 功能性备注: 初始化图片下载响应对象
+            try:
+                # 功能性备注: 构建下载图片的请求参数
+                view_params = {'filename': filename}
+                if subfolder: view_params['subfolder'] = subfolder
+                if img_type: view_params['type'] = img_type
+
+                # 功能性备注: 发送 GET 请求下载图片
+                img_response = requests.get(view_endpoint, params=view_params, timeout=60)
+                img_response.raise_for_status() # 功能性备注: 检查下载请求的 HTTP 状态
+
+                # 功能性备注: 检查返回内容的 Content-Type 是否是图片
+                content_type = img_response.headers.get('content-type', '').lower()
+                if 'image/' in content_type:
+                    # 功能性备注: 下载成功，将图片数据 (bytes) 添加到结果列表
+                    image_data_list.append(img_response.content)
+                    logger.info(f"    - 图片 '{filename}' 下载成功 ({len(img_response.content)} bytes)。") # 功能性备注: 记录下载成功
+                else:
+                    # 逻辑备注: 如果 Content-Type 不是图片，则认为是下载错误
+                    img_download_error = f"下载链接 '{filename}' 返回非图片类型: {content_type}"
+            except requests.exceptions.RequestException as dl_e:
+                # 逻辑备注: 处理下载时的网络或 HTTP 错误
+                img_download_error = f"下载图片 '{filename}' 时网络/HTTP错误: {dl_e}"
+            except Exception as generic_dl_e:
+                 # 逻辑备注: 处理下载时的其他未知错误
+                 img_download_error = f"下载图片 '{filename}' 时发生意外错误: {generic_dl_e}"
+            finally:
+                 # 功能性备注: 确保关闭图片下载的响应对象
+                 if img_response:
+                     try: img_response.close()
+                     except Exception: pass
+
+            # 逻辑备注: 如果下载单张图片时出错，记录错误信息
+            if img_download_error:
+                logger.error(f"    - {img_download_error}") # 功能性备注: 记录错误
+                download_errors.append(img_download_error)
+        else:
+            # 逻辑备注: 如果图片信息中缺少文件名
+            logger.warning(f"  > 警告: 输出节点信息中缺少 'filename'。 Info: {img_info}") # 功能性备注: 记录警告
+            download_errors.append("输出节点信息缺少 'filename'")
+    return image_data_list, download_errors
+
+def get_comfyui_queue_remaining(comfyui_url):
+    """通过 /queue 查询服务器队列数量 (正在执行 + 等待中)，失败时返回 None"""
+    try:
+        response = requests.get(urljoin(comfyui_url, "/queue"), timeout=5)
+        response.raise_for_status()
+        queue_info = response.json()
+        return len(queue_info.get("queue_running", [])) + len(queue_info.get("queue_pending", []))
+    except (requests.exceptions.RequestException, ValueError, AttributeError) as queue_e:
+        logger.debug(f"查询 ComfyUI 队列失败: {queue_e}") # 逻辑备注
+        return None
+
+def cancel_comfyui_prompt(comfyui_url, prompt_id):
     """
-    调用 ComfyUI 的 /prompt API 提交工作流，并轮询或使用 WebSocket 获取结果。
+    取消已提交的 prompt：先读取 /queue，确认 queue_running 中是该 prompt 时才调用 /interrupt；
+    否则只从等待队列删除。只中断本程序提交的 prompt (共享服务器上不影响其他人的任务)。返回 (是否成功, 错误信息)。
+    """
+    try:
+        response = requests.get(urljoin(comfyui_url, "/queue"), timeout=5)
+        response.raise_for_status()
+        running_ids = [entry[1] for entry in response.json().get("queue_running", []) if isinstance(entry, list) and len(entry) > 1]
+        if prompt_id in running_ids:
+            # 逻辑备注: 新版本按 prompt_id 中断；旧版本忽略请求体，中断当前执行的任务 (已确认就是本 prompt)
+            requests.post(urljoin(comfyui_url, "/interrupt"), json={"prompt_id": prompt_id}, timeout=5).raise_for_status()
+            logger.info(f"已中断正在执行的 ComfyUI Prompt {prompt_id}。") # 功能性备注
+        else:
+            # 逻辑备注: 删除后不再检查是否已开始执行，避免在两次请求之间中断到其他客户端的任务 (刚开始执行的本 prompt 会执行完，结果被丢弃)
+            requests.post(urljoin(comfyui_url, "/queue"), json={"delete": [prompt_id]}, timeout=5).raise_for_status()
+            logger.info(f"已从 ComfyUI 队列删除 Prompt {prompt_id}。") # 功能性备注
+        return True, None
+    except (requests.exceptions.RequestException, ValueError, AttributeError) as cancel_e:
+        logger.warning(f"取消 ComfyUI Prompt {prompt_id} 失败: {cancel_e}") # 逻辑备注
+        return False, f"取消 ComfyUI Prompt 失败: {cancel_e}"
+
+def call_comfyui_api(comfyui_url, workflow_dict, expected_output_node_title="SaveOutputImage", client_id=None, save_debug=False, ws_client=None, output_node_id=None, ws_image_node_id=None, on_event=None, max_queued=0, stop_event=None, output_node_ids=None):
+    """
+    调用 ComfyUI 的 /prompt API 提交工作流，并通过共享 WebSocket 长连接或 HTTP 轮询获取结果。
+    ws_client 为空时自动获取该服务器的共享长连接客户端；client_id 仅在长连接不可用时使用。
+    output_node_id 为已知的输出节点 ID (例如由预编译模板解析)，提供时不再按标题查找。
+    ws_image_node_id 为工作流中 WebSocket 保存节点 (SaveImageWebsocket) 的 ID：提供且长连接可用时，
+    图片直接从 WebSocket 二进制帧获取；未收到图片时再回退到 /history + /view。
+    on_event(msg_type, data) 可选，接收该 prompt 的 WebSocket 事件 (execution_start、progress 等)，用于显示进度。
+    max_queued > 0 时，提交前等待服务器队列 (status 事件中的 queue_remaining，断线时查询 /queue) 低于该数量；
+    等待期间 stop_event 被设置则不提交并返回错误；提交后 stop_event 被设置时，从服务器队列删除或中断该 prompt 并立即返回。
+    output_node_ids 为多个输出节点 ID (融合了多个任务的工作流) 时，按节点分别下载，返回 ({节点 ID: [图片 bytes]}, error_msg)；
+    此时不使用 WebSocket 保存节点的图片帧 (无法区分属于哪个输出)。
     """
     # 功能性备注: 这是调用 ComfyUI API 的主要函数。它负责提交工作流、处理响应、通过 WebSocket 或 HTTP 轮询获取结果，并下载最终生成的图片。
     # --- 输入校验和 URL 准备 ---
@@ -129,8 +246,6 @@ def call_comfyui_api(comfyui_url, workflow_dict, expected_output_node_title="Sav
         prompt_endpoint = urljoin(base_url, "/prompt") # 提交工作流的端点
         history_endpoint_base = urljoin(base_url, "/history/") # 获取历史记录的基础端点
         view_endpoint = urljoin(base_url, "/view") # 下载图片的端点
-        # 功能性备注: 如果提供了 client_id，则构建 WebSocket URL，否则不使用 WebSocket
-        ws_url = f"ws://{netloc}/ws?clientId={client_id}" if client_id else None
     except Exception as url_e:
         logger.error(f"处理 ComfyUI URL 时出错: {url_e}") # 功能性备注: 记录 URL 处理错误
         return None, f"处理 ComfyUI URL 时出错: {url_e}"
@@ -140,35 +255,56 @@ def call_comfyui_api(comfyui_url, workflow_dict, expected_output_node_title="Sav
     image_data_list = [] # 功能性备注: 存储最终下载到的图片数据 (bytes)
     error_message = None # 功能性备注: 存储过程中发生的错误信息
     response = None # 功能性备注: 存储 HTTP 响应对象
-    ws = None # 功能性备注: 存储 WebSocket 连接对象
 
     # --- 主逻辑包裹在 try...except 中以捕获意外错误 ---
     try:
         # --- 1. 准备并提交工作流 ---
         logger.info(f"准备提交工作流到: {prompt_endpoint}") # 功能性备注: 记录提交信息
         # 功能性备注: 构建提交给 /prompt API 的 payload
+        # 功能性备注: 获取 (或复用) 该服务器的 WebSocket 长连接，必须在提交前确定 client_id
+        if ws_client is None:
+            try:
+                ws_client = get_comfyui_ws_client(base_url)
+            except Exception as ws_init_e:
+                logger.warning(f"无法建立 ComfyUI WebSocket 长连接: {ws_init_e}。将使用 HTTP 轮询。") # 逻辑备注
+                ws_client = None
+        if ws_client:
+            client_id = ws_client.client_id
         payload = {"prompt": workflow_dict}
         if client_id:
             payload["client_id"] = client_id # 功能性备注: 如果有 client_id，添加到 payload
 
         # --- *** 新增的调试打印 *** ---
-        logger.debug("--- [DEBUG] Workflow being sent to ComfyUI ---") # 功能性备注: 调试日志，标记工作流开始
-        try:
-            # 功能性备注: 尝试将工作流格式化为 JSON 打印，便于调试查看
-            logger.debug(json.dumps(workflow_dict, indent=2, sort_keys=True, ensure_ascii=False))
-        except TypeError as json_dump_error:
-             # 逻辑备注: 如果工作流无法序列化为 JSON（理论上不应发生），则打印原始字典
-             logger.warning(f"无法序列化为 JSON 进行调试打印: {json_dump_error}")
-             logger.debug(workflow_dict)
-        logger.debug("--- [DEBUG] End of Workflow ---") # 功能性备注: 调试日志，标记工作流结束
+        # 逻辑备注: 仅在 DEBUG 级别开启时才序列化整个工作流，避免每个任务白白做一次大 JSON 格式化
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("--- [DEBUG] Workflow being sent to ComfyUI ---") # 功能性备注: 调试日志，标记工作流开始
+            try:
+                # 功能性备注: 尝试将工作流格式化为 JSON 打印，便于调试查看
+                logger.debug(json.dumps(workflow_dict, indent=2, sort_keys=True, ensure_ascii=False))
+            except TypeError as json_dump_error:
+                 # 逻辑备注: 如果工作流无法序列化为 JSON（理论上不应发生），则打印原始字典
+                 logger.warning(f"无法序列化为 JSON 进行调试打印: {json_dump_error}")
+                 logger.debug(workflow_dict)
+            logger.debug("--- [DEBUG] End of Workflow ---") # 功能性备注: 调试日志，标记工作流结束
         # --- *** 调试打印结束 *** ---
 
         # 功能性备注: 如果启用了调试保存，则保存请求 payload
         if save_debug:
             _save_debug_input("comfyui", payload, "prompt")
 
+        # 功能性备注: 限制服务器上排队的 prompt 数量 (保持 GPU 忙碌，同时让停止和服务器内存可控)
+        slot_acquired = False
+        if ws_client and max_queued and max_queued > 0:
+            if not ws_client.acquire_submit_slot(max_queued, stop_event=stop_event, poll_queue=lambda: get_comfyui_queue_remaining(base_url)):
+                return None, "ComfyUI 提交前任务被停止。"
+            slot_acquired = True
+
         # 功能性备注: 发送 POST 请求提交工作流
-        response = requests.post(prompt_endpoint, json=payload, timeout=30)
+        try:
+            response = requests.post(prompt_endpoint, json=payload, timeout=30)
+        finally:
+            if slot_acquired:
+                ws_client.release_submit_slot(submitted=response is not None and response.ok)
         response.raise_for_status() # 功能性备注: 检查 HTTP 错误 (4xx, 5xx)，如果出错则抛出异常
         result_json = response.json() # 功能性备注: 解析返回的 JSON 响应
 
@@ -189,135 +325,59 @@ def call_comfyui_api(comfyui_url, workflow_dict, expected_output_node_title="Sav
             logger.error(f"{error_message} 响应: {response.text[:200]}...") # 功能性备注: 记录错误
             return None, error_message
 
-        # --- 2. 获取结果 (优先 WebSocket，否则轮询) ---
+        # --- 2. 获取结果 (优先共享 WebSocket 长连接，否则轮询) ---
         execution_finished = False # 功能性备注: 标记任务是否执行完成
         final_history = None # 功能性备注: 存储最终获取到的历史记录
-
-        # 逻辑备注: 如果 WebSocket URL 有效，则尝试使用 WebSocket
-        if ws_url:
-            # --- 2a. 使用 WebSocket 获取结果 ---
-            logger.info(f"尝试使用 WebSocket 连接: {ws_url}") # 功能性备注: 记录连接尝试
+        ws_outputs = {} # 功能性备注: 通过 WebSocket 'executed' 事件收集到的节点输出
+        ws_images = [] # 功能性备注: 通过 WebSocket 二进制帧收到的图片数据
+
+        # 逻辑备注: 如果长连接客户端可用，则在共享连接上等待该 prompt 的事件
+        if ws_client:
+            # --- 2a. 使用共享 WebSocket 长连接获取结果 ---
+            watch = ws_client.watch(prompt_id, on_event=on_event, image_node_id=ws_image_node_id)
+            history_endpoint = urljoin(history_endpoint_base, prompt_id)
+            start_time = time.time()
+            timeout_seconds = 600 # 功能性备注: 设置等待超时时间 (10分钟)
             try:
-                # 功能性备注: 创建 WebSocket 连接，设置超时
-                ws = websocket.create_connection(ws_url, timeout=10)
-                logger.info(f"WebSocket 连接成功。等待 Prompt ID {prompt_id} 的结果...") # 功能性备注: 记录连接成功
-                start_time = time.time()
-                timeout_seconds = 600 # 功能性备注: 设置 WebSocket 等待超时时间 (10分钟)
-
-                # 功能性备注: 循环接收 WebSocket 消息，直到任务完成或超时
                 while time.time() - start_time < timeout_seconds:
-                    message_str = None
-                    message = None
+                    if stop_event and stop_event.is_set():
+                        cancel_comfyui_prompt(base_url, prompt_id)
+                        error_message = f"ComfyUI 任务被停止 (Prompt {prompt_id} 已取消)。"
+                        break
+                    # 逻辑备注: 连接正常时只等待事件；断线期间完成事件可能丢失，改为每秒查询一次历史记录兜底
+                    wait_slice = 5.0 if ws_client.connected else 1.0
+                    if stop_event: wait_slice = min(wait_slice, STOP_CHECK_INTERVAL)
                     try:
-                        # 功能性备注: 设置接收超时，避免无限阻塞
-                        ws.settimeout(10.0)
-                        # 功能性备注: 接收数据
-                        received_data = ws.recv()
-                        if not received_data: continue # 功能性备注: 忽略空消息
-
-                        # 功能性备注: 检查类型并解码 (如果需要)
-                        if isinstance(received_data, bytes):
-                            # 逻辑备注: 收到的是字节串，尝试解码
-                          # logger.debug(f"收到原始 WebSocket 消息 (bytes): {received_data!r}") # 功能性备注: 记录原始字节
-                            try:
-                                message_str = received_data.decode('utf-8')
-                            except UnicodeDecodeError:
-                                logger.warning(f"WebSocket 消息解码失败 (非 UTF-8 或二进制数据?)，已跳过此消息。") # 功能性备注: 记录解码失败警告
-                                continue # 功能性备注: 跳过无法解码的字节消息
-                        elif isinstance(received_data, str):
-                            # 逻辑备注: 收到的是字符串，直接使用
-                            #logger.debug(f"收到原始 WebSocket 消息 (str): {received_data!r}") # 功能性备注: 记录原始字符串
-                            message_str = received_data
-                        else:
-                            # 逻辑备注: 收到未知类型的数据
-                            logger.warning(f"收到未知类型的 WebSocket 数据: {type(received_data)}，跳过。") # 功能性备注: 记录未知类型警告
-                            continue
-
-                        # 功能性备注: 如果成功获取到字符串，尝试解析 JSON
-                        if message_str:
-                            if message_str.strip() == '[DONE]': # 逻辑备注: 检查是否是结束标记
-                                logger.info("WebSocket 收到 [DONE] 标记。") # 功能性备注: 记录收到 DONE
-                                break # 功能性备注: 结束循环
-
-                            try:
-                                message = json.loads(message_str)
-                            except json.JSONDecodeError as json_err:
-                                logger.error(f"处理 ComfyUI WebSocket 消息时 JSON 解析错误: {json_err} - Raw Str: '{message_str[:100]}...'") # 功能性备注: 记录 JSON 解析错误
-                                continue # 逻辑备注: 跳过无法解析的 JSON 消息
-                        else:
-                            # 逻辑备注: 如果 message_str 为 None 或空 (理论上不应发生)
-                            continue
-
-                        # 功能性备注: 处理解析后的 JSON 消息
-                        if message:
-                            msg_type = message.get('type')
-                            data = message.get('data', {})
-                            msg_prompt_id = data.get('prompt_id')
-
-                            # 逻辑备注: 只处理与当前提交任务相关的消息
-                            if msg_prompt_id == prompt_id:
-                                if msg_type == 'executing':
-                                    # 逻辑备注: 'executing' 消息中 node 为 None 表示执行完成
-                                    if data.get('node') is None:
-                                        logger.info(f"WebSocket: Prompt {prompt_id} 执行完成。") # 功能性备注: 记录完成
-                                        execution_finished = True
-                                        break # 功能性备注: 执行完毕，跳出 WebSocket 循环
-                                    else:
-                                        # 功能性备注: 记录正在执行的节点信息
-                                        logger.info(f"WebSocket: 节点 {data.get('node')} 正在执行...")
-                                elif msg_type == 'execution_error':
-                                    # 逻辑备注: 如果收到执行错误消息
-                                    node_id = data.get('node_id', 'N/A')
-                                    node_type = data.get('node_type', 'N/A')
-                                    err_msg = data.get('exception_message', '未知执行错误')
-                                    error_message = f"ComfyUI 执行错误 (Node {node_id}, Type {node_type}): {err_msg}"
+                        ws_result = watch.future.result(timeout=wait_slice)
+                    except FutureTimeoutError:
+                        if not ws_client.connected:
+                            prompt_info = _get_prompt_history(history_endpoint, prompt_id)
+                            if prompt_info is not None:
+                                status_info = prompt_info.get("status", {})
+                                if status_info.get("completed", False):
+                                    logger.info(f"WebSocket 断线期间轮询到 Prompt {prompt_id} 已完成。") # 功能性备注
+                                    final_history = prompt_info
+                                    execution_finished = True
+                                    break
+                                if status_info.get("status_str") == "error":
+                                    error_message = f"ComfyUI 执行错误 (Prompt {prompt_id})，详情见服务器日志。"
                                     logger.error(f"{error_message}") # 功能性备注: 记录错误
-                                    execution_finished = True # 功能性备注: 认为执行因错误而结束
-                                    break # 功能性备注: 出错，跳出 WebSocket 循环
-                            elif msg_type == 'status':
-                                # 功能性备注: 处理状态更新消息（例如队列剩余数量）
-                                 if 'exec_info' in data:
-                                     q_size = data['exec_info'].get('queue_remaining', '?')
-                                     logger.info(f"WebSocket Status: 队列剩余 {q_size}") # 功能性备注: 记录队列状态
-
-                    except websocket.WebSocketTimeoutException:
-                        # 逻辑备注: 接收超时是正常的，继续等待下一条消息
+                                    execution_finished = True
+                                    break
                         continue
-                    except websocket.WebSocketConnectionClosedException:
-                        # 逻辑备注: WebSocket 连接意外关闭
-                        error_message = "ComfyUI WebSocket 连接意外关闭。"
-                        logger.error(f"{error_message}") # 功能性备注: 记录错误
-                        execution_finished = True # 功能性备注: 无法再接收，认为结束
-                        break # 功能性备注: 连接关闭，跳出 WebSocket 循环
-                    except AttributeError as ae: # 逻辑备注: 捕获可能的其他 AttributeError
-                        logger.error(f"处理 WebSocket 消息时发生 AttributeError: {ae}", exc_info=True) # 功能性备注: 记录错误
-                        continue # 逻辑备注: 跳过此消息
-                    except Exception as ws_proc_e:
-                        # 逻辑备注: 捕获处理 WebSocket 消息时的其他未知错误
-                        logger.exception(f"处理 WebSocket 消息时发生其他错误: {ws_proc_e}") # 功能性备注: 记录异常
-                        continue # 逻辑备注: 跳过此消息
-
-                # 逻辑备注: 检查是否是因为超时退出 WebSocket 循环
-                if not execution_finished and not error_message:
-                    error_message = f"ComfyUI WebSocket 等待超时 ({timeout_seconds}秒)，未收到完成信号。"
-                    logger.error(f"{error_message}") # 功能性备注: 记录超时错误
-
-            except websocket.WebSocketException as ws_connect_e:
-                # 逻辑备注: 处理 WebSocket 连接或通信失败的情况
-                logger.warning(f"WebSocket 连接或通信失败: {ws_connect_e}。将回退到 HTTP 轮询。") # 功能性备注: 记录警告
-                ws_url = None # 功能性备注: 标记 WebSocket 不可用，以便后续进入轮询
-            except Exception as ws_generic_e:
-                # 逻辑备注: 处理 WebSocket 过程中的其他未知错误
-                logger.exception(f"WebSocket 处理中发生其他错误: {ws_generic_e}。将回退到 HTTP 轮询。") # 功能性备注: 记录异常
-                ws_url = None # 功能性备注: 标记 WebSocket 不可用
+                    execution_finished = True
+                    error_message = ws_result.get("error")
+                    ws_outputs = ws_result.get("outputs") or {}
+                    ws_images = ws_result.get("images") or []
+                    break
             finally:
-                # 功能性备注: 确保关闭 WebSocket 连接
-                if ws:
-                    try:
-                        ws.close()
-                        logger.info("WebSocket 连接已关闭。") # 功能性备注: 记录关闭
-                    except Exception as ws_close_e:
-                        logger.warning(f"关闭 WebSocket 时出错: {ws_close_e}") # 功能性备注: 记录关闭错误
+                ws_client.unwatch(prompt_id)
+
+            # 逻辑备注: 检查是否是因为超时退出等待循环
+            if not execution_finished and not error_message:
+                error_message = f"ComfyUI WebSocket 等待超时 ({timeout_seconds}秒)，未收到完成信号。"
+                logger.error(f"{error_message}") # 功能性备注: 记录超时错误
+                cancel_comfyui_prompt(base_url, prompt_id) # 逻辑备注: prompt 可能仍在服务器上排队或执行，先取消，避免重试时重复生成
 
         # --- 2b. 如果 WebSocket 失败或未启用，并且之前没有错误，使用 HTTP 轮询获取结果 ---
         # 逻辑备注: 只有在任务未完成且没有发生错误时才进行轮询
@@ -330,6 +390,10 @@ def call_comfyui_api(comfyui_url, workflow_dict, expected_output_node_title="Sav
 
             # 功能性备注: 循环轮询，直到任务完成或超时
             while time.time() - start_time < timeout_seconds:
+                if stop_event and stop_event.is_set():
+                    cancel_comfyui_prompt(base_url, prompt_id)
+                    error_message = f"ComfyUI 任务被停止 (Prompt {prompt_id} 已取消)。"
+                    break
                 history_response = None # 功能性备注: 初始化轮询响应对象
                 try:
                     # 功能性备注: 发送 GET 请求获取历史记录
@@ -390,12 +454,27 @@ def call_comfyui_api(comfyui_url, workflow_dict, expected_output_node_title="Sav
             if not execution_finished and not error_message:
                 error_message = f"ComfyUI 任务轮询超时 ({timeout_seconds}秒)。"
                 logger.error(f"{error_message}") # 功能性备注: 记录超时错误
+                cancel_comfyui_prompt(base_url, prompt_id) # 逻辑备注: prompt 可能仍在服务器上排队或执行，先取消，避免重试时重复生成
 
         # --- 3. 如果执行成功，尝试获取最终结果 ---
-        # 逻辑备注: 只有在任务执行完成且没有发生错误时才进行
-        if execution_finished and not error_message:
+        # 逻辑备注: WebSocket 保存节点已推送图片时直接使用，不再请求历史记录和下载
+        if execution_finished and not error_message and ws_images and not output_node_ids:
+            logger.info(f"通过 WebSocket 收到 {len(ws_images)} 张图片，跳过 /history 和 /view 请求。") # 功能性备注
+            image_data_list = list(ws_images)
+        elif execution_finished and not error_message:
+            if ws_image_node_id:
+                logger.warning(f"未通过 WebSocket 收到 Prompt {prompt_id} 的图片，回退到历史记录下载。") # 逻辑备注
             # 逻辑备注: 如果是轮询成功，final_history 已经有值
             # 逻辑备注: 如果是 WebSocket 成功，需要重新发送 GET 请求获取一次最终的历史记录
+            # 逻辑备注: 如果 WebSocket 已经收到输出节点的 'executed' 事件，直接使用，无需再请求历史记录
+            if not final_history and ws_outputs and output_node_ids:
+                if all(node_id in ws_outputs for node_id in output_node_ids):
+                    final_history = {"outputs": ws_outputs}
+            elif not final_history and ws_outputs:
+                if not output_node_id:
+                    output_node_id, _ = _find_node_id_by_title(workflow_dict, expected_output_node_title)
+                if output_node_id and output_node_id in ws_outputs:
+                    final_history = {"outputs": ws_outputs}
             if not final_history:
                 logger.info(f"WebSocket 完成后，获取最终历史记录: {history_endpoint_base}{prompt_id}") # 功能性备注: 记录获取最终历史
                 final_hist_response = None # 功能性备注: 初始化最终历史响应对象
@@ -424,68 +503,32 @@ def call_comfyui_api(comfyui_url, workflow_dict, expected_output_node_title="Sav
             # 逻辑备注: 只有在成功获取到最终历史记录且没有错误时才进行
             if final_history and 'outputs' in final_history and not error_message:
                 outputs = final_history.get('outputs', {})
-                # 功能性备注: 使用原始 workflow_dict 和预期的输出节点标题查找对应的节点 ID
-                output_node_id, _ = _find_node_id_by_title(workflow_dict, expected_output_node_title)
+                # 功能性备注: 未提供输出节点 ID 时，使用原始 workflow_dict 和预期的输出节点标题查找
+                if not output_node_id:
+                    output_node_id, _ = _find_node_id_by_title(workflow_dict, expected_output_node_title)
 
                 # 逻辑备注: 检查是否找到了输出节点并且其输出在历史记录中
-                if output_node_id and output_node_id in outputs:
+                if output_node_ids:
+                    # 功能性备注: 融合工作流按输出节点分别下载 (某个节点没有输出时其列表为空，由调用方按任务处理)
+                    image_data_list = {}
+                    download_errors = []
+                    for node_id in output_node_ids:
+                        node_images = (outputs.get(node_id) or {}).get('images')
+                        node_data, node_errors = _download_output_images(view_endpoint, node_images if isinstance(node_images, list) else [])
+                        image_data_list[node_id] = node_data; download_errors.extend(node_errors)
+                    logger.info(f"融合工作流: {sum(1 for images in image_data_list.values() if images)}/{len(output_node_ids)} 个输出节点返回了图片。") # 功能性备注
+                    if not any(image_data_list.values()):
+                        image_data_list = {}
+                        error_message = f"图片下载全部失败: {download_errors[0]}" if download_errors else f"融合工作流的输出节点均未返回图片。Available outputs: {list(outputs.keys())}"
+                    elif download_errors:
+                        logger.warning(f"警告: 部分图片下载失败 ({len(download_errors)} 个)。错误示例: {download_errors[0]}") # 功能性备注: 记录警告
+                elif output_node_id and output_node_id in outputs:
                     node_output = outputs[output_node_id]
                     # 逻辑备注: 检查输出节点是否有 'images' 列表
                     if 'images' in node_output and isinstance(node_output['images'], list):
                         logger.info(f"在节点 '{expected_output_node_title}' (ID: {output_node_id}) 找到 {len(node_output['images'])} 个输出图片信息。") # 功能性备注: 记录找到图片信息
                         images_to_download = node_output['images']
-                        download_errors = [] # 功能性备注: 用于存储下载过程中发生的错误
-
-                        # 功能性备注: 遍历每个图片信息并尝试下载
-                        for img_info in images_to_download:
-                            filename = img_info.get('filename')
-                            subfolder = img_info.get('subfolder')
-                            img_type = img_info.get('type', 'output') # 功能性备注: 获取图片类型（通常是 'output' 或 'temp'）
-
-                            # 逻辑备注: 必须要有文件名才能下载
-                            if filename:
-                                logger.info(f"  > 准备下载图片: filename={filename}, subfolder={subfolder}, type={img_type}") # 功能性备注: 记录准备下载
-                                img_download_error = None # 功能性备注: 初始化单张图片下载错误信息
-                                img_response = None # 功能性备注: 初始化图片下载响应对象
-                                try:
-                                    # 功能性备注: 构建下载图片的请求参数
-                                    view_params = {'filename': filename}
-                                    if subfolder: view_params['subfolder'] = subfolder
-                                    if img_type: view_params['type'] = img_type
-
-                                    # 功能性备注: 发送 GET 请求下载图片
-                                    img_response = requests.get(view_endpoint, params=view_params, timeout=60)
-                                    img_response.raise_for_status() # 功能性备注: 检查下载请求的 HTTP 状态
-
-                                    # 功能性备注: 检查返回内容的 Content-Type 是否是图片
-                                    content_type = img_response.headers.get('content-type', '').lower()
-                                    if 'image/' in content_type:
-                                        # 功能性备注: 下载成功，将图片数据 (bytes) 添加到结果列表
-                                        image_data_list.append(img_response.content)
-                                        logger.info(f"    - 图片 '{filename}' 下载成功 ({len(img_response.content)} bytes)。") # 功能性备注: 记录下载成功
-                                    else:
-                                        # 逻辑备注: 如果 Content-Type 不是图片，则认为是下载错误
-                                        img_download_error = f"下载链接 '{filename}' 返回非图片类型: {content_type}"
-                                except requests.exceptions.RequestException as dl_e:
-                                    # 逻辑备注: 处理下载时的网络或 HTTP 错误
-                                    img_download_error = f"下载图片 '{filename}' 时网络/HTTP错误: {dl_e}"
-                                except Exception as generic_dl_e:
-                                     # 逻辑备注: 处理下载时的其他未知错误
-                                     img_download_error = f"下载图片 '{filename}' 时发生意外错误: {generic_dl_e}"
-                                finally:
-                                     # 功能性备注: 确保关闭图片下载的响应对象
-                                     if img_response:
-                                         try: img_response.close()
-                                         except Exception: pass
-
-                                # 逻辑备注: 如果下载单张图片时出错，记录错误信息
-                                if img_download_error:
-                                    logger.error(f"    - {img_download_error}") # 功能性备注: 记录错误
-                                    download_errors.append(img_download_error)
-                            else:
-                                # 逻辑备注: 如果图片信息中缺少文件名
-                                logger.warning(f"  > 警告: 输出节点信息中缺少 'filename'。 Info: {img_info}") # 功能性备注: 记录警告
-                                download_errors.append("输出节点信息缺少 'filename'")
+                        image_data_list, download_errors = _download_output_images(view_endpoint, images_to_download)
 
                         # 功能性备注: 处理所有图片下载完成后的结果
                         if not image_data_list and download_errors:
@@ -548,9 +591,10 @@ def call_comfyui_api(comfyui_url, workflow_dict, expected_output_node_title="Sav
         return None, final_error # 返回 (无数据, 错误信息)
 
 
-def upload_image_to_comfyui(comfyui_url, local_filepath, overwrite=True, save_debug=False):
+def upload_image_to_comfyui(comfyui_url, local_filepath, overwrite=True, save_debug=False, upload_filename=None):
     """
     将本地图片上传到 ComfyUI 服务器的 /upload/image 端点。
+    upload_filename 可指定服务器端使用的文件名 (默认使用本地文件名)。
     """
     # 功能性备注: 此函数负责将本地的图片文件上传到 ComfyUI 服务器，通常用于图生图或内绘的输入。
     # 逻辑备注: 检查输入 URL 和文件路径是否有效
@@ -576,7 +620,7 @@ def upload_image_to_comfyui(comfyui_url, local_filepath, overwrite=True, save_de
 
     try:
         # 功能性备注: 准备 multipart/form-data，包含图片文件和覆盖参数
-        files = {'image': (os.path.basename(local_filepath), open(local_filepath, 'rb'))}
+        files = {'image': (upload_filename or os.path.basename(local_filepath), open(local_filepath, 'rb'))}
         data = {'overwrite': str(overwrite).lower()} # 功能性备注: 参数需要是字符串 'true' 或 'false'
 
         # 功能性备注: 如果启用了调试保存，则保存请求信息（不含文件内容）
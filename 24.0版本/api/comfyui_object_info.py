@@ -0,0 +1,102 @@
+# api/comfyui_object_info.py
+"""
+ComfyUI /object_info 缓存与工作流预检。
+每个服务器的 /object_info (所有节点类型及其输入定义) 只获取一次，在有效期内复用；
+预检时逐个节点检查节点类型是否已安装、下拉选项类输入 (模型、VAE、LoRA、采样器等) 的值是否存在于服务器，
+在批次开始前一次性报告，而不是每个任务提交后才得到执行错误。
+"""
+import threading # 功能性备注: 导入线程模块，多个调用方共享缓存
+import time # 功能性备注: 导入 time 库用于缓存有效期
+from urllib.parse import urlparse # 功能性备注: 导入 URL 处理函数
+import logging # 功能性备注: 导入日志模块
+
+import requests # 功能性备注: 导入 requests 库用于获取 /object_info
+
+# 功能性备注: 获取当前模块的 logger 实例
+logger = logging.getLogger(__name__)
+
+# 功能性备注: /object_info 缓存有效期 (秒)；服务器上新增模型后最多等待这么久才会被识别
+OBJECT_INFO_TTL = 300
+OBJECT_INFO_TIMEOUT = 30
+
+_object_info_cache = {} # 功能性备注: {服务器: (获取时间, object_info)}
+_object_info_lock = threading.Lock()
+
+
+def _normalize_server(comfyui_url):
+    """将 ComfyUI 地址规范化为 scheme://netloc"""
+    parsed_url = urlparse(comfyui_url)
+    return f"{parsed_url.scheme or 'http'}://{parsed_url.netloc or '127.0.0.1:8188'}"
+
+def get_comfyui_object_info(comfyui_url, ttl=OBJECT_INFO_TTL, force_refresh=False):
+    """获取服务器的 /object_info (有效期内使用缓存)。返回 (object_info, error_msg)"""
+    server = _normalize_server(comfyui_url)
+    with _object_info_lock:
+        cached = _object_info_cache.get(server)
+    if cached and not force_refresh and time.time() - cached[0] < ttl:
+        return cached[1], None
+    try:
+        response = requests.get(f"{server}/object_info", timeout=OBJECT_INFO_TIMEOUT)
+        response.raise_for_status()
+        object_info = response.json()
+        if not isinstance(object_info, dict):
+            return None, f"ComfyUI /object_info 返回格式无效 ({type(object_info).__name__})"
+    except requests.exceptions.RequestException as e:
+        return None, f"获取 ComfyUI /object_info 失败 ({server}): {e}"
+    except ValueError as e:
+        return None, f"解析 ComfyUI /object_info 响应失败 ({server}): {e}"
+    with _object_info_lock:
+        _object_info_cache[server] = (time.time(), object_info)
+    logger.info(f"已获取 ComfyUI 节点信息 ({server}): {len(object_info)} 个节点类型。") # 功能性备注
+    return object_info, None
+
+
+def _input_specs(node_info):
+    """节点定义中的全部输入 {输入名: 定义} (required + optional)"""
+    inputs = node_info.get("input") if isinstance(node_info, dict) else None
+    specs = {}
+    if isinstance(inputs, dict):
+        for section in ("required", "optional"):
+            if isinstance(inputs.get(section), dict):
+                specs.update(inputs[section])
+    return specs
+
+def combo_options(object_info, class_type, input_name):
+    """
+    返回节点输入的可选值列表；不是下拉选项类输入或允许上传文件 (如 LoadImage.image) 时返回 None。
+    兼容旧格式 [[选项...], {...}] 与新格式 ["COMBO", {"options": [...]}]。
+    """
+    spec = _input_specs(object_info.get(class_type)).get(input_name)
+    if not isinstance(spec, (list, tuple)) or not spec:
+        return None
+    extra = spec[1] if len(spec) > 1 and isinstance(spec[1], dict) else {}
+    if extra.get("image_upload") or extra.get("upload"):
+        return None
+    if isinstance(spec[0], list):
+        return spec[0]
+    if spec[0] == "COMBO" and isinstance(extra.get("options"), list):
+        return extra["options"]
+    return None
+
+def validate_workflow(workflow, object_info, skip_inputs=()):
+    """
+    按 /object_info 检查工作流：节点类型是否已安装、下拉选项类输入的值是否有效。
+    skip_inputs 为不检查的 (节点 ID, 输入名) (例如每个任务上传后才设置的参考图)。返回问题描述列表。
+    """
+    problems = []
+    skip_inputs = set(skip_inputs)
+    for node_id, node_data in workflow.items():
+        if not isinstance(node_data, dict):
+            continue
+        class_type = node_data.get("class_type")
+        title = (node_data.get("_meta") or {}).get("title") or class_type
+        if class_type not in object_info:
+            problems.append(f"节点 {node_id} '{title}': 服务器上没有节点类型 '{class_type}' (可能缺少自定义节点)。")
+            continue
+        for input_name, value in (node_data.get("inputs") or {}).items():
+            if (node_id, input_name) in skip_inputs or isinstance(value, list):
+                continue # 逻辑备注: 列表值是连接到其他节点的输出
+            options = combo_options(object_info, class_type, input_name)
+            if options is not None and value not in options:
+                problems.append(f"节点 {node_id} '{title}': {input_name} = '{value}' 不在服务器的可选值中。")
+    return problems
@@ -0,0 +1,161 @@
+# api/comfyui_upload_cache.py
+"""
+ComfyUI 参考图/蒙版上传缓存。
+以 (服务器地址, 文件内容 sha256) 为键记录服务器端文件名：同一批次内同一张图片只上传一次；
+缓存写入本地文件，下次运行时只要服务器上该文件仍然存在 (通过 /view 检查) 就继续复用。
+上传时使用带内容哈希的文件名，保证服务器上的同名文件内容一致。
+"""
+import hashlib # 功能性备注: 导入 hashlib 用于计算文件内容哈希
+import json # 功能性备注: 导入 json 库用于读写缓存文件
+import os # 功能性备注: 导入 os 库用于路径和文件状态
+import threading # 功能性备注: 导入线程模块，多个工作线程可能同时上传同一张图
+from pathlib import Path # 功能性备注: 导入 Path 对象用于路径处理
+from urllib.parse import urlparse, urljoin # 功能性备注: 导入 URL 处理函数
+import logging # 功能性备注: 导入日志模块
+
+import requests # 功能性备注: 导入 requests 库用于检查服务器文件是否存在
+
+from .comfyui_api_helper import upload_image_to_comfyui # 功能性备注: 实际的上传函数
+
+# 功能性备注: 获取当前模块的 logger 实例
+logger = logging.getLogger(__name__)
+
+# 功能性备注: 缓存文件位置
+UPLOAD_CACHE_FILE = Path("cache") / "comfyui_upload_cache.json"
+
+
+def _normalize_server(comfyui_url):
+    """将 ComfyUI 地址规范化为 scheme://netloc"""
+    parsed_url = urlparse(comfyui_url)
+    return f"{parsed_url.scheme or 'http'}://{parsed_url.netloc or '127.0.0.1:8188'}"
+
+
+class ComfyUIUploadCache:
+    """线程安全的上传缓存 (内存 + 本地文件)"""
+    def __init__(self, cache_file=UPLOAD_CACHE_FILE):
+        self.cache_file = Path(cache_file)
+        self._lock = threading.Lock()
+        self._key_locks = {} # 功能性备注: 每个缓存键一把锁，避免并发重复上传
+        self._entries = None # 功能性备注: {"server|sha256": 服务器文件名}，首次使用时从文件加载
+        self._verified = set() # 功能性备注: 本次运行中已确认存在 (或刚上传) 的缓存键，不再重复检查
+        self._hash_memo = {} # 功能性备注: {(路径, 修改时间, 大小): sha256}，避免每个任务都重新读取文件
+
+    def _load(self):
+        """加载缓存文件 (调用方需持有 self._lock)"""
+        if self._entries is not None:
+            return
+        self._entries = {}
+        try:
+            if self.cache_file.is_file():
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    loaded = json.load(f)
+                if isinstance(loaded, dict):
+                    self._entries = {str(k): str(v) for k, v in loaded.items()}
+        except (OSError, json.JSONDecodeError) as load_e:
+            logger.warning(f"读取 ComfyUI 上传缓存文件失败，将重新建立缓存: {load_e}") # 逻辑备注
+
+    def _save(self):
+        """写回缓存文件 (调用方需持有 self._lock)"""
+        try:
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.cache_file.with_suffix(".tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._entries, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.cache_file)
+        except OSError as save_e:
+            logger.warning(f"保存 ComfyUI 上传缓存文件失败: {save_e}") # 逻辑备注
+
+    def _file_sha256(self, local_filepath):
+        """计算文件内容的 sha256 (按路径/修改时间/大小缓存结果)"""
+        stat = os.stat(local_filepath)
+        memo_key = (os.path.abspath(local_filepath), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            digest = self._hash_memo.get(memo_key)
+        if digest:
+            return digest
+        hasher = hashlib.sha256()
+        with open(local_filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+        with self._lock:
+            self._hash_memo[memo_key] = digest
+        return digest
+
+    @staticmethod
+    def _server_has_file(server, server_filename):
+        """通过 /view 检查服务器 input 目录中是否仍有该文件"""
+        response = None
+        try:
+            response = requests.get(urljoin(server, "/view"), params={"filename": server_filename, "type": "input"}, stream=True, timeout=10)
+            return response.status_code == 200
+        except requests.exceptions.RequestException as check_e:
+            logger.warning(f"检查 ComfyUI 服务器文件 '{server_filename}' 是否存在时出错: {check_e}") # 逻辑备注
+            return False
+        finally:
+            if response is not None:
+                response.close()
+
+    def begin_run(self):
+        """新批次开始：已缓存的文件需重新确认服务器上是否存在"""
+        with self._lock:
+            self._verified.clear()
+
+    def upload(self, comfyui_url, local_filepath, save_debug=False):
+        """
+        上传 (或复用已上传的) 本地图片，返回 (服务器文件名, 错误信息)。
+        """
+        if not local_filepath or not os.path.exists(local_filepath):
+            return None, f"错误: 本地文件路径无效或文件不存在: '{local_filepath}'"
+        try:
+            digest = self._file_sha256(local_filepath)
+        except OSError as hash_e:
+            return None, f"ComfyUI 图片上传错误: 读取本地文件时出错 '{local_filepath}': {hash_e}"
+        server = _normalize_server(comfyui_url)
+        cache_key = f"{server}|{digest}"
+
+        with self._lock:
+            self._load()
+            key_lock = self._key_locks.setdefault(cache_key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                cached_name = self._entries.get(cache_key)
+                verified = cache_key in self._verified
+            if cached_name and verified:
+                logger.info(f"复用已上传的图片: '{os.path.basename(local_filepath)}' -> '{cached_name}'") # 功能性备注
+                return cached_name, None
+            # 逻辑备注: 上次运行留下的缓存项，需确认服务器上文件仍在 (服务器可能已重启或清理 input 目录)
+            if cached_name and self._server_has_file(server, cached_name):
+                with self._lock:
+                    self._verified.add(cache_key)
+                logger.info(f"服务器上仍存在已上传的图片，复用: '{cached_name}'") # 功能性备注
+                return cached_name, None
+
+            # 功能性备注: 使用带内容哈希的文件名上传，同名即同内容
+            stem, ext = os.path.splitext(os.path.basename(local_filepath))
+            upload_filename = f"{stem}_{digest[:12]}{ext or '.png'}"
+            server_filename, upload_error = upload_image_to_comfyui(comfyui_url, local_filepath, save_debug=save_debug, upload_filename=upload_filename)
+            if upload_error:
+                return None, upload_error
+            with self._lock:
+                self._entries[cache_key] = server_filename
+                self._verified.add(cache_key)
+                self._save()
+            return server_filename, None
+
+
+# 功能性备注: 进程内共享的缓存实例
+_upload_cache = None
+_upload_cache_lock = threading.Lock()
+
+def get_comfyui_upload_cache():
+    """获取进程内共享的上传缓存"""
+    global _upload_cache
+    with _upload_cache_lock:
+        if _upload_cache is None:
+            _upload_cache = ComfyUIUploadCache()
+        return _upload_cache
+
+def upload_image_to_comfyui_cached(comfyui_url, local_filepath, save_debug=False):
+    """带缓存的图片上传，返回 (服务器文件名, 错误信息)"""
+    return get_comfyui_upload_cache().upload(comfyui_url, local_filepath, save_debug=save_debug)
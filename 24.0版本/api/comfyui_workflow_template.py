@@ -0,0 +1,168 @@
+# api/comfyui_workflow_template.py
+"""
+预编译的 ComfyUI 工作流模板。
+工作流只加载、索引一次：节点标题在编译时解析为节点 ID，缺失节点的校验报告也只生成一次；
+每个任务只需提交一组“补丁” (节点 ID -> 输入覆盖)，build() 按写时复制的方式生成提交用的工作流，
+未修改的节点直接与模板共享，不再对整个工作流做深拷贝。
+fuse_workflows() 把多个任务的工作流合并为一次提交的图：各任务相同的节点 (模型加载等) 只保留一份，
+不同的节点 (提示词、采样器、保存节点等) 及其下游节点按任务复制。
+"""
+import logging # 功能性备注: 导入日志模块
+
+# 功能性备注: 获取当前模块的 logger 实例
+logger = logging.getLogger(__name__)
+
+
+class ComfyUIWorkflowTemplate:
+    """编译后的工作流：标题索引 + 角色到节点 ID 的映射 + 写时复制的补丁构建"""
+    def __init__(self, workflow, node_titles=None):
+        """
+        workflow: API 格式的工作流字典 (编译后视为只读)。
+        node_titles: {角色键: 节点标题}，例如 {"comfySamplerNodeTitle": "MainSampler"}。
+        """
+        if not isinstance(workflow, dict):
+            raise ValueError(f"工作流数据无效 (类型: {type(workflow)})。")
+        self.workflow = workflow
+        # 功能性备注: 一次遍历建立 标题 -> 节点 ID 索引 (与线性查找一致，同名时取第一个)
+        self._title_index = {}
+        for node_id, node_data in workflow.items():
+            meta = node_data.get("_meta") if isinstance(node_data, dict) else None
+            title = meta.get("title") if isinstance(meta, dict) else None
+            if title and title not in self._title_index:
+                self._title_index[title] = node_id
+        # 功能性备注: 解析各角色对应的节点 ID，并记录缺失项
+        self.node_titles = dict(node_titles or {})
+        self.node_ids = {}
+        self.missing = {} # 功能性备注: {角色键: 标题}，配置了标题但工作流中找不到的节点
+        for role, title in self.node_titles.items():
+            node_id = self._title_index.get(title) if title else None
+            self.node_ids[role] = node_id
+            if title and node_id is None:
+                self.missing[role] = title
+
+    def find(self, title):
+        """按标题查找节点 ID (O(1))，找不到返回 None"""
+        return self._title_index.get(title) if title else None
+
+    def node_id(self, role):
+        """返回角色对应的节点 ID，找不到返回 None"""
+        return self.node_ids.get(role)
+
+    def validation_report(self):
+        """返回编译时的校验信息列表 (每行一条)"""
+        report = [f"共 {len(self.workflow)} 个节点，已解析 {sum(1 for v in self.node_ids.values() if v)}/{len(self.node_ids)} 个配置的节点标题。"]
+        for role, title in self.missing.items():
+            report.append(f"警告: 未在工作流中找到标题为 '{title}' 的节点 ({role})。")
+        return report
+
+    def build(self, patches):
+        """
+        根据补丁生成提交用的工作流。
+        patches: {节点 ID: {输入名: 值}}，值为 None 表示移除该输入 (使用 ComfyUI 默认值)。
+        只有被修改的节点 (及其 inputs) 会被复制，其余节点与模板共享引用，调用方不得修改返回结果。
+        """
+        workflow_to_run = dict(self.workflow)
+        for node_id, input_patch in patches.items():
+            node_data = self.workflow.get(node_id)
+            if not isinstance(node_data, dict) or not isinstance(node_data.get("inputs"), dict) or not input_patch:
+                continue
+            new_inputs = dict(node_data["inputs"])
+            for input_name, value in input_patch.items():
+                if value is None:
+                    new_inputs.pop(input_name, None)
+                else:
+                    new_inputs[input_name] = value
+            new_node = dict(node_data)
+            new_node["inputs"] = new_inputs
+            workflow_to_run[node_id] = new_node
+        return workflow_to_run
+
+
+class WorkflowPatch:
+    """单个任务的补丁收集器，记录修改日志"""
+    def __init__(self, template):
+        self.template = template
+        self.patches = {} # 功能性备注: {节点 ID: {输入名: 值}}
+        self.log = [] # 功能性备注: 记录工作流修改操作
+
+    def set(self, role, input_name, value, description=None):
+        """为角色对应的节点设置输入，节点不存在时返回 False"""
+        node_id = self.template.node_id(role)
+        if node_id is None or not isinstance(self.template.workflow[node_id].get("inputs"), dict):
+            return False
+        self.patches.setdefault(node_id, {})[input_name] = value
+        if description:
+            self.log.append(description)
+        return True
+
+    def set_by_title(self, title, input_name, value, description=None):
+        """按标题为节点设置输入 (用于不在角色表中的节点)，节点不存在时返回 False"""
+        node_id = self.template.find(title)
+        if node_id is None or not isinstance(self.template.workflow[node_id].get("inputs"), dict):
+            return False
+        self.patches.setdefault(node_id, {})[input_name] = value
+        if description:
+            self.log.append(description)
+        return True
+
+    def build(self):
+        """生成提交用的工作流"""
+        return self.template.build(self.patches)
+
+
+def _is_link(value):
+    """输入值是否为连接 [源节点 ID, 输出序号]"""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int)
+
+def fuse_workflows(workflows, output_node_id):
+    """
+    把多个由同一模板生成的工作流合并为一个图。
+    输入不同的节点与输出节点，以及它们的全部下游节点，按工作流各复制一份 (第一个工作流沿用原节点 ID，
+    其余使用新的数字 ID，内部连接随之改写)；其余节点在所有工作流中相同，只保留一份共享。
+    返回 (合并后的工作流, [每个工作流的输出节点 ID], [每个工作流的 {原节点 ID: 新节点 ID}])。
+    """
+    base = workflows[0]
+    varying = {output_node_id} if output_node_id in base else set()
+    for node_id, node_data in base.items():
+        if any(workflow.get(node_id) != node_data for workflow in workflows[1:]):
+            varying.add(node_id)
+    # 功能性备注: 按连接关系找出下游节点 (源节点 -> 使用其输出的节点)
+    consumers = {}
+    for node_id, node_data in base.items():
+        inputs = node_data.get("inputs") if isinstance(node_data, dict) else None
+        for value in (inputs or {}).values():
+            if _is_link(value):
+                consumers.setdefault(value[0], set()).add(node_id)
+    per_task = set()
+    pending = list(varying)
+    while pending:
+        node_id = pending.pop()
+        if node_id in per_task:
+            continue
+        per_task.add(node_id)
+        pending.extend(consumers.get(node_id, ()))
+
+    fused = {node_id: node_data for node_id, node_data in base.items() if node_id not in per_task}
+    used_ids = set(base)
+    next_id = max((int(node_id) for node_id in base if str(node_id).isdigit()), default=0) + 1
+    output_ids = []; id_maps = []
+    for index, workflow in enumerate(workflows):
+        id_map = {}
+        for node_id in sorted(per_task, key=str):
+            if index == 0:
+                id_map[node_id] = node_id
+                continue
+            while str(next_id) in used_ids:
+                next_id += 1
+            id_map[node_id] = str(next_id); used_ids.add(str(next_id))
+        for node_id in per_task:
+            node_data = workflow[node_id]
+            inputs = node_data.get("inputs") if isinstance(node_data, dict) else None
+            if index and isinstance(inputs, dict):
+                # 逻辑备注: 指向本任务复制节点的连接改写为新 ID，指向共享节点的连接保持不变
+                node_data = dict(node_data)
+                node_data["inputs"] = {name: [id_map[value[0]], value[1]] if _is_link(value) and value[0] in id_map else value for name, value in inputs.items()}
+            fused[id_map[node_id]] = node_data
+        output_ids.append(id_map.get(output_node_id))
+        id_maps.append(id_map)
+    return fused, output_ids, id_maps
@@ -0,0 +1,327 @@
+# api/comfyui_ws_client.py
+"""
+ComfyUI 长连接 WebSocket 客户端。
+每个 ComfyUI 服务器在整个生成批次中只维持一个 WebSocket 连接 (固定 client_id)，
+后台读取线程按 prompt_id 将 executing / progress / executed / execution_error 等事件
+分发给对应的 Future，并在连接断开后自动重连。
+工作流中包含 WebSocket 保存节点 (SaveImageWebsocket) 时，图片以二进制帧直接推送到本连接，
+按当前正在执行的 prompt/节点归属到对应的监听对象，无需再请求 /history 和 /view。
+"""
+import json # 功能性备注: 导入 json 库用于解析 WebSocket 消息
+import struct # 功能性备注: 导入 struct 库用于解析二进制帧头
+import threading # 功能性备注: 导入线程模块用于后台读取线程
+import uuid # 功能性备注: 导入 uuid 库用于生成客户端 ID
+from collections import OrderedDict # 功能性备注: 用于有界的“未认领事件”缓存
+from concurrent.futures import Future # 功能性备注: 每个 prompt 对应一个 Future
+from urllib.parse import urlparse # 功能性备注: 导入 URL 解析函数
+import logging # 功能性备注: 导入日志模块
+
+import websocket # 功能性备注: 导入 websocket-client 库
+
+# 功能性备注: 获取当前模块的 logger 实例
+logger = logging.getLogger(__name__)
+
+# 功能性备注: 重连退避的最大间隔 (秒)
+_MAX_RECONNECT_DELAY = 30.0
+# 功能性备注: 在 prompt 被认领之前收到的终止事件最多缓存的条数
+_MAX_ORPHAN_PROMPTS = 256
+# 功能性备注: 等待服务器队列低于上限时的检查间隔 (秒)；连接正常时 status 事件会提前唤醒
+_QUEUE_WAIT_SLICE = 1.0
+# 功能性备注: ComfyUI 二进制帧的事件类型 (帧头为 4 字节大端整数)
+_BINARY_PREVIEW_IMAGE = 1 # 后跟 4 字节图片格式 (1=JPEG, 2=PNG) 和图片数据，SaveImageWebsocket 使用此类型
+_BINARY_PREVIEW_IMAGE_WITH_METADATA = 4 # 后跟 4 字节元数据长度、JSON 元数据 (含 node_id/prompt_id) 和图片数据
+
+
+class _PromptWatch:
+    """单个 prompt 的监听状态"""
+    def __init__(self, prompt_id, on_event=None, image_node_id=None):
+        self.prompt_id = prompt_id
+        self.future = Future() # 功能性备注: 完成时结果为 {"error": None 或 错误信息, "outputs": {...}, "images": [...]}
+        self.outputs = {} # 功能性备注: 通过 'executed' 事件收集的节点输出 {node_id: output}
+        self.on_event = on_event # 功能性备注: 可选回调，接收 (msg_type, data)，用于进度等
+        self.image_node_id = str(image_node_id) if image_node_id is not None else None # 功能性备注: WebSocket 保存节点 ID
+        self.images = [] # 功能性备注: 该节点通过二进制帧推送的图片数据 (bytes)
+
+    def finish(self, error=None):
+        """标记此 prompt 结束 (仅第一次生效)"""
+        if not self.future.done():
+            self.future.set_result({"error": error, "outputs": self.outputs, "images": self.images})
+
+
+class ComfyUIWebSocketClient:
+    """单个 ComfyUI 服务器的长连接客户端 (线程安全)"""
+    def __init__(self, base_url):
+        parsed_url = urlparse(base_url)
+        scheme = parsed_url.scheme or "http"
+        netloc = parsed_url.netloc or "127.0.0.1:8188"
+        self.base_url = f"{scheme}://{netloc}"
+        self.client_id = str(uuid.uuid4()) # 功能性备注: 整个批次共用的客户端 ID
+        ws_scheme = "wss" if scheme == "https" else "ws"
+        self.ws_url = f"{ws_scheme}://{netloc}/ws?clientId={self.client_id}"
+
+        self.queue_remaining = None # 功能性备注: 最近一次 'status' 事件报告的服务器队列剩余数量
+        self._queue_cond = threading.Condition() # 功能性备注: 队列数量变化时唤醒等待提交的线程
+        self._pending_submits = 0 # 功能性备注: 已获得提交名额、/prompt 请求尚未返回的数量
+        self._unconfirmed = 0 # 功能性备注: 已提交成功、但还没有 status 事件计入的数量 (收到 status 时清零)
+        self._status_seq = 0 # 功能性备注: 已收到的 status 事件数，用于判断提交期间是否已有 status 计入该 prompt
+        self._submit_local = threading.local() # 功能性备注: 各提交线程获得名额时的 status 序号
+        self._executing = (None, None) # 功能性备注: 当前正在执行的 (prompt_id, node_id)，用于归属不带 prompt_id 的二进制帧
+        self._lock = threading.Lock()
+        self._watches = {} # 功能性备注: prompt_id -> _PromptWatch
+        self._orphans = OrderedDict() # 功能性备注: 尚未被认领的 prompt 事件 {prompt_id: [(type, data), ...]}
+        self._ws = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._connected = threading.Event()
+        self._first_attempt_done = threading.Event() # 功能性备注: 首次连接尝试 (无论成败) 已结束
+
+    # --- 连接管理 ---
+    def start(self, wait_timeout=10.0):
+        """启动后台读取线程 (幂等)，首次启动时等待连接成功。返回当前是否已连接。"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return self._connected.is_set() # 逻辑备注: 已在运行 (可能正在重连)，不再阻塞调用方
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._reader_loop, name=f"ComfyWS-{self.base_url}", daemon=True)
+            self._thread.start()
+        self._first_attempt_done.wait(wait_timeout)
+        return self._connected.is_set()
+
+    @property
+    def connected(self):
+        """当前 WebSocket 是否处于连接状态"""
+        return self._connected.is_set()
+
+    def close(self):
+        """停止读取线程并关闭连接，未完成的 prompt 会以错误结束"""
+        self._stop.set()
+        ws = self._ws
+        if ws:
+            try: ws.close()
+            except Exception as close_e: logger.warning(f"关闭 ComfyUI WebSocket 时出错: {close_e}") # 逻辑备注
+        if self._thread and self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        with self._lock:
+            pending = list(self._watches.values())
+            self._watches.clear()
+            self._orphans.clear()
+        for watch in pending:
+            watch.finish(error="ComfyUI WebSocket 客户端已关闭。")
+        logger.info(f"ComfyUI WebSocket 长连接已关闭: {self.base_url}") # 功能性备注
+
+    def _reader_loop(self):
+        """后台线程：保持连接、读取消息并分发，断线后按指数退避重连"""
+        delay = 1.0
+        while not self._stop.is_set():
+            try:
+                logger.info(f"ComfyUI WebSocket 正在连接: {self.ws_url}") # 功能性备注
+                self._ws = websocket.create_connection(self.ws_url, timeout=10)
+                self._ws.settimeout(30.0) # 逻辑备注: 空闲时定期醒来检查停止标志
+                self._connected.set()
+                self._first_attempt_done.set()
+                delay = 1.0
+                logger.info(f"ComfyUI WebSocket 长连接已建立 (client_id={self.client_id})。") # 功能性备注
+                while not self._stop.is_set():
+                    try:
+                        received_data = self._ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        continue # 逻辑备注: 接收超时是正常的，继续等待
+                    if not received_data:
+                        continue
+                    self._handle_raw(received_data)
+            except Exception as ws_e:
+                if not self._stop.is_set():
+                    logger.warning(f"ComfyUI WebSocket 连接中断或失败: {ws_e}。{delay:.0f} 秒后重连...") # 逻辑备注
+            finally:
+                self._connected.clear()
+                self._first_attempt_done.set()
+                if self._ws:
+                    try: self._ws.close()
+                    except Exception: pass
+                    self._ws = None
+            # 逻辑备注: 退避等待，可被 close() 提前唤醒
+            if self._stop.wait(delay):
+                break
+            delay = min(delay * 2, _MAX_RECONNECT_DELAY)
+
+    # --- 消息分发 ---
+    def _handle_raw(self, received_data):
+        """解析原始消息：文本为 JSON 事件，二进制为图片帧"""
+        if isinstance(received_data, bytes):
+            self._handle_binary(received_data)
+            return
+        try:
+            message = json.loads(received_data)
+        except json.JSONDecodeError as json_err:
+            logger.debug(f"ComfyUI WebSocket 消息 JSON 解析失败: {json_err} - '{str(received_data)[:100]}'") # 逻辑备注
+            return
+        if isinstance(message, dict):
+            self._dispatch(message.get('type'), message.get('data') or {})
+
+    def _handle_binary(self, frame):
+        """解析二进制图片帧，归属到当前正在执行的 prompt/节点"""
+        if len(frame) < 8:
+            return
+        event_type = struct.unpack(">I", frame[:4])[0]
+        prompt_id, node_id = self._executing
+        if event_type == _BINARY_PREVIEW_IMAGE:
+            image_bytes = frame[8:]
+        elif event_type == _BINARY_PREVIEW_IMAGE_WITH_METADATA:
+            metadata_length = struct.unpack(">I", frame[4:8])[0]
+            try:
+                metadata = json.loads(frame[8:8 + metadata_length].decode('utf-8'))
+            except (UnicodeDecodeError, json.JSONDecodeError):
+                return
+            prompt_id = metadata.get("prompt_id") or prompt_id
+            node_id = metadata.get("node_id") or node_id
+            image_bytes = frame[8 + metadata_length:]
+        else:
+            return # 逻辑备注: 其他二进制事件 (如未编码预览) 不处理
+        if not prompt_id or node_id is None or not image_bytes:
+            return
+        # 逻辑备注: 采样器的实时预览也使用同样的帧类型，只有来自登记的保存节点的帧才会被收集 (见 _apply_event)
+        self._dispatch('binary_image', {"prompt_id": prompt_id, "node": str(node_id), "image": image_bytes})
+
+    def _dispatch(self, msg_type, data):
+        """按 prompt_id 将事件分发到对应的监听对象"""
+        if msg_type == 'status':
+            # 功能性备注: 记录服务器队列剩余数量
+            exec_info = data.get('status', {}).get('exec_info', {}) if isinstance(data.get('status'), dict) else {}
+            if 'queue_remaining' in exec_info:
+                with self._queue_cond:
+                    self.queue_remaining = exec_info.get('queue_remaining')
+                    self._unconfirmed = 0
+                    self._status_seq += 1
+                    self._queue_cond.notify_all()
+                logger.debug(f"ComfyUI WebSocket Status: 队列剩余 {self.queue_remaining}") # 功能性备注
+            return
+
+        prompt_id = data.get('prompt_id')
+        if not prompt_id:
+            return
+        if msg_type == 'executing':
+            # 逻辑备注: 记录当前执行位置，之后到达的二进制帧属于该节点
+            node_id = data.get('node')
+            self._executing = (prompt_id, str(node_id)) if node_id is not None else (None, None)
+        with self._lock:
+            watch = self._watches.get(prompt_id)
+            if watch is None:
+                # 逻辑备注: prompt 还未被认领 (POST 返回前事件已到达)，暂存事件
+                events = self._orphans.setdefault(prompt_id, [])
+                events.append((msg_type, data))
+                while len(self._orphans) > _MAX_ORPHAN_PROMPTS:
+                    self._orphans.popitem(last=False)
+                return
+        self._apply_event(watch, msg_type, data)
+
+    def _apply_event(self, watch, msg_type, data):
+        """将单个事件应用到监听对象"""
+        if watch.on_event:
+            try: watch.on_event(msg_type, data)
+            except Exception as cb_e: logger.warning(f"ComfyUI 事件回调出错: {cb_e}") # 逻辑备注
+
+        if msg_type == 'binary_image':
+            # 功能性备注: 收集 WebSocket 保存节点推送的图片
+            if watch.image_node_id is not None and data.get('node') == watch.image_node_id:
+                watch.images.append(data['image'])
+                logger.info(f"WebSocket: 收到 Prompt {watch.prompt_id} 的图片 ({len(data['image'])} bytes)。") # 功能性备注
+        elif msg_type == 'executed':
+            # 功能性备注: 收集节点输出 (包含生成图片的文件信息)
+            node_id = data.get('node')
+            if node_id is not None and isinstance(data.get('output'), dict):
+                watch.outputs[str(node_id)] = data['output']
+        elif msg_type == 'executing':
+            # 逻辑备注: node 为 None 表示该 prompt 执行完毕
+            if data.get('node') is None:
+                logger.info(f"WebSocket: Prompt {watch.prompt_id} 执行完成。") # 功能性备注
+                self._finish(watch, None)
+        elif msg_type == 'execution_success':
+            self._finish(watch, None)
+        elif msg_type == 'execution_error':
+            error_message = f"ComfyUI 执行错误 (Node {data.get('node_id', 'N/A')}, Type {data.get('node_type', 'N/A')}): {data.get('exception_message', '未知执行错误')}"
+            logger.error(error_message) # 逻辑备注
+            self._finish(watch, error_message)
+        elif msg_type == 'execution_interrupted':
+            self._finish(watch, "ComfyUI 执行被中断。")
+
+    def _finish(self, watch, error):
+        with self._lock:
+            self._watches.pop(watch.prompt_id, None)
+        watch.finish(error=error)
+
+    # --- 对外接口 ---
+    def watch(self, prompt_id, on_event=None, image_node_id=None):
+        """
+        登记一个 prompt，返回其 _PromptWatch (其 future 在执行结束时完成)。
+        image_node_id 为 WebSocket 保存节点的 ID，提供时收集该节点以二进制帧推送的图片。
+        """
+        watch = _PromptWatch(prompt_id, on_event=on_event, image_node_id=image_node_id)
+        with self._lock:
+            self._watches[prompt_id] = watch
+            early_events = self._orphans.pop(prompt_id, [])
+        # 逻辑备注: 回放认领前已收到的事件
+        for msg_type, data in early_events:
+            if watch.future.done(): break
+            self._apply_event(watch, msg_type, data)
+        return watch
+
+    def acquire_submit_slot(self, max_queued, stop_event=None, poll_queue=None):
+        """
+        提交前等待：服务器队列剩余数量 (含正在执行的) 加上本客户端正在提交、已提交但未计入的数量低于 max_queued 时获得名额。
+        连接断开期间 status 事件不可用，改用 poll_queue() (返回队列数量或 None) 查询。
+        返回 False 表示等待期间收到停止信号；获得名额后必须调用 release_submit_slot()。
+        """
+        while True:
+            if stop_event and stop_event.is_set():
+                return False
+            polled = None if self.connected or poll_queue is None else poll_queue()
+            with self._queue_cond:
+                # 逻辑备注: 轮询得到的是服务器当前的真实数量，已包含之前提交成功的 prompt
+                queue_remaining = (self.queue_remaining or 0) + self._unconfirmed if polled is None else polled
+                if queue_remaining + self._pending_submits < max_queued:
+                    self._pending_submits += 1
+                    self._submit_local.status_seq = self._status_seq
+                    return True
+                self._queue_cond.wait(_QUEUE_WAIT_SLICE)
+
+    def release_submit_slot(self, submitted):
+        """
+        /prompt 请求返回后释放名额；submitted 为 True 时在下一次 status 事件前计为未确认的提交。
+        提交期间已收到 status 事件时，服务器报告的数量可能已包含该 prompt，不再重复计数；
+        还没有收到过 status 事件 (不知道队列数量) 时也不计数，否则没有 status 校正会一直累加。
+        """
+        with self._queue_cond:
+            self._pending_submits = max(0, self._pending_submits - 1)
+            if submitted and self.queue_remaining is not None and getattr(self._submit_local, "status_seq", None) == self._status_seq:
+                self._unconfirmed += 1
+            self._queue_cond.notify_all()
+
+    def unwatch(self, prompt_id):
+        """取消登记 (例如等待超时或转为轮询后)"""
+        with self._lock:
+            self._watches.pop(prompt_id, None)
+
+
+# --- 按服务器共享的客户端注册表 ---
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_comfyui_ws_client(comfyui_url):
+    """获取 (或创建并启动) 指定 ComfyUI 服务器的共享长连接客户端"""
+    parsed_url = urlparse(comfyui_url)
+    key = f"{parsed_url.scheme or 'http'}://{parsed_url.netloc or '127.0.0.1:8188'}"
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = ComfyUIWebSocketClient(key)
+            _clients[key] = client
+    client.start()
+    return client
+
+def close_all_comfyui_ws_clients():
+    """关闭所有共享客户端 (在一次生成批次结束时调用)"""
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
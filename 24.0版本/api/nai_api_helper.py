@@ -5,6 +5,7 @@ import time
 import json
 import re
 import copy
+import tempfile # 功能性备注: 导入 tempfile，流式接收 Zip 响应时使用溢出到磁盘的临时文件
 from pathlib import Path
 import logging # 导入日志模块
 
@@ -25,6 +26,9 @@ except ImportError as e:
 NAI_API_BASE = "https://api.novelai.net" # NAI API 基础 URL
 # 调试日志基础目录
 DEBUG_LOG_DIR = Path("debug_logs") / "api_requests"
+# 功能性备注: 流式接收 Zip 响应时的读取块大小，以及临时文件保留在内存中的上限 (超过后转存到磁盘)
+NAI_STREAM_CHUNK_SIZE = 256 * 1024
+NAI_SPOOL_MAX_MEMORY = 4 * 1024 * 1024
 
 def _save_debug_input(api_type, payload, identifier):
     """保存调试输入文件 (移除敏感信息)"""
@@ -53,9 +57,11 @@ def _save_debug_input(api_type, payload, identifier):
         logger.error(f"错误：保存 {api_type.upper()} 请求调试文件时出错: {save_e}", exc_info=True)
 
 
-def call_novelai_image_api(api_key, payload, proxy_config=None, save_debug=False):
+def call_novelai_image_api(api_key, payload, proxy_config=None, save_debug=False, spool=False):
     """
     调用 NovelAI 图像生成 API (/ai/generate-image)。
+    spool 为 True 时流式接收响应，返回定位到开头的临时文件 (SpooledTemporaryFile，由调用方关闭)，
+    而不是整个 Zip 的 bytes；内存中最多保留 NAI_SPOOL_MAX_MEMORY 字节，其余写入磁盘。
     """
     # --- 输入校验 ---
     if not api_key:
@@ -82,7 +88,7 @@ def call_novelai_image_api(api_key, payload, proxy_config=None, save_debug=False
     try:
         logger.info(f"调用 NAI API: {api_endpoint}") # 记录信息
         # 发送 POST 请求，超时时间设为 300 秒 (5 分钟)
-        response = requests.post(api_endpoint, headers=headers, json=payload, timeout=300, proxies=proxies)
+        response = requests.post(api_endpoint, headers=headers, json=payload, timeout=300, proxies=proxies, stream=spool)
         logger.info(f"NAI API 响应状态码: {response.status_code}") # 记录信息
 
         # 检查 HTTP 状态码
@@ -92,6 +98,8 @@ def call_novelai_image_api(api_key, payload, proxy_config=None, save_debug=False
             # 检查 Content-Type 是否是预期的 Zip
             if 'application/zip' in content_type:
                 logger.info(f"NAI API 调用成功: 收到图像数据 (Zip)。") # 记录信息
+                if spool:
+                    return _spool_response(response), None # 返回 Zip 临时文件
                 return response.content, None # 返回 Zip 文件内容的 bytes
             else:
                 # 如果 Content-Type 不对，可能是 API 返回了错误信息 (即使状态码是 200)
@@ -132,4 +140,19 @@ def call_novelai_image_api(api_key, payload, proxy_config=None, save_debug=False
     except Exception as e:
         error_msg = f"NAI API 调用时发生未预期的严重错误: {e}"
         logger.exception(error_msg) # 使用 logger.exception
-        return None, error_msg
\ No newline at end of file
+        return None, error_msg
+    finally:
+        # 逻辑备注: 流式请求需要显式关闭以归还连接
+        if response is not None and spool: response.close()
+
+def _spool_response(response):
+    """把流式响应体按块写入 SpooledTemporaryFile 并定位到开头 (出错时关闭临时文件后抛出异常)"""
+    spool_file = tempfile.SpooledTemporaryFile(max_size=NAI_SPOOL_MAX_MEMORY)
+    try:
+        for chunk in response.iter_content(chunk_size=NAI_STREAM_CHUNK_SIZE):
+            if chunk: spool_file.write(chunk)
+        spool_file.seek(0)
+    except BaseException:
+        spool_file.close()
+        raise
+    return spool_file
\ No newline at end of file
@@ -50,9 +50,10 @@ def _save_debug_input(api_type, payload, identifier):
 
 # --- Stable Diffusion WebUI API 调用助手 ---
 
-def call_sd_webui_api(sd_webui_url, endpoint_suffix, payload, save_debug=False):
+def call_sd_webui_api(sd_webui_url, endpoint_suffix, payload, save_debug=False, expect_images=True):
     """
     调用 Stable Diffusion WebUI 的指定 API 端点。
+    expect_images=False 用于服务器端保存模式 (send_images=false)，此时响应中没有图片不视为错误，返回空列表。
     """
     # --- 输入校验 ---
     if not sd_webui_url:
@@ -86,6 +87,9 @@ def call_sd_webui_api(sd_webui_url, endpoint_suffix, payload, save_debug=False):
                     image_list = response_json['images']
                     logger.info(f"SD API 调用成功: 收到 {len(image_list)} 张图像数据 (Base64)。") # 记录信息
                     return image_list, None
+                elif not expect_images:
+                    logger.info("SD API 调用成功 (图片由服务器端保存)。") # 记录信息
+                    return [], None
                 else:
                     error_msg = f"SD API 错误 ({endpoint_suffix}): 响应成功 (200 OK) 但未找到 'images' 列表或列表为空。"
                     logger.error(f"{error_msg} Response: {response.text[:200]}...") # 记录错误
@@ -125,4 +129,134 @@ def call_sd_webui_api(sd_webui_url, endpoint_suffix, payload, save_debug=False):
     except Exception as e:
         error_msg = f"SD API 调用 ({endpoint_suffix}) 时发生未预期的严重错误: {e}"
         logger.exception(error_msg) # 使用 logger.exception
-        return None, error_msg
\ No newline at end of file
+        return None, error_msg
+
+def get_sd_options(sd_webui_url):
+    """
+    查询 SD WebUI 当前的全局设置 (GET /sdapi/v1/options)。
+    返回 (设置字典, 错误信息)。
+    """
+    if not sd_webui_url:
+        return None, "错误: Stable Diffusion WebUI URL 不能为空。"
+    api_endpoint = f"{sd_webui_url.rstrip('/')}/sdapi/v1/options"
+    try:
+        response = requests.get(api_endpoint, timeout=15)
+        response.raise_for_status()
+        options = response.json()
+        if not isinstance(options, dict):
+            return None, "SD API 错误: /sdapi/v1/options 响应格式无效。"
+        return options, None
+    except requests.exceptions.RequestException as req_e:
+        error_msg = f"SD API 网络/HTTP 错误 (/sdapi/v1/options): {req_e}"
+        logger.warning(error_msg) # 记录警告
+        return None, error_msg
+    except (json.JSONDecodeError, AttributeError) as parse_e:
+        error_msg = f"SD API 错误: 无法解析 /sdapi/v1/options 响应: {parse_e}"
+        logger.warning(error_msg) # 记录警告
+        return None, error_msg
+
+def set_sd_options(sd_webui_url, options):
+    """
+    修改 SD WebUI 的全局设置 (POST /sdapi/v1/options)。切换模型时服务器会在加载完成后才返回。
+    返回 (是否成功, 错误信息)。
+    """
+    if not sd_webui_url:
+        return False, "错误: Stable Diffusion WebUI URL 不能为空。"
+    api_endpoint = f"{sd_webui_url.rstrip('/')}/sdapi/v1/options"
+    try:
+        logger.info(f"设置 SD WebUI 全局选项: {list(options.keys())} -> {api_endpoint}") # 记录信息
+        response = requests.post(api_endpoint, json=options, timeout=600)
+        response.raise_for_status()
+        return True, None
+    except requests.exceptions.Timeout:
+        error_msg = "SD API 网络错误 (/sdapi/v1/options): 请求超时 (超过 600 秒)。"
+        logger.warning(error_msg) # 记录警告
+        return False, error_msg
+    except requests.exceptions.RequestException as req_e:
+        error_msg = f"SD API 网络/HTTP 错误 (/sdapi/v1/options): {req_e}"
+        logger.warning(error_msg) # 记录警告
+        return False, error_msg
+
+def get_sd_current_model(sd_webui_url):
+    """
+    查询 SD WebUI 当前加载的 Checkpoint (/sdapi/v1/options 中的 sd_model_checkpoint)。
+    返回 (模型名称, 错误信息)。
+    """
+    options, error_msg = get_sd_options(sd_webui_url)
+    if error_msg:
+        return None, error_msg
+    model_name = options.get("sd_model_checkpoint")
+    if not model_name:
+        return None, "SD API 错误: /sdapi/v1/options 响应中没有 sd_model_checkpoint。"
+    return str(model_name), None
+
+def interrupt_sd_webui(sd_webui_url):
+    """
+    请求 SD WebUI 中断当前任务 (POST /sdapi/v1/interrupt)，正在等待的生成请求会尽快返回 (已采样的部分结果)。
+    返回 (是否成功, 错误信息)。
+    """
+    if not sd_webui_url:
+        return False, "错误: Stable Diffusion WebUI URL 不能为空。"
+    api_endpoint = f"{sd_webui_url.rstrip('/')}/sdapi/v1/interrupt"
+    try:
+        response = requests.post(api_endpoint, timeout=10)
+        response.raise_for_status()
+        logger.info(f"已请求 SD WebUI 中断当前任务: {sd_webui_url}") # 记录信息
+        return True, None
+    except requests.exceptions.RequestException as req_e:
+        error_msg = f"SD API 网络/HTTP 错误 (/sdapi/v1/interrupt): {req_e}"
+        logger.warning(error_msg) # 记录警告
+        return False, error_msg
+
+def get_sd_task_progress(sd_webui_url, id_task):
+    """
+    查询指定任务 (请求中的 force_task_id) 的状态 (POST /internal/progress)。
+    返回 ({"active", "queued", "completed", "progress"}, 错误信息)；active 表示服务器正在执行该任务。
+    """
+    if not sd_webui_url:
+        return None, "错误: Stable Diffusion WebUI URL 不能为空。"
+    api_endpoint = f"{sd_webui_url.rstrip('/')}/internal/progress"
+    try:
+        response = requests.post(api_endpoint, json={"id_task": id_task, "id_live_preview": -1, "live_preview": False}, timeout=5)
+        response.raise_for_status()
+        data = response.json()
+        return {
+            "active": bool(data.get("active")),
+            "queued": bool(data.get("queued")),
+            "completed": bool(data.get("completed")),
+            "progress": float(data.get("progress") or 0.0),
+        }, None
+    except requests.exceptions.RequestException as req_e:
+        logger.debug(f"SD API 任务状态查询失败 (/internal/progress): {req_e}")
+        return None, f"SD API 网络/HTTP 错误 (/internal/progress): {req_e}"
+    except (ValueError, TypeError, AttributeError) as parse_e:
+        logger.debug(f"SD API 任务状态响应无法解析: {parse_e}")
+        return None, f"SD API 错误: 无法解析 /internal/progress 响应: {parse_e}"
+
+def get_sd_progress(sd_webui_url):
+    """
+    查询 SD WebUI 当前任务的进度 (GET /sdapi/v1/progress，不返回预览图)。
+    返回 ({"progress", "eta_relative", "step", "steps", "job_count"}, 错误信息)。
+    """
+    if not sd_webui_url:
+        return None, "错误: Stable Diffusion WebUI URL 不能为空。"
+    api_endpoint = f"{sd_webui_url.rstrip('/')}/sdapi/v1/progress"
+    try:
+        response = requests.get(api_endpoint, params={"skip_current_image": "true"}, timeout=5)
+        response.raise_for_status()
+        data = response.json()
+        state = data.get("state") or {}
+        return {
+            "progress": float(data.get("progress") or 0.0),
+            "eta_relative": float(data.get("eta_relative") or 0.0),
+            "step": int(state.get("sampling_step") or 0),
+            "steps": int(state.get("sampling_steps") or 0),
+            "job_count": int(state.get("job_count") or 0),
+        }, None
+    except requests.exceptions.RequestException as req_e:
+        # 逻辑备注: 进度查询失败不影响生成，只记录调试日志
+        logger.debug(f"SD API 进度查询失败 (/sdapi/v1/progress): {req_e}")
+        return None, f"SD API 网络/HTTP 错误 (/sdapi/v1/progress): {req_e}"
+    except (ValueError, TypeError, AttributeError) as parse_e:
+        logger.debug(f"SD API 进度响应无法解析: {parse_e}")
+        return None, f"SD API 错误: 无法解析 /sdapi/v1/progress 响应: {parse_e}"
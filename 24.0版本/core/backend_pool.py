@@ -0,0 +1,199 @@
+# core/backend_pool.py
+"""
+图片生成后端节点池。
+将多个 SD WebUI / ComfyUI 服务器视为一个池：每个节点有权重和并发上限，
+任务分配给当前负载最低 (在途任务数 / 权重) 的健康节点；节点失败后进入冷却期，
+其任务由调用方重新排队到其他节点。
+启用自适应并发时，每个节点的并发上限由 AIMD 控制器根据延迟和过载响应动态调整。
+"""
+import json # 功能性备注: 导入 json 库用于解析列表形式的节点配置
+import re # 功能性备注: 导入正则表达式模块用于拆分节点配置字符串
+import threading # 功能性备注: 导入线程模块用于节点池的同步
+import time # 功能性备注: 导入 time 库用于冷却计时
+import logging # 功能性备注: 导入日志模块
+
+from .concurrency_controller import AIMDController # 功能性备注: 自适应并发控制器
+
+# 功能性备注: 获取当前模块的 logger 实例
+logger = logging.getLogger(__name__)
+
+# 功能性备注: 节点连续失败后的默认冷却时间 (秒)
+DEFAULT_FAILURE_COOLDOWN = 30.0
+# 功能性备注: 过载 (429 等) 后同一节点再次开始请求前的退避时间 (秒，随连续失败次数增加)
+OVERLOAD_BACKOFF = 2.0
+
+
+class BackendEndpoint:
+    """池中的单个后端节点"""
+    def __init__(self, url, weight=1.0, concurrency=1, min_interval=0.0):
+        self.url = str(url).strip().rstrip('/')
+        self.weight = max(0.01, float(weight))
+        self.concurrency = max(1, int(concurrency))
+        self.min_interval = max(0.0, float(min_interval)) # 功能性备注: 两次请求开始之间的最小间隔 (秒)，用于限速
+        self.next_start = 0.0 # 功能性备注: 下一次允许开始请求的时间戳
+        self.in_flight = 0 # 功能性备注: 当前正在执行的任务数
+        self.consecutive_failures = 0 # 功能性备注: 连续失败次数，成功一次即清零
+        self.cooldown_until = 0.0 # 功能性备注: 冷却结束的时间戳
+        self.completed = 0 # 功能性备注: 成功完成的任务数 (统计用)
+        self.failed = 0 # 功能性备注: 失败的任务数 (统计用)
+        self.controller = None # 功能性备注: 自适应并发控制器 (未启用时为 None，使用固定的 concurrency)
+        self.last_affinity = None # 功能性备注: 最近分配到该节点的任务的模型亲和键 (节点上当前加载的 LoRA/模式)
+
+    def is_healthy(self, now=None):
+        """节点当前是否不在冷却期"""
+        return (now or time.time()) >= self.cooldown_until
+
+    @property
+    def current_limit(self):
+        """当前生效的并发上限"""
+        return self.controller.current_limit if self.controller else self.concurrency
+
+    @property
+    def max_concurrency(self):
+        """并发上限的最大可能值 (用于确定工作线程数)"""
+        return self.controller.maximum if self.controller else self.concurrency
+
+    def is_ready(self, now):
+        """节点是否有空闲并发槽、不在冷却期且已过限速间隔"""
+        return self.in_flight < self.current_limit and self.is_healthy(now) and now >= self.next_start
+
+    def load(self):
+        """按权重归一化的负载，越小越空闲"""
+        return self.in_flight / (self.weight * self.current_limit / self.concurrency)
+
+    def __repr__(self):
+        return f"BackendEndpoint({self.url}, weight={self.weight}, concurrency={self.concurrency})"
+
+
+def parse_endpoint_list(spec, fallback_url=""):
+    """
+    解析节点列表配置。支持两种形式:
+    1. 字符串: 以逗号/分号/换行分隔的条目，每个条目为 "url|权重|并发"，权重与并发可省略；
+    2. 列表: [{"url": ..., "weight": ..., "concurrency": ...}, ...] (或 JSON 字符串形式)。
+    列表为空时使用 fallback_url 作为唯一节点。返回 BackendEndpoint 列表。
+    """
+    entries = []
+    if isinstance(spec, str) and spec.strip().startswith('['):
+        try: spec = json.loads(spec)
+        except json.JSONDecodeError as json_err: logger.warning(f"节点列表 JSON 解析失败，将按文本格式解析: {json_err}") # 逻辑备注
+    if isinstance(spec, list):
+        for item in spec:
+            if isinstance(item, dict) and item.get("url"):
+                entries.append((item.get("url"), item.get("weight", 1), item.get("concurrency", 1)))
+            elif isinstance(item, str) and item.strip():
+                entries.append((item.strip(), 1, 1))
+    elif isinstance(spec, str):
+        for raw_entry in re.split(r'[,;\n]+', spec):
+            parts = [p.strip() for p in raw_entry.split('|')]
+            if not parts or not parts[0]: continue
+            weight = parts[1] if len(parts) > 1 and parts[1] else 1
+            concurrency = parts[2] if len(parts) > 2 and parts[2] else 1
+            entries.append((parts[0], weight, concurrency))
+
+    endpoints = []
+    seen_urls = set()
+    for url, weight, concurrency in entries:
+        try:
+            endpoint = BackendEndpoint(url, weight, concurrency)
+        except (TypeError, ValueError) as parse_err:
+            logger.warning(f"忽略无效的节点配置 '{url}|{weight}|{concurrency}': {parse_err}") # 逻辑备注
+            continue
+        if endpoint.url in seen_urls: continue # 逻辑备注: 忽略重复地址
+        seen_urls.add(endpoint.url)
+        endpoints.append(endpoint)
+    if not endpoints and fallback_url:
+        endpoints.append(BackendEndpoint(fallback_url))
+    return endpoints
+
+
+class BackendPool:
+    """线程安全的后端节点池 (最低负载优先 + 失败冷却)"""
+    def __init__(self, endpoints, failure_cooldown=DEFAULT_FAILURE_COOLDOWN):
+        self.endpoints = list(endpoints)
+        self.failure_cooldown = failure_cooldown
+        self._cond = threading.Condition()
+
+    @property
+    def total_concurrency(self):
+        """所有节点并发上限 (的最大可能值) 之和，即同时在途的最大任务数"""
+        return sum(ep.max_concurrency for ep in self.endpoints)
+
+    def enable_adaptive(self, max_concurrency):
+        """为每个节点启用自适应并发：从配置的并发数开始，最高到 max(配置并发, max_concurrency)"""
+        for ep in self.endpoints:
+            ep.controller = AIMDController(initial=ep.concurrency, maximum=max(ep.concurrency, int(max_concurrency)))
+
+    def acquire(self, exclude=None, stop_event=None, affinity=None):
+        """
+        阻塞直到有可用节点，返回负载最低的健康节点 (已占用一个并发槽)。
+        exclude 中的节点会被优先避开 (该任务已在其上失败过)，仅当其他节点都不可用时才会被选中。
+        affinity 为任务的模型亲和键，负载相同时优先选择上一个任务亲和键相同的节点 (避免切换权重)。
+        stop_event 被设置或池为空时返回 None。
+        """
+        exclude = exclude or set()
+        with self._cond:
+            while True:
+                if stop_event and stop_event.is_set(): return None
+                if not self.endpoints: return None
+                now = time.time()
+                candidates = [ep for ep in self.endpoints if ep.is_ready(now)]
+                preferred = [ep for ep in candidates if ep.url not in exclude]
+                # 逻辑备注: 只有当所有未尝试的节点都在冷却中时，才回到已失败过的节点
+                untried_alive = [ep for ep in self.endpoints if ep.url not in exclude and ep.is_healthy(now)]
+                pool = preferred if (preferred or untried_alive) else candidates
+                if pool:
+                    endpoint = min(pool, key=lambda ep: (ep.load(), affinity is None or ep.last_affinity != affinity, ep.consecutive_failures))
+                    endpoint.in_flight += 1
+                    if affinity is not None: endpoint.last_affinity = affinity
+                    endpoint.next_start = now + endpoint.min_interval
+                    return endpoint
+                # 逻辑备注: 所有节点都忙、在冷却中或在限速间隔内，等待释放或时间到达
+                waits = [ep.cooldown_until - now for ep in self.endpoints if not ep.is_healthy(now)]
+                waits += [ep.next_start - now for ep in self.endpoints if ep.next_start > now]
+                wait_time = min([1.0] + [w for w in waits if w > 0])
+                self._cond.wait(timeout=max(0.05, wait_time))
+
+    def release(self, endpoint, success=True, started_at=None, overloaded=False):
+        """
+        释放节点的并发槽并记录结果；失败时节点进入冷却期。
+        started_at 为本次请求开始时间 (None 表示未实际调用后端，如缓存命中)，用于自适应并发的延迟采样；
+        overloaded 表示后端返回过载 (429/超时等)，会降低并发上限并短暂退避。
+        """
+        if endpoint.controller and started_at is not None:
+            if overloaded:
+                endpoint.controller.on_overload(started_at, reason=f"节点 {endpoint.url} 过载")
+            elif success:
+                endpoint.controller.on_success(started_at, time.time() - started_at, concurrent=endpoint.in_flight)
+        with self._cond:
+            endpoint.in_flight = max(0, endpoint.in_flight - 1)
+            if overloaded:
+                # 逻辑备注: 过载时推迟该节点的下一次请求 (单节点时也生效，相当于退避重试)
+                backoff = OVERLOAD_BACKOFF * min(4, endpoint.consecutive_failures + 1)
+                endpoint.next_start = max(endpoint.next_start, time.time() + backoff)
+            if success:
+                endpoint.completed += 1
+                endpoint.consecutive_failures = 0
+            else:
+                endpoint.failed += 1
+                endpoint.consecutive_failures += 1
+                # 逻辑备注: 只有一个节点时冷却没有意义 (没有其他节点可以接手)，直接跳过
+                if len(self.endpoints) <= 1:
+                    self._cond.notify_all()
+                    return
+                # 逻辑备注: 连续失败越多，冷却越久 (上限为 4 倍)
+                cooldown = self.failure_cooldown * min(4, endpoint.consecutive_failures)
+                endpoint.cooldown_until = time.time() + cooldown
+                logger.warning(f"后端节点 {endpoint.url} 失败 (连续 {endpoint.consecutive_failures} 次)，冷却 {cooldown:.0f} 秒。") # 逻辑备注
+            self._cond.notify_all()
+
+    def limit_summary(self):
+        """返回各节点当前并发上限的简短文本 (用于进度显示)"""
+        with self._cond:
+            if len(self.endpoints) == 1:
+                return f"并发 {self.endpoints[0].current_limit}"
+            return "并发 " + ", ".join(f"{ep.url.split('://')[-1]}={ep.current_limit}" for ep in self.endpoints)
+
+    def summary(self):
+        """返回各节点完成/失败统计的简短文本"""
+        with self._cond:
+            return ", ".join(f"{ep.url}: 成功 {ep.completed} / 失败 {ep.failed}" + (f" / 最终并发上限 {ep.current_limit}" if ep.controller else "") for ep in self.endpoints)
@@ -0,0 +1,83 @@
+# core/concurrency_controller.py
+"""
+后端自适应并发控制 (AIMD: 加性增、乘性减)。
+每个后端节点一个控制器：请求成功且延迟没有明显上升时缓慢提高并发上限 (每完成约“上限”个请求 +1)；
+遇到 429/5xx 过载响应、连接/请求超时，或延迟相对基线明显上升 (说明请求只是在服务器端排队) 时将上限减半。
+同一时刻发出的一批请求同时失败只触发一次减半，避免上限瞬间降到最低。
+"""
+import re # 功能性备注: 导入正则表达式模块用于识别过载错误
+import threading # 功能性备注: 导入线程模块，多个工作线程共享控制器
+import time # 功能性备注: 导入 time 库用于记录减半时间
+import logging # 功能性备注: 导入日志模块
+
+# 功能性备注: 获取当前模块的 logger 实例
+logger = logging.getLogger(__name__)
+
+# 功能性备注: 默认参数
+DEFAULT_ADAPTIVE_MAX_CONCURRENCY = 4
+DEFAULT_LATENCY_TOLERANCE = 1.5 # 功能性备注: 延迟超过基线的倍数时视为服务器端排队
+DECREASE_FACTOR = 0.5
+
+# 逻辑备注: 各 API 助手返回的错误信息中表示过载的部分 (HTTP 429/502/503/504、HTTP 连接/请求超时)。
+# 等待已提交任务完成的超时 (例如 ComfyUI 的 WebSocket 等待/轮询超时) 不属于过载：任务仍在服务器上，不能直接重新提交
+_OVERLOAD_PATTERN = re.compile(r'(状态码|Status):?\s*(429|502|503|504)\b|请求超时|Read timed out|Connect(ion)? ?timed? ?out|ConnectTimeout', re.IGNORECASE)
+
+def is_overload_error(error_msg):
+    """错误信息是否表示后端过载 (应降低并发并稍后重试)"""
+    return bool(error_msg) and bool(_OVERLOAD_PATTERN.search(str(error_msg)))
+
+
+class AIMDController:
+    """单个后端节点的自适应并发上限"""
+    def __init__(self, initial=1, maximum=DEFAULT_ADAPTIVE_MAX_CONCURRENCY, minimum=1, latency_tolerance=DEFAULT_LATENCY_TOLERANCE):
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.limit = float(min(self.maximum, max(self.minimum, int(initial)))) # 功能性备注: 当前上限 (浮点，整数部分生效)
+        self.latency_tolerance = max(1.0, float(latency_tolerance))
+        self.baseline_latency = None # 功能性备注: 基线延迟 (近期最小值，缓慢上浮以适应参数变化)
+        self.last_decrease = 0.0 # 功能性备注: 最近一次减半的时间戳
+        self._lock = threading.Lock()
+
+    @property
+    def current_limit(self):
+        """当前生效的并发上限 (整数)"""
+        return int(self.limit)
+
+    def on_success(self, started_at, latency, concurrent=1):
+        """
+        请求成功：延迟正常时加性增加，明显高于基线时乘性减少。
+        concurrent 为请求结束时该节点的在途请求数 (含本请求)，为 1 时视为单独执行的延迟样本。
+        """
+        with self._lock:
+            if self.baseline_latency is None or latency < self.baseline_latency:
+                self.baseline_latency = latency
+            elif concurrent <= 1:
+                # 逻辑备注: 单独执行的样本代表真实的处理时间，较快地跟随 (生成参数变化时基线随之调整)
+                self.baseline_latency += (latency - self.baseline_latency) * 0.2
+            elif latency <= self.baseline_latency * self.latency_tolerance:
+                # 逻辑备注: 并发样本只在正常范围内缓慢上浮，避免基线被服务器端排队的延迟带高
+                self.baseline_latency += (latency - self.baseline_latency) * 0.01
+            if latency > self.baseline_latency * self.latency_tolerance and self.limit > self.minimum:
+                return self._decrease(started_at, f"延迟 {latency:.1f}s 高于基线 {self.baseline_latency:.1f}s")
+            if self.limit < self.maximum:
+                old_limit = self.current_limit
+                self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+                if self.current_limit != old_limit:
+                    logger.info(f"自适应并发: 上限提高到 {self.current_limit}。") # 功能性备注
+            return False
+
+    def on_overload(self, started_at, reason=""):
+        """过载 (429/超时等)：乘性减少"""
+        with self._lock:
+            return self._decrease(started_at, reason or "后端过载")
+
+    def _decrease(self, started_at, reason):
+        """将上限减半 (调用方需持有 self._lock)；在上次减半之前发出的请求不再重复触发"""
+        if started_at is not None and started_at < self.last_decrease:
+            return False
+        old_limit = self.current_limit
+        self.limit = max(float(self.minimum), self.limit * DECREASE_FACTOR)
+        self.last_decrease = time.time()
+        if self.current_limit != old_limit:
+            logger.warning(f"自适应并发: {reason}，上限降低到 {self.current_limit}。") # 逻辑备注
+        return True
@@ -66,6 +66,19 @@ DEFAULT_IMAGE_GEN_SHARED_CONFIG = {
     "additionalPositivePrompt": "masterpiece, best quality",
     "additionalNegativePrompt": "lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry",
     "saveImageDebugInputs": False, # 图片生成调试开关 (SD/ComfyUI)
+    "img2imgDownscaleInputs": True, # 图生图参考图/蒙版大于生成尺寸时先缩小再发送 (NAI/SD)
+    "imageCacheEnabled": False, # 固定种子时按生成参数复用已生成的图片 (需手动启用)
+    "imageCacheMaxMB": 1024, # 图片缓存容量上限 (MB)，超出按 LRU 淘汰
+    "adaptiveConcurrencyEnabled": False, # 根据延迟和 429/超时自动调整每个后端节点的并发数 (SD WebUI / ComfyUI，需手动启用)
+    "adaptiveMaxConcurrency": 4, # 自适应并发的上限 (每个节点)
+    "affinitySchedulingEnabled": True, # 按 LoRA 组合/生成模式分组执行任务，减少后端切换权重
+    "postprocessEnabled": False, # 保存后在进程池中重新编码图片
+    "postprocessFormat": "keep", # 后处理输出格式: keep / png / webp / jpeg
+    "postprocessQuality": 90, # WebP/JPEG 编码质量 (1-100)
+    "postprocessStripMetadata": True, # 后处理时去除元数据 (PNG 文本块等)
+    "postprocessWorkers": 2, # 后处理进程数
+    "postprocessResizeMode": "none", # 保存后缩放方式: none / fit / fill / pad
+    "postprocessTargetWidth": 0, "postprocessTargetHeight": 0, # 保存后缩放的目标分辨率 (图层尺寸)
 }
 DEFAULT_GOOGLE_CONFIG = { "apiKey": "", "apiEndpoint": "https://generativelanguage.googleapis.com", "modelName": "gemini-1.5-flash-latest", }
 DEFAULT_OPENAI_CONFIG = { "apiKey": "", "apiBaseUrl": "https://api.openai.com/v1", "modelName": "gpt-4o", "customHeaders": {} }
@@ -81,12 +94,17 @@ DEFAULT_NAI_CONFIG = {
 }
 DEFAULT_SD_CONFIG = {
     "sdWebUiUrl": "http://127.0.0.1:7860",
+    "sdWebUiEndpoints": "", # 多节点列表 "url|权重|并发"，留空则只使用 sdWebUiUrl
     "sdOverrideModel": "", "sdOverrideVAE": "",
+    "sdOverrideMode": "sticky", # 覆盖设置应用方式: sticky (批次内固定) / no_restore (请求后不恢复) / per_request (每次请求覆盖)
+    "sdServerSaveMode": "off", # 图片传输方式: off (Base64 返回) / local (本机节点由服务器直接保存) / always (所有节点由服务器保存到共享目录)
+    "sdServerSaveDir": "", # 服务器端保存的共享目录 (留空则使用图片保存目录下的 .sd_server_output)
     "sdEnableHR": False, "sdHRScale": 2.0, "sdHRUpscaler": "Latent", "sdHRSteps": 0,
     "sdInpaintingFill": 1, "sdMaskMode": 0, "sdInpaintArea": 1, "sdResizeMode": 1
 }
 DEFAULT_COMFYUI_CONFIG = {
     "comfyapiUrl": "http://127.0.0.1:8188",
+    "comfyEndpoints": "", # 多节点列表 "url|权重|并发"，留空则只使用 comfyapiUrl
     "comfyWorkflowFile": "",
     "comfyCkptName": "", "comfyVaeName": "",
     "comfyLoraName": "", "comfyLoraStrengthModel": 0.7, "comfyLoraStrengthClip": 0.7,
@@ -105,6 +123,10 @@ DEFAULT_COMFYUI_CONFIG = {
     # --- 新增开始 ---
     "comfyLoadMaskNodeTitle": "Load_Mask_Image", # 用于内/外绘加载蒙版图
     # --- 新增结束 ---
+    "comfyWebsocketSaveNodeTitle": "", # 可选: SaveImageWebsocket 节点标题，图片经 WebSocket 直接返回
+    "comfyPreflightEnabled": True, # 批次开始前按 /object_info 校验工作流、模型和 LoRA 名称
+    "comfyMaxQueuedPerServer": 2, # 每个服务器上最多排队的 prompt 数 (含正在执行的，0 表示不限制)
+    "comfyFuseTaskCount": 1, # 每次提交合并的文生图任务数 (1 表示不融合)
 }
 DEFAULT_GPTSOVITS_CONFIG = {
     "apiUrl": "http://127.0.0.1:9880", "model_name": "", "audioSaveDir": "", "audioPrefix": "cv_",
@@ -196,7 +218,20 @@ def load_config(config_type):
             except: final_config['clipSkip'] = defaults.get('clipSkip')
             try: final_config['maskBlur'] = int(final_config.get('maskBlur', defaults.get('maskBlur')))
             except: final_config['maskBlur'] = defaults.get('maskBlur')
-            for key in ['restoreFaces', 'tiling', 'saveImageDebugInputs']: final_config[key] = str(final_config.get(key, defaults.get(key))).lower() == 'true' # 添加 saveImageDebugInputs
+            for key in ['restoreFaces', 'tiling', 'saveImageDebugInputs', 'img2imgDownscaleInputs', 'imageCacheEnabled', 'adaptiveConcurrencyEnabled', 'affinitySchedulingEnabled', 'postprocessEnabled', 'postprocessStripMetadata']: final_config[key] = str(final_config.get(key, defaults.get(key))).lower() == 'true' # 添加 saveImageDebugInputs
+            try: final_config['imageCacheMaxMB'] = max(0, int(final_config.get('imageCacheMaxMB', defaults.get('imageCacheMaxMB'))))
+            except: final_config['imageCacheMaxMB'] = defaults.get('imageCacheMaxMB')
+            try: final_config['adaptiveMaxConcurrency'] = max(1, int(final_config.get('adaptiveMaxConcurrency', defaults.get('adaptiveMaxConcurrency'))))
+            except: final_config['adaptiveMaxConcurrency'] = defaults.get('adaptiveMaxConcurrency')
+            if final_config.get('postprocessFormat') not in ("keep", "png", "webp", "jpeg"): final_config['postprocessFormat'] = defaults.get('postprocessFormat')
+            try: final_config['postprocessQuality'] = min(100, max(1, int(final_config.get('postprocessQuality', defaults.get('postprocessQuality')))))
+            except: final_config['postprocessQuality'] = defaults.get('postprocessQuality')
+            try: final_config['postprocessWorkers'] = max(1, int(final_config.get('postprocessWorkers', defaults.get('postprocessWorkers'))))
+            except: final_config['postprocessWorkers'] = defaults.get('postprocessWorkers')
+            if final_config.get('postprocessResizeMode') not in ("none", "fit", "fill", "pad"): final_config['postprocessResizeMode'] = defaults.get('postprocessResizeMode')
+            for key in ['postprocessTargetWidth', 'postprocessTargetHeight']:
+                try: final_config[key] = max(0, int(final_config.get(key, defaults.get(key))))
+                except: final_config[key] = defaults.get(key)
             final_config['imageSaveDir'] = str(final_config.get('imageSaveDir', defaults.get('imageSaveDir', '')))
             final_config['sampler'] = str(final_config.get('sampler', defaults.get('sampler', '')))
             final_config['scheduler'] = str(final_config.get('scheduler', defaults.get('scheduler', '')))
@@ -229,8 +264,13 @@ def load_config(config_type):
             final_config['nai_proxy_port'] = str(final_config.get('nai_proxy_port', defaults.get('nai_proxy_port', '')))
         elif config_type == "sd":
             if 'sdWebUiUrl' in final_config and final_config.get('sdWebUiUrl'): final_config['sdWebUiUrl'] = str(final_config['sdWebUiUrl']).rstrip('/')
+            final_config['sdWebUiEndpoints'] = str(final_config.get('sdWebUiEndpoints') or '')
             final_config['sdOverrideModel'] = str(final_config.get('sdOverrideModel', defaults.get('sdOverrideModel', '')))
             final_config['sdOverrideVAE'] = str(final_config.get('sdOverrideVAE', defaults.get('sdOverrideVAE', '')))
+            final_config['sdOverrideMode'] = str(final_config.get('sdOverrideMode') or defaults.get('sdOverrideMode'))
+            if final_config['sdOverrideMode'] not in ("sticky", "no_restore", "per_request"): final_config['sdOverrideMode'] = defaults.get('sdOverrideMode')
+            if final_config.get('sdServerSaveMode') not in ("off", "local", "always"): final_config['sdServerSaveMode'] = defaults.get('sdServerSaveMode')
+            final_config['sdServerSaveDir'] = str(final_config.get('sdServerSaveDir') or '')
             final_config['sdEnableHR'] = str(final_config.get('sdEnableHR', defaults.get('sdEnableHR', False))).lower() == 'true'
             try: final_config['sdHRScale'] = float(final_config.get('sdHRScale', defaults.get('sdHRScale')))
             except: final_config['sdHRScale'] = defaults.get('sdHRScale')
@@ -247,6 +287,7 @@ def load_config(config_type):
             except: final_config['sdResizeMode'] = defaults.get('sdResizeMode')
         elif config_type == "comfyui":
             if 'comfyapiUrl' in final_config and final_config.get('comfyapiUrl'): final_config['comfyapiUrl'] = str(final_config['comfyapiUrl']).rstrip('/')
+            final_config['comfyEndpoints'] = str(final_config.get('comfyEndpoints') or '')
             final_config['comfyWorkflowFile'] = str(final_config.get('comfyWorkflowFile', defaults.get('comfyWorkflowFile', '')))
             final_config['comfyCkptName'] = str(final_config.get('comfyCkptName', defaults.get('comfyCkptName', '')))
             final_config['comfyVaeName'] = str(final_config.get('comfyVaeName', defaults.get('comfyVaeName', '')))
@@ -264,9 +305,15 @@ def load_config(config_type):
                 # --- 新增开始 ---
                 "comfyLoadMaskNodeTitle",
                 # --- 新增结束 ---
+                "comfyWebsocketSaveNodeTitle",
             ]
             for key in node_title_keys:
                  final_config[key] = str(final_config.get(key, defaults.get(key, "")))
+            try: final_config['comfyMaxQueuedPerServer'] = max(0, int(final_config.get('comfyMaxQueuedPerServer', defaults.get('comfyMaxQueuedPerServer'))))
+            except: final_config['comfyMaxQueuedPerServer'] = defaults.get('comfyMaxQueuedPerServer')
+            try: final_config['comfyFuseTaskCount'] = min(16, max(1, int(final_config.get('comfyFuseTaskCount', defaults.get('comfyFuseTaskCount')))))
+            except: final_config['comfyFuseTaskCount'] = defaults.get('comfyFuseTaskCount')
+            final_config['comfyPreflightEnabled'] = str(final_config.get('comfyPreflightEnabled', defaults.get('comfyPreflightEnabled'))).lower() == 'true'
         elif config_type == "gptsovits":
             final_config['model_name'] = str(final_config.get('model_name', defaults.get('model_name', '')))
             try: final_config['top_k'] = int(final_config.get('top_k', defaults.get('top_k')))
@@ -522,4 +569,148 @@ if "comfyui" in HELP_DATA:
         "name": "加载蒙版节点标题 (内/外绘)",
         "desc": "工作流中用于加载内/外绘蒙版图像的 LoadImage 节点的标题。\n程序会设置其 'image' 输入（使用上传后的蒙版文件名）。\n重要：该蒙版文件必须位于 ComfyUI 服务器的 'input' 目录下。",
         "default": "Load_Mask_Image"
-    }
\ No newline at end of file
+    }
+
+# 功能性备注: 多后端节点列表的帮助信息
+_ENDPOINTS_HELP_DESC = (
+    "可选。填写多个后端服务器，图片任务会在这些节点之间并行分配。\n"
+    "格式: 每个条目为 \"地址|权重|并发\"，条目之间用逗号或换行分隔，权重和并发可省略 (默认均为 1)。\n"
+    "例如: http://192.168.1.10:{port}|2|2, http://192.168.1.11:{port}\n"
+    "任务优先分配给负载 (在途任务数/权重) 最低的节点；某节点出现网络错误或超时时，任务会重新排队到其他节点，该节点暂时冷却。\n"
+    "留空则只使用上方的 API 地址。"
+)
+if "sd" in HELP_DATA:
+    HELP_DATA["sd"]["sdWebUiEndpoints"] = {
+        "key": "sdWebUiEndpoints", "name": "多节点列表 (可选)",
+        "desc": _ENDPOINTS_HELP_DESC.format(port=7860),
+        "default": ""
+    }
+if "comfyui" in HELP_DATA:
+    HELP_DATA["comfyui"]["comfyEndpoints"] = {
+        "key": "comfyEndpoints", "name": "多节点列表 (可选)",
+        "desc": _ENDPOINTS_HELP_DESC.format(port=8188),
+        "default": ""
+    }
+if "image_gen_shared" in HELP_DATA:
+    HELP_DATA["image_gen_shared"]["img2imgDownscaleInputs"] = {
+        "key": "img2imgDownscaleInputs", "name": "缩小过大的参考图",
+        "desc": "图生图/内绘时 (NAI 与 SD WebUI)，如果人物参考图或蒙版比生成尺寸大，先按生成尺寸等比缩小 (保证覆盖目标宽高) 后再发送，以减小请求体积。\n每张参考图在一次生成批次中只读取和编码一次。",
+        "default": "True"
+    }
+    HELP_DATA["image_gen_shared"]["imageCacheEnabled"] = {
+        "key": "imageCacheEnabled", "name": "启用生成图片缓存",
+        "desc": "种子固定 (非 -1 且未勾选客户端随机种子) 时，按完整生成参数 (提示词、种子、模型、采样器、尺寸、LoRA 等) 缓存生成的图片。\n再次生成参数完全相同的任务时直接从缓存 (cache/generated_images) 复制，不再调用后端，计为成功。",
+        "default": "False"
+    }
+    HELP_DATA["image_gen_shared"]["imageCacheMaxMB"] = {
+        "key": "imageCacheMaxMB", "name": "图片缓存上限 (MB)",
+        "desc": "图片缓存占用的最大磁盘空间，超出时删除最久未使用的图片。0 表示不写入新的缓存。",
+        "default": "1024"
+    }
+    HELP_DATA["image_gen_shared"]["adaptiveConcurrencyEnabled"] = {
+        "key": "adaptiveConcurrencyEnabled", "name": "自适应并发",
+        "desc": "启用后，每个后端节点 (SD WebUI / ComfyUI) 的同时请求数自动调整：请求成功且耗时没有明显变长时逐步增加，\n遇到 429/5xx、连接/请求超时或耗时明显变长 (请求只是在服务器端排队) 时减半，并在退避后重试该任务。\n起始并发为节点配置的并发数 (默认 1)，最高不超过右侧的上限。生成时状态栏会显示进度和当前并发。\nNAI 每个账号只允许同时生成一张图片，始终按单并发执行，不受此选项影响。",
+        "default": "False"
+    }
+    HELP_DATA["image_gen_shared"]["adaptiveMaxConcurrency"] = {
+        "key": "adaptiveMaxConcurrency", "name": "自适应并发上限",
+        "desc": "自适应并发时每个节点最多同时发出的请求数。节点列表中配置了更大的并发数时以节点配置为准。",
+        "default": "4"
+    }
+if "comfyui" in HELP_DATA:
+    HELP_DATA["comfyui"]["comfyWebsocketSaveNodeTitle"] = {
+        "key": "comfyWebsocketSaveNodeTitle", "name": "WebSocket 保存节点标题 (可选)",
+        "desc": "工作流中 SaveImageWebsocket 节点的标题。填写后，生成的图片会在执行过程中直接通过已打开的 WebSocket 连接推送回来，\n不再在完成后请求 /history 和逐张 /view 下载。\n未收到推送的图片时 (例如连接中断) 自动回退到原来的下载方式。留空则不使用。",
+        "default": ""
+    }
+if "image_gen_shared" in HELP_DATA:
+    HELP_DATA["image_gen_shared"]["affinitySchedulingEnabled"] = {
+        "key": "affinitySchedulingEnabled", "name": "按模型亲和性排序",
+        "desc": "SD WebUI / ComfyUI 生成时，把使用相同 LoRA 组合和相同生成模式 (文生图/图生图/内绘) 的任务排在一起执行，\n减少后端在相邻任务之间反复加载、卸载权重的次数 (步数较少的模型中这部分往往占大头)。\n多节点时任务优先分配给刚处理过相同组合的节点。生成结果和脚本修改仍按脚本顺序汇总。",
+        "default": "True"
+    }
+if "sd" in HELP_DATA:
+    HELP_DATA["sd"]["sdOverrideMode"] = {
+        "key": "sdOverrideMode", "name": "覆盖设置应用方式",
+        "desc": "模型、VAE 和 CLIP Skip 覆盖设置如何应用到 SD WebUI：\n"
+                "- 批次内固定 (推荐)：每个节点在第一个任务前通过 /sdapi/v1/options 设置一次，并核对当前加载的模型；之后的请求不再带覆盖设置。\n"
+                "- 请求后不恢复：每个请求仍带覆盖设置，但要求服务器请求后不恢复 (override_settings_restore_afterwards=false)。\n"
+                "- 每次请求覆盖：旧行为，服务器在每次请求后恢复原设置，可能导致每张图都重新加载模型。\n"
+                "前两种方式在本批次结束时会把各节点恢复为生成前的设置。",
+        "default": "sticky"
+    }
+if "image_gen_shared" in HELP_DATA:
+    HELP_DATA["image_gen_shared"]["postprocessEnabled"] = {
+        "key": "postprocessEnabled", "name": "保存后重新编码",
+        "desc": "启用后，图片保存时交给独立的进程池重新编码 (与后续生成并行，不拖慢批次)，批次结束时在结果中报告体积变化。\n"
+                "- 沿用原格式：按脚本中文件名的扩展名重新编码 (PNG 会做无损优化)。\n"
+                "- PNG (优化) / WebP / JPEG：转换为该格式，并同步修改脚本中 [image storage=...] 的扩展名。\n"
+                "JPEG 不支持透明，透明区域会铺白底。编码失败时保留后端返回的原始数据。",
+        "default": "False"
+    }
+    HELP_DATA["image_gen_shared"]["postprocessQuality"] = {
+        "key": "postprocessQuality", "name": "编码质量",
+        "desc": "WebP/JPEG 的编码质量 (1-100)，数值越大画质越好、文件越大。PNG 为无损格式，不受此项影响。",
+        "default": "90"
+    }
+    HELP_DATA["image_gen_shared"]["postprocessStripMetadata"] = {
+        "key": "postprocessStripMetadata", "name": "去除元数据",
+        "desc": "重新编码时不保留元数据 (例如 SD WebUI 写入 PNG 的生成参数文本)。取消勾选时 PNG 输出会保留文本块。",
+        "default": "True"
+    }
+    HELP_DATA["image_gen_shared"]["postprocessWorkers"] = {
+        "key": "postprocessWorkers", "name": "后处理进程数",
+        "desc": "重新编码使用的进程数。编码是 CPU 密集操作，建议不超过 CPU 核心数的一半，以免影响本机运行的后端。",
+        "default": "2"
+    }
+    HELP_DATA["image_gen_shared"]["postprocessResizeMode"] = {
+        "key": "postprocessResizeMode", "name": "保存后缩放到目标分辨率",
+        "desc": "保存时在后处理进程池中用 Lanczos 把图片缩放到右侧的目标分辨率 (例如游戏图层尺寸)，与生成并行执行：\n"
+                "- 适应 (fit)：等比缩放到目标框内，不裁剪，输出可能比目标小一边。\n"
+                "- 填充裁剪 (fill)：等比缩放到铺满目标尺寸，再居中裁掉多余部分。\n"
+                "- 补边 (pad)：等比缩放到目标框内，再居中补边到目标尺寸 (透明，JPEG 为白色)。\n"
+                "在本机完成缩小后，可以关闭 SD WebUI 的高清修复 (Hires. fix) 等服务器端放大，节省 GPU 时间。\n"
+                "未勾选“保存后重新编码”时保留原格式和元数据。目标宽高为 0 时不缩放。",
+        "default": "none"
+    }
+    HELP_DATA["comfyui"]["comfyPreflightEnabled"] = {
+        "key": "comfyPreflightEnabled", "name": "生成前预检",
+        "desc": "批次开始前从每个 ComfyUI 节点获取 /object_info (缓存 5 分钟)，检查：\n"
+                "- 工作流中的节点类型是否已安装 (缺少自定义节点)；\n"
+                "- Checkpoint / VAE 覆盖、采样器、调度器以及工作流中其他下拉选项的值是否存在于服务器；\n"
+                "- 本批次人物配置的 LoRA 名称是否存在；输出节点标题是否正确。\n"
+                "发现问题时不提交任何任务，一次性列出所有问题。无法连接的节点跳过检查。",
+        "default": "True"
+    }
+    HELP_DATA["comfyui"]["comfyMaxQueuedPerServer"] = {
+        "key": "comfyMaxQueuedPerServer", "name": "每节点排队上限",
+        "desc": "每个 ComfyUI 服务器上最多同时排队的 prompt 数 (包括正在执行的那个，也包括其他客户端提交的)。\n"
+                "提交前读取服务器推送的队列数量 (WebSocket status 事件，断线时查询 /queue)，达到上限时等待。\n"
+                "2 表示一个在执行、一个在排队，GPU 不会空闲；停止任务时服务器上最多只剩这么多个未完成的 prompt，队列和历史记录也不会无限增长。\n"
+                "0 表示不限制 (只受节点并发数限制)。",
+        "default": "2"
+    }
+    HELP_DATA["comfyui"]["comfyFuseTaskCount"] = {
+        "key": "comfyFuseTaskCount", "name": "融合提交任务数",
+        "desc": "把最多 K 个相邻的文生图任务 (LoRA 组合相同，模型和分辨率由配置统一决定) 合并为一个工作流提交。\n"
+                "各任务相同的节点 (模型、VAE 加载等) 只保留一份，提示词、采样器、潜空间、保存节点等按任务复制，输出按节点对应回各任务。\n"
+                "适合图标、Q 版头像等小尺寸、采样很快的图片：每个 prompt 的调度、模型缓存检查和历史记录开销由 K 张图分摊。\n"
+                "图生图/内绘任务和使用 WebSocket 保存节点的工作流不融合；融合提交失败时自动改为逐个提交。\n"
+                "1 表示不融合 (最大 16)。",
+        "default": "1"
+    }
+    HELP_DATA["sd"]["sdServerSaveMode"] = {
+        "key": "sdServerSaveMode", "name": "图片传输方式",
+        "desc": "SD WebUI 返回图片的方式：\n"
+                "- Base64 返回：图片编码在 JSON 响应中传回 (体积增加约 33%，内存中有多份拷贝)，适用于任何服务器。\n"
+                "- 本机服务器直接保存：仅对地址为 localhost/127.0.0.1 的节点，请求服务器把图片保存到共享目录 (save_images，send_images=false)，本程序直接移动文件。\n"
+                "- 总是服务器保存：所有节点都使用服务器保存，适用于服务器与本机通过同一路径访问的共享目录。\n"
+                "找不到服务器保存的文件时，本批次对该节点自动改回 Base64 传输 (该任务会重新请求一次)。",
+        "default": "off"
+    }
+    HELP_DATA["sd"]["sdServerSaveDir"] = {
+        "key": "sdServerSaveDir", "name": "服务器端保存目录",
+        "desc": "服务器端保存模式下 SD WebUI 写入图片的目录，服务器和本程序必须能以同一路径访问。\n"
+                "留空则使用图片保存目录下的 .sd_server_output (与最终目录在同一磁盘，移动文件只需改名)。",
+        "default": ""
+    }
@@ -0,0 +1,162 @@
+# core/generated_image_cache.py
+"""
+已生成图片的本地缓存 (按内容寻址)。
+键为“有效生成参数”规范化 JSON 的 sha256 (NAI payload / SD payload / 打过补丁的 ComfyUI 工作流)，
+只在种子固定时使用：命中时直接把缓存文件复制到目标位置，无需调用后端。
+缓存总大小有上限，超出时按最近最少使用 (LRU) 淘汰。
+"""
+import hashlib # 功能性备注: 导入 hashlib 用于计算参数哈希
+import json # 功能性备注: 导入 json 库用于规范化参数和读写索引
+import os # 功能性备注: 导入 os 库用于文件操作
+import shutil # 功能性备注: 导入 shutil 用于复制缓存文件
+import threading # 功能性备注: 导入线程模块，多个工作线程共享缓存
+import time # 功能性备注: 导入 time 库记录最近使用时间
+from pathlib import Path # 功能性备注: 导入 Path 对象用于路径处理
+import logging # 功能性备注: 导入日志模块
+
+# 功能性备注: 获取当前模块的 logger 实例
+logger = logging.getLogger(__name__)
+
+# 功能性备注: 缓存目录与默认容量上限 (MB)
+IMAGE_CACHE_DIR = Path("cache") / "generated_images"
+DEFAULT_IMAGE_CACHE_MAX_MB = 1024
+
+
+def make_cache_key(api_type, params):
+    """根据 API 类型和有效生成参数计算缓存键 (规范化 JSON 的 sha256)"""
+    canonical = json.dumps({"api": api_type, "params": params}, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class GeneratedImageCache:
+    """线程安全的图片缓存：索引文件记录每个键对应的文件、大小和最近使用时间"""
+    def __init__(self, cache_dir=IMAGE_CACHE_DIR, max_mb=DEFAULT_IMAGE_CACHE_MAX_MB):
+        self.cache_dir = Path(cache_dir)
+        self.index_file = self.cache_dir / "index.json"
+        self.max_bytes = max(0, int(max_mb)) * 1024 * 1024
+        self._lock = threading.Lock()
+        self._index = None # 功能性备注: {键: {"files": [文件名], "size": 字节数, "last_used": 时间戳}}
+        self._dirty = False # 功能性备注: 索引是否有未写回的修改 (命中时只更新使用时间)
+
+    def _load(self):
+        """加载索引 (调用方需持有 self._lock)，丢弃文件已丢失的条目"""
+        if self._index is not None:
+            return
+        self._index = {}
+        try:
+            if self.index_file.is_file():
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    loaded = json.load(f)
+                if isinstance(loaded, dict):
+                    for key, entry in loaded.items():
+                        files = entry.get("files") if isinstance(entry, dict) else None
+                        if files and all((self.cache_dir / name).is_file() for name in files):
+                            self._index[key] = entry
+        except (OSError, json.JSONDecodeError) as load_e:
+            logger.warning(f"读取图片缓存索引失败，将重新建立: {load_e}") # 逻辑备注
+
+    def _save(self):
+        """写回索引 (调用方需持有 self._lock)"""
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.index_file.with_suffix(".tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._index, f, ensure_ascii=False)
+            os.replace(tmp_path, self.index_file)
+            self._dirty = False
+        except OSError as save_e:
+            logger.warning(f"保存图片缓存索引失败: {save_e}") # 逻辑备注
+
+    def get(self, key):
+        """查找缓存，命中时返回缓存文件路径列表，否则返回 None"""
+        with self._lock:
+            self._load()
+            entry = self._index.get(key)
+            if not entry:
+                return None
+            paths = [self.cache_dir / name for name in entry["files"]]
+            if not all(path.is_file() for path in paths):
+                # 逻辑备注: 缓存文件被外部删除，移除该条目
+                self._index.pop(key, None); self._dirty = True
+                return None
+            entry["last_used"] = time.time(); self._dirty = True
+            return paths
+
+    def put(self, key, image_data_list, file_ext=".png"):
+        """写入一组图片 (bytes 或已在磁盘上的文件路径) 并按容量上限淘汰旧条目"""
+        if self.max_bytes <= 0 or not image_data_list:
+            return
+        try:
+            total_size = sum(os.path.getsize(data) if isinstance(data, (str, Path)) else len(data) for data in image_data_list)
+        except OSError as size_e:
+            logger.warning(f"读取待缓存图片大小失败: {size_e}") # 逻辑备注
+            return
+        if total_size > self.max_bytes:
+            return # 逻辑备注: 单个条目就超过上限，不缓存
+        with self._lock:
+            self._load()
+            try:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                names = []
+                for idx, data in enumerate(image_data_list):
+                    name = f"{key}_{idx}{file_ext}"
+                    if isinstance(data, (str, Path)):
+                        shutil.copyfile(data, self.cache_dir / name) # 逻辑备注: 暂存文件直接复制，不读入内存
+                    else:
+                        with open(self.cache_dir / name, 'wb') as f:
+                            f.write(data)
+                    names.append(name)
+            except OSError as write_e:
+                logger.warning(f"写入图片缓存失败: {write_e}") # 逻辑备注
+                return
+            self._index[key] = {"files": names, "size": total_size, "last_used": time.time()}
+            self._evict()
+            self._save()
+
+    def _evict(self):
+        """按最近使用时间淘汰，直到总大小不超过上限 (调用方需持有 self._lock)"""
+        total = sum(entry.get("size", 0) for entry in self._index.values())
+        if total <= self.max_bytes:
+            return
+        for key in sorted(self._index, key=lambda k: self._index[k].get("last_used", 0)):
+            if total <= self.max_bytes:
+                break
+            entry = self._index.pop(key)
+            total -= entry.get("size", 0)
+            for name in entry.get("files", []):
+                try: (self.cache_dir / name).unlink()
+                except FileNotFoundError: pass
+                except OSError as unlink_e: logger.warning(f"删除缓存文件 '{name}' 失败: {unlink_e}") # 逻辑备注
+        logger.info(f"图片缓存超过上限，已按 LRU 淘汰至 {total / 1024 / 1024:.1f} MB。") # 功能性备注
+
+    def flush(self):
+        """写回命中时更新的使用时间"""
+        with self._lock:
+            if self._dirty and self._index is not None:
+                self._save()
+
+
+def materialize_cached_file(cached_path, target_path):
+    """
+    将缓存文件复制到目标位置 (先写临时文件再原子改名)。
+    不使用硬链接：用户就地编辑输出图片时会同时改写缓存条目，之后的运行会复用被编辑过的文件。
+    """
+    temp_path = f"{os.fspath(target_path)}.{os.getpid()}.tmp"
+    shutil.copyfile(cached_path, temp_path)
+    os.replace(temp_path, target_path)
+
+
+# 功能性备注: 进程内共享的缓存实例 (容量变化时重建)
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+def get_generated_image_cache(max_mb=DEFAULT_IMAGE_CACHE_MAX_MB):
+    """获取进程内共享的图片缓存"""
+    global _image_cache
+    with _image_cache_lock:
+        max_bytes = max(0, int(max_mb)) * 1024 * 1024
+        if _image_cache is None:
+            _image_cache = GeneratedImageCache(max_mb=max_mb)
+        elif _image_cache.max_bytes != max_bytes:
+            _image_cache.max_bytes = max_bytes
+        return _image_cache
@@ -0,0 +1,105 @@
+# core/generation_journal.py
+"""
+图片生成日志 (只追加的 JSONL 文件，位于图片保存目录)。
+每张图片写入完成后立即追加一条记录 (脚本中的 image 行、保存的文件名与 sha256、种子、生成参数哈希) 并落盘，
+程序崩溃或用户中途停止时，已完成的任务不会丢失；“续传”范围读取日志，跳过已完成的任务并补上未写回脚本的取消注释。
+"""
+import hashlib # 功能性备注: 导入 hashlib 用于计算文件哈希和任务键
+import json # 功能性备注: 导入 json 库用于读写日志行
+import os # 功能性备注: 导入 os 库用于落盘和原子替换
+import re # 功能性备注: 导入正则表达式模块，用于规范化提示词中的空白
+import threading # 功能性备注: 导入线程模块，多个写入线程共享日志
+import time # 功能性备注: 导入 time 库记录时间戳
+from pathlib import Path # 功能性备注: 导入 Path 对象用于路径处理
+import logging # 功能性备注: 导入日志模块
+
+# 功能性备注: 获取当前模块的 logger 实例
+logger = logging.getLogger(__name__)
+
+# 功能性备注: 日志文件名 (位于图片保存目录)
+JOURNAL_FILENAME = ".image_journal.jsonl"
+
+
+def task_journal_key(task):
+    """
+    任务在日志中的键：角色名 + 正/负面提示词 + 文件名的哈希 (空白已规范化)，提示词改变后视为新任务。
+    不依赖注释行和 image 标签的具体写法，由步骤二结果推测生成的图片也能对应到步骤三生成的脚本。
+    """
+    fields = (task.get('name', ''), task.get('positive', ''), task.get('negative', ''), task.get('filename', ''))
+    raw = "\n".join(re.sub(r'\s+', ' ', str(field)).strip() for field in fields)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def file_sha256(path):
+    """计算文件的 sha256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class GenerationJournal:
+    """单个保存目录的生成日志 (线程安全，每条记录写入后立即 fsync)"""
+    def __init__(self, directory, filename=JOURNAL_FILENAME):
+        self.path = Path(directory) / filename
+        self._lock = threading.Lock()
+
+    def record(self, task, files, seed=None, payload_hash=None, storage=None, api_type=None):
+        """
+        追加一条已完成任务的记录。files 为保存的文件名列表 (相对保存目录)，
+        storage 为脚本中应写回的文件名 (后处理改变扩展名时与原文件名不同)。返回错误信息，成功时返回 None。
+        """
+        try:
+            hashes = [file_sha256(self.path.parent / name) for name in files]
+        except OSError as hash_e:
+            return f"计算图片哈希失败: {hash_e}"
+        entry = {
+            "key": task_journal_key(task), "filename": task['filename'], "storage": storage or task['filename'],
+            "files": list(files), "sha256": hashes, "seed": seed, "payload_hash": payload_hash,
+            "api": api_type, "time": time.time(),
+        }
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + "\n"
+        with self._lock:
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+                    f.flush()
+                    os.fsync(f.fileno())
+            except OSError as write_e:
+                return f"写入生成日志失败: {write_e}"
+        return None
+
+    def load(self):
+        """读取日志，返回 {任务键: 最新记录}；跳过崩溃时写了一半的行"""
+        entries = {}
+        with self._lock:
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    for line_no, line in enumerate(f, 1):
+                        if not line.strip(): continue
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            logger.warning(f"生成日志第 {line_no} 行不完整，已跳过。") # 逻辑备注
+                            continue
+                        if isinstance(entry, dict) and entry.get("key") and entry.get("files"):
+                            entries[entry["key"]] = entry
+            except FileNotFoundError:
+                pass
+            except OSError as read_e:
+                logger.warning(f"读取生成日志失败 '{self.path}': {read_e}") # 逻辑备注
+        return entries
+
+    def compact(self, entries):
+        """用给定的记录 (通常为 load() 中仍然有效的部分) 原子重写日志，去掉重复和失效的行"""
+        with self._lock:
+            tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    for entry in entries.values():
+                        f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except OSError as compact_e:
+                logger.warning(f"整理生成日志失败: {compact_e}") # 逻辑备注
@@ -591,10 +591,19 @@ HELP_DATA = {
             "desc": "仅在勾选“覆盖KAG温度”时生效。指定用于步骤三（建议BGM并转KAG）的LLM温度值。",
             "default": "0.1"
         },
+        "speculative_image_gen": {
+            "key": "speculative_api_var",
+            "name": "推测生成图片",
+            "desc": "选择一个图片 API 后，点击第三步时会同时在后台按“步骤二结果”中的 [NAI:...] / [IMG:...] 提示词生成图片，让显卡与最慢的 LLM 步骤并行工作。\n"
+                    "图片按替换占位符后将出现的文件名 (图片前缀 + 名字 + 序号) 保存，并记入生成日志；步骤三完成并替换图片占位符后，提示词和文件名都一致的任务会自动取消注释 (绑定)。\n"
+                    "如果步骤三改动了提示词或增删了图片，不一致的任务不会绑定，之后用“未生成”或“续传”范围补生成即可。\n"
+                    "生成数量和图生图开关使用下方图片生成选项；推测生成进行中时不能启动其他图片生成，停止按钮可中止推测生成。",
+            "default": "关闭"
+        },
         "img_gen_scope": {
             "key": "img_gen_scope_var",
             "name": "图片生成范围",
-            "desc": "选择图片生成的范围：\n- 所有: 处理 KAG 脚本中所有找到的、注释掉的图片任务。\n- 指定: 只处理下方输入框中指定的、逗号分隔的文件名对应的任务。",
+            "desc": "选择图片生成的范围：\n- 所有: 处理 KAG 脚本中所有找到的图片任务。\n- 未生成: 只处理注释掉的图片任务。\n- 已生成: 只处理未注释的图片任务 (重新生成)。\n- 续传: 与“未生成”相同，但跳过图片保存目录的生成日志 (.image_journal.jsonl) 中已完成且文件仍存在的任务，并补上它们的取消注释；用于程序崩溃或中途停止后继续上次的批次。\n- 指定: 只处理下方输入框中指定的、逗号分隔的文件名对应的任务。\n每张图片写入完成后都会立即记录到生成日志，图片先写临时文件再改名，不会留下写了一半的文件。",
             "default": "all"
         },
          "specific_images": {
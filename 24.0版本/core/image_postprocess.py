@@ -0,0 +1,168 @@
+# core/image_postprocess.py
+"""
+生成图片的保存后处理 (可选)。
+在独立的进程池中把后端返回的图片缩放/裁剪到目标分辨率 (fit / fill / pad)，
+重新编码为配置的格式 (优化 PNG / WebP / JPEG)，可去除元数据，并统计体积变化；
+编码是 CPU 密集操作，放在进程池中与生成并行执行，不占用生成线程和写入线程。
+"""
+import os # 功能性备注: 导入 os 库用于文件操作
+import io # 功能性备注: 导入 io 模块用于从内存读取图片
+import threading # 功能性备注: 导入线程模块用于统计同步
+from concurrent.futures import ProcessPoolExecutor # 功能性备注: 编码进程池
+from PIL import Image, ImageOps, PngImagePlugin # 功能性备注: 导入 Pillow 库用于图像缩放和编码
+import logging # 功能性备注: 导入日志模块
+
+# 功能性备注: 获取当前模块的 logger 实例
+logger = logging.getLogger(__name__)
+
+# 功能性备注: 输出格式 -> 扩展名 ("keep" 表示沿用脚本中文件名的扩展名)
+POSTPROCESS_FORMATS = {"keep": None, "png": ".png", "webp": ".webp", "jpeg": ".jpg"}
+_PIL_FORMATS = {".png": "PNG", ".webp": "WEBP", ".jpg": "JPEG", ".jpeg": "JPEG"}
+# 功能性备注: 缩放方式 ("none" 不缩放；fit 等比缩放到框内；fill 等比缩放铺满后居中裁剪；pad 等比缩放后补边到目标尺寸)
+RESIZE_MODES = ("none", "fit", "fill", "pad")
+DEFAULT_POSTPROCESS_WORKERS = 2
+
+
+def postprocess_options_from_config(shared_config):
+    """从共享图片配置读取后处理选项 (重新编码和/或缩放到目标分辨率)；都未启用时返回 None"""
+    reencode_enabled = bool(shared_config.get('postprocessEnabled', False))
+    resize_mode = shared_config.get('postprocessResizeMode', 'none')
+    resize_mode = resize_mode if resize_mode in RESIZE_MODES else 'none'
+    try: target_size = (int(shared_config.get('postprocessTargetWidth', 0)), int(shared_config.get('postprocessTargetHeight', 0)))
+    except (TypeError, ValueError): target_size = (0, 0)
+    if resize_mode != 'none' and min(target_size) <= 0:
+        logger.warning(f"后处理目标分辨率无效 {target_size}，不进行缩放。") # 逻辑备注
+        resize_mode = 'none'
+    if not reencode_enabled and resize_mode == 'none':
+        return None
+    image_format = shared_config.get('postprocessFormat', 'keep') if reencode_enabled else 'keep'
+    return {
+        "format": image_format if image_format in POSTPROCESS_FORMATS else "keep",
+        "quality": min(100, max(1, int(shared_config.get('postprocessQuality', 90)))),
+        # 逻辑备注: 仅缩放时保留元数据 (用户未要求去除)
+        "strip_metadata": bool(shared_config.get('postprocessStripMetadata', True)) if reencode_enabled else False,
+        "resize_mode": resize_mode, "target_size": target_size,
+    }
+
+def resize_to_target(image, mode, target_size, pad_color):
+    """按缩放方式把图片调整到目标分辨率 (LANCZOS)"""
+    if mode == "fit":
+        return ImageOps.contain(image, target_size, method=Image.Resampling.LANCZOS)
+    if mode == "fill":
+        return ImageOps.fit(image, target_size, method=Image.Resampling.LANCZOS, centering=(0.5, 0.5))
+    if mode == "pad":
+        return ImageOps.pad(image, target_size, method=Image.Resampling.LANCZOS, color=pad_color, centering=(0.5, 0.5))
+    return image
+
+def output_extension(options, original_ext):
+    """后处理后的文件扩展名 (未启用后处理或沿用原格式时返回原扩展名)"""
+    if not options:
+        return original_ext
+    return POSTPROCESS_FORMATS.get(options.get("format")) or original_ext
+
+
+def encode_image_file(source, target_path, options, fallback_path=None):
+    """
+    进程池中执行：读取图片 (bytes 或文件路径)，按选项缩放/裁剪、重新编码并原子写入 target_path。
+    编码失败时原样写入原始数据，避免丢失图片；输出格式改变了扩展名时原始数据写入 fallback_path (原扩展名)，
+    避免文件内容与扩展名不符。
+    返回 (原始字节数, 写入字节数, 错误信息, 实际写入的路径)。
+    """
+    target_path = written_path = os.fspath(target_path)
+    temp_path = f"{target_path}.{os.getpid()}.tmp"
+    if isinstance(source, (bytes, bytearray)):
+        raw_data = bytes(source)
+    else:
+        with open(source, 'rb') as f:
+            raw_data = f.read()
+    error = None
+    try:
+        pil_format = _PIL_FORMATS.get(os.path.splitext(target_path)[1].lower(), "PNG")
+        with Image.open(io.BytesIO(raw_data)) as img:
+            img.load()
+            pnginfo = None
+            if not options.get("strip_metadata", True) and pil_format == "PNG" and getattr(img, "text", None):
+                # 逻辑备注: 保留 PNG 文本块 (例如 SD WebUI 写入的 parameters)
+                pnginfo = PngImagePlugin.PngInfo()
+                for key, value in img.text.items(): pnginfo.add_text(key, value)
+            image = img
+            resize_mode = options.get("resize_mode", "none")
+            if resize_mode != "none" and tuple(image.size) != tuple(options["target_size"]):
+                if resize_mode == "pad" and pil_format != "JPEG" and image.mode != "RGBA":
+                    image = image.convert("RGBA") # 逻辑备注: 补边区域透明 (JPEG 输出时补白边)
+                pad_color = (255, 255, 255) if pil_format == "JPEG" else (0, 0, 0, 0)
+                image = resize_to_target(image, resize_mode, tuple(options["target_size"]), pad_color if image.mode in ("RGB", "RGBA") else None)
+            if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+                # 逻辑备注: JPEG 不支持透明通道，铺白底后转换为 RGB
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                rgba = image.convert("RGBA")
+                background.paste(rgba, mask=rgba.getchannel("A"))
+                image = background
+            elif pil_format != "JPEG" and image.mode not in ("RGB", "RGBA", "L", "LA"):
+                image = image.convert("RGBA")
+            quality = options.get("quality", 90)
+            if pil_format == "PNG":
+                image.save(temp_path, format="PNG", optimize=True, pnginfo=pnginfo)
+            elif pil_format == "WEBP":
+                image.save(temp_path, format="WEBP", quality=quality, method=6)
+            else:
+                image.save(temp_path, format="JPEG", quality=quality, optimize=True, progressive=True)
+    except Exception as encode_e:
+        if fallback_path:
+            try: os.remove(temp_path) # 逻辑备注: 清理编码中途写入的临时文件
+            except OSError: pass
+            written_path = os.fspath(fallback_path)
+            temp_path = f"{written_path}.{os.getpid()}.tmp"
+        error = f"重新编码失败，已保存原始数据到 '{os.path.basename(written_path)}': {encode_e}"
+        with open(temp_path, 'wb') as f:
+            f.write(raw_data)
+    # 逻辑备注: 先写临时文件再替换，目标若是其他文件的硬链接也不会被改写
+    os.replace(temp_path, written_path)
+    return len(raw_data), os.path.getsize(written_path), error, written_path
+
+
+class ImagePostprocessor:
+    """单次生成批次的后处理进程池 + 体积统计 (进程池在首次提交时创建)"""
+    def __init__(self, options, max_workers=DEFAULT_POSTPROCESS_WORKERS):
+        self.options = options
+        self.max_workers = max(1, int(max_workers))
+        self._executor = None
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def output_extension(self, original_ext):
+        return output_extension(self.options, original_ext)
+
+    def submit(self, source, target_path, fallback_path=None):
+        """提交一个编码任务 (source 为图片 bytes 或缓存文件路径，fallback_path 为编码失败时的原格式路径)，立即返回"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            future = self._executor.submit(encode_image_file, source, target_path, self.options, fallback_path)
+            self._futures.append((target_path, future))
+        return future
+
+    def shutdown(self):
+        """等待全部编码完成并关闭进程池，返回统计文本 (没有任务时返回 None)"""
+        with self._lock:
+            executor, futures = self._executor, list(self._futures)
+            self._executor = None; self._futures = []
+        if executor is None:
+            return None
+        original_total = 0; encoded_total = 0; done = 0; failed = 0
+        for target_path, future in futures:
+            try:
+                original_size, encoded_size, error, _ = future.result()
+            except Exception as post_e:
+                failed += 1
+                logger.error(f"图片后处理失败 '{target_path}': {post_e}") # 逻辑备注
+                continue
+            if error:
+                failed += 1
+                logger.warning(f"图片后处理 '{target_path}': {error}") # 逻辑备注
+            done += 1; original_total += original_size; encoded_total += encoded_size
+        executor.shutdown(wait=True)
+        saved_percent = (1 - encoded_total / original_total) * 100 if original_total else 0.0
+        summary = f"后处理 {done} 张: {original_total / 1048576:.1f} MB -> {encoded_total / 1048576:.1f} MB (节省 {saved_percent:.1f}%)"
+        if failed: summary += f"，{failed} 张失败"
+        return summary
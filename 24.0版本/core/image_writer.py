@@ -0,0 +1,122 @@
+# core/image_writer.py
+"""
+图片写入线程池。
+后端调用返回后，解码与写盘交给少量写入线程完成，生成线程立即释放后端节点；
+待写入任务数有上限 (有界队列)，超过时提交方阻塞，避免内存中堆积大量图片。
+文件名冲突通过共享的目录索引 (core.media_dir_index) 解决，不再反复探测磁盘。
+图片先写入临时文件再原子改名，中途崩溃不会留下写了一半的图片。
+"""
+import os # 功能性备注: 导入 os 库用于原子替换和清理临时文件
+import re # 功能性备注: 导入正则表达式模块，用于识别遗留的临时文件
+import shutil # 功能性备注: 导入 shutil 用于跨磁盘移动文件
+import threading # 功能性备注: 导入线程模块用于索引和队列同步
+import time # 功能性备注: 导入 time 库生成时间戳文件名
+from concurrent.futures import ThreadPoolExecutor # 功能性备注: 写入线程池
+import logging # 功能性备注: 导入日志模块
+from .media_dir_index import get_media_dir_index # 功能性备注: 导入共享的媒体目录索引
+
+# 功能性备注: 获取当前模块的 logger 实例
+logger = logging.getLogger(__name__)
+
+# 功能性备注: 默认写入线程数与最多排队的写入任务数
+DEFAULT_WRITER_WORKERS = 2
+DEFAULT_MAX_PENDING_WRITES = 8
+# 功能性备注: 写入临时文件的命名 (目标文件名.进程号.tmp)，与后处理进程池使用的格式相同
+_TEMP_FILE_PATTERN = re.compile(r"^.+\.(png|jpe?g|webp)\.\d+\.tmp$", re.IGNORECASE)
+
+
+def write_bytes_atomic(target_path, data):
+    """先写临时文件并落盘，再原子替换为目标文件"""
+    target_path = os.fspath(target_path)
+    temp_path = f"{target_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, target_path)
+    except BaseException:
+        try: os.remove(temp_path)
+        except OSError: pass
+        raise
+
+def move_file_atomic(source_path, target_path):
+    """把文件移动到目标位置：同一磁盘直接改名，跨磁盘时复制到临时文件再原子替换并删除源文件"""
+    try:
+        os.replace(source_path, target_path)
+        return
+    except OSError:
+        pass
+    temp_path = f"{os.fspath(target_path)}.{os.getpid()}.tmp"
+    shutil.copyfile(source_path, temp_path)
+    os.replace(temp_path, target_path)
+    os.remove(source_path)
+
+def remove_stale_temp_files(directory):
+    """删除上次运行中断后遗留的图片临时文件，返回删除的数量"""
+    removed = 0
+    try:
+        with os.scandir(directory) as entries:
+            stale = [entry.path for entry in entries if entry.is_file() and _TEMP_FILE_PATTERN.match(entry.name)]
+    except OSError:
+        return 0
+    for path in stale:
+        try:
+            os.remove(path); removed += 1
+        except OSError as remove_e:
+            logger.warning(f"删除遗留临时文件失败 '{path}': {remove_e}") # 逻辑备注
+    return removed
+
+
+class ImageWriterPool:
+    """单个保存目录的写入线程池 + 文件名预留索引"""
+    def __init__(self, base_save_path, max_workers=DEFAULT_WRITER_WORKERS, max_pending=DEFAULT_MAX_PENDING_WRITES):
+        self.base_save_path = base_save_path
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ImageWriter")
+        self._slots = threading.BoundedSemaphore(max_pending) # 功能性备注: 有界队列
+        self._lock = threading.Lock()
+        self._index = get_media_dir_index(base_save_path) # 功能性备注: 目录中已存在的文件名
+        self._index_checked = False
+        self._reserved = set() # 功能性备注: 本次运行已预留的文件名 (casefold)，目录重新列出时也不会丢失
+
+    def _is_taken(self, name):
+        """文件名是否已存在或已预留 (调用方需持有 self._lock)"""
+        if not self._index_checked:
+            self._index.refresh() # 逻辑备注: 首次预留时按目录修改时间检查一次索引是否过期
+            self._index_checked = True
+        return name.casefold() in self._reserved or self._index.exists(name)
+
+    def reserve(self, stem, ext):
+        """
+        预留一个不冲突的目标路径：优先 stem+ext，已存在时附加时间戳 (仍冲突再附加序号)。
+        返回 (目标路径, 是否因冲突改名)。
+        """
+        with self._lock:
+            candidate = f"{stem}{ext}"
+            renamed = False
+            if self._is_taken(candidate):
+                renamed = True
+                timestamp = time.strftime("%Y%m%d_%H%M%S")
+                candidate = f"{stem}_{timestamp}{ext}"
+                counter = 2
+                while self._is_taken(candidate):
+                    candidate = f"{stem}_{timestamp}_{counter}{ext}"
+                    counter += 1
+            self._reserved.add(candidate.casefold())
+            self._index.add(candidate)
+            return self.base_save_path.joinpath(candidate), renamed
+
+    def submit(self, fn, *args, **kwargs):
+        """提交写入任务 (队列已满时阻塞)，返回 Future"""
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _f: self._slots.release())
+        return future
+
+    def shutdown(self, wait=True):
+        """等待已提交的写入完成并关闭线程池"""
+        self._executor.shutdown(wait=wait)
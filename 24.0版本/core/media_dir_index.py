@@ -0,0 +1,99 @@
+# core/media_dir_index.py
+"""
+媒体保存目录 (imageSaveDir / naiImageSaveDir / audioSaveDir) 的文件名索引。
+首次使用时列出一次目录；之后 refresh() 只检查目录的修改时间，有文件增删改名时才重新列出，
+查询 (按文件名或主文件名) 只访问内存，不再对每个文件调用 exists()/stat。
+同一目录在进程内共享一个索引 (get_media_dir_index)，弹窗和生成任务看到的是同一份数据。
+"""
+import os # 功能性备注: 导入 os 库用于列出目录
+import threading # 功能性备注: 导入线程模块，多个工作线程共享索引
+import logging # 功能性备注: 导入日志模块
+
+# 功能性备注: 获取当前模块的 logger 实例
+logger = logging.getLogger(__name__)
+
+
+class MediaDirIndex:
+    """单个目录的文件名索引 (不区分大小写，兼容 Windows/macOS 文件系统)"""
+    def __init__(self, directory):
+        self.directory = os.fspath(directory)
+        self._lock = threading.Lock()
+        self._names = {} # 功能性备注: {文件名 casefold: 实际文件名}
+        self._stems = {} # 功能性备注: {主文件名 casefold: {实际文件名}}
+        self._dir_mtime = None # 功能性备注: 上次列出目录时目录的修改时间 (None 表示尚未列出)
+
+    def refresh(self, force=False):
+        """目录修改时间变化 (或 force) 时重新列出目录；返回是否重新列出"""
+        try:
+            dir_mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            dir_mtime = -1 # 逻辑备注: 目录不存在时视为空目录
+        with self._lock:
+            if not force and self._dir_mtime == dir_mtime:
+                return False
+            names = {}
+            if dir_mtime != -1:
+                try:
+                    with os.scandir(self.directory) as entries:
+                        for entry in entries:
+                            names[entry.name.casefold()] = entry.name
+                except OSError as scan_e:
+                    logger.warning(f"列出媒体目录失败 '{self.directory}': {scan_e}") # 逻辑备注
+            self._names = names
+            self._stems = {}
+            for name in names.values():
+                self._stems.setdefault(os.path.splitext(name)[0].casefold(), set()).add(name)
+            self._dir_mtime = dir_mtime
+            logger.debug(f"媒体目录索引已更新: '{self.directory}' ({len(names)} 个文件)") # 功能性备注 (调试)
+            return True
+
+    def _ensure_loaded(self):
+        """尚未列出过目录时列出一次"""
+        if self._dir_mtime is None:
+            self.refresh()
+
+    def exists(self, filename):
+        """目录中是否已有该文件名"""
+        self._ensure_loaded()
+        with self._lock:
+            return filename.casefold() in self._names
+
+    def find_by_stem(self, stem):
+        """按主文件名 (不含扩展名) 查找，返回实际文件名列表 (已排序)"""
+        self._ensure_loaded()
+        with self._lock:
+            return sorted(self._stems.get(stem.casefold(), ()))
+
+    def find_asset(self, filename):
+        """
+        查找脚本中引用的文件实际保存的文件名：依次尝试原文件名、去掉末尾 _数字 的文件名、以及其 _1 版本。
+        返回实际文件名，找不到时返回 None。
+        """
+        self._ensure_loaded()
+        stem, ext = os.path.splitext(filename)
+        base_stem = stem
+        if (parts := stem.rsplit('_', 1)) and len(parts) == 2 and parts[1].isdigit():
+            base_stem = parts[0]
+        with self._lock:
+            for candidate in (filename, f"{base_stem}{ext}", f"{base_stem}_1{ext}"):
+                if (actual := self._names.get(candidate.casefold())):
+                    return actual
+        return None
+
+    def add(self, filename):
+        """记录本进程新写入的文件 (无需等待下次重新列出)"""
+        with self._lock:
+            self._names[filename.casefold()] = filename
+            self._stems.setdefault(os.path.splitext(filename)[0].casefold(), set()).add(filename)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_media_dir_index(directory):
+    """获取目录对应的共享索引 (按规范化的绝对路径区分)"""
+    key = os.path.normcase(os.path.abspath(os.fspath(directory)))
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = MediaDirIndex(directory)
+        return _indexes[key]
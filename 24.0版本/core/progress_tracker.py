@@ -0,0 +1,160 @@
+# core/progress_tracker.py
+"""
+批量生成的进度模型。
+记录每个进行中任务的状态 (排队 / 生成中 + 采样步数)，按节点推算排队位置，
+并根据已完成任务的实际耗时估算整批剩余时间；汇总文本通过回调推送给 UI，推送频率有上限。
+"""
+import threading # 功能性备注: 导入线程模块，多个工作线程共享进度模型
+import time # 功能性备注: 导入 time 库用于计时
+import logging # 功能性备注: 导入日志模块
+
+# 功能性备注: 获取当前模块的 logger 实例
+logger = logging.getLogger(__name__)
+
+# 功能性备注: 默认参数
+DEFAULT_MIN_PUSH_INTERVAL = 1.0 # 功能性备注: 两次推送之间的最短间隔 (秒)
+MAX_TASKS_IN_STATUS = 3 # 功能性备注: 状态文本中最多列出的进行中任务数
+
+
+def format_duration(seconds):
+    """把秒数格式化为简短的中文时长"""
+    seconds = max(0, int(round(seconds)))
+    if seconds >= 3600: return f"{seconds // 3600}小时{seconds % 3600 // 60:02d}分"
+    if seconds >= 60: return f"{seconds // 60}分{seconds % 60:02d}秒"
+    return f"{seconds}秒"
+
+
+class BatchProgressTracker:
+    """单次批量生成的进度：任务级状态 + 整批完成数与预计剩余时间"""
+    def __init__(self, total, callback=None, min_interval=DEFAULT_MIN_PUSH_INTERVAL, extra_info=None):
+        self.total = total
+        self.callback = callback # 功能性备注: callback(text)，在工作线程中调用
+        self.min_interval = min_interval
+        self.extra_info = extra_info # 功能性备注: 可选，返回附加在状态末尾的文本 (例如节点并发上限)
+        self.finished = 0
+        self.failed = 0
+        self._active = {} # 功能性备注: {任务键: {"label", "endpoint", "since", "running", "step", "steps"}}
+        self._servers = {} # 功能性备注: {节点: (step, steps)}，节点正在执行的不属于本批次的任务
+        self._batch_start = None
+        self._last_push = 0.0
+        self._trailing_timer = None # 功能性备注: 被限流的更新的补推定时器
+        self._lock = threading.Lock()
+
+    # --- 任务事件 (工作线程调用) ---
+    def task_started(self, key, label, endpoint=None):
+        """任务已分配到节点并发出请求 (在服务器开始执行前视为排队)"""
+        with self._lock:
+            now = time.time()
+            if self._batch_start is None: self._batch_start = now
+            self._active[key] = {"label": label, "endpoint": endpoint, "since": now, "running": False, "step": 0, "steps": 0}
+        self._push()
+
+    def task_running(self, key):
+        """服务器开始执行该任务"""
+        with self._lock:
+            if (info := self._active.get(key)) is None or info["running"]: return
+            info["running"] = True
+        self._push()
+
+    def task_step(self, key, step, steps):
+        """采样进度 (step/steps)"""
+        with self._lock:
+            if (info := self._active.get(key)) is None: return
+            info["running"] = True; info["step"] = int(step); info["steps"] = int(steps)
+        self._push()
+
+    def server_step(self, endpoint, step, steps):
+        """节点正在执行其他任务 (不属于本批次或无法对应到任务) 的采样进度；steps 为 0 时清除"""
+        with self._lock:
+            if steps: self._servers[endpoint] = (int(step), int(steps))
+            elif self._servers.pop(endpoint, None) is None: return
+        self._push()
+
+    def task_finished(self, key, status):
+        """任务结束 (status 为 "success" / "failed")"""
+        with self._lock:
+            self._active.pop(key, None)
+            self.finished += 1
+            if status != "success": self.failed += 1
+            is_last = self.finished >= self.total
+        self._push(force=is_last)
+
+    # --- 查询 ---
+    def active_tasks(self, endpoint=None):
+        """进行中的任务键 (按发出请求的先后排序)，可按节点过滤"""
+        with self._lock:
+            items = [(info["since"], key) for key, info in self._active.items() if endpoint is None or info["endpoint"] == endpoint]
+        return [key for _, key in sorted(items, key=lambda item: item[0])]
+
+    def active_endpoints(self):
+        """有进行中任务的节点"""
+        with self._lock:
+            return {info["endpoint"] for info in self._active.values() if info["endpoint"]}
+
+    def status_text(self):
+        """汇总文本：完成数、进行中任务的步数/排队位置、每张耗时与预计剩余时间"""
+        with self._lock:
+            finished, failed, total = self.finished, self.failed, self.total
+            active = sorted(self._active.values(), key=lambda info: info["since"])
+            batch_start = self._batch_start
+            servers = sorted(self._servers.items())
+        parts = [f"进度 {finished}/{total}" + (f"，失败 {failed}" if failed else "")]
+
+        # 功能性备注: 进行中的任务 (排队位置按同一节点上更早发出且尚未执行的任务数计算)
+        task_texts = []
+        queued_per_endpoint = {}
+        for info in active:
+            if info["running"]:
+                task_texts.append(f"{info['label']} {info['step']}/{info['steps']}" if info["steps"] else f"{info['label']} 生成中")
+            else:
+                position = queued_per_endpoint.get(info["endpoint"], 0) + 1
+                queued_per_endpoint[info["endpoint"]] = position
+                task_texts.append(f"{info['label']} 排队 #{position}")
+        if task_texts:
+            shown = task_texts[:MAX_TASKS_IN_STATUS]
+            if len(task_texts) > MAX_TASKS_IN_STATUS: shown.append(f"等 {len(task_texts)} 个")
+            parts.append("，".join(shown))
+        # 功能性备注: 节点正在执行的其他任务 (本批次的请求在其后排队)
+        if servers:
+            parts.append("，".join(f"{endpoint} 执行其他任务 {step}/{steps}" for endpoint, (step, steps) in servers))
+
+        if finished and batch_start is not None:
+            per_task = (time.time() - batch_start) / finished
+            eta_text = f"每张约 {per_task:.1f}s"
+            if finished < total: eta_text += f"，预计剩余 {format_duration(per_task * (total - finished))}"
+            parts.append(eta_text)
+        if self.extra_info:
+            try:
+                if extra := self.extra_info(): parts.append(f"({extra})")
+            except Exception as extra_e:
+                logger.debug(f"获取进度附加信息出错: {extra_e}") # 逻辑备注
+        return " | ".join(parts)
+
+    def _push(self, force=False):
+        """按频率上限把汇总文本推送给回调；被限流的更新在间隔结束时补推一次"""
+        if not self.callback: return
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_push < self.min_interval:
+                if self._trailing_timer is None:
+                    self._trailing_timer = threading.Timer(self.min_interval - (now - self._last_push), self._push_trailing)
+                    self._trailing_timer.daemon = True
+                    self._trailing_timer.start()
+                return
+            self._last_push = now
+        try:
+            self.callback(self.status_text())
+        except Exception as cb_e:
+            logger.warning(f"进度回调出错: {cb_e}") # 逻辑备注
+
+    def _push_trailing(self):
+        """补推定时器到期"""
+        with self._lock:
+            self._trailing_timer = None
+        self._push(force=True)
+
+    def close(self):
+        """批次结束：取消尚未执行的补推"""
+        with self._lock:
+            timer, self._trailing_timer = self._trailing_timer, None
+        if timer: timer.cancel()
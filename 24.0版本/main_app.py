@@ -2,6 +2,7 @@
 import customtkinter as ctk
 from tkinter import messagebox, BooleanVar, StringVar, filedialog # 功能性备注: 导入 filedialog
 import threading
+import multiprocessing # 功能性备注: 图片后处理使用进程池，打包运行时需要 freeze_support
 import queue # 功能性备注: 导入 queue 用于日志和结果处理
 import os
 import sys
@@ -857,6 +858,7 @@ class NovelConverterApp(ctk.CTk):
 # --- 程序入口 ---
 # 功能性备注: 保持不变
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # 功能性备注: 打包后的程序中，进程池的子进程从这里返回
     # 确保目录存在 (使用 logging 记录)
     try:
         config_manager._ensure_config_dir()
@@ -3,100 +3,74 @@ import re # 功能性备注: 导入正则表达式模块，用于解析 KAG 脚
 import os # 功能性备注: 导入操作系统模块，用于路径操作和文件检查
 import time # 功能性备注: 导入时间模块，用于生成时间戳和添加延时
 import zipfile # 功能性备注: 导入 zipfile 模块，用于处理 NAI 返回的 Zip 文件
+import shutil # 功能性备注: 导入 shutil，用固定大小的缓冲区把 Zip 中的图片解压到暂存文件
 import io # 功能性备注: 导入 io 模块，用于内存中的字节流操作
 import base64 # 功能性备注: 导入 base64 模块，用于图像数据的编码和解码
 from pathlib import Path # 功能性备注: 导入 Path 对象，用于更方便地处理文件路径
-import copy # 功能性备注: 导入 copy 模块，用于深拷贝工作流字典
 import json # 功能性备注: 导入 json 模块，用于加载和保存 JSON 数据（例如 ComfyUI 工作流）
-import uuid # 功能性备注: 导入 uuid 模块，用于生成 ComfyUI 的客户端 ID
 import logging # 功能性备注: 导入日志模块
 import random # 功能性备注: 导入 random 模块用于生成随机种子
+import threading # 功能性备注: 导入线程模块，用于保存图片时的互斥
+import uuid # 功能性备注: 导入 uuid 库，为服务器端保存的图片生成唯一文件名标记
+from urllib.parse import urlparse # 功能性备注: 导入 URL 解析函数，用于判断 SD 节点是否在本机
+from PIL import Image # 功能性备注: 导入 Pillow，用于缩小过大的图生图参考图
+from concurrent.futures import ThreadPoolExecutor, Future # 功能性备注: 导入线程池，用于多后端节点并行执行任务
 
-# 功能性备注: 导入 ComfyUI API 助手中定义的上传函数
-from api.comfyui_api_helper import upload_image_to_comfyui
+# 功能性备注: 导入带缓存的 ComfyUI 上传函数 (同一张参考图/蒙版每个服务器只上传一次)
+from api.comfyui_upload_cache import get_comfyui_upload_cache, upload_image_to_comfyui_cached
+# 功能性备注: 导入预编译工作流模板，节点标题只解析一次
+from api.comfyui_workflow_template import ComfyUIWorkflowTemplate, WorkflowPatch, fuse_workflows
+# 功能性备注: 导入 /object_info 缓存与工作流预检 (批次开始前校验节点类型、模型和 LoRA 名称)
+from api.comfyui_object_info import get_comfyui_object_info, validate_workflow, combo_options
+# 功能性备注: 导入后端节点池，用于在多个 SD WebUI / ComfyUI 服务器间分配任务
+from core.backend_pool import BackendPool, BackendEndpoint, parse_endpoint_list
+from core.concurrency_controller import is_overload_error, DEFAULT_ADAPTIVE_MAX_CONCURRENCY
+# 功能性备注: 导入已生成图片缓存 (固定种子时按生成参数复用图片)
+# 功能性备注: 导入图片写入线程池 (解码与写盘不占用后端节点)
+from core.image_writer import ImageWriterPool, write_bytes_atomic, move_file_atomic, remove_stale_temp_files
+from core.generation_journal import GenerationJournal, task_journal_key # 功能性备注: 导入生成日志 (逐张记录已完成的图片，用于续传)
+from core.media_dir_index import get_media_dir_index # 功能性备注: 导入媒体目录索引，续传时检查日志中的文件是否仍存在
+from core.utils import replace_kag_placeholders # 功能性备注: 导入图片占位符替换 (推测生成时按相同规则编排文件名)
+from core.image_postprocess import ImagePostprocessor, postprocess_options_from_config, DEFAULT_POSTPROCESS_WORKERS # 功能性备注: 导入保存后处理 (重新编码) 进程池
+from core.progress_tracker import BatchProgressTracker # 功能性备注: 导入批量进度模型 (步数、排队位置、预计剩余时间)
+from core.generated_image_cache import get_generated_image_cache, make_cache_key, materialize_cached_file, DEFAULT_IMAGE_CACHE_MAX_MB
 
 # 功能性备注: 获取当前模块的 logger 实例
 logger = logging.getLogger(__name__)
 
-# --- 辅助函数 ---
-def _find_node_id_by_title(workflow, title):
-    """
-    在工作流字典中根据节点标题查找节点 ID 和数据 (增强健壮性)。
-    无论是否找到，都返回两个值 (node_id, node_data) 或 (None, None)。
-    """
-    # 逻辑备注: 检查输入标题和工作流数据的有效性
-    if not title:
-        return None, None
-    if not workflow or not isinstance(workflow, dict):
-        logger.warning(f"(_find_node_id_by_title): 工作流数据无效或为空 (类型: {type(workflow)})。") # 逻辑备注
-        return None, None
-
-    # 逻辑备注: 遍历工作流字典查找匹配的节点
-    for node_id, node_data in workflow.items():
-        # 逻辑备注: 增加更严格的检查，确保 node_data 和 _meta 结构符合预期
-        if isinstance(node_data, dict) and \
-           "_meta" in node_data and \
-           isinstance(node_data.get("_meta"), dict) and \
-           "title" in node_data["_meta"] and \
-           node_data["_meta"].get("title") == title:
-            # 功能性备注: 找到了匹配的节点
-            return node_id, node_data # 返回 ID 和节点数据
-
-    # 逻辑备注: 如果循环结束还没找到
-    logger.warning(f"(_find_node_id_by_title): 未能在工作流中找到标题为 '{title}' 的节点。") # 逻辑备注
-    return None, None # 确保在找不到时也返回两个 None
-
-def _set_node_input(node_data, input_name, value):
-    """安全地设置节点输入值"""
-    # 逻辑备注: 检查节点数据和 inputs 键是否存在
-    if isinstance(node_data, dict) and 'inputs' in node_data:
-        # 逻辑备注: 如果输入值为 None，则尝试从节点输入中移除该键（使用 ComfyUI 默认值）
-        if value is None:
-             if input_name in node_data['inputs']:
-                 logger.info(f"    - 输入值 '{input_name}' 为 None，将从节点输入中移除（使用默认）。") # 功能性备注
-                 del node_data['inputs'][input_name]
-             else:
-                 logger.info(f"    - 输入值 '{input_name}' 为 None 且节点无此输入，跳过。") # 功能性备注
-             return True
-        else:
-            # 逻辑备注: 设置或更新节点输入值
-            node_data['inputs'][input_name] = value
-            return True
-    # 逻辑备注: 记录设置失败的警告
-    logger.warning(f"    - 无法设置节点输入 '{input_name}'，节点数据无效或缺少 'inputs' 键。 Node Data: {str(node_data)[:100]}...") # 逻辑备注
-    return False
+# 功能性备注: 用户停止任务时使用的统一错误信息
+STOPPED_MESSAGE = "任务被用户停止"
+# 功能性备注: NAI 没有多节点概念，使用一个虚拟节点 (默认并发 1，启用自适应并发时按 429 响应自动调整)
+NAI_ENDPOINT_URL = "https://image.novelai.net"
+# 功能性备注: NAI 两次请求开始之间的最小间隔 (秒)，由节点池限速，代替调用后的固定等待
+NAI_MIN_REQUEST_INTERVAL = 1.0
+# 功能性备注: 后端过载 (429/超时) 时单个任务额外的重试次数
+OVERLOAD_MAX_RETRIES = 2
+# 功能性备注: 每个 ComfyUI 服务器上最多排队的 prompt 数 (含正在执行的，0 表示不限制)
+DEFAULT_COMFY_MAX_QUEUED = 2
+# 功能性备注: SD WebUI 服务器端保存模式的默认暂存目录名 (位于图片保存目录下)
+SD_SERVER_SAVE_SUBDIR = ".sd_server_output"
+_LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1", "0.0.0.0"}
+# 功能性备注: NAI Zip 中的图片解压到的暂存目录名 (位于图片保存目录下，与目标文件同一磁盘，移动时只是改名)，以及解压缓冲区大小
+NAI_STAGING_SUBDIR = ".nai_staging"
+NAI_EXTRACT_BUFFER_SIZE = 1024 * 1024
+# 功能性备注: SD WebUI 进度轮询间隔 (秒)
+SD_PROGRESS_POLL_INTERVAL = 1.0
+# 功能性备注: 等待 SD WebUI 响应期间检查本请求是否已在停止时被放弃的间隔 (秒)
+SD_ABANDON_CHECK_INTERVAL = 0.2
+# 功能性备注: 需要在 ComfyUI 工作流中按标题解析的节点 (配置键 -> 配置缺失时的默认标题)
+COMFY_NODE_TITLE_KEYS = {
+    "comfyOutputNodeTitle": None, "comfyPositiveNodeTitle": None, "comfyNegativeNodeTitle": None,
+    "comfySamplerNodeTitle": None, "comfyLatentImageNodeTitle": None, "comfyCheckpointNodeTitle": None,
+    "comfyVAENodeTitle": None, "comfyClipTextEncodeNodeTitle": None, "comfyLoraLoaderNodeTitle": None,
+    "comfyLoadImageNodeTitle": None, "comfyLoadMaskNodeTitle": "Load_Mask_Image",
+    "comfyFaceDetailerNodeTitle": None, "comfyTilingSamplerNodeTitle": None,
+    "comfyWebsocketSaveNodeTitle": None,
+}
 
-# --- 主任务函数 ---
-def task_generate_images(api_helpers, api_type, shared_config, specific_config, kag_script, generation_options, use_img2img_toggle, character_profiles, stop_event=None): # 功能性备注: 添加 stop_event 参数
-    """
-    后台任务：解析 KAG 脚本中的任务，调用所选 API 生成图片（支持文生图/图生图/内绘/LoRA），
-    并在成功后取消对应 image 标签的注释。
-    如果目标文件已存在，则在文件名后附加时间戳。
-    """
-    # --- 获取调试开关 ---
-    save_debug = False
-    # 逻辑备注: 根据 API 类型确定使用哪个配置中的调试开关
-    if api_type == "NAI":
-        save_debug = specific_config.get('saveNaiDebugInputs', False)
-    elif api_type in ["SD WebUI", "ComfyUI"]:
-        save_debug = shared_config.get('saveImageDebugInputs', False)
-    logger.info(f"执行图片生成后台任务 ({api_type})... Options: {generation_options}, Img2Img Toggle: {use_img2img_toggle}, Save Debug: {save_debug}") # 功能性备注
-
-    # 功能性备注: 获取生成范围和指定文件名
-    scope = generation_options.get('scope', 'all') # 逻辑修改: 默认值改为 'all' 或根据 UI 默认值调整
-    specific_files_str = generation_options.get('specific_files', '')
-    n_samples = max(1, generation_options.get('n_samples', 1)) # 功能性备注: 获取生成数量，至少为 1
-
-    target_files = set()
-    # 逻辑备注: 如果是指定范围，解析文件名列表
-    if scope == 'specific':
-        target_files = set(f.strip() for f in specific_files_str.split(',') if f.strip())
-        if not target_files:
-            # 逻辑备注: 如果范围是 'specific' 但未指定文件名，则返回错误
-            logger.error("选择了“指定”范围但未提供有效的文件名。") # 逻辑备注
-            return {"message": "错误：选择了“指定”范围但未提供有效的文件名。", "details": [], "modified_script": kag_script}, None
-
-    # --- 解析 KAG 脚本中的图片生成任务 (逻辑修改: 识别注释和非注释标签) ---
+# --- 辅助函数 ---
+def _parse_image_tasks(kag_script, api_type):
+    """解析 KAG 脚本中的图片生成任务 (包括已生成和未生成的)，按脚本顺序返回任务列表"""
     # 逻辑修改: 正则表达式现在捕获可选的分号，并记录是否被注释
     pattern = re.compile(
         r"^\s*(;\s*(?:(NAI)|(IMG))\s+Prompt for\s*(.*?):\s*Positive=\[(.*?)\](?:\s*Negative=\[(.*?)\])?)\s*$\n" # NAI 或 IMG 行
@@ -162,15 +136,1470 @@ def task_generate_images(api_helpers, api_type, shared_config, specific_config,
              # 逻辑备注: 打印警告，跳过无效或格式不匹配的任务
              logger.warning(f"({api_type}): 跳过无效或格式不匹配的任务。文件名: '{filename}', 完整图片行: '{full_image_line[:50]}...'") # 逻辑备注
     logger.info(f"[{api_type} Gen] 解析完成，共找到 {len(all_tasks)} 个潜在任务。") # 功能性备注
+    return all_tasks
+
+def _task_affinity_key(task, character_profiles, use_img2img_toggle):
+    """
+    任务的模型亲和键: (LoRA 组合, 文生图/图生图/内绘)。
+    键相同的任务在后端使用相同的权重，连续执行可避免反复加载/卸载 LoRA。
+    (模型和 VAE 在一次运行中由配置统一决定，不需要区分。)
+    """
+    profile_data = character_profiles.get(task['name'])
+    if not isinstance(profile_data, dict):
+        return ((), "txt2img")
+    loras = profile_data.get("loras", [])
+    lora_key = tuple(sorted(
+        (str(lora.get("name")), lora.get("model_weight", 1.0), lora.get("clip_weight", 1.0))
+        for lora in (loras if isinstance(loras, list) else []) if isinstance(lora, dict) and lora.get("name")
+    ))
+    mode = "txt2img"
+    image_path = str(profile_data.get("image_path", "")).strip()
+    if use_img2img_toggle and image_path and os.path.exists(image_path):
+        mask_path = str(profile_data.get("mask_path", "")).strip()
+        mode = "inpaint" if mask_path and os.path.exists(mask_path) else "img2img"
+    return (lora_key, mode)
+
+def _plan_task_order(affinity_keys):
+    """
+    按亲和键分组重排任务的执行顺序 (组按在脚本中首次出现的顺序，组内保持脚本顺序)。
+    返回任务下标列表；结果仍按原下标 (脚本顺序) 汇总。
+    """
+    groups = {}
+    for index, key in enumerate(affinity_keys):
+        groups.setdefault(key, []).append(index)
+    return [index for group in groups.values() for index in group]
+
+class _Base64Image(str):
+    """尚未解码的 Base64 图片 (由写入线程解码)"""
+
+class _StagedImage(str):
+    """已在磁盘上的暂存图片路径 (SD WebUI 服务器端保存、NAI Zip 解压)，由写入线程移动到目标位置"""
+
+def _remove_staged_file(path):
+    """删除暂存文件 (已不需要时)"""
+    try: os.remove(path)
+    except OSError: pass
+
+def _clear_staging_dir(staging_dir):
+    """删除暂存目录中遗留的文件 (例如上次运行中断时未移动的图片) 并删除空目录"""
+    try:
+        with os.scandir(staging_dir) as entries:
+            leftovers = [entry.path for entry in entries if entry.is_file()]
+    except OSError:
+        return
+    for path in leftovers: _remove_staged_file(path)
+    try: os.rmdir(staging_dir)
+    except OSError: pass
+
+class _Img2ImgInputCache:
+    """
+    单次运行内的图生图输入缓存 (NAI / SD WebUI)。
+    以 (路径, 修改时间, 目标尺寸, 是否蒙版) 为键：每张参考图/蒙版只读取、(按需) 缩小并编码一次，
+    之后所有任务共享同一个 Base64 字符串。
+    """
+    def __init__(self, target_size=None):
+        self.target_size = target_size # 功能性备注: (宽, 高)；为 None 时不缩小，直接编码原文件
+        self._lock = threading.Lock()
+        self._entries = {} # 功能性备注: 键 -> Base64 字符串
+
+    def get_b64(self, path, is_mask=False):
+        """返回文件的 Base64 编码 (必要时先缩小)，读取失败时抛出异常"""
+        key = (os.path.abspath(path), os.stat(path).st_mtime_ns, self.target_size, is_mask)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None:
+                return cached
+            # 逻辑备注: 在锁内编码，避免多个工作线程同时处理同一张大图
+            encoded = base64.b64encode(self._load_bytes(path, is_mask)).decode('utf-8')
+            self._entries[key] = encoded
+            return encoded
+
+    def _load_bytes(self, path, is_mask):
+        """读取文件；图片大于目标尺寸时等比缩小 (仍覆盖目标宽高) 并重新编码为 PNG"""
+        with open(path, "rb") as f:
+            raw_bytes = f.read()
+        if not self.target_size:
+            return raw_bytes
+        target_w, target_h = self.target_size
+        try:
+            with Image.open(io.BytesIO(raw_bytes)) as img:
+                scale = max(target_w / img.width, target_h / img.height)
+                if scale >= 1.0:
+                    return raw_bytes # 逻辑备注: 不比目标大，原样发送
+                new_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+                # 逻辑备注: 蒙版使用最近邻插值，保持黑白边界
+                resample = Image.NEAREST if is_mask else Image.LANCZOS
+                resized = img.resize(new_size, resample)
+                buffer = io.BytesIO()
+                resized.save(buffer, format="PNG")
+        except (OSError, ValueError) as resize_e:
+            logger.warning(f"  - 无法缩小图生图输入 '{os.path.basename(path)}'，将发送原图: {resize_e}") # 逻辑备注
+            return raw_bytes
+        logger.info(f"  - 图生图输入 '{os.path.basename(path)}' 已从 {img.width}x{img.height} 缩小到 {new_size[0]}x{new_size[1]} ({len(raw_bytes)} -> {buffer.tell()} 字节)。") # 功能性备注
+        return buffer.getvalue()
+
+def _sd_model_matches(current, desired):
+    """SD 模型名称是否一致 (服务器返回的标题可能带 [hash] 后缀或子目录)"""
+    if not current or not desired: return False
+    current_name = str(current).split(' [')[0].replace('\\', '/'); desired_name = str(desired).split(' [')[0].replace('\\', '/')
+    return current == desired or current_name == desired_name or current_name.endswith('/' + desired_name)
+
+class _SdOptionsSession:
+    """
+    单次运行内的 SD WebUI 模型/VAE/CLIP Skip 设置管理 (sdOverrideMode)。
+    "sticky": 每个节点在第一个任务前通过 /sdapi/v1/options 设置一次并核对当前模型，之后的请求不再带 override_settings；
+    "no_restore": 请求仍带 override_settings，但设置 override_settings_restore_afterwards=false，避免每次请求后恢复；
+    "per_request": 保持旧行为 (每次请求覆盖并在请求后恢复)。
+    前两种模式在运行结束时把各节点恢复为运行前的设置。
+    """
+    def __init__(self, mode):
+        self.mode = mode if mode in ("sticky", "no_restore", "per_request") else "sticky"
+        self._lock = threading.Lock()
+        self._endpoint_locks = {}
+        self._originals = {} # 功能性备注: {节点地址: 运行前的设置 (仅本次修改的键)}
+        self._applied = {} # 功能性备注: {节点地址: sticky 设置是否已生效}
+
+    def prepare(self, api_helpers, endpoint_url, options):
+        """
+        在节点的第一个任务前调用：记录原始设置，sticky 模式下写入并核对。
+        返回 True 表示设置已在服务器端生效，请求中无需再带 override_settings。
+        """
+        if self.mode == "per_request":
+            return False
+        with self._lock:
+            endpoint_lock = self._endpoint_locks.setdefault(endpoint_url, threading.Lock())
+        with endpoint_lock:
+            if endpoint_url in self._applied:
+                return self._applied[endpoint_url]
+            applied = False
+            current_options, options_error = api_helpers.get_sd_options(endpoint_url)
+            if options_error:
+                logger.warning(f"  - 无法读取 SD WebUI 当前设置 ({endpoint_url})，改为每次请求覆盖设置: {options_error}") # 逻辑备注
+            else:
+                self._originals[endpoint_url] = {key: current_options.get(key) for key in options if key in current_options}
+                if self.mode == "sticky":
+                    applied = self._apply(api_helpers, endpoint_url, options, current_options)
+            self._applied[endpoint_url] = applied
+            return applied
+
+    def _apply(self, api_helpers, endpoint_url, options, current_options):
+        """写入设置并核对当前模型 (调用方需持有该节点的锁)"""
+        changed = {key: value for key, value in options.items()
+                   if not (key == "sd_model_checkpoint" and _sd_model_matches(current_options.get(key), value)) and current_options.get(key) != value}
+        if changed:
+            logger.info(f"  - SD WebUI 节点 {endpoint_url} 本批次固定设置: {changed}") # 功能性备注
+            success, set_error = api_helpers.set_sd_options(endpoint_url, changed)
+            if not success:
+                logger.warning(f"  - 设置 SD WebUI 全局选项失败，改为每次请求覆盖设置: {set_error}") # 逻辑备注
+                return False
+        # 逻辑备注: 核对服务器当前加载的模型，防止名称拼写不符导致静默使用了其他模型
+        if desired_model := options.get("sd_model_checkpoint"):
+            current_model, model_error = api_helpers.get_sd_current_model(endpoint_url)
+            if model_error or not _sd_model_matches(current_model, desired_model):
+                logger.warning(f"  - SD WebUI 节点 {endpoint_url} 当前模型 '{current_model}' 与目标 '{desired_model}' 不一致，改为每次请求覆盖设置。") # 逻辑备注
+                return False
+        return True
+
+    def restore_all(self, api_helpers):
+        """运行结束：把修改过的节点恢复为运行前的设置"""
+        for endpoint_url, original_options in list(self._originals.items()):
+            if not original_options:
+                continue
+            current_options, options_error = api_helpers.get_sd_options(endpoint_url)
+            to_restore = {key: value for key, value in original_options.items() if options_error or current_options.get(key) != value}
+            if not to_restore:
+                continue
+            logger.info(f"恢复 SD WebUI 节点 {endpoint_url} 的原始设置: {list(to_restore.keys())}") # 功能性备注
+            success, restore_error = api_helpers.set_sd_options(endpoint_url, to_restore)
+            if not success:
+                logger.warning(f"恢复 SD WebUI 原始设置失败 ({endpoint_url}): {restore_error}") # 逻辑备注
+        self._originals.clear()
+
+def _prepare_task_inputs(task, api_type, shared_config, specific_config, character_profiles, use_img2img_toggle, img2img_cache=None):
+    """
+    读取任务对应的人物设定，确定 LoRA、图生图/内绘输入和种子。
+    img2img_cache 为本次运行共享的 _Img2ImgInputCache (为 None 时每次直接读取编码)。
+    返回包含这些信息的字典 (与具体后端节点无关，重新排队时可复用)。
+    """
+    inputs = {
+        "loras": [], # 功能性备注: 存储当前任务应用的 LoRA
+        "is_img2img": False, # 功能性备注: 标记当前任务是否执行图生图
+        "init_image_path": None, "init_image_b64": None,
+        "mask_path": None, "mask_b64": None,
+        "seed": -1,
+        "seed_fixed": False, # 功能性备注: 种子是否由配置固定 (只有固定种子的任务才使用图片缓存)
+        "cache_key": None, # 功能性备注: 本次调用的图片缓存键，由各后端的执行函数设置
+    }
+    if img2img_cache is None: img2img_cache = _Img2ImgInputCache()
+
+    # 功能性备注: 获取当前任务对应的人物设定数据
+    profile_data = character_profiles.get(task['name'])
+    if isinstance(profile_data, dict):
+        task_loras = profile_data.get("loras", []) # 获取 LoRA 列表
+        inputs["loras"] = task_loras if isinstance(task_loras, list) else [] # 确保是列表
+    else:
+        profile_data = {} # 如果找不到人物，则为空字典
+
+    # 功能性备注: 检查图生图/内绘条件
+    if use_img2img_toggle: # 检查全局开关是否打开
+        init_image_path = profile_data.get("image_path", "").strip()
+        inputs["init_image_path"] = init_image_path
+        if init_image_path and os.path.exists(init_image_path):
+            inputs["is_img2img"] = True # 只有开关打开且路径有效才激活
+            logger.info(f"  - 图生图模式已激活，使用参考图: {init_image_path}") # 功能性备注
+            # 功能性备注: 读取并编码参考图 (Base64) - 仅 NAI 和 SD 需要在此步骤处理
+            if api_type in ["NAI", "SD WebUI"]:
+                try:
+                    inputs["init_image_b64"] = img2img_cache.get_b64(init_image_path)
+                    logger.info(f"  - 参考图已编码为 Base64 (同一运行内复用)。") # 功能性备注
+                except Exception as img_read_e:
+                    logger.exception(f"  - 错误：读取或编码参考图像 '{init_image_path}' 失败: {img_read_e}") # 逻辑备注
+                    inputs["is_img2img"] = False; inputs["init_image_b64"] = None
+            # 功能性备注: 检查并读取蒙版图 (可选) - 仅在参考图成功加载后进行
+            if inputs["is_img2img"]:
+                mask_path = profile_data.get("mask_path", "").strip()
+                if mask_path and os.path.exists(mask_path):
+                    inputs["mask_path"] = mask_path
+                    logger.info(f"  - 检测到蒙版图像: {mask_path}") # 功能性备注
+                    # 功能性备注: NAI 和 SD 需要 Base64 编码
+                    if api_type in ["NAI", "SD WebUI"]:
+                        try:
+                             inputs["mask_b64"] = img2img_cache.get_b64(mask_path, is_mask=True)
+                             logger.info(f"  - 蒙版图像已编码为 Base64。将执行内/外绘模式。") # 功能性备注
+                        except Exception as mask_read_e:
+                             logger.warning(f"  - 读取或编码蒙版图像失败: {mask_read_e}，将执行标准图生图。") # 逻辑备注
+                             inputs["mask_b64"] = None
+                # 逻辑备注: 如果蒙版路径无效
+                elif mask_path:
+                     logger.warning(f"  - 配置了蒙版路径但文件无效: '{mask_path}'，将执行标准图生图。") # 逻辑备注
+                else:
+                     logger.info("  - 未配置蒙版图像，将执行标准图生图。") # 功能性备注
+        # 逻辑备注: 处理参考图路径无效或未配置的情况
+        elif init_image_path:
+             logger.warning(f"  - 图生图开关已启用，但人物 '{task['name']}' 的参考图路径无效或不存在，执行文生图。") # 逻辑备注
+        else:
+             logger.info(f"  - 图生图开关已启用，但人物 '{task['name']}' 未配置参考图，执行文生图。") # 功能性备注
+    else:
+        logger.info("  - 图生图开关未启用，执行文生图。") # 功能性备注
+
+    # --- *** 逻辑修改：确定当前任务使用的种子值 *** ---
+    if api_type == "NAI":
+        if specific_config.get('naiRandomSeed', False):
+            inputs["seed"] = random.randint(1, 2**31 - 1)
+            logger.info(f"  - NAI 任务 '{task['filename']}' 使用客户端生成的随机种子: {inputs['seed']}") # 功能性备注
+        else:
+            inputs["seed"] = specific_config.get('naiSeed', -1)
+            inputs["seed_fixed"] = inputs["seed"] not in (-1, None)
+            logger.info(f"  - NAI 任务 '{task['filename']}' 使用配置种子: {inputs['seed']}") # 功能性备注
+    elif api_type in ["SD WebUI", "ComfyUI"]:
+        if shared_config.get('sharedRandomSeed', False):
+            inputs["seed"] = random.randint(1, 2**31 - 1)
+            logger.info(f"  - {api_type} 任务 '{task['filename']}' 使用客户端生成的随机种子: {inputs['seed']}") # 功能性备注
+        else:
+            inputs["seed"] = shared_config.get('seed', -1)
+            inputs["seed_fixed"] = inputs["seed"] not in (-1, None)
+            logger.info(f"  - {api_type} 任务 '{task['filename']}' 使用配置种子: {inputs['seed']}") # 功能性备注
+    # --- *** 种子确定结束 *** ---
+    return inputs
+
+def _image_cache_enabled(run_ctx, inputs):
+    """该任务是否使用图片缓存 (缓存已启用且种子固定)"""
+    return run_ctx.get("image_cache") is not None and bool(inputs.get("seed_fixed"))
+
+def _image_cache_key(run_ctx, inputs, params):
+    """固定种子且缓存启用时，返回该任务有效生成参数的缓存键，否则返回 None"""
+    if not _image_cache_enabled(run_ctx, inputs):
+        return None
+    return make_cache_key(run_ctx["api_type"], params)
+
+def _payload_hash(run_ctx, params):
+    """返回任务有效生成参数的哈希 (写入生成日志)，与是否启用图片缓存无关"""
+    return make_cache_key(run_ctx["api_type"], params)
+
+def _lookup_image_cache(run_ctx, cache_key, task):
+    """查找图片缓存，命中时返回缓存文件路径列表"""
+    if not cache_key:
+        return None
+    cached_paths = run_ctx["image_cache"].get(cache_key)
+    if cached_paths:
+        logger.info(f"  - 任务 '{task['filename']}' 命中图片缓存 ({len(cached_paths)} 张)，跳过后端调用。") # 功能性备注
+    return cached_paths
+
+def _store_image_cache(run_ctx, cache_key, image_data_list):
+    """将新生成的图片写入缓存"""
+    if cache_key and image_data_list:
+        run_ctx["image_cache"].put(cache_key, image_data_list)
+
+def _get_sd_model_name(api_helpers, run_ctx, endpoint_url):
+    """返回 SD 任务实际使用的模型名称 (覆盖模型或服务器当前模型，每个节点每次运行只查询一次)"""
+    if override_model := run_ctx["specific_config"].get("sdOverrideModel"):
+        return override_model
+    with run_ctx["state_lock"]:
+        if endpoint_url in run_ctx["sd_model_names"]:
+            return run_ctx["sd_model_names"][endpoint_url]
+    model_name, model_error = api_helpers.get_sd_current_model(endpoint_url)
+    if model_error:
+        logger.warning(f"  - 无法获取 SD WebUI 当前模型，本节点的任务不使用图片缓存: {model_error}") # 逻辑备注
+    with run_ctx["state_lock"]:
+        run_ctx["sd_model_names"][endpoint_url] = model_name
+    return model_name
+
+def _run_nai_task(api_helpers, run_ctx, task, inputs):
+    """
+    调用 NAI 生成单个任务的图片。
+    返回 (image_data_list, error_msg, retryable)，retryable 表示错误是否值得换节点重试。
+    """
+    specific_config = run_ctx["specific_config"]; shared_config = run_ctx["shared_config"]
+    n_samples = run_ctx["n_samples"]; stop_event = run_ctx["stop_event"]
+    # 逻辑备注: NAI 不支持 LoRA 注入
+    if inputs["loras"]: logger.warning("NAI API 不支持通过此方式注入 LoRA，将忽略人物设定的 LoRA 配置。") # 逻辑备注
+    # 功能性备注: 构建 NAI 请求体
+    payload = {
+        "action": "generate", # 默认为 generate，如果内绘则改为 inpaint
+        "input": task['positive'],
+        "model": specific_config.get('naiModel'),
+        "parameters": {
+            "width": shared_config.get('width'),
+            "height": shared_config.get('height'),
+            "scale": specific_config.get('naiScale'),
+            "sampler": specific_config.get('naiSampler'),
+            "steps": specific_config.get('naiSteps'),
+            "seed": inputs["seed"], # 逻辑修改: 使用当前任务的种子
+            "n_samples": n_samples,
+            "ucPreset": specific_config.get('naiUcPreset'),
+            "qualityToggle": specific_config.get('naiQualityToggle'),
+            "sm": specific_config.get("naiSmea", False),
+            "sm_dyn": specific_config.get("naiSmeaDyn", False),
+            "dynamic_thresholding": specific_config.get("naiDynamicThresholding", False),
+            "uncond_scale": specific_config.get("naiUncondScale", 1.0),
+            "negative_prompt": task['negative']
+        }
+    }
+    # 功能性备注: 处理图生图/内绘参数
+    if inputs["is_img2img"] and inputs["init_image_b64"]:
+        payload["parameters"]["image"] = inputs["init_image_b64"]
+        payload["parameters"]["strength"] = specific_config.get("naiReferenceStrength", 0.6)
+        payload["parameters"]["noise"] = 1.0 - specific_config.get("naiReferenceInfoExtracted", 0.7)
+        payload["parameters"]["add_original_image"] = specific_config.get("naiAddOriginalImage", True)
+        if inputs["mask_b64"]:
+            payload["parameters"]["mask"] = inputs["mask_b64"]
+            payload["action"] = "inpaint" # 切换 action
+            logger.info("  - NAI 内绘模式参数已添加。") # 功能性备注
+        else:
+            logger.info("  - NAI 图生图模式参数已添加。") # 功能性备注
+    else:
+        logger.info("  - NAI 文生图模式。") # 功能性备注
+
+    # 功能性备注: 固定种子时先查图片缓存
+    inputs["payload_hash"] = _payload_hash(run_ctx, payload)
+    cache_key = inputs["cache_key"] = _image_cache_key(run_ctx, inputs, payload)
+    if cached_paths := _lookup_image_cache(run_ctx, cache_key, task):
+        return cached_paths, None, False
+
+    # 功能性备注: 调用 NAI API 助手函数 (流式接收，Zip 写入临时文件而不是整体读入内存)
+    zip_file, task_error_msg = api_helpers.call_novelai_image_api(run_ctx["api_key"], payload, proxy_config=run_ctx["nai_proxy_config"], save_debug=run_ctx["save_debug"], spool=True)
+    if isinstance(zip_file, (bytes, bytearray)):
+        zip_file = io.BytesIO(zip_file) # 逻辑备注: 兼容返回 bytes 的 API 助手
+
+    try:
+        # 逻辑备注: 在 API 调用后检查停止信号
+        if stop_event and stop_event.is_set():
+            logger.info(f"任务在 NAI API 调用后被停止，结果将被丢弃。") # 功能性备注
+            return None, STOPPED_MESSAGE, False
+        if task_error_msg:
+            return None, task_error_msg, False
+        # 功能性备注: 处理返回的 Zip 数据
+        if zip_file is None:
+            task_error_msg = "错误: NAI API 调用成功但未返回数据。"
+            logger.error(task_error_msg) # 逻辑备注
+            return None, task_error_msg, False
+        staged_images, task_error_msg = _extract_nai_zip(zip_file, run_ctx["base_save_path"] / NAI_STAGING_SUBDIR, n_samples)
+        return staged_images, task_error_msg, False
+    finally:
+        if zip_file is not None: zip_file.close()
+
+def _extract_nai_zip(zip_file, staging_dir, n_samples):
+    """
+    把 NAI Zip 中的 PNG 图片 (最多 n_samples 张) 逐个解压到暂存目录，内存中只保留固定大小的缓冲区。
+    返回 (暂存图片列表, error_msg)；失败时已解压的暂存文件会被删除。
+    """
+    staged_images = []
+    try:
+        staging_dir.mkdir(parents=True, exist_ok=True)
+        token = uuid.uuid4().hex
+        with zipfile.ZipFile(zip_file) as zf:
+            for img_info in zf.infolist():
+                # 逻辑备注: 确保只提取 PNG 文件且不超过请求数量
+                if img_info.is_dir() or not img_info.filename.lower().endswith('.png') or len(staged_images) >= n_samples:
+                    continue
+                staged_path = _StagedImage(staging_dir / f"{token}_{len(staged_images) + 1}.png")
+                staged_images.append(staged_path)
+                with zf.open(img_info) as src, open(staged_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, NAI_EXTRACT_BUFFER_SIZE)
+    except Exception as zip_e:
+        task_error_msg = f"错误: 解压 NAI Zip 文件失败: {zip_e}"
+        logger.exception(task_error_msg) # 逻辑备注
+        for staged in staged_images: _remove_staged_file(staged)
+        return None, task_error_msg
+    # 逻辑备注: 检查返回数量是否符合预期
+    if len(staged_images) != n_samples:
+        logger.warning(f"NAI 返回 PNG 图片数量 ({len(staged_images)}) 与请求数量 ({n_samples}) 不符!") # 逻辑备注
+    if not staged_images:
+        task_error_msg = "错误: 未能从 NAI Zip 文件中提取到 PNG 图片。"
+        logger.error(task_error_msg) # 逻辑备注
+        return None, task_error_msg
+    return staged_images, None
+
+def _run_sd_task(api_helpers, run_ctx, endpoint_url, task, inputs):
+    """
+    在指定的 SD WebUI 节点上生成单个任务的图片。
+    返回 (image_data_list, error_msg, retryable)。
+    """
+    specific_config = run_ctx["specific_config"]; shared_config = run_ctx["shared_config"]
+    n_samples = run_ctx["n_samples"]; stop_event = run_ctx["stop_event"]
+    image_data_list = []
+    # 功能性备注: 组合最终的提示词 (包括 LoRA 和全局附加提示)
+    final_positive = task['positive']; add_pos = shared_config.get('additionalPositivePrompt', ''); final_negative = task['negative']; add_neg = shared_config.get('additionalNegativePrompt', '')
+    if add_pos: final_positive += f", {add_pos}"
+    if add_neg: final_negative = f"{final_negative}, {add_neg}" if final_negative else add_neg
+    # 功能性备注: 添加 LoRA 到正向提示词
+    lora_strings = []
+    for lora in inputs["loras"]:
+        lora_name = lora.get("name")
+        model_weight = lora.get("model_weight", 1.0)
+        if lora_name:
+            lora_strings.append(f"<lora:{lora_name}:{model_weight}>")
+    if lora_strings:
+        final_positive += " " + " ".join(lora_strings) # 用空格分隔 LoRA 标记
+        logger.info(f"  - 已将 {len(lora_strings)} 个 LoRA 添加到 SD WebUI 正向提示词。") # 功能性备注
+
+    # 功能性备注: 构建 SD WebUI 请求体
+    payload = {
+        "prompt": final_positive.strip(', '),
+        "negative_prompt": final_negative.strip(', '),
+        "sampler_name": shared_config.get('sampler'),
+        "steps": shared_config.get('steps'),
+        "cfg_scale": shared_config.get('cfgScale'),
+        "width": shared_config.get('width'),
+        "height": shared_config.get('height'),
+        "seed": inputs["seed"], # 逻辑修改: 使用当前任务的种子
+        "restore_faces": shared_config.get('restoreFaces'),
+        "tiling": shared_config.get('tiling'),
+        "n_iter": 1, # 迭代次数固定为 1
+        "batch_size": n_samples, # 批处理大小等于请求的样本数
+    }
+
+    # 功能性备注: 确定 API 端点后缀和添加特定参数
+    endpoint_suffix = "/sdapi/v1/txt2img" # 默认为文生图
+    if inputs["is_img2img"] and inputs["init_image_b64"]:
+        # 逻辑备注: 如果是图生图模式
+        payload["init_images"] = [inputs["init_image_b64"]]
+        payload["denoising_strength"] = shared_config.get('denoisingStrength', 0.7)
+        payload["resize_mode"] = specific_config.get('sdResizeMode', 1)
+        endpoint_suffix = "/sdapi/v1/img2img" # 切换到图生图端点
+        if inputs["mask_b64"]:
+            # 逻辑备注: 如果有蒙版，添加内绘参数
+            payload["mask"] = inputs["mask_b64"]
+            payload["mask_blur"] = shared_config.get('maskBlur', 4)
+            payload["inpainting_fill"] = specific_config.get('sdInpaintingFill', 1)
+            payload["inpainting_mask_invert"] = specific_config.get('sdMaskMode', 0)
+            payload["inpaint_full_res"] = specific_config.get('sdInpaintArea', 1) == 0
+            logger.info("  - SD WebUI 内绘模式参数已添加。") # 功能性备注
+        else:
+            logger.info("  - SD WebUI 图生图模式参数已添加。") # 功能性备注
+    else:
+        # 逻辑备注: 如果是文生图模式
+        logger.info("  - SD WebUI 文生图模式。") # 功能性备注
+        # 功能性备注: 添加高清修复参数 (仅文生图时有效)
+        if specific_config.get("sdEnableHR", False):
+            payload["enable_hr"] = True
+            payload["hr_scale"] = specific_config.get("sdHRScale", 2.0)
+            payload["hr_upscaler"] = specific_config.get("sdHRUpscaler", "Latent")
+            payload["hr_second_pass_steps"] = specific_config.get("sdHRSteps", 0)
+            payload["denoising_strength"] = shared_config.get('denoisingStrength', 0.7) # Hires fix 也需要 denoise
+            logger.info("  - SD WebUI 高清修复参数已添加。") # 功能性备注
+
+    # 功能性备注: 添加覆盖设置 (模型, VAE, CLIP Skip)，缓存键总是包含这些设置
+    override_settings = {}
+    if override_model := specific_config.get("sdOverrideModel"): override_settings["sd_model_checkpoint"] = override_model
+    if override_vae := specific_config.get("sdOverrideVAE"): override_settings["sd_vae"] = override_vae
+    override_settings["CLIP_stop_at_last_layers"] = shared_config.get("clipSkip", 1)
+    if override_settings:
+        payload["override_settings"] = override_settings
+        logger.info(f"  - SD WebUI 覆盖设置已添加: {list(override_settings.keys())}") # 功能性备注
+
+    # 功能性备注: 构建基础 API URL
+    base_api_url = endpoint_url.rstrip('/')
+    logger.info(f"  - SD WebUI API Endpoint: {base_api_url}{endpoint_suffix}") # 功能性备注
+
+    # 功能性备注: 参数哈希与缓存键使用同一组参数 (包含实际使用的模型)；固定种子时先查图片缓存
+    model_name = _get_sd_model_name(api_helpers, run_ctx, base_api_url)
+    key_params = {"endpoint": endpoint_suffix, "model": model_name, "payload": payload}
+    inputs["payload_hash"] = _payload_hash(run_ctx, key_params)
+    # 逻辑备注: 模型未知时不使用缓存 (无法确认缓存的图片来自同一模型)
+    cache_key = _image_cache_key(run_ctx, inputs, key_params) if model_name else None
+    inputs["cache_key"] = cache_key
+    if cached_paths := _lookup_image_cache(run_ctx, cache_key, task):
+        return cached_paths, None, False
+
+    # 功能性备注: 按 sdOverrideMode 决定覆盖设置的发送方式 (避免每次请求后服务器恢复设置并重新加载模型)
+    options_session = run_ctx["sd_options_session"]
+    if override_settings and options_session.prepare(api_helpers, base_api_url, override_settings):
+        payload = {k: v for k, v in payload.items() if k != "override_settings"} # 逻辑备注: 设置已在服务器端固定
+    elif override_settings and options_session.mode in ("sticky", "no_restore"):
+        payload = dict(payload, override_settings_restore_afterwards=False) # 逻辑备注: 设置保留到运行结束后统一恢复
+
+    # 功能性备注: 服务器端保存模式：服务器把图片写入共享目录，不再通过 Base64 JSON 传输
+    server_save_dir = _sd_server_save_dir(run_ctx, base_api_url)
+    if server_save_dir and payload.get("override_settings_restore_afterwards") is False:
+        server_save_dir = None # 逻辑备注: 本次请求的覆盖设置不会恢复，保存目录设置不能一起留在服务器上
+    if server_save_dir:
+        save_token = f"kag_{uuid.uuid4().hex}"
+        payload = dict(payload, save_images=True, send_images=False, override_settings=dict(
+            payload.get("override_settings") or {},
+            outdir_txt2img_samples=server_save_dir, outdir_img2img_samples=server_save_dir, save_to_dirs=False,
+            samples_filename_pattern=save_token, samples_format="png", grid_save=False,
+        ))
+        _, task_error_msg = _call_sd_webui_tracked(api_helpers, run_ctx, inputs, base_api_url, endpoint_suffix, payload, expect_images=False)
+        if stop_event and stop_event.is_set():
+            logger.info(f"任务在 SD WebUI API 调用后被停止，结果将被丢弃。") # 功能性备注
+            for staged in _collect_server_saved_images(server_save_dir, save_token): _remove_staged_file(staged)
+            return None, STOPPED_MESSAGE, False
+        if task_error_msg:
+            return None, task_error_msg, True
+        staged_images = _collect_server_saved_images(server_save_dir, save_token)
+        if staged_images:
+            for extra in staged_images[n_samples:]: _remove_staged_file(extra)
+            logger.info(f"  - SD WebUI 已在服务器端保存 {len(staged_images)} 张图片 (无需 Base64 传输)。") # 功能性备注
+            return [_StagedImage(path) for path in staged_images[:n_samples]], None, False
+        # 逻辑备注: 没有找到服务器保存的文件，说明该节点与本机不共享目录，本批次对该节点改用 Base64 传输并重新请求
+        with run_ctx["state_lock"]:
+            run_ctx["sd_server_save_disabled"].add(base_api_url)
+        logger.warning(f"  - 未在 '{server_save_dir}' 找到 SD WebUI 节点 {base_api_url} 保存的图片 (可能不共享文件系统)，本批次改用 Base64 传输。") # 逻辑备注
+        payload = {k: v for k, v in payload.items() if k not in ("save_images", "send_images")}
+        payload["override_settings"] = {k: v for k, v in payload["override_settings"].items() if k not in ("outdir_txt2img_samples", "outdir_img2img_samples", "save_to_dirs", "samples_filename_pattern", "samples_format", "grid_save")}
+        if not payload["override_settings"]: payload.pop("override_settings")
+
+    # 功能性备注: 调用 SD WebUI API 助手函数
+    base64_image_list, task_error_msg = _call_sd_webui_tracked(api_helpers, run_ctx, inputs, base_api_url, endpoint_suffix, payload)
+
+    # 逻辑备注: 在 API 调用后检查停止信号
+    if stop_event and stop_event.is_set():
+        logger.info(f"任务在 SD WebUI API 调用后被停止，结果将被丢弃。") # 功能性备注
+        return None, STOPPED_MESSAGE, False
+    if task_error_msg:
+        # 逻辑备注: 网络/HTTP/超时错误属于节点问题，可以换节点重试
+        return None, task_error_msg, True
+
+    # 功能性备注: 处理返回的 Base64 图像列表
+    if not base64_image_list:
+        # 逻辑备注: API 调用成功但未返回数据错误
+        task_error_msg = "错误: SD API 调用成功但未返回任何图片数据。"
+        logger.error(task_error_msg) # 逻辑备注
+        return None, task_error_msg, True
+    # 逻辑备注: 检查返回数量是否符合预期
+    if len(base64_image_list) != n_samples:
+        logger.warning(f"SD API 返回图片数量 ({len(base64_image_list)}) 与请求数量 ({n_samples}) 不符!") # 逻辑备注
+    # 功能性备注: Base64 数据交给写入线程解码 (最多只处理请求的数量)
+    image_data_list = [_Base64Image(b64_img) for b64_img in base64_image_list[:n_samples]]
+    return image_data_list, None, False
+
+def _call_sd_webui_tracked(api_helpers, run_ctx, inputs, base_api_url, endpoint_suffix, payload, expect_images=True):
+    """
+    以本次请求专用的任务 ID (force_task_id) 调用 SD WebUI，请求期间登记在 run_ctx["sd_task_ids"] 中，
+    进度轮询和停止时据此通过 /internal/progress 判断服务器正在执行的是否是本任务。
+    停止时仍在服务器队列中的请求由 _SdCancelWatcher 标记为放弃，此时不再等待响应，直接返回停止信息。
+    """
+    task_id = f"task(kag_{uuid.uuid4().hex})"
+    progress_key = inputs.get("progress_key")
+    stop_event = run_ctx["stop_event"]
+    call_api = lambda: api_helpers.call_sd_webui_api(base_api_url, endpoint_suffix, dict(payload, force_task_id=task_id), save_debug=run_ctx["save_debug"], expect_images=expect_images)
+    with run_ctx["state_lock"]:
+        run_ctx["sd_task_ids"][progress_key] = task_id
+    try:
+        if not stop_event:
+            return call_api()
+        # 逻辑备注: 请求在后台线程中等待响应，被放弃时本任务立即返回 (服务器仍会执行该请求，响应被丢弃)
+        response = {}
+        request_thread = threading.Thread(target=lambda: response.update(result=call_api()), name="SdRequest", daemon=True)
+        request_thread.start()
+        while request_thread.is_alive():
+            request_thread.join(SD_ABANDON_CHECK_INTERVAL)
+            with run_ctx["state_lock"]:
+                abandoned = task_id in run_ctx["sd_abandoned_tasks"]
+            if abandoned and request_thread.is_alive():
+                return None, STOPPED_MESSAGE
+        return response.get("result", (None, "错误: SD WebUI 请求意外终止。"))
+    finally:
+        with run_ctx["state_lock"]:
+            if run_ctx["sd_task_ids"].get(progress_key) == task_id: run_ctx["sd_task_ids"].pop(progress_key)
+
+def _sd_active_task(api_helpers, run_ctx, endpoint_url, active_keys):
+    """返回该节点上服务器正在执行的本批次任务的进度键 (按 /internal/progress 判断)，没有时返回 None"""
+    with run_ctx["state_lock"]:
+        task_ids = [(key, run_ctx["sd_task_ids"].get(key)) for key in active_keys]
+    for key, task_id in task_ids:
+        if not task_id: continue
+        task_state, state_error = api_helpers.get_sd_task_progress(endpoint_url, task_id)
+        if not state_error and task_state and task_state.get("active"):
+            return key
+    return None
+
+def _sd_server_save_dir(run_ctx, base_api_url):
+    """
+    服务器端保存模式下该节点使用的共享目录 (绝对路径)；模式关闭、节点不在本机 (local 模式) 或
+    本批次已确认该节点不共享目录时返回 None。
+    """
+    specific_config = run_ctx["specific_config"]
+    mode = specific_config.get("sdServerSaveMode", "off")
+    if mode not in ("local", "always"):
+        return None
+    if mode == "local" and (urlparse(base_api_url).hostname or "").lower() not in _LOCAL_HOSTS:
+        return None
+    with run_ctx["state_lock"]:
+        if base_api_url in run_ctx["sd_server_save_disabled"]:
+            return None
+    save_dir = Path(specific_config.get("sdServerSaveDir") or run_ctx["base_save_path"] / SD_SERVER_SAVE_SUBDIR).resolve()
+    try:
+        save_dir.mkdir(parents=True, exist_ok=True)
+    except OSError as mkdir_e:
+        logger.warning(f"  - 无法创建 SD 服务器端保存目录 '{save_dir}': {mkdir_e}，改用 Base64 传输。") # 逻辑备注
+        return None
+    return str(save_dir)
+
+def _collect_server_saved_images(server_save_dir, save_token):
+    """查找服务器按文件名标记保存的图片 (按文件名排序，即服务器的保存顺序)"""
+    try:
+        with os.scandir(server_save_dir) as entries:
+            return sorted(entry.path for entry in entries if entry.is_file() and save_token in entry.name)
+    except OSError:
+        return []
+
+def _compile_comfyui_workflow(base_workflow, shared_config, specific_config):
+    """编译基础工作流：解析所有配置的节点标题，并只输出一次校验报告"""
+    node_titles = {key: specific_config.get(key, default) for key, default in COMFY_NODE_TITLE_KEYS.items()}
+    # 逻辑备注: 可选节点只在对应功能启用时才检查，避免无关的缺失警告
+    if not shared_config.get('restoreFaces'): node_titles.pop("comfyFaceDetailerNodeTitle", None)
+    if not shared_config.get('tiling'): node_titles.pop("comfyTilingSamplerNodeTitle", None)
+    workflow_template = ComfyUIWorkflowTemplate(base_workflow, node_titles)
+    logger.info(f"[ComfyUI Gen] 工作流模板编译完成:\n    - " + "\n    - ".join(workflow_template.validation_report())) # 功能性备注
+    return workflow_template
+
+def _preflight_comfyui(endpoints, workflow_template, shared_config, specific_config, character_profiles, tasks):
+    """
+    批次开始前按各服务器的 /object_info (有缓存) 校验：节点类型是否已安装、工作流中的下拉选项值、
+    Checkpoint/VAE 覆盖、采样器/调度器，以及本批次任务用到的人物 LoRA 名称。
+    返回汇总的错误报告文本，没有问题 (或无法获取任何服务器的节点信息) 时返回 None。
+    """
+    problems = [] # 功能性备注: 与服务器无关的配置问题
+    patch = WorkflowPatch(workflow_template)
+    if workflow_template.node_id("comfyOutputNodeTitle") is None:
+        problems.append(f"未在工作流中找到输出节点 '{specific_config.get('comfyOutputNodeTitle')}' (comfyOutputNodeTitle)。")
+    # 功能性备注: 应用与任务无关的覆盖 (与 _run_comfyui_task 中的设置一致)，校验的是实际提交的值
+    for role, input_name, config_key in (("comfyCheckpointNodeTitle", "ckpt_name", "comfyCkptName"), ("comfyVAENodeTitle", "vae_name", "comfyVaeName")):
+        if (override := specific_config.get(config_key)) and not patch.set(role, input_name, override):
+            problems.append(f"配置了覆盖 {config_key} = '{override}'，但工作流中没有节点 '{specific_config.get(role)}' ({role})。")
+    patch.set("comfySamplerNodeTitle", "sampler_name", shared_config.get('sampler'))
+    patch.set("comfySamplerNodeTitle", "scheduler", shared_config.get('scheduler'))
+    workflow_to_check = patch.build()
+
+    # 功能性备注: 参考图/蒙版在每个任务上传后才设置，不检查工作流中的原值
+    skip_inputs = {(node_id, "image") for node_id in (workflow_template.node_id("comfyLoadImageNodeTitle"), workflow_template.node_id("comfyLoadMaskNodeTitle")) if node_id}
+    # 功能性备注: 本批次人物使用的 LoRA (只有第一个 LoRA 会写入工作流)
+    lora_node_id = workflow_template.node_id("comfyLoraLoaderNodeTitle")
+    lora_users = {} # 功能性备注: {LoRA 名称: {人物名称}}
+    tasks_without_lora = False
+    for task in tasks:
+        profile_data = character_profiles.get(task['name'])
+        task_loras = profile_data.get("loras") if isinstance(profile_data, dict) else None
+        if isinstance(task_loras, list) and task_loras and isinstance(task_loras[0], dict) and task_loras[0].get("name"):
+            lora_users.setdefault(task_loras[0]["name"], set()).add(task['name'])
+        else:
+            tasks_without_lora = True
+    if lora_node_id and not tasks_without_lora:
+        skip_inputs.add((lora_node_id, "lora_name")) # 逻辑备注: 每个任务都会覆盖 LoRA，工作流中的原值不会被使用
+
+    server_problems = {} # 功能性备注: {问题描述: [服务器]}，多个服务器的相同问题合并显示
+    checked_servers = 0
+    for endpoint in endpoints:
+        object_info, info_error = get_comfyui_object_info(endpoint.url)
+        if info_error:
+            logger.warning(f"[ComfyUI Gen] 预检跳过节点 {endpoint.url}: {info_error}") # 逻辑备注: 节点暂时不可用时交给节点池处理
+            continue
+        checked_servers += 1
+        found = validate_workflow(workflow_to_check, object_info, skip_inputs)
+        if lora_node_id and lora_users:
+            lora_class = workflow_template.workflow[lora_node_id].get("class_type")
+            if (lora_options := combo_options(object_info, lora_class, "lora_name")) is not None:
+                for lora_name, users in sorted(lora_users.items()):
+                    if lora_name not in lora_options:
+                        found.append(f"LoRA '{lora_name}' 不在服务器的 LoRA 列表中 (人物: {', '.join(sorted(users))})。")
+        for problem in found:
+            server_problems.setdefault(problem, []).append(endpoint.url)
+    if not checked_servers:
+        logger.warning("[ComfyUI Gen] 无法获取任何节点的 /object_info，跳过预检。") # 逻辑备注
+        return None
+
+    report_lines = list(problems)
+    for problem, urls in server_problems.items():
+        report_lines.append(f"{problem} [{', '.join(urls)}]" if len(endpoints) > 1 else problem)
+    if not report_lines:
+        logger.info(f"[ComfyUI Gen] 预检通过 ({checked_servers}/{len(endpoints)} 个节点)。") # 功能性备注
+        return None
+    return f"ComfyUI 预检发现 {len(report_lines)} 个问题，批次未开始:\n- " + "\n- ".join(report_lines)
+
+def _apply_comfyui_task_patch(run_ctx, task, inputs, patch, is_img2img_mode_active, server_filename=None, server_mask_filename=None):
+    """
+    把任务的提示词、采样参数、潜空间尺寸、LoRA、图生图输入和保存前缀写入补丁 (不调用后端)。
+    返回预处理错误信息，没有错误时返回 None。
+    """
+    specific_config = run_ctx["specific_config"]; shared_config = run_ctx["shared_config"]
+    n_samples = run_ctx["n_samples"]; workflow_template = run_ctx["workflow_template"]
+    task_loras = inputs["loras"]; mask_path = inputs["mask_path"]
+    filename_base = os.path.splitext(task['filename'])[0]
+    modification_log = patch.log
+    task_error_msg = None
+    # 功能性备注: 组合最终的提示词
+    final_positive = task['positive']; add_pos = shared_config.get('additionalPositivePrompt', ''); final_negative = task['negative']; add_neg = shared_config.get('additionalNegativePrompt', '')
+    if add_pos: final_positive += f", {add_pos}"
+    if add_neg: final_negative = f"{final_negative}, {add_neg}" if final_negative else add_neg
+
+    # 功能性备注: 1. Checkpoint / VAE 覆盖
+    if ckpt_override := specific_config.get("comfyCkptName"):
+        patch.set("comfyCheckpointNodeTitle", "ckpt_name", ckpt_override, f"覆盖 Checkpoint 为 '{ckpt_override}'")
+    if vae_override := specific_config.get("comfyVaeName"):
+        patch.set("comfyVAENodeTitle", "vae_name", vae_override, f"覆盖 VAE 为 '{vae_override}'")
+    # 功能性备注: 2. 提示词节点
+    patch.set("comfyPositiveNodeTitle", "text", final_positive.strip(', '), "设置正向提示")
+    patch.set("comfyNegativeNodeTitle", "text", final_negative.strip(', '), "设置负向提示")
+    # 功能性备注: 3. CLIP Skip (ComfyUI 用负数表示跳过层数)
+    comfy_clip_skip = -abs(shared_config.get("clipSkip", 1))
+    patch.set("comfyClipTextEncodeNodeTitle", "stop_at_clip_layer", comfy_clip_skip, f"设置 CLIP Skip 为 {comfy_clip_skip}")
+    # 功能性备注: 4. 采样器节点 (注入共享参数)；Denoise: 图生图用配置值，文生图固定为 1.0
+    current_denoise = shared_config.get('denoisingStrength', 0.7) if is_img2img_mode_active else 1.0
+    sampler_inputs = {
+        "seed": inputs["seed"], "steps": shared_config.get('steps'), "cfg": shared_config.get('cfgScale'),
+        "sampler_name": shared_config.get('sampler'), "scheduler": shared_config.get('scheduler'), "denoise": current_denoise,
+    }
+    for input_name, value in sampler_inputs.items():
+        patch.set("comfySamplerNodeTitle", input_name, value)
+    modification_log.append(f"设置采样器参数 (种子 {inputs['seed']}, Denoise {current_denoise})")
+    # 功能性备注: 5. 潜空间节点 (设置尺寸和批处理大小，仅文生图时；图生图时尺寸由 VAEEncode 决定)
+    if not is_img2img_mode_active:
+        patch.set("comfyLatentImageNodeTitle", "width", shared_config.get('width'))
+        patch.set("comfyLatentImageNodeTitle", "height", shared_config.get('height'))
+        patch.set("comfyLatentImageNodeTitle", "batch_size", n_samples, f"设置潜空间尺寸与批处理大小 ({n_samples})")
+    # 功能性备注: 6. LoRA 覆盖 (目前只处理第一个 LoRA)
+    if task_loras:
+        first_lora = task_loras[0]
+        lora_name_override = first_lora.get("name")
+        if lora_name_override:
+            if patch.set("comfyLoraLoaderNodeTitle", "lora_name", lora_name_override, f"设置 LoRA '{lora_name_override}'"):
+                patch.set("comfyLoraLoaderNodeTitle", "strength_model", first_lora.get("model_weight", 1.0))
+                patch.set("comfyLoraLoaderNodeTitle", "strength_clip", first_lora.get("clip_weight", 1.0))
+            else: modification_log.append(f"警告: 配置了 LoRA 但工作流中没有 LoRA 加载节点。")
+        else: modification_log.append(f"警告: 第一个 LoRA 条目缺少名称。")
+    # 功能性备注: 7. 图生图/内绘处理 (设置 LoadImage 节点和可能的 Mask 节点)
+    if is_img2img_mode_active:
+        load_image_title = specific_config.get("comfyLoadImageNodeTitle")
+        if workflow_template.node_id("comfyLoadImageNodeTitle") is None:
+            # 逻辑备注: 未找到加载图像节点
+            task_error_msg = f"图生图失败：未找到 LoadImage 节点 '{load_image_title}'"
+            logger.error(task_error_msg) # 逻辑备注
+        elif server_filename: # 必须参考图上传成功
+            patch.set("comfyLoadImageNodeTitle", "image", server_filename, f"设置加载图像为服务器文件 '{server_filename}'")
+            # 功能性备注: 处理蒙版 (如果蒙版上传成功)
+            if server_mask_filename:
+                if patch.set("comfyLoadMaskNodeTitle", "image", server_mask_filename, f"设置加载蒙版为服务器文件 '{server_mask_filename}'"):
+                    pass
+                else:
+                    # 逻辑备注: 未找到配置的蒙版加载节点
+                    modification_log.append(f"警告: 提供了蒙版图像并上传成功，但未在工作流中找到加载蒙版节点 '{specific_config.get('comfyLoadMaskNodeTitle', 'Load_Mask_Image')}'。内绘可能无法按预期工作。")
+            elif mask_path:
+                 # 逻辑备注: 本地有蒙版但上传失败或未使用
+                 modification_log.append(f"信息: 检测到本地蒙版路径，但未使用或上传失败，执行标准图生图。")
+        else:
+             # 逻辑备注: 参考图未上传成功
+             modification_log.append(f"警告: 图生图模式失败，参考图未成功上传或未提供。")
+             logger.warning("图生图模式失败，参考图未成功上传或未提供。") # 逻辑备注
+    # 功能性备注: 8. 保存节点前缀 (使用任务中的文件名基础部分)
+    patch.set("comfyOutputNodeTitle", "filename_prefix", filename_base, f"设置保存节点前缀 '{filename_base}'")
+    # 功能性备注: 9. 可选节点 (面部修复/Tiling) 的实际效果依赖工作流，缺失情况已在编译报告中给出
+
+    logger.info(f"  [ComfyUI Gen] 工作流修改: " + "; ".join(modification_log)) # 功能性备注
+    return task_error_msg
+
+def _comfyui_cache_key(run_ctx, inputs, workflow_to_run):
+    """记录任务的参数哈希并返回图片缓存键 (键为打过补丁的工作流，去掉只影响文件名的保存前缀)"""
+    output_node_id = run_ctx["workflow_template"].node_id("comfyOutputNodeTitle")
+    cache_key = None
+    key_workflow = dict(workflow_to_run)
+    if output_node_id in key_workflow:
+        output_node = dict(key_workflow[output_node_id])
+        output_node["inputs"] = {k: v for k, v in output_node.get("inputs", {}).items() if k != "filename_prefix"}
+        key_workflow[output_node_id] = output_node
+    inputs["payload_hash"] = _payload_hash(run_ctx, key_workflow)
+    if _image_cache_enabled(run_ctx, inputs):
+        cache_key = _image_cache_key(run_ctx, inputs, key_workflow)
+    inputs["cache_key"] = cache_key
+    return cache_key
+
+def _run_comfyui_task(api_helpers, run_ctx, endpoint_url, task, inputs):
+    """
+    在指定的 ComfyUI 节点上生成单个任务的图片 (基于预编译模板生成补丁后提交)。
+    返回 (image_data_list, error_msg, retryable)。
+    """
+    specific_config = run_ctx["specific_config"]
+    n_samples = run_ctx["n_samples"]; stop_event = run_ctx["stop_event"]; save_debug = run_ctx["save_debug"]
+    workflow_template = run_ctx["workflow_template"]
+    task_error_msg = None
+    is_img2img_mode_active = inputs["is_img2img"]
+    init_image_path = inputs["init_image_path"]; mask_path = inputs["mask_path"]
+
+    # 逻辑备注: 检查工作流模板是否已编译
+    if not workflow_template:
+        task_error_msg = "错误: 基础 ComfyUI 工作流未加载。"; logger.error(task_error_msg) # 逻辑备注
+        return None, task_error_msg, False
+    # 功能性备注: 只收集需要修改的输入，提交时按写时复制生成工作流 (缺失节点已在编译时报告)
+    patch = WorkflowPatch(workflow_template)
+    modification_log = patch.log
+
+    server_filename = None # 用于存储上传后的参考图文件名
+    server_mask_filename = None # 用于存储上传后的蒙版文件名
+
+    # --- 上传图片逻辑 (如果需要) ---
+    if is_img2img_mode_active:
+        logger.info(f"  - [ComfyUI Img2Img] 检测到图生图模式，尝试上传文件到 {endpoint_url} ...") # 功能性备注
+        if init_image_path:
+            # 功能性备注: 上传参考图 (上传到当前分配的节点)
+            uploaded_name, upload_error = upload_image_to_comfyui_cached(endpoint_url, init_image_path, save_debug=save_debug)
+            if upload_error:
+                # 逻辑备注: 上传失败视为节点问题，交由调用方换节点重试
+                task_error_msg = f"参考图上传失败: {upload_error}"
+                logger.error(f"  - {task_error_msg}，图生图无法进行。") # 逻辑备注
+                return None, task_error_msg, True
+            # 功能性备注: 上传成功则记录服务器文件名
+            server_filename = uploaded_name
+            modification_log.append(f"参考图上传成功: 服务器文件名 '{server_filename}'")
+        else:
+            # 逻辑备注: 未提供有效本地路径
+            modification_log.append("警告: 图生图模式已启用，但未提供有效的本地参考图路径。")
+            logger.warning("图生图模式已启用，但未提供有效的本地参考图路径。") # 逻辑备注
+            is_img2img_mode_active = False # 退回文生图
+
+        # 功能性备注: 如果参考图上传成功，且有蒙版路径，则上传蒙版
+        if is_img2img_mode_active and mask_path:
+            uploaded_mask_name, upload_mask_error = upload_image_to_comfyui_cached(endpoint_url, mask_path, save_debug=save_debug)
+            if upload_mask_error:
+                # 逻辑备注: 蒙版上传失败则记录警告，但不中断图生图
+                mask_error_msg = f"蒙版图上传失败: {upload_mask_error}"
+                modification_log.append(f"警告: {mask_error_msg}，将执行标准图生图（如果可能）。")
+                logger.warning(f"  - {mask_error_msg}") # 逻辑备注
+            else:
+                # 功能性备注: 蒙版上传成功则记录服务器文件名
+                server_mask_filename = uploaded_mask_name
+                modification_log.append(f"蒙版图上传成功: 服务器文件名 '{server_mask_filename}'")
+
+    # --- 生成工作流补丁 ---
+    task_error_msg = _apply_comfyui_task_patch(run_ctx, task, inputs, patch, is_img2img_mode_active, server_filename, server_mask_filename)
+    # 逻辑备注: 预处理阶段（如节点查找）出错，不调用 API
+    if task_error_msg:
+        logger.error(f"  - ComfyUI 任务因预处理错误中止: {task_error_msg}") # 逻辑备注
+        return None, task_error_msg, False
+
+    workflow_to_run = patch.build()
+    output_node_id = workflow_template.node_id("comfyOutputNodeTitle")
+    # 功能性备注: 固定种子时先查图片缓存
+    cache_key = _comfyui_cache_key(run_ctx, inputs, workflow_to_run)
+    if cached_paths := _lookup_image_cache(run_ctx, cache_key, task):
+        return cached_paths, None, False
+
+    # 功能性备注: 调用 ComfyUI API 助手函数 (输出节点 ID 已在编译时解析)
+    # 逻辑备注: 配置了 WebSocket 保存节点时，图片通过长连接二进制帧直接返回
+    downloaded_images_bytes, api_error = api_helpers.call_comfyui_api(
+        endpoint_url, workflow_to_run, expected_output_node_title=specific_config.get("comfyOutputNodeTitle"),
+        save_debug=save_debug, output_node_id=output_node_id,
+        ws_image_node_id=workflow_template.node_id("comfyWebsocketSaveNodeTitle"),
+        on_event=lambda msg_type, data: _on_comfyui_event(run_ctx["progress"], inputs["progress_key"], msg_type, data),
+        max_queued=specific_config.get("comfyMaxQueuedPerServer", DEFAULT_COMFY_MAX_QUEUED), stop_event=stop_event
+    )
+
+    # 逻辑备注: 在 API 调用后检查停止信号
+    if stop_event and stop_event.is_set():
+        logger.info(f"任务在 ComfyUI API 调用后被停止，结果将被丢弃。") # 功能性备注
+        return None, STOPPED_MESSAGE, False
+
+    if downloaded_images_bytes and not api_error:
+        # 功能性备注: API 调用成功且返回了图片数据
+        # 逻辑备注: 检查返回数量是否符合预期
+        if len(downloaded_images_bytes) != n_samples:
+            logger.warning(f"ComfyUI 返回图片数量 ({len(downloaded_images_bytes)}) 与预期 ({n_samples}) 不符!") # 逻辑备注
+        return downloaded_images_bytes, None, False
+    if not api_error:
+        # 逻辑备注: API 调用成功但未返回数据
+        task_error_msg = "错误: ComfyUI API 调用成功但未返回任何图片数据。"
+        logger.error(task_error_msg) # 逻辑备注
+        return None, task_error_msg, True
+    # 逻辑备注: API 调用失败；工作流本身的提交/执行错误换节点也无济于事，其余 (网络、超时) 可重试
+    logger.error(f"ComfyUI API 调用失败: {api_error}") # 逻辑备注
+    return None, api_error, _comfyui_error_retryable(api_error)
+
+def _comfyui_error_retryable(api_error):
+    """工作流本身的提交/执行错误换节点也无济于事，其余 (网络、超时) 可重试"""
+    return not (api_error.startswith("ComfyUI 执行错误") or api_error.startswith("ComfyUI 提交错误"))
+
+def _save_task_images(run_ctx, task, image_data_list):
+    """
+    保存单个任务的图片 (多样本时添加序号，文件已存在时附加时间戳)，先写临时文件再原子改名。
+    文件名冲突由写入池的内存目录索引解决。
+    返回 (saved, error_msg)，saved 为 [(目标路径, 后处理 Future 或 None)]，成功时 error_msg 为 None。
+    """
+    api_type = run_ctx["api_type"]; base_save_path = run_ctx["base_save_path"]
+    n_samples = run_ctx["n_samples"]; stop_event = run_ctx["stop_event"]
+    image_writer = run_ctx["image_writer"]; postprocessor = run_ctx["postprocessor"]
+    filename_base, file_ext = os.path.splitext(task['filename']); file_ext = file_ext if file_ext else ".png"
+    saved = []
+    for sample_idx, img_data in enumerate(image_data_list):
+        # 逻辑备注: 在保存每个样本前检查停止信号
+        if stop_event and stop_event.is_set():
+            logger.info(f"任务在保存图片 {sample_idx+1} 之前被停止。") # 功能性备注
+            for staged in image_data_list[sample_idx:]:
+                if isinstance(staged, _StagedImage): _remove_staged_file(staged)
+            return saved, STOPPED_MESSAGE
+
+        # 功能性备注: 构造初始文件名 (多样本时添加序号)
+        current_filename_base = f"{filename_base}_{sample_idx+1}" if n_samples > 1 else filename_base
+        current_filename = f"{current_filename_base}{file_ext}"
+        target_path = None # 初始化 target_path
+        try:
+            # 功能性备注: 清理文件名中的非法字符，替换为下划线
+            safe_filename_base = re.sub(r'[\\/:"*?<>|]', '_', current_filename_base)
+            safe_filename = f"{safe_filename_base}{file_ext}"
+            initial_target_path = base_save_path.joinpath(safe_filename)
+
+            # 逻辑备注: 检查路径是否合法 (防止路径穿越)
+            if '..' in safe_filename or not initial_target_path.resolve().is_relative_to(base_save_path.resolve()):
+                raise ValueError("检测到无效的文件名或路径穿越尝试。")
+
+            # 逻辑备注: 检查并处理文件扩展名，强制使用常见图片格式
+            if initial_target_path.suffix.lower() not in ['.png', '.jpg', '.jpeg', '.webp']:
+                logger.warning(f"    - 文件扩展名 '{initial_target_path.suffix}' 非预期，将强制保存为 .png") # 逻辑备注
+                initial_target_path = initial_target_path.with_suffix('.png')
+                safe_filename_base = initial_target_path.stem # 更新基础名以匹配新扩展名
+                file_ext = '.png' # 更新扩展名
+
+            # 功能性备注: 从内存目录索引预留文件名 (已存在时附加时间戳)；启用后处理时使用输出格式的扩展名
+            save_ext = postprocessor.output_extension(file_ext) if postprocessor else file_ext
+            target_path, renamed = image_writer.reserve(safe_filename_base, save_ext)
+            if renamed:
+                logger.info(f"    - 文件 '{initial_target_path.name}' 已存在，使用新文件名: {target_path.name}") # 功能性备注
+
+            # 功能性备注: 保存图片到最终确定的路径
+            logger.info(f"  [{api_type} Gen] 保存图片 {sample_idx+1}/{len(image_data_list)} -> {target_path}") # 功能性备注
+            post_future = None
+            if postprocessor:
+                # 逻辑备注: 输出格式改变扩展名时，为编码失败 (按原格式保存原始数据) 预留原扩展名的文件名
+                fallback_path = image_writer.reserve(safe_filename_base, file_ext)[0] if save_ext.lower() != file_ext.lower() else None
+                # 功能性备注: 交给后处理进程池重新编码并写入 (不等待，与后续生成并行)
+                if isinstance(img_data, _StagedImage):
+                    post_future = postprocessor.submit(str(img_data), target_path, fallback_path)
+                    post_future.add_done_callback(lambda _f, staged=str(img_data): _remove_staged_file(staged))
+                else:
+                    post_future = postprocessor.submit(img_data, target_path, fallback_path)
+            elif isinstance(img_data, _StagedImage):
+                # 功能性备注: 暂存图片 (服务器端保存 / NAI 解压) 直接移动到目标位置 (同一磁盘时只是改名)
+                move_file_atomic(img_data, target_path)
+            elif isinstance(img_data, Path):
+                # 功能性备注: 图片缓存命中时传入的是缓存文件路径，复制到目标位置
+                materialize_cached_file(img_data, target_path)
+            else:
+                write_bytes_atomic(target_path, img_data)
+            saved.append((target_path, post_future))
+        except Exception as save_e:
+            # 逻辑备注: 保存文件时出错
+            save_target_display = str(target_path) if target_path else f"目录 {base_save_path}"
+            task_error_msg = f"错误: 保存图片 '{current_filename}' 到 '{save_target_display}' 时出错: {save_e}"
+            logger.exception(f"  [{api_type} Gen] 严重错误: {task_error_msg}") # 逻辑备注
+            return saved, task_error_msg
+    return saved, None
+
+def _script_storage_name(run_ctx, task):
+    """脚本中应写回的 storage 文件名 (后处理改变图片格式时更换扩展名；编码失败、按原格式保存时沿用原文件名)"""
+    postprocessor = run_ctx["postprocessor"]
+    with run_ctx["state_lock"]:
+        kept_original = task['full_image_line'] in run_ctx["postprocess_fallbacks"]
+    if not postprocessor or kept_original:
+        return task['filename']
+    storage_base, storage_ext = os.path.splitext(task['filename'])
+    new_ext = postprocessor.output_extension(storage_ext or ".png")
+    return task['filename'] if new_ext.lower() == storage_ext.lower() else f"{storage_base}{new_ext}"
+
+def _wait_task_postprocess(run_ctx, task, saved):
+    """
+    等待该任务的后处理全部完成，返回 (实际写入的文件路径列表, error_msg)。
+    编码失败、图片按原格式保存时记录下来，脚本的 storage 沿用原文件名；后处理本身出错 (没有写入文件) 时返回错误。
+    """
+    written_paths = []
+    for target_path, post_future in saved:
+        if post_future is None:
+            written_paths.append(target_path)
+            continue
+        try:
+            _, _, _, written_path = post_future.result()
+        except Exception as post_e:
+            return written_paths, f"错误: 图片 '{target_path.name}' 后处理失败，未能写入文件: {post_e}"
+        if Path(written_path) != Path(target_path):
+            with run_ctx["state_lock"]:
+                run_ctx["postprocess_fallbacks"].add(task['full_image_line'])
+        written_paths.append(Path(written_path))
+    return written_paths, None
+
+def _journal_task_images(run_ctx, task, written_paths, inputs):
+    """该任务的图片全部写入 (含后处理) 后追加一条生成日志"""
+    journal_error = run_ctx["journal"].record(
+        task, [written_path.name for written_path in written_paths], seed=inputs.get("seed"),
+        payload_hash=inputs.get("payload_hash"), storage=_script_storage_name(run_ctx, task), api_type=run_ctx["api_type"])
+    if journal_error:
+        logger.warning(f"  - 任务 '{task['filename']}': {journal_error}") # 逻辑备注: 日志失败不影响本次生成结果
+
+def _write_task_images(run_ctx, task, image_data_list, inputs=None):
+    """
+    写入线程执行：解码 Base64 图片、写入图片缓存并保存到目标目录，全部写入后记录生成日志。
+    返回 (status, error_msg, image_count)。
+    """
+    inputs = inputs or {}
+    cache_key = inputs.get("cache_key")
+    decoded_list = []
+    for idx, img_data in enumerate(image_data_list):
+        if isinstance(img_data, _Base64Image):
+            try:
+                # 逻辑备注: 处理可能的 data:image/... 前缀
+                b64_data = img_data.split(',', 1)[-1] if ',' in img_data else img_data
+                img_data = base64.b64decode(b64_data)
+            except Exception as dec_e:
+                # 逻辑备注: 解码失败错误
+                task_error_msg = f"错误: Base64 解码失败 (图片 {idx+1}): {dec_e}"
+                logger.exception(task_error_msg) # 逻辑备注
+                return "failed", task_error_msg, 0
+        decoded_list.append(img_data)
+    # 功能性备注: 新生成的图片写入缓存 (缓存命中的文件路径无需再写)
+    if cache_key and not any(isinstance(img_data, Path) for img_data in decoded_list):
+        # 逻辑备注: 暂存图片以路径传入，由缓存直接复制文件
+        _store_image_cache(run_ctx, cache_key, decoded_list)
+    saved, save_error = _save_task_images(run_ctx, task, decoded_list)
+    if save_error == STOPPED_MESSAGE:
+        logger.info(f"图片保存循环因停止信号中断。") # 功能性备注
+        return "stopped", STOPPED_MESSAGE, 0
+    if save_error:
+        return "failed", save_error, 0
+    written_paths, post_error = _wait_task_postprocess(run_ctx, task, saved)
+    if post_error:
+        logger.error(f"  [{run_ctx['api_type']} Gen] {post_error}") # 逻辑备注: 不记录日志、不计为成功
+        return "failed", post_error, 0
+    if run_ctx["journal"] is not None:
+        _journal_task_images(run_ctx, task, written_paths, inputs)
+    return "success", None, len(decoded_list)
+
+class _SdProgressPoller:
+    """
+    SD WebUI 进度轮询线程：定期查询有进行中任务的节点的 /sdapi/v1/progress。
+    /sdapi/v1/progress 报告的是服务器当前执行的任务 (可能属于其他客户端)，因此先按各任务的 force_task_id
+    查询 /internal/progress，只把步数记到服务器确认正在执行的本批次任务上；否则作为节点级进度显示。
+    """
+    def __init__(self, api_helpers, run_ctx, interval=SD_PROGRESS_POLL_INTERVAL):
+        self.api_helpers = api_helpers
+        self.run_ctx = run_ctx
+        self.tracker = run_ctx["progress"]
+        self._server_busy = set()
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="SdProgressPoller", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=self.interval + 5)
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            server_busy = set() # 功能性备注: 本轮显示节点级进度的节点，其余节点的节点级进度清除
+            active_endpoints = self.tracker.active_endpoints()
+            for endpoint_url in active_endpoints:
+                active_keys = self.tracker.active_tasks(endpoint_url)
+                if not active_keys: continue
+                owner_key = _sd_active_task(self.api_helpers, self.run_ctx, endpoint_url, active_keys)
+                progress, progress_error = self.api_helpers.get_sd_progress(endpoint_url)
+                # 逻辑备注: 模型加载等阶段没有采样步数，此时不更新任务步数
+                if progress_error or not progress or not progress.get("steps"):
+                    continue
+                if owner_key is not None:
+                    self.tracker.server_step(endpoint_url, 0, 0)
+                    self.tracker.task_step(owner_key, progress["step"], progress["steps"])
+                else:
+                    self.tracker.server_step(endpoint_url, progress["step"], progress["steps"])
+                    server_busy.add(endpoint_url)
+            for endpoint_url in self._server_busy - server_busy:
+                self.tracker.server_step(endpoint_url, 0, 0)
+            self._server_busy = server_busy
+
+class _SdCancelWatcher:
+    """
+    SD WebUI 停止监视线程：停止信号被设置时，按 /internal/progress 确认服务器正在执行本批次的任务后
+    才调用 /sdapi/v1/interrupt (interrupt 会中断服务器当前的任务，可能属于其他客户端)。
+    仍在服务器队列中的请求只在本地放弃等待，服务器之后仍会执行它们。
+    """
+    def __init__(self, api_helpers, run_ctx, interval=0.2):
+        self.api_helpers = api_helpers
+        self.run_ctx = run_ctx
+        self.tracker = run_ctx["progress"]
+        self.stop_event = run_ctx["stop_event"]
+        self.interval = interval
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="SdCancelWatcher", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._done.set()
+        self._thread.join(timeout=self.interval + 15)
+
+    def _loop(self):
+        while not self._done.is_set():
+            if self.stop_event.wait(self.interval):
+                for endpoint_url in self.tracker.active_endpoints():
+                    self._cancel_endpoint(endpoint_url)
+                return
+
+    def _cancel_endpoint(self, endpoint_url):
+        active_keys = self.tracker.active_tasks(endpoint_url)
+        owner_key = _sd_active_task(self.api_helpers, self.run_ctx, endpoint_url, active_keys)
+        if owner_key is not None:
+            self.api_helpers.interrupt_sd_webui(endpoint_url)
+        with self.run_ctx["state_lock"]:
+            waiting_ids = [task_id for key in active_keys if key != owner_key and (task_id := self.run_ctx["sd_task_ids"].get(key))]
+            self.run_ctx["sd_abandoned_tasks"].update(waiting_ids)
+        if waiting_ids:
+            logger.info(f"[SD WebUI Gen] 停止: 节点 {endpoint_url} 上有 {len(waiting_ids)} 个请求尚未开始执行，已在本地放弃 (服务器仍会执行这些请求，结果将被丢弃)。") # 功能性备注
+
+def _on_comfyui_event(tracker, progress_key, msg_type, data):
+    """ComfyUI WebSocket 事件 -> 进度模型 (开始执行、采样步数)"""
+    if msg_type == 'execution_start':
+        tracker.task_running(progress_key)
+    elif msg_type == 'progress' and isinstance(data, dict):
+        tracker.task_step(progress_key, data.get('value', 0), data.get('max', 0))
+
+def _call_with_node_retries(run_ctx, pool, label, progress_items, run_on_endpoint, affinity=None):
+    """
+    从节点池获取负载最低的健康节点并调用 run_on_endpoint(endpoint) -> (image_data, error_msg, retryable)，
+    节点失败 (网络/超时等) 时换到其他节点，过载 (429/超时) 时退避后重试。单个任务与融合任务共用。
+    progress_items 为 [(进度键, 文件名)]。返回 (image_data, error_msg)，停止时 error_msg 为 STOPPED_MESSAGE。
+    """
+    api_type = run_ctx["api_type"]; stop_event = run_ctx["stop_event"]
+    tracker = run_ctx["progress"]
+    tried_urls = set() # 功能性备注: 已失败过的节点
+    # 逻辑备注: 每个节点最多尝试一次；过载 (429/超时) 额外允许退避后重试
+    max_attempts = max(1, len(pool.endpoints)) + OVERLOAD_MAX_RETRIES
+    overload_retries = 0
+    image_data = None; task_error_msg = None
+    for attempt in range(max_attempts):
+        # 功能性备注: 获取节点 (阻塞直到有空闲节点，停止时返回 None)
+        endpoint = pool.acquire(exclude=tried_urls, stop_event=stop_event, affinity=affinity)
+        if endpoint is None:
+            logger.info(f"任务在调用 API for '{label}' 之前被停止。") # 功能性备注
+            return None, STOPPED_MESSAGE
+        retryable = False
+        started_at = time.time()
+        for progress_key, filename in progress_items:
+            tracker.task_started(progress_key, filename, endpoint.url)
+            if api_type == "NAI": tracker.task_running(progress_key) # 逻辑备注: NAI 没有排队/步数信息，发出请求即视为生成中
+        try:
+            if len(pool.endpoints) > 1:
+                logger.info(f"  - 任务 '{label}' 分配到节点 {endpoint.url} (第 {attempt+1} 次尝试)") # 功能性备注
+            image_data, task_error_msg, retryable = run_on_endpoint(endpoint)
+        except Exception as run_e:
+            # 逻辑备注: 捕获单个任务内的意外异常，避免影响其他并行任务
+            task_error_msg = f"错误: 执行任务时发生意外错误: {run_e}"
+            logger.exception(task_error_msg) # 逻辑备注
+            retryable = True
+        finally:
+            overloaded = task_error_msg != STOPPED_MESSAGE and is_overload_error(task_error_msg)
+            # 逻辑备注: 缓存命中 (返回缓存文件路径) 没有实际调用后端，不作为延迟样本
+            backend_called = not (isinstance(image_data, list) and image_data and isinstance(image_data[0], Path))
+            pool.release(endpoint, success=not (task_error_msg and (retryable or overloaded)), started_at=started_at if backend_called else None, overloaded=overloaded)
+
+        if task_error_msg == STOPPED_MESSAGE:
+            return None, STOPPED_MESSAGE
+        if task_error_msg and overloaded and overload_retries < OVERLOAD_MAX_RETRIES and not (stop_event and stop_event.is_set()):
+            # 逻辑备注: 过载时不排除该节点 (可能是唯一节点)，节点池会降低并发并退避
+            overload_retries += 1
+            logger.warning(f"  - 任务 '{label}' 在节点 {endpoint.url} 过载: {task_error_msg}。降低并发后重试 ({overload_retries}/{OVERLOAD_MAX_RETRIES})。") # 逻辑备注
+            continue
+        if task_error_msg and retryable and len(tried_urls) + 1 < len(pool.endpoints) and not (stop_event and stop_event.is_set()):
+            tried_urls.add(endpoint.url)
+            logger.warning(f"  - 任务 '{label}' 在节点 {endpoint.url} 失败: {task_error_msg}。将重新排队到其他节点。") # 逻辑备注
+            continue
+        break
+    return image_data, task_error_msg
+
+def _process_task(api_helpers, run_ctx, pool, task_index, task, affinity=None, inputs=None):
+    """
+    执行单个图片任务：准备输入 (inputs 已准备好时直接使用)，从节点池获取节点并调用 API
+    (失败时换节点重试)，最后把图片交给写入线程池保存。
+    返回 (status, error_msg, image_count)，status 为 "success" / "failed" / "stopped"；
+    需要保存图片时返回写入任务的 Future (其结果为同样的三元组)。
+    """
+    api_type = run_ctx["api_type"]; stop_event = run_ctx["stop_event"]; n_samples = run_ctx["n_samples"]
+    # 逻辑备注: 在处理每个任务前检查停止信号
+    if stop_event and stop_event.is_set():
+        logger.info(f"任务在处理 '{task['filename']}' 之前被停止。") # 功能性备注
+        return "stopped", STOPPED_MESSAGE, 0
+
+    if inputs is None:
+        logger.info(f"\n--- [{api_type} Gen] {task_index+1}/{run_ctx['total_tasks']}: 处理任务 '{task['filename']}' (原始状态: {'已注释' if task['is_commented'] else '未注释'}, 请求生成 {n_samples} 张) ---") # 功能性备注
+        inputs = _prepare_task_inputs(task, api_type, run_ctx["shared_config"], run_ctx["specific_config"], run_ctx["character_profiles"], run_ctx["use_img2img_toggle"], img2img_cache=run_ctx["img2img_cache"])
+        inputs["progress_key"] = task_index # 功能性备注: 该任务在进度模型中的键
+    tracker = run_ctx["progress"]
+
+    def run_on_endpoint(endpoint):
+        if api_type == "NAI":
+            return _run_nai_task(api_helpers, run_ctx, task, inputs)
+        if api_type == "SD WebUI":
+            return _run_sd_task(api_helpers, run_ctx, endpoint.url, task, inputs)
+        if api_type == "ComfyUI":
+            return _run_comfyui_task(api_helpers, run_ctx, endpoint.url, task, inputs)
+        return None, f"错误: 未知的 API 类型 '{api_type}'。", False
+
+    image_data_list, task_error_msg = _call_with_node_retries(run_ctx, pool, task['filename'], [(task_index, task['filename'])], run_on_endpoint, affinity)
+    if task_error_msg == STOPPED_MESSAGE:
+        return "stopped", STOPPED_MESSAGE, 0
+
+    # --- 保存图片 ---
+    if task_error_msg or not image_data_list:
+        # 逻辑备注: 如果在 API 调用或数据处理中出错
+        task_error_msg = task_error_msg or "未知错误"
+        logger.error(f"  [{api_type} Gen] API 调用或数据处理失败: {task_error_msg}") # 逻辑备注
+        tracker.task_finished(task_index, "failed")
+        return "failed", task_error_msg, 0
+    tracker.task_finished(task_index, "success")
+    # 逻辑备注: 交给写入线程池后立即返回，后端节点可以马上处理下一个任务
+    return run_ctx["image_writer"].submit(_write_task_images, run_ctx, task, image_data_list, inputs)
+
+def _plan_fused_groups(execution_order, affinity_keys, fuse_count):
+    """
+    把执行顺序中相邻、亲和键相同的文生图任务按最多 fuse_count 个分为一组 (同一组的模型、LoRA 和分辨率相同)；
+    图生图/内绘任务需要逐个上传参考图，单独成组。返回任务下标列表的列表。
+    """
+    groups = []
+    for index in execution_order:
+        key = affinity_keys[index]
+        last = groups[-1] if groups else None
+        if key[1] == "txt2img" and last and len(last) < fuse_count and affinity_keys[last[0]] == key:
+            last.append(index)
+        else:
+            groups.append([index])
+    return groups
+
+def _process_fused_comfyui_tasks(api_helpers, run_ctx, pool, task_indices, tasks, affinity=None):
+    """
+    把一组文生图任务合并为一个 ComfyUI 工作流提交：模型加载等相同节点只保留一份，提示词、采样器、
+    保存节点等按任务复制 (见 fuse_workflows)，分摊每次提交的调度和历史记录开销；输出按节点对应回各任务。
+    融合提交失败 (停止除外) 时逐个任务单独重试。返回与 task_indices 对应的结果列表 (同 _process_task)。
+    """
+    stop_event = run_ctx["stop_event"]; n_samples = run_ctx["n_samples"]; specific_config = run_ctx["specific_config"]
+    workflow_template = run_ctx["workflow_template"]; tracker = run_ctx["progress"]
+    results = [None] * len(tasks)
+    if stop_event and stop_event.is_set():
+        logger.info(f"融合任务组在处理 '{tasks[0]['filename']}' 等 {len(tasks)} 个任务之前被停止。") # 功能性备注
+        return [("stopped", STOPPED_MESSAGE, 0)] * len(tasks)
+
+    members = [] # 功能性备注: 需要生成的任务 [(组内序号, 工作流, 输入)]
+    for position, (task_index, task) in enumerate(zip(task_indices, tasks)):
+        logger.info(f"\n--- [ComfyUI Gen] {task_index+1}/{run_ctx['total_tasks']}: 处理任务 '{task['filename']}' (融合提交, 请求生成 {n_samples} 张) ---") # 功能性备注
+        inputs = _prepare_task_inputs(task, "ComfyUI", run_ctx["shared_config"], specific_config, run_ctx["character_profiles"], run_ctx["use_img2img_toggle"], img2img_cache=run_ctx["img2img_cache"])
+        inputs["progress_key"] = task_index
+        patch = WorkflowPatch(workflow_template)
+        if patch_error := _apply_comfyui_task_patch(run_ctx, task, inputs, patch, False):
+            tracker.task_finished(task_index, "failed")
+            results[position] = ("failed", patch_error, 0)
+            continue
+        workflow_to_run = patch.build()
+        if cached_paths := _lookup_image_cache(run_ctx, _comfyui_cache_key(run_ctx, inputs, workflow_to_run), task):
+            tracker.task_finished(task_index, "success")
+            results[position] = run_ctx["image_writer"].submit(_write_task_images, run_ctx, task, cached_paths, inputs)
+            continue
+        members.append((position, workflow_to_run, inputs))
+    if not members:
+        return results
+
+    output_node_id = workflow_template.node_id("comfyOutputNodeTitle")
+    fused_workflow, output_ids, id_maps = fuse_workflows([workflow for _, workflow, _ in members], output_node_id)
+    # 功能性备注: 复制节点 -> 任务的进度键，采样进度事件按节点对应到任务
+    node_owners = {new_id: inputs["progress_key"] for (_, _, inputs), id_map in zip(members, id_maps) for new_id in id_map.values()}
+    progress_keys = [inputs["progress_key"] for _, _, inputs in members]
+    label = f"{tasks[members[0][0]]['filename']} 等 {len(members)} 个任务"
+    logger.info(f"  [ComfyUI Gen] 融合 {len(members)} 个任务为一个工作流: {len(workflow_template.workflow)} -> {len(fused_workflow)} 个节点 (每个任务复制 {len(id_maps[0])} 个)。") # 功能性备注
+
+    def on_event(msg_type, data):
+        if msg_type == 'execution_start':
+            for progress_key in progress_keys: tracker.task_running(progress_key)
+        elif msg_type == 'progress' and isinstance(data, dict) and data.get('node') in node_owners:
+            tracker.task_step(node_owners[data['node']], data.get('value', 0), data.get('max', 0))
+
+    def run_on_endpoint(endpoint):
+        images_by_node, api_error = api_helpers.call_comfyui_api(
+            endpoint.url, fused_workflow, expected_output_node_title=specific_config.get("comfyOutputNodeTitle"),
+            save_debug=run_ctx["save_debug"], output_node_ids=output_ids, on_event=on_event,
+            max_queued=specific_config.get("comfyMaxQueuedPerServer", DEFAULT_COMFY_MAX_QUEUED), stop_event=stop_event
+        )
+        if stop_event and stop_event.is_set():
+            logger.info(f"融合任务组在 ComfyUI API 调用后被停止，结果将被丢弃。") # 功能性备注
+            return None, STOPPED_MESSAGE, False
+        if api_error:
+            logger.error(f"ComfyUI API 调用失败 (融合任务组): {api_error}") # 逻辑备注
+            return None, api_error, _comfyui_error_retryable(api_error)
+        return images_by_node, None, False
+
+    images_by_node, group_error = _call_with_node_retries(run_ctx, pool, label, [(inputs["progress_key"], tasks[position]['filename']) for position, _, inputs in members], run_on_endpoint, affinity)
+    if group_error == STOPPED_MESSAGE:
+        for position, _, _ in members: results[position] = ("stopped", STOPPED_MESSAGE, 0)
+        return results
+    if group_error or not images_by_node:
+        # 逻辑备注: 一个任务的错误会让整个融合工作流失败，逐个单独提交以免拖累同组的其他任务
+        logger.warning(f"  [ComfyUI Gen] 融合任务组失败: {group_error or '未返回图片'}。改为逐个提交 {len(members)} 个任务。") # 逻辑备注
+        for position, _, inputs in members:
+            results[position] = _process_task(api_helpers, run_ctx, pool, task_indices[position], tasks[position], affinity, inputs=inputs)
+        return results
+
+    for (position, _, inputs), output_id in zip(members, output_ids):
+        task = tasks[position]; images = images_by_node.get(output_id) or []
+        if not images:
+            task_error_msg = "错误: 融合工作流中该任务的输出节点未返回图片。"
+            logger.error(f"  [ComfyUI Gen] 任务 '{task['filename']}': {task_error_msg}") # 逻辑备注
+            tracker.task_finished(inputs["progress_key"], "failed")
+            results[position] = ("failed", task_error_msg, 0)
+            continue
+        if len(images) != n_samples:
+            logger.warning(f"ComfyUI 返回图片数量 ({len(images)}) 与预期 ({n_samples}) 不符! (任务 '{task['filename']}')") # 逻辑备注
+        tracker.task_finished(inputs["progress_key"], "success")
+        results[position] = run_ctx["image_writer"].submit(_write_task_images, run_ctx, task, images, inputs)
+    return results
+
+def _split_resumable_tasks(all_tasks, save_dir):
+    """
+    续传范围：读取保存目录中的生成日志，把被注释的任务分为已完成 (日志有记录且文件都还在) 和仍需生成两部分，
+    并清理中断时遗留的临时文件、整理日志 (只保留仍有效的记录)。
+    返回 (待生成任务列表, [(已完成任务, 日志记录)])。
+    """
+    pending = [t for t in all_tasks if t['is_commented']]
+    if not save_dir or not Path(save_dir).is_dir():
+        return pending, []
+    if removed := remove_stale_temp_files(save_dir):
+        logger.info(f"续传: 已删除上次中断遗留的 {removed} 个临时文件。") # 功能性备注
+    journal = GenerationJournal(save_dir)
+    entries = journal.load()
+    if not entries:
+        return pending, []
+    index = get_media_dir_index(save_dir)
+    index.refresh()
+    valid_entries = {key: entry for key, entry in entries.items() if all(index.exists(name) for name in entry["files"])}
+    journal.compact(valid_entries)
+    to_run = []; completed = []
+    for task in pending:
+        if entry := valid_entries.get(task_journal_key(task)):
+            completed.append((task, entry))
+        else:
+            to_run.append(task)
+    return to_run, completed
+
+def _apply_script_updates(kag_script, api_type, lines_to_uncomment, storage_rewrites):
+    """取消成功任务 image 行的注释，并按需更新 storage 扩展名。返回 (修改后的脚本, 取消注释数)"""
+    logger.info(f"[{api_type} Gen] 准备修改 KAG 脚本，取消 {len(lines_to_uncomment)} 个成功任务的注释...") # 功能性备注
+    modified_script_lines = []
+    uncommented_count = 0
+    for line in kag_script.splitlines():
+        trimmed_line = line.strip()
+        # 逻辑修改: 使用带分号的完整行来匹配需要取消注释的行
+        if trimmed_line in lines_to_uncomment:
+            # 逻辑备注: 如果当前行是记录的成功任务行，则取消注释
+            uncommented_line = line.lstrip(';').lstrip()
+            logger.info(f"  > 取消注释: {uncommented_line}") # 功能性备注
+            uncommented_count += 1
+        else:
+            # 逻辑备注: 否则保留原行
+            uncommented_line = line
+        if trimmed_line in storage_rewrites:
+            # 逻辑备注: 后处理改变了图片格式，同步更新 storage 中的扩展名
+            old_storage, new_storage = storage_rewrites[trimmed_line]
+            uncommented_line = uncommented_line.replace(f'storage="{old_storage}"', f'storage="{new_storage}"', 1)
+        modified_script_lines.append(uncommented_line)
+    logger.info(f"[{api_type} Gen] KAG 脚本修改完成，共取消注释 {uncommented_count} 个图片标签。") # 功能性备注
+    if storage_rewrites:
+        logger.info(f"[{api_type} Gen] 后处理改变了图片格式，已更新 {len(storage_rewrites)} 个图片标签的 storage 扩展名。") # 功能性备注
+    return "\n".join(modified_script_lines), uncommented_count
+
+def _resumed_script_updates(resumed_tasks):
+    """由续传跳过的任务生成 (待取消注释的行, storage 改写, 日志文本)"""
+    lines_to_uncomment = set(); storage_rewrites = {}; results_log = []
+    for task, entry in resumed_tasks:
+        lines_to_uncomment.add(task['full_image_line'])
+        if (storage := entry.get("storage")) and storage != task['filename']:
+            storage_rewrites[task['full_image_line']] = (task['filename'], storage)
+        results_log.append(f"续传: {task['filename']} (上次运行已生成: {', '.join(entry['files'])})")
+    return lines_to_uncomment, storage_rewrites, results_log
+
+# --- 主任务函数 ---
+def task_generate_images(api_helpers, api_type, shared_config, specific_config, kag_script, generation_options, use_img2img_toggle, character_profiles, stop_event=None, progress_callback=None): # 功能性备注: 添加 stop_event 参数
+    """
+    后台任务：解析 KAG 脚本中的任务，调用所选 API 生成图片（支持文生图/图生图/内绘/LoRA），
+    并在成功后取消对应 image 标签的注释。
+    SD WebUI / ComfyUI 支持配置多个后端节点，任务在节点间并行分配，结果仍按脚本顺序汇总。
+    启用自适应并发时，各节点的并发上限根据延迟和过载响应自动调整；
+    progress_callback(text) 在工作线程中被调用 (频率有上限)，报告完成数、进行中任务的步数/排队位置、预计剩余时间和当前并发上限。
+    如果目标文件已存在，则在文件名后附加时间戳。
+    每张图片写入完成后记录到保存目录的生成日志；范围为 'resume' 时跳过日志中已完成的任务，并补上它们的取消注释。
+    """
+    # --- 获取调试开关 ---
+    save_debug = False
+    # 逻辑备注: 根据 API 类型确定使用哪个配置中的调试开关
+    if api_type == "NAI":
+        save_debug = specific_config.get('saveNaiDebugInputs', False)
+    elif api_type in ["SD WebUI", "ComfyUI"]:
+        save_debug = shared_config.get('saveImageDebugInputs', False)
+    logger.info(f"执行图片生成后台任务 ({api_type})... Options: {generation_options}, Img2Img Toggle: {use_img2img_toggle}, Save Debug: {save_debug}") # 功能性备注
+
+    # 功能性备注: 获取生成范围和指定文件名
+    scope = generation_options.get('scope', 'all') # 逻辑修改: 默认值改为 'all' 或根据 UI 默认值调整
+    specific_files_str = generation_options.get('specific_files', '')
+    n_samples = max(1, generation_options.get('n_samples', 1)) # 功能性备注: 获取生成数量，至少为 1
+
+    target_files = set()
+    # 逻辑备注: 如果是指定范围，解析文件名列表
+    if scope == 'specific':
+        target_files = set(f.strip() for f in specific_files_str.split(',') if f.strip())
+        if not target_files:
+            # 逻辑备注: 如果范围是 'specific' 但未指定文件名，则返回错误
+            logger.error("选择了“指定”范围但未提供有效的文件名。") # 逻辑备注
+            return {"message": "错误：选择了“指定”范围但未提供有效的文件名。", "details": [], "modified_script": kag_script}, None
+
+    # --- 解析 KAG 脚本中的图片生成任务 (逻辑修改: 识别注释和非注释标签) ---
+    all_tasks = _parse_image_tasks(kag_script, api_type)
 
     # --- 筛选需要执行的任务 (逻辑修改: 根据新的 scope) ---
     tasks_to_run = []
+    resumed_tasks = [] # 功能性备注: 续传时日志中已完成的任务 [(任务, 日志记录)]
     if scope == 'all':
         tasks_to_run = all_tasks
     elif scope == 'uncommented': # 新增：未生成 (即被注释的)
         tasks_to_run = [t for t in all_tasks if t['is_commented']]
     elif scope == 'commented': # 新增：已生成 (即未被注释的)
         tasks_to_run = [t for t in all_tasks if not t['is_commented']]
+    elif scope == 'resume': # 续传：未生成的任务中，跳过生成日志里已完成的
+        tasks_to_run, resumed_tasks = _split_resumable_tasks(all_tasks, shared_config.get("imageSaveDir"))
+        if resumed_tasks:
+            logger.info(f"[{api_type} Gen] 续传: 生成日志中已有 {len(resumed_tasks)} 个任务完成，将跳过并补上取消注释。") # 功能性备注
     elif scope == 'specific':
         tasks_to_run = [t for t in all_tasks if t['filename'] in target_files]
         missing_files = target_files - {t['filename'] for t in tasks_to_run}
@@ -181,13 +1610,21 @@ def task_generate_images(api_helpers, api_type, shared_config, specific_config,
             logger.error(f"未在脚本中找到指定的有效任务文件: {specific_files_str}") # 逻辑备注
             return {"message": f"未在脚本中找到指定的有效任务文件: {specific_files_str}", "details": [], "modified_script": kag_script}, None
     # 逻辑备注: 如果最终没有任务需要执行 (无论是 'all' 还是 'specific' 筛选后)
+    if not tasks_to_run and resumed_tasks:
+        # 逻辑备注: 续传时所有任务都已在日志中完成，只需把取消注释写回脚本
+        lines_to_uncomment, storage_rewrites, results_log = _resumed_script_updates(resumed_tasks)
+        modified_script, _ = _apply_script_updates(kag_script, api_type, lines_to_uncomment, storage_rewrites)
+        final_message = f"{api_type} 续传完成：{len(resumed_tasks)} 个任务已在上次运行中生成，无需生成新图片。"
+        logger.info(final_message) # 功能性备注
+        return {"message": final_message, "details": results_log, "modified_script": modified_script}, None
     if not tasks_to_run:
         logger.info(f"根据范围 '{scope}' 未找到需要执行的有效图片生成任务。") # 功能性备注
         return {"message": f"根据范围 '{scope}' 未找到需要执行的有效图片生成任务。", "details": [], "modified_script": kag_script}, None
     logger.info(f"[{api_type} Gen] 根据范围 '{scope}' 筛选后，准备执行 {len(tasks_to_run)} 个任务。") # 功能性备注
 
-    # --- 准备 API 配置和保存路径 (保持不变) ---
-    base_save_path = None; api_key = None; api_url = None; nai_proxy_config = None; workflow_file_path = None; base_workflow = None
+    # --- 准备 API 配置和保存路径 ---
+    base_save_path = None; api_key = None; nai_proxy_config = None; workflow_file_path = None; workflow_template = None
+    endpoints = []
     # 功能性备注: 获取共享配置中的保存目录
     save_dir = shared_config.get("imageSaveDir")
     if not save_dir:
@@ -209,18 +1646,19 @@ def task_generate_images(api_helpers, api_type, shared_config, specific_config,
         logger.exception(err_msg) # 逻辑备注
         return None, err_msg
 
-    # 功能性备注: 根据 API 类型加载特定配置
+    # 功能性备注: 根据 API 类型加载特定配置，并构建后端节点列表
     if api_type == "NAI":
         api_key = specific_config.get('naiApiKey')
         nai_proxy_config = {k: specific_config.get(k) for k in ["nai_use_proxy", "nai_proxy_address", "nai_proxy_port"]}
         if not api_key: logger.error("NAI API Key 未配置。"); return None, "错误：NAI API Key 未配置。" # 逻辑备注
+        endpoints = [BackendEndpoint(NAI_ENDPOINT_URL, min_interval=NAI_MIN_REQUEST_INTERVAL)]
     elif api_type == "SD WebUI":
-        api_url = specific_config.get('sdWebUiUrl')
-        if not api_url: logger.error("SD WebUI URL 未配置。"); return None, "错误：SD WebUI URL 未配置。" # 逻辑备注
+        endpoints = parse_endpoint_list(specific_config.get('sdWebUiEndpoints', ''), fallback_url=specific_config.get('sdWebUiUrl'))
+        if not endpoints: logger.error("SD WebUI URL 未配置。"); return None, "错误：SD WebUI URL 未配置。" # 逻辑备注
     elif api_type == "ComfyUI":
-        api_url = specific_config.get('comfyapiUrl')
+        endpoints = parse_endpoint_list(specific_config.get('comfyEndpoints', ''), fallback_url=specific_config.get('comfyapiUrl'))
         workflow_file_path = specific_config.get('comfyWorkflowFile')
-        if not api_url: logger.error("ComfyUI URL 未配置。"); return None, "错误：ComfyUI URL 未配置。" # 逻辑备注
+        if not endpoints: logger.error("ComfyUI URL 未配置。"); return None, "错误：ComfyUI URL 未配置。" # 逻辑备注
         if not workflow_file_path or not Path(workflow_file_path).is_file():
             # 逻辑备注: Comfy 工作流文件无效或不存在，返回错误
             err_msg = f"错误：ComfyUI 工作流文件路径无效或文件不存在: '{workflow_file_path}'"
@@ -231,8 +1669,12 @@ def task_generate_images(api_helpers, api_type, shared_config, specific_config,
             with open(workflow_file_path, 'r', encoding='utf-8') as f:
                 base_workflow = json.load(f)
             logger.info(f"[{api_type} Gen] 成功加载基础工作流: {workflow_file_path}") # 功能性备注
+            # 功能性备注: 编译为模板，每个任务只生成补丁，不再深拷贝和逐个查找节点
+            workflow_template = _compile_comfyui_workflow(base_workflow, shared_config, specific_config)
+            # 功能性备注: 新批次开始，上次运行缓存的上传文件需重新确认仍存在于服务器
+            get_comfyui_upload_cache().begin_run()
         except Exception as e:
-            # 逻辑备注: 加载或解析工作流失败，返回错误
+            # 逻辑备注: 加载、解析或编译工作流失败，返回错误
             err_msg = f"错误：加载或解析 ComfyUI 工作流文件失败: {e}"
             logger.exception(err_msg) # 逻辑备注
             return None, err_msg
@@ -242,584 +1684,145 @@ def task_generate_images(api_helpers, api_type, shared_config, specific_config,
         logger.error(err_msg) # 逻辑备注
         return None, err_msg
 
-    # --- 循环执行任务 ---
-    generated_count = 0; failed_count = 0; results_log = []; lines_to_uncomment = set()
-
-    for i, task in enumerate(tasks_to_run):
-        # 逻辑备注: 在处理每个任务前检查停止信号
-        if stop_event and stop_event.is_set():
-            logger.info(f"任务在处理 '{task['filename']}' 之前被停止。") # 功能性备注
-            task_error_msg = "任务被用户停止"
-            break # 功能性备注: 跳出循环
-
-        logger.info(f"\n--- [{api_type} Gen] {i+1}/{len(tasks_to_run)}: 处理任务 '{task['filename']}' (原始状态: {'已注释' if task['is_commented'] else '未注释'}, 请求生成 {n_samples} 张) ---") # 功能性备注
-        filename_base, file_ext = os.path.splitext(task['filename']); file_ext = file_ext if file_ext else ".png"
-        all_samples_successful = True; task_error_msg = None; image_data_list = []
-        is_img2img_mode_active = False # 功能性备注: 标记当前任务是否执行图生图
-        init_image_path = None
-        init_image_b64 = None
-        mask_path = None
-        mask_b64 = None
-        task_loras = [] # 功能性备注: 存储当前任务应用的 LoRA
-
-        # 功能性备注: 获取当前任务对应的人物设定数据
-        profile_data = character_profiles.get(task['name'])
-        if isinstance(profile_data, dict):
-            task_loras = profile_data.get("loras", []) # 获取 LoRA 列表
-            if not isinstance(task_loras, list): task_loras = [] # 确保是列表
-        else:
-            profile_data = {} # 如果找不到人物，则为空字典
-
-        # 功能性备注: 检查图生图/内绘条件
-        if use_img2img_toggle: # 检查全局开关是否打开
-            init_image_path = profile_data.get("image_path", "").strip()
-            if init_image_path and os.path.exists(init_image_path):
-                is_img2img_mode_active = True # 只有开关打开且路径有效才激活
-                logger.info(f"  - 图生图模式已激活，使用参考图: {init_image_path}") # 功能性备注
-                # 功能性备注: 读取并编码参考图 (Base64) - 仅 NAI 和 SD 需要在此步骤处理
-                if api_type in ["NAI", "SD WebUI"]:
-                    try:
-                        with open(init_image_path, "rb") as img_file:
-                            init_image_b64 = base64.b64encode(img_file.read()).decode('utf-8')
-                        logger.info(f"  - 参考图已读取并编码为 Base64。") # 功能性备注
-                    except Exception as img_read_e:
-                        task_error_msg = f"错误：读取或编码参考图像 '{init_image_path}' 失败: {img_read_e}"
-                        logger.exception(f"  - {task_error_msg}"); is_img2img_mode_active = False; init_image_b64 = None # 逻辑备注
-                # 功能性备注: 检查并读取蒙版图 (可选) - 仅在参考图成功加载后进行
-                if is_img2img_mode_active:
-                    mask_path = profile_data.get("mask_path", "").strip()
-                    if mask_path and os.path.exists(mask_path):
-                        logger.info(f"  - 检测到蒙版图像: {mask_path}") # 功能性备注
-                        # 功能性备注: NAI 和 SD 需要 Base64 编码
-                        if api_type in ["NAI", "SD WebUI"]:
-                            try:
-                                 with open(mask_path, "rb") as mask_file:
-                                     mask_b64 = base64.b64encode(mask_file.read()).decode('utf-8')
-                                 logger.info(f"  - 蒙版图像已读取并编码为 Base64。将执行内/外绘模式。") # 功能性备注
-                            except Exception as mask_read_e:
-                                 logger.warning(f"  - 读取或编码蒙版图像失败: {mask_read_e}，将执行标准图生图。") # 逻辑备注
-                                 mask_b64 = None
-                        # 逻辑备注: 如果蒙版路径无效
-                        elif mask_path:
-                             logger.warning(f"  - 配置了蒙版路径但文件无效: '{mask_path}'，将执行标准图生图。") # 逻辑备注
-                        else:
-                             logger.info("  - 未配置蒙版图像，将执行标准图生图。") # 功能性备注
-            # 逻辑备注: 处理参考图路径无效或未配置的情况
-            elif init_image_path:
-                 logger.warning(f"  - 图生图开关已启用，但人物 '{task['name']}' 的参考图路径无效或不存在，执行文生图。") # 逻辑备注
-            else:
-                 logger.info(f"  - 图生图开关已启用，但人物 '{task['name']}' 未配置参考图，执行文生图。") # 功能性备注
-        else:
-            logger.info("  - 图生图开关未启用，执行文生图。") # 功能性备注
-
-        # --- *** 逻辑修改：确定当前任务使用的种子值 *** ---
-        current_task_seed = -1 # 默认值
-        if api_type == "NAI":
-            if specific_config.get('naiRandomSeed', False):
-                current_task_seed = random.randint(1, 2**31 - 1)
-                logger.info(f"  - NAI 任务 '{task['filename']}' 使用客户端生成的随机种子: {current_task_seed}") # 功能性备注
-            else:
-                current_task_seed = specific_config.get('naiSeed', -1)
-                logger.info(f"  - NAI 任务 '{task['filename']}' 使用配置种子: {current_task_seed}") # 功能性备注
-        elif api_type in ["SD WebUI", "ComfyUI"]:
-            if shared_config.get('sharedRandomSeed', False):
-                current_task_seed = random.randint(1, 2**31 - 1)
-                logger.info(f"  - {api_type} 任务 '{task['filename']}' 使用客户端生成的随机种子: {current_task_seed}") # 功能性备注
-            else:
-                current_task_seed = shared_config.get('seed', -1)
-                logger.info(f"  - {api_type} 任务 '{task['filename']}' 使用配置种子: {current_task_seed}") # 功能性备注
-        # --- *** 种子确定结束 *** ---
+    pool = BackendPool(endpoints)
+    # 逻辑备注: NAI 每个账号只允许同时生成一张图片，提高并发只会得到 429，因此不启用自适应并发
+    if api_type != "NAI" and shared_config.get('adaptiveConcurrencyEnabled', False):
+        pool.enable_adaptive(shared_config.get('adaptiveMaxConcurrency', DEFAULT_ADAPTIVE_MAX_CONCURRENCY))
+    logger.info(f"[{api_type} Gen] 后端节点池: {len(pool.endpoints)} 个节点，总并发 {pool.total_concurrency}。 {pool.endpoints}") # 功能性备注
+    # 功能性备注: ComfyUI 预检 (节点类型、模型/VAE/LoRA 名称)，配置错误时在提交任何任务前一次性报告
+    if api_type == "ComfyUI" and specific_config.get('comfyPreflightEnabled', True):
+        if preflight_report := _preflight_comfyui(pool.endpoints, workflow_template, shared_config, specific_config, character_profiles, tasks_to_run):
+            logger.error(preflight_report) # 逻辑备注
+            return None, preflight_report
 
-        # --- 调用 API (根据 api_type 和 is_img2img_mode_active) ---
-        # 逻辑备注: 在调用具体 API 前再次检查停止信号
-        if stop_event and stop_event.is_set():
-            logger.info(f"任务在调用 API for '{task['filename']}' 之前被停止。") # 功能性备注
-            task_error_msg = "任务被用户停止"
-            break # 功能性备注: 跳出循环
+    # 功能性备注: 本次运行中所有任务共享的上下文
+    run_ctx = {
+        "api_type": api_type, "shared_config": shared_config, "specific_config": specific_config,
+        "character_profiles": character_profiles, "use_img2img_toggle": use_img2img_toggle,
+        "n_samples": n_samples, "save_debug": save_debug, "stop_event": stop_event,
+        "base_save_path": base_save_path, "api_key": api_key, "nai_proxy_config": nai_proxy_config,
+        "workflow_template": workflow_template, "total_tasks": len(tasks_to_run),
+        "state_lock": threading.Lock(),
+        "postprocess_fallbacks": set(), # 功能性备注: 重新编码失败、图片按原格式保存的任务 (完整 image 行)
+        # 功能性备注: 图片解码与写盘的线程池 (有界队列)
+        "image_writer": ImageWriterPool(base_save_path),
+        # 功能性备注: 生成日志 (每个任务写入完成后立即追加记录，用于续传)
+        "journal": GenerationJournal(base_save_path),
+        # 功能性备注: 可选的保存后处理 (重新编码为配置的格式)，在进程池中与生成并行
+        "postprocessor": ImagePostprocessor(postprocess_options, shared_config.get('postprocessWorkers', DEFAULT_POSTPROCESS_WORKERS)) if (postprocess_options := postprocess_options_from_config(shared_config)) else None,
+        # 功能性备注: 已生成图片缓存 (仅固定种子的任务使用) 与 SD 节点当前模型名称
+        "image_cache": get_generated_image_cache(shared_config.get('imageCacheMaxMB', DEFAULT_IMAGE_CACHE_MAX_MB)) if shared_config.get('imageCacheEnabled', False) else None,
+        "sd_model_names": {},
+        "sd_server_save_disabled": set(), # 功能性备注: 本批次已确认不共享目录、改用 Base64 传输的 SD 节点
+        "sd_task_ids": {}, # 功能性备注: {进度键: 进行中的 SD WebUI 请求的 force_task_id}
+        "sd_abandoned_tasks": set(), # 功能性备注: 停止时仍在服务器队列中、已在本地放弃等待的 force_task_id
+        # 功能性备注: SD WebUI 模型/VAE/CLIP Skip 设置的发送方式与运行结束时的恢复
+        "sd_options_session": _SdOptionsSession(specific_config.get('sdOverrideMode', 'sticky')),
+        # 功能性备注: 进度统计与 UI 回调
+        "progress": BatchProgressTracker(len(tasks_to_run), progress_callback, extra_info=pool.limit_summary),
+        # 功能性备注: 图生图参考图/蒙版的编码缓存 (按配置缩小到生成尺寸)
+        "img2img_cache": _Img2ImgInputCache(
+            (shared_config.get('width'), shared_config.get('height'))
+            if shared_config.get('img2imgDownscaleInputs', True) and shared_config.get('width') and shared_config.get('height') else None
+        ),
+    }
 
-        if api_type == "NAI":
-            # 逻辑备注: NAI 不支持 LoRA 注入
-            if task_loras: logger.warning("NAI API 不支持通过此方式注入 LoRA，将忽略人物设定的 LoRA 配置。") # 逻辑备注
-            # 功能性备注: 构建 NAI 请求体
-            payload = {
-                "action": "generate", # 默认为 generate，如果内绘则改为 inpaint
-                "input": task['positive'],
-                "model": specific_config.get('naiModel'),
-                "parameters": {
-                    "width": shared_config.get('width'),
-                    "height": shared_config.get('height'),
-                    "scale": specific_config.get('naiScale'),
-                    "sampler": specific_config.get('naiSampler'),
-                    "steps": specific_config.get('naiSteps'),
-                    "seed": current_task_seed, # 逻辑修改: 使用当前任务的种子
-                    "n_samples": n_samples,
-                    "ucPreset": specific_config.get('naiUcPreset'),
-                    "qualityToggle": specific_config.get('naiQualityToggle'),
-                    "sm": specific_config.get("naiSmea", False),
-                    "sm_dyn": specific_config.get("naiSmeaDyn", False),
-                    "dynamic_thresholding": specific_config.get("naiDynamicThresholding", False),
-                    "uncond_scale": specific_config.get("naiUncondScale", 1.0),
-                    "negative_prompt": task['negative']
-                }
-            }
-            # 功能性备注: 处理图生图/内绘参数
-            if is_img2img_mode_active and init_image_b64:
-                payload["parameters"]["image"] = init_image_b64
-                payload["parameters"]["strength"] = specific_config.get("naiReferenceStrength", 0.6)
-                payload["parameters"]["noise"] = 1.0 - specific_config.get("naiReferenceInfoExtracted", 0.7)
-                payload["parameters"]["add_original_image"] = specific_config.get("naiAddOriginalImage", True)
-                if mask_b64:
-                    payload["parameters"]["mask"] = mask_b64
-                    payload["action"] = "inpaint" # 切换 action
-                    logger.info("  - NAI 内绘模式参数已添加。") # 功能性备注
-                else:
-                    logger.info("  - NAI 图生图模式参数已添加。") # 功能性备注
-            else:
-                logger.info("  - NAI 文生图模式。") # 功能性备注
+    # --- 规划执行顺序: 按模型亲和键 (LoRA 组合、生成模式) 分组，减少后端切换权重的次数 ---
+    affinity_keys = [_task_affinity_key(task, character_profiles, use_img2img_toggle) for task in tasks_to_run]
+    execution_order = list(range(len(tasks_to_run)))
+    if shared_config.get('affinitySchedulingEnabled', True) and api_type != "NAI":
+        execution_order = _plan_task_order(affinity_keys)
+        switches_before = sum(1 for a, b in zip(affinity_keys, affinity_keys[1:]) if a != b)
+        switches_after = sum(1 for a, b in zip(execution_order, execution_order[1:]) if affinity_keys[a] != affinity_keys[b])
+        if switches_after < switches_before:
+            logger.info(f"[{api_type} Gen] 按模型亲和性重排执行顺序: 权重切换 {switches_before} -> {switches_after} 次 (结果仍按脚本顺序汇总)。") # 功能性备注
 
-            # 功能性备注: 调用 NAI API 助手函数
-            zip_data, task_error_msg = api_helpers.call_novelai_image_api(api_key, payload, proxy_config=nai_proxy_config, save_debug=save_debug)
-            time.sleep(1) # 调用后等待
-
-            # 逻辑备注: 在 API 调用后检查停止信号
-            if stop_event and stop_event.is_set():
-                logger.info(f"任务在 NAI API 调用后被停止，结果将被丢弃。") # 功能性备注
-                task_error_msg = "任务被用户停止"
-                break # 功能性备注: 跳出循环
+    # --- ComfyUI 融合提交: 相邻的同类文生图任务每 K 个合并为一个工作流 ---
+    task_groups = [[i] for i in execution_order]
+    fuse_count = specific_config.get('comfyFuseTaskCount', 1) if api_type == "ComfyUI" else 1
+    if fuse_count > 1:
+        if workflow_template.node_id("comfyWebsocketSaveNodeTitle"):
+            logger.info(f"[ComfyUI Gen] 工作流使用 WebSocket 保存节点，无法区分融合后各任务的图片，不融合提交。") # 逻辑备注
+        elif workflow_template.node_id("comfyOutputNodeTitle") is None:
+            logger.info(f"[ComfyUI Gen] 未找到输出节点，不融合提交。") # 逻辑备注
+        else:
+            task_groups = _plan_fused_groups(execution_order, affinity_keys, fuse_count)
+            if (fused_count := sum(1 for group in task_groups if len(group) > 1)):
+                logger.info(f"[ComfyUI Gen] 融合提交: {len(tasks_to_run)} 个任务合并为 {len(task_groups)} 次提交 ({fused_count} 组融合，每组最多 {fuse_count} 个)。") # 功能性备注
 
-            # 功能性备注: 处理返回的 Zip 数据
-            if zip_data and not task_error_msg:
+    # --- 并行执行任务 (工作线程数等于节点池总并发的最大可能值，实际并发由节点池控制) ---
+    task_results = [None] * len(tasks_to_run) # 功能性备注: 按脚本顺序存放每个任务的结果
+    max_workers = max(1, min(pool.total_concurrency, len(task_groups)))
+    # 功能性备注: SD WebUI 的采样进度需要轮询 /sdapi/v1/progress (ComfyUI 通过 WebSocket 事件推送)
+    sd_progress_poller = _SdProgressPoller(api_helpers, run_ctx) if api_type == "SD WebUI" and progress_callback else None
+    if sd_progress_poller: sd_progress_poller.start()
+    # 功能性备注: 停止时中断 SD WebUI 节点上正在执行的本批次任务 (ComfyUI 由 call_comfyui_api 自行取消已提交的 prompt)
+    sd_cancel_watcher = _SdCancelWatcher(api_helpers, run_ctx) if api_type == "SD WebUI" and stop_event else None
+    if sd_cancel_watcher: sd_cancel_watcher.start()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ImageGen") as executor:
+            # 逻辑备注: 按规划顺序提交 (线程池按提交顺序取任务)，结果按原下标存放
+            group_futures = [
+                executor.submit(_process_task, api_helpers, run_ctx, pool, group[0], tasks_to_run[group[0]], affinity_keys[group[0]]) if len(group) == 1
+                else executor.submit(_process_fused_comfyui_tasks, api_helpers, run_ctx, pool, group, [tasks_to_run[i] for i in group], affinity_keys[group[0]])
+                for group in task_groups
+            ]
+            for group, future in zip(task_groups, group_futures):
                 try:
-                    with zipfile.ZipFile(io.BytesIO(zip_data)) as zf:
-                        extracted_count = 0
-                        for img_info in zf.infolist():
-                            # 逻辑备注: 确保只提取 PNG 文件且不超过请求数量
-                            if not img_info.is_dir() and img_info.filename.lower().endswith('.png') and extracted_count < n_samples:
-                                image_data_list.append(zf.read(img_info.filename)); extracted_count += 1
-                        # 逻辑备注: 检查返回数量是否符合预期
-                        if len(image_data_list) != n_samples:
-                            logger.warning(f"NAI 返回 PNG 图片数量 ({len(image_data_list)}) 与请求数量 ({n_samples}) 不符!") # 逻辑备注
-                        if not image_data_list:
-                            task_error_msg = "错误: 未能从 NAI Zip 文件中提取到 PNG 图片。"
-                            logger.error(task_error_msg) # 逻辑备注
-                except Exception as zip_e:
-                    task_error_msg = f"错误: 解压 NAI Zip 文件失败: {zip_e}"
-                    logger.exception(task_error_msg) # 逻辑备注
-            elif not task_error_msg:
-                task_error_msg = "错误: NAI API 调用成功但未返回数据。"
-                logger.error(task_error_msg) # 逻辑备注
-
-        elif api_type == "SD WebUI":
-            # 功能性备注: 组合最终的提示词 (包括 LoRA 和全局附加提示)
-            final_positive = task['positive']; add_pos = shared_config.get('additionalPositivePrompt', ''); final_negative = task['negative']; add_neg = shared_config.get('additionalNegativePrompt', '')
-            if add_pos: final_positive += f", {add_pos}"
-            if add_neg: final_negative = f"{final_negative}, {add_neg}" if final_negative else add_neg
-            # 功能性备注: 添加 LoRA 到正向提示词
-            lora_strings = []
-            if task_loras:
-                for lora in task_loras:
-                    lora_name = lora.get("name")
-                    model_weight = lora.get("model_weight", 1.0)
-                    if lora_name:
-                        lora_strings.append(f"<lora:{lora_name}:{model_weight}>")
-                if lora_strings:
-                    final_positive += " " + " ".join(lora_strings) # 用空格分隔 LoRA 标记
-                    logger.info(f"  - 已将 {len(lora_strings)} 个 LoRA 添加到 SD WebUI 正向提示词。") # 功能性备注
-
-            # 功能性备注: 构建 SD WebUI 请求体
-            payload = {
-                "prompt": final_positive.strip(', '),
-                "negative_prompt": final_negative.strip(', '),
-                "sampler_name": shared_config.get('sampler'),
-                "steps": shared_config.get('steps'),
-                "cfg_scale": shared_config.get('cfgScale'),
-                "width": shared_config.get('width'),
-                "height": shared_config.get('height'),
-                "seed": current_task_seed, # 逻辑修改: 使用当前任务的种子
-                "restore_faces": shared_config.get('restoreFaces'),
-                "tiling": shared_config.get('tiling'),
-                "n_iter": 1, # 迭代次数固定为 1
-                "batch_size": n_samples, # 批处理大小等于请求的样本数
-            }
-
-            # 功能性备注: 确定 API 端点后缀和添加特定参数
-            endpoint_suffix = "/sdapi/v1/txt2img" # 默认为文生图
-            if is_img2img_mode_active and init_image_b64:
-                # 逻辑备注: 如果是图生图模式
-                payload["init_images"] = [init_image_b64]
-                payload["denoising_strength"] = shared_config.get('denoisingStrength', 0.7)
-                payload["resize_mode"] = specific_config.get('sdResizeMode', 1)
-                endpoint_suffix = "/sdapi/v1/img2img" # 切换到图生图端点
-                if mask_b64:
-                    # 逻辑备注: 如果有蒙版，添加内绘参数
-                    payload["mask"] = mask_b64
-                    payload["mask_blur"] = shared_config.get('maskBlur', 4)
-                    payload["inpainting_fill"] = specific_config.get('sdInpaintingFill', 1)
-                    payload["inpainting_mask_invert"] = specific_config.get('sdMaskMode', 0)
-                    payload["inpaint_full_res"] = specific_config.get('sdInpaintArea', 1) == 0
-                    logger.info("  - SD WebUI 内绘模式参数已添加。") # 功能性备注
-                else:
-                    logger.info("  - SD WebUI 图生图模式参数已添加。") # 功能性备注
-            else:
-                # 逻辑备注: 如果是文生图模式
-                logger.info("  - SD WebUI 文生图模式。") # 功能性备注
-                # 功能性备注: 添加高清修复参数 (仅文生图时有效)
-                if specific_config.get("sdEnableHR", False):
-                    payload["enable_hr"] = True
-                    payload["hr_scale"] = specific_config.get("sdHRScale", 2.0)
-                    payload["hr_upscaler"] = specific_config.get("sdHRUpscaler", "Latent")
-                    payload["hr_second_pass_steps"] = specific_config.get("sdHRSteps", 0)
-                    payload["denoising_strength"] = shared_config.get('denoisingStrength', 0.7) # Hires fix 也需要 denoise
-                    logger.info("  - SD WebUI 高清修复参数已添加。") # 功能性备注
-
-            # 功能性备注: 添加覆盖设置 (模型, VAE, CLIP Skip)
-            override_settings = {}
-            if override_model := specific_config.get("sdOverrideModel"): override_settings["sd_model_checkpoint"] = override_model
-            if override_vae := specific_config.get("sdOverrideVAE"): override_settings["sd_vae"] = override_vae
-            override_settings["CLIP_stop_at_last_layers"] = shared_config.get("clipSkip", 1)
-            if override_settings:
-                payload["override_settings"] = override_settings
-                logger.info(f"  - SD WebUI 覆盖设置已添加: {list(override_settings.keys())}") # 功能性备注
-
-            # 功能性备注: 构建基础 API URL
-            base_api_url = api_url.rstrip('/')
-            logger.info(f"  - SD WebUI API Endpoint Suffix: {endpoint_suffix}") # 功能性备注
-
-            # 功能性备注: 调用 SD WebUI API 助手函数
-            base64_image_list, task_error_msg = api_helpers.call_sd_webui_api(base_api_url, endpoint_suffix, payload, save_debug=save_debug)
-            time.sleep(0.2) # 调用后等待
-
-            # 逻辑备注: 在 API 调用后检查停止信号
-            if stop_event and stop_event.is_set():
-                logger.info(f"任务在 SD WebUI API 调用后被停止，结果将被丢弃。") # 功能性备注
-                task_error_msg = "任务被用户停止"
-                break # 功能性备注: 跳出循环
-
-            # 功能性备注: 处理返回的 Base64 图像列表
-            if base64_image_list and not task_error_msg:
-                # 逻辑备注: 检查返回数量是否符合预期
-                if len(base64_image_list) != n_samples:
-                    logger.warning(f"SD API 返回图片数量 ({len(base64_image_list)}) 与请求数量 ({n_samples}) 不符!") # 逻辑备注
-                # 功能性备注: 解码 Base64 数据
-                for idx, b64_img in enumerate(base64_image_list):
-                    if idx >= n_samples: break # 最多只处理请求的数量
-                    try:
-                        # 逻辑备注: 处理可能的 data:image/... 前缀
-                        b64_data = b64_img.split(',', 1)[-1] if isinstance(b64_img, str) and ',' in b64_img else b64_img
-                        image_data_list.append(base64.b64decode(b64_data))
-                    except Exception as dec_e:
-                        # 逻辑备注: 解码失败错误
-                        task_error_msg = f"错误: Base64 解码失败 (图片 {idx+1}): {dec_e}"; image_data_list = [];
-                        logger.exception(task_error_msg) # 逻辑备注
-                        break
-            elif not task_error_msg:
-                # 逻辑备注: API 调用成功但未返回数据错误
-                task_error_msg = "错误: SD API 调用成功但未返回任何图片数据。"
-                logger.error(task_error_msg) # 逻辑备注
-
-        elif api_type == "ComfyUI":
-            # 逻辑备注: 检查基础工作流是否已加载
-            if not base_workflow: task_error_msg = "错误: 基础 ComfyUI 工作流未加载。"; logger.error(task_error_msg); break # 逻辑备注
-            # 功能性备注: 深拷贝基础工作流，避免修改原始字典
-            workflow_to_run = copy.deepcopy(base_workflow)
-            modification_log = [] # 功能性备注: 记录工作流修改操作
-            client_id = str(uuid.uuid4()) # 功能性备注: 为本次调用生成唯一的客户端 ID
-
-            # 功能性备注: 获取节点标题配置
-            pos_title = specific_config.get("comfyPositiveNodeTitle")
-            neg_title = specific_config.get("comfyNegativeNodeTitle")
-            sampler_title = specific_config.get("comfySamplerNodeTitle")
-            latent_title = specific_config.get("comfyLatentImageNodeTitle")
-            save_title = specific_config.get("comfyOutputNodeTitle")
-            ckpt_title = specific_config.get("comfyCheckpointNodeTitle")
-            vae_title = specific_config.get("comfyVAENodeTitle")
-            clip_enc_title = specific_config.get("comfyClipTextEncodeNodeTitle")
-            lora_loader_title = specific_config.get("comfyLoraLoaderNodeTitle") # 获取 LoRA 加载节点标题
-            load_image_title = specific_config.get("comfyLoadImageNodeTitle") # 用于图生图
-            # --- 新增开始 ---
-            load_mask_title = specific_config.get("comfyLoadMaskNodeTitle") # 获取加载蒙版节点标题
-            # --- 新增结束 ---
-            face_detailer_title = specific_config.get("comfyFaceDetailerNodeTitle") # 可选
-            tiling_sampler_title = specific_config.get("comfyTilingSamplerNodeTitle") # 可选
-
-            # 功能性备注: 组合最终的提示词
-            final_positive = task['positive']; add_pos = shared_config.get('additionalPositivePrompt', ''); final_negative = task['negative']; add_neg = shared_config.get('additionalNegativePrompt', '')
-            if add_pos: final_positive += f", {add_pos}"
-            if add_neg: final_negative = f"{final_negative}, {add_neg}" if final_negative else add_neg
-
-            logger.info("  - 开始修改 ComfyUI 工作流节点...") # 功能性备注
-            node_modified = False # 标记是否有节点被修改
-            server_filename = None # 用于存储上传后的参考图文件名
-            server_mask_filename = None # 用于存储上传后的蒙版文件名
-
-            # --- 上传图片逻辑 (如果需要) ---
-            if is_img2img_mode_active:
-                logger.info("  - [ComfyUI Img2Img] 检测到图生图模式，尝试上传文件...") # 功能性备注
-                if init_image_path:
-                    # 功能性备注: 上传参考图
-                    uploaded_name, upload_error = upload_image_to_comfyui(api_url, init_image_path, save_debug=save_debug)
-                    if upload_error:
-                        # 逻辑备注: 上传失败则记录错误并退回文生图
-                        task_error_msg = f"参考图上传失败: {upload_error}"
-                        modification_log.append(f"错误: {task_error_msg}")
-                        logger.error(f"  - {task_error_msg}，图生图无法进行。") # 逻辑备注
-                        is_img2img_mode_active = False # 退回文生图
-                        modification_log.append("警告: 因参考图上传失败，已切换回文生图模式。")
-                    else:
-                        # 功能性备注: 上传成功则记录服务器文件名
-                        server_filename = uploaded_name
-                        modification_log.append(f"参考图上传成功: 服务器文件名 '{server_filename}'")
-                else:
-                    # 逻辑备注: 未提供有效本地路径
-                    modification_log.append("警告: 图生图模式已启用，但未提供有效的本地参考图路径。")
-                    logger.warning("图生图模式已启用，但未提供有效的本地参考图路径。") # 逻辑备注
-                    is_img2img_mode_active = False # 退回文生图
-
-                # 功能性备注: 如果参考图上传成功，且有蒙版路径，则上传蒙版
-                if is_img2img_mode_active and mask_path:
-                    uploaded_mask_name, upload_mask_error = upload_image_to_comfyui(api_url, mask_path, save_debug=save_debug)
-                    if upload_mask_error:
-                        # 逻辑备注: 蒙版上传失败则记录警告，但不中断图生图
-                        mask_error_msg = f"蒙版图上传失败: {upload_mask_error}"
-                        modification_log.append(f"警告: {mask_error_msg}，将执行标准图生图（如果可能）。")
-                        logger.warning(f"  - {mask_error_msg}") # 逻辑备注
-                    else:
-                        # 功能性备注: 蒙版上传成功则记录服务器文件名
-                        server_mask_filename = uploaded_mask_name
-                        modification_log.append(f"蒙版图上传成功: 服务器文件名 '{server_mask_filename}'")
-
-            # --- 修改工作流节点 ---
-            # 功能性备注: 1. Checkpoint 覆盖
-            ckpt_override = specific_config.get("comfyCkptName")
-            if ckpt_override:
-                ckpt_id, ckpt_node = _find_node_id_by_title(workflow_to_run, ckpt_title)
-                if ckpt_node and _set_node_input(ckpt_node, "ckpt_name", ckpt_override):
-                    modification_log.append(f"覆盖 Checkpoint '{ckpt_title}' 为 '{ckpt_override}'"); node_modified = True
-                else: modification_log.append(f"警告: 未找到 Checkpoint 节点 '{ckpt_title}' 或设置失败，无法应用覆盖。")
-            # 功能性备注: 2. VAE 覆盖
-            vae_override = specific_config.get("comfyVaeName")
-            if vae_override:
-                # 功能性备注: 尝试查找单独的 VAE 加载节点
-                vae_id, vae_node = _find_node_id_by_title(workflow_to_run, vae_title)
-                if vae_node and _set_node_input(vae_node, "vae_name", vae_override):
-                    modification_log.append(f"覆盖 VAE '{vae_title}' 为 '{vae_override}'"); node_modified = True
-                else: modification_log.append(f"警告: 未找到 VAE 加载节点 '{vae_title}' 或设置失败，无法应用 VAE 覆盖。")
-            # 功能性备注: 3. 提示词节点
-            pos_id, pos_node = _find_node_id_by_title(workflow_to_run, pos_title)
-            if pos_node and _set_node_input(pos_node, "text", final_positive.strip(', ')): modification_log.append(f"设置正向提示 '{pos_title}'"); node_modified = True
-            else: modification_log.append(f"警告: 未找到或无法设置正向提示节点 '{pos_title}'")
-            neg_id, neg_node = _find_node_id_by_title(workflow_to_run, neg_title)
-            if neg_node and _set_node_input(neg_node, "text", final_negative.strip(', ')): modification_log.append(f"设置负向提示 '{neg_title}'"); node_modified = True
-            else: modification_log.append(f"警告: 未找到或无法设置负向提示节点 '{neg_title}'")
-            # 功能性备注: 4. CLIP Skip (应用于指定的 CLIP 编码节点)
-            clip_skip_val = shared_config.get("clipSkip", 1)
-            clip_enc_id, clip_enc_node = _find_node_id_by_title(workflow_to_run, clip_enc_title) # 查找用于 ClipSkip 的节点
-            if clip_enc_node:
-                 comfy_clip_skip = -abs(clip_skip_val) # ComfyUI 用负数表示跳过层数
-                 if _set_node_input(clip_enc_node, "stop_at_clip_layer", comfy_clip_skip):
-                     modification_log.append(f"设置 CLIP Skip '{clip_enc_title}' 为 {comfy_clip_skip}"); node_modified = True
-                 else: modification_log.append(f"警告: 无法设置 CLIP Skip 节点 '{clip_enc_title}' 的输入。")
-            else: modification_log.append(f"警告: 未找到 CLIP 编码节点 '{clip_enc_title}'，无法设置 CLIP Skip。")
-            # 功能性备注: 5. 采样器节点 (注入共享参数)
-            sampler_id, sampler_node = _find_node_id_by_title(workflow_to_run, sampler_title)
-            if sampler_node:
-                if _set_node_input(sampler_node, "seed", current_task_seed): modification_log.append(f"设置采样器种子 '{sampler_title}' 为 {current_task_seed}"); node_modified = True # 逻辑修改: 使用当前任务种子
-                if _set_node_input(sampler_node, "steps", shared_config.get('steps')): modification_log.append(f"设置采样器步数 '{sampler_title}'"); node_modified = True
-                if _set_node_input(sampler_node, "cfg", shared_config.get('cfgScale')): modification_log.append(f"设置采样器 CFG '{sampler_title}'"); node_modified = True
-                if _set_node_input(sampler_node, "sampler_name", shared_config.get('sampler')): modification_log.append(f"设置采样器名称 '{sampler_title}'"); node_modified = True
-                if _set_node_input(sampler_node, "scheduler", shared_config.get('scheduler')): modification_log.append(f"设置采样器调度器 '{sampler_title}'"); node_modified = True
-                # 功能性备注: Denoise: 图生图用配置值，文生图固定为 1.0
-                current_denoise = shared_config.get('denoisingStrength', 0.7) if is_img2img_mode_active else 1.0
-                if _set_node_input(sampler_node, "denoise", current_denoise): modification_log.append(f"设置采样器 Denoise '{sampler_title}' 为 {current_denoise}"); node_modified = True
-            else: modification_log.append(f"警告: 未找到采样器节点 '{sampler_title}'")
-            # 功能性备注: 6. 潜空间节点 (设置尺寸和批处理大小，仅文生图时)
-            latent_id, latent_node = _find_node_id_by_title(workflow_to_run, latent_title)
-            if latent_node:
-                if not is_img2img_mode_active: # 仅在文生图时修改尺寸和批处理
-                    if _set_node_input(latent_node, "width", shared_config.get('width')): modification_log.append(f"设置潜空间宽度 '{latent_title}'"); node_modified = True
-                    if _set_node_input(latent_node, "height", shared_config.get('height')): modification_log.append(f"设置潜空间高度 '{latent_title}'"); node_modified = True
-                    if _set_node_input(latent_node, "batch_size", n_samples): modification_log.append(f"设置潜空间批处理大小为 {n_samples}"); node_modified = True
-                else:
-                    # 逻辑备注: 图生图模式下潜空间尺寸由 VAEEncode 决定，不修改
-                    modification_log.append(f"信息: 图生图模式，潜空间尺寸由工作流决定。")
-            else: modification_log.append(f"警告: 未找到潜空间节点 '{latent_title}'")
-            # 功能性备注: 7. LoRA 覆盖 (如果人物设定中有 LoRA)
-            if task_loras:
-                # 逻辑备注: 目前只处理第一个 LoRA
-                first_lora = task_loras[0]
-                lora_name_override = first_lora.get("name")
-                lora_model_w = first_lora.get("model_weight", 1.0)
-                lora_clip_w = first_lora.get("clip_weight", 1.0)
-                if lora_name_override:
-                    lora_loader_id, lora_loader_node = _find_node_id_by_title(workflow_to_run, lora_loader_title)
-                    if lora_loader_node:
-                        if _set_node_input(lora_loader_node, "lora_name", lora_name_override): modification_log.append(f"设置 LoRA 名称 '{lora_loader_title}' 为 '{lora_name_override}'"); node_modified = True
-                        if _set_node_input(lora_loader_node, "strength_model", lora_model_w): modification_log.append(f"设置 LoRA 模型权重 '{lora_loader_title}' 为 {lora_model_w}"); node_modified = True
-                        if _set_node_input(lora_loader_node, "strength_clip", lora_clip_w): modification_log.append(f"设置 LoRA CLIP 权重 '{lora_loader_title}' 为 {lora_clip_w}"); node_modified = True
-                    else: modification_log.append(f"警告: 配置了 LoRA 但未找到 LoRA 加载节点 '{lora_loader_title}'")
-                else: modification_log.append(f"警告: 第一个 LoRA 条目缺少名称。")
-            # 功能性备注: 8. 图生图/内绘处理 (设置 LoadImage 节点和可能的 Mask 节点)
-            if is_img2img_mode_active:
-                logger.info("  - 应用 ComfyUI 图生图/内绘设置 (使用上传后的文件名)...") # 功能性备注
-                load_image_id, load_image_node = _find_node_id_by_title(workflow_to_run, load_image_title)
-                if load_image_node and server_filename: # 必须有 LoadImage 节点且参考图上传成功
-                    if _set_node_input(load_image_node, "image", server_filename):
-                        modification_log.append(f"设置加载图像 '{load_image_title}' 为服务器文件 '{server_filename}'")
-                        node_modified = True
-                    else:
-                         modification_log.append(f"警告: 无法设置加载图像节点 '{load_image_title}' 的输入。")
-                         task_error_msg = f"图生图失败：无法设置 LoadImage 节点 '{load_image_title}'"
-                         logger.error(task_error_msg) # 逻辑备注
-                    # 功能性备注: 处理蒙版 (如果蒙版上传成功)
-                    if server_mask_filename:
-                        # --- 修改开始 ---
-                        # 逻辑备注: 从配置中获取加载蒙版节点的标题
-                        load_mask_title = specific_config.get("comfyLoadMaskNodeTitle", "Load_Mask_Image") # 使用默认值以防万一
-                        if not load_mask_title:
-                            modification_log.append("警告: 未在配置中指定加载蒙版节点的标题，无法应用蒙版。")
-                            logger.warning("未在配置中指定加载蒙版节点的标题，无法应用蒙版。")
-                        else:
-                            # 逻辑备注: 使用配置的标题查找节点
-                            load_mask_id, load_mask_node = _find_node_id_by_title(workflow_to_run, load_mask_title)
-                            if load_mask_node:
-                                 if _set_node_input(load_mask_node, "image", server_mask_filename):
-                                     modification_log.append(f"设置加载蒙版 '{load_mask_title}' 为服务器文件 '{server_mask_filename}'")
-                                     node_modified = True
-                                 else:
-                                     modification_log.append(f"警告: 无法设置加载蒙版节点 '{load_mask_title}' 的输入。")
-                            else:
-                                 # 逻辑备注: 未找到配置的蒙版加载节点
-                                 modification_log.append(f"警告: 提供了蒙版图像并上传成功，但未在工作流中找到标题为 '{load_mask_title}' 的加载蒙版节点。内绘可能无法按预期工作。")
-                        # --- 修改结束 ---
-                    elif mask_path and not server_mask_filename:
-                         # 逻辑备注: 本地有蒙版但上传失败或未使用
-                         modification_log.append(f"信息: 检测到本地蒙版路径，但未使用或上传失败，执行标准图生图。")
-                elif not load_image_node:
-                    # 逻辑备注: 未找到加载图像节点
-                    modification_log.append(f"警告: 图生图模式失败，未找到加载图像节点 '{load_image_title}'。")
-                    task_error_msg = f"图生图失败：未找到 LoadImage 节点 '{load_image_title}'"
-                    logger.error(task_error_msg) # 逻辑备注
-                elif not server_filename:
-                     # 逻辑备注: 参考图未上传成功
-                     modification_log.append(f"警告: 图生图模式失败，参考图未成功上传或未提供。")
-                     logger.warning("图生图模式失败，参考图未成功上传或未提供。") # 逻辑备注
-            # 功能性备注: 9. 保存节点前缀 (使用任务中的文件名基础部分)
-            save_id, save_node = _find_node_id_by_title(workflow_to_run, save_title)
-            if save_node and _set_node_input(save_node, "filename_prefix", filename_base): modification_log.append(f"设置保存节点前缀 '{save_title}'"); node_modified = True
-            else: modification_log.append(f"警告: 未找到保存节点 '{save_title}'")
-            # 功能性备注: 10. 可选节点处理 (面部修复/Tiling) - 仅打印信息，实际效果依赖工作流
-            if shared_config.get('restoreFaces'):
-                face_detailer_id, face_detailer_node = _find_node_id_by_title(workflow_to_run, face_detailer_title)
-                if face_detailer_node: modification_log.append(f"信息: 面部修复已启用 (找到节点 '{face_detailer_title}', 实际效果依赖工作流)")
-                else: modification_log.append(f"警告: 面部修复已启用，但未找到节点 '{face_detailer_title}'")
-            if shared_config.get('tiling'):
-                 tiling_id, tiling_node = _find_node_id_by_title(workflow_to_run, tiling_sampler_title)
-                 if tiling_node: modification_log.append(f"信息: Tiling 已启用 (找到节点 '{tiling_sampler_title}', 实际效果依赖工作流)")
-                 else: modification_log.append(f"警告: Tiling 已启用，但未找到节点 '{tiling_sampler_title}'")
-
-            logger.info(f"  [ComfyUI Gen] 工作流修改日志:\n    - " + "\n    - ".join(modification_log)) # 功能性备注
-
-            # 逻辑备注: 只有在没有预处理错误时才调用 API
-            if not task_error_msg:
-                # 功能性备注: 调用 ComfyUI API 助手函数
-                downloaded_images_bytes, api_error = api_helpers.call_comfyui_api(
-                    api_url, workflow_to_run, expected_output_node_title=save_title, client_id=client_id, save_debug=save_debug
-                )
-                time.sleep(0.5) # API 调用后等待
-
-                # 逻辑备注: 在 API 调用后检查停止信号
-                if stop_event and stop_event.is_set():
-                    logger.info(f"任务在 ComfyUI API 调用后被停止，结果将被丢弃。") # 功能性备注
-                    task_error_msg = "任务被用户停止"
-                    break # 功能性备注: 跳出循环
-
-                if downloaded_images_bytes and not api_error:
-                    # 功能性备注: API 调用成功且返回了图片数据
-                    image_data_list = downloaded_images_bytes
-                    # 逻辑备注: 检查返回数量是否符合预期
-                    if len(image_data_list) != n_samples:
-                        logger.warning(f"ComfyUI 返回图片数量 ({len(image_data_list)}) 与预期 ({n_samples}) 不符!") # 逻辑备注
-                elif not api_error:
-                    # 逻辑备注: API 调用成功但未返回数据
-                    task_error_msg = "错误: ComfyUI API 调用成功但未返回任何图片数据。"
-                    logger.error(task_error_msg) # 逻辑备注
-                else:
-                    # 逻辑备注: API 调用失败
-                    task_error_msg = api_error # 使用 API 返回的错误信息
-                    logger.error(f"ComfyUI API 调用失败: {task_error_msg}") # 逻辑备注
-            else:
-                 # 逻辑备注: 预处理阶段（如上传、节点查找）出错，不调用 API
-                 logger.error(f"  - ComfyUI 任务因预处理错误中止: {task_error_msg}") # 逻辑备注
+                    group_result = future.result()
+                    for i, task_result in zip(group, group_result if len(group) > 1 else [group_result]):
+                        try:
+                            # 逻辑备注: 成功的任务返回写入线程池的 Future，等待其保存结果
+                            task_results[i] = task_result.result() if isinstance(task_result, Future) else task_result
+                        except Exception as write_e:
+                            logger.exception(f"[{api_type} Gen] 任务 '{tasks_to_run[i]['filename']}' 保存时发生意外错误: {write_e}") # 逻辑备注
+                            task_results[i] = ("failed", f"错误: 执行任务时发生意外错误: {write_e}", 0)
+                except Exception as future_e:
+                    for i in group:
+                        logger.exception(f"[{api_type} Gen] 任务 '{tasks_to_run[i]['filename']}' 执行时发生意外错误: {future_e}") # 逻辑备注
+                        task_results[i] = ("failed", f"错误: 执行任务时发生意外错误: {future_e}", 0)
+    finally:
+        if sd_progress_poller: sd_progress_poller.stop()
+        if sd_cancel_watcher: sd_cancel_watcher.stop()
+        run_ctx["progress"].close()
+        # 功能性备注: 等待所有图片写入完成
+        run_ctx["image_writer"].shutdown(wait=True)
+        # 功能性备注: 等待后处理完成 (图片写入线程已全部提交)
+        postprocess_summary = run_ctx["postprocessor"].shutdown() if run_ctx["postprocessor"] else None
+        if postprocess_summary: logger.info(f"[{api_type} Gen] {postprocess_summary}") # 功能性备注
+        # 功能性备注: 写回图片缓存的使用记录
+        if run_ctx["image_cache"] is not None:
+            run_ctx["image_cache"].flush()
+        # 功能性备注: 删除 NAI 解压暂存目录 (图片都已移动到目标位置；中断时遗留的文件一并清理)
+        if api_type == "NAI":
+            _clear_staging_dir(base_save_path / NAI_STAGING_SUBDIR)
+        # 功能性备注: 恢复 SD WebUI 节点在本批次前的设置
+        if api_type == "SD WebUI":
+            run_ctx["sd_options_session"].restore_all(api_helpers)
+        # 功能性备注: 本批次结束，关闭 ComfyUI 的共享 WebSocket 长连接
+        if api_type == "ComfyUI":
+            api_helpers.close_all_comfyui_ws_clients()
+    if len(pool.endpoints) > 1 or pool.endpoints[0].controller:
+        logger.info(f"[{api_type} Gen] 节点统计: {pool.summary()}") # 功能性备注
 
-        # --- 保存图片 (统一处理，增加时间戳逻辑) ---
-        if task_error_msg:
-            # 逻辑备注: 如果在 API 调用或数据处理中出错
-            all_samples_successful = False
-            logger.error(f"  [{api_type} Gen] API 调用或数据处理失败: {task_error_msg}") # 逻辑备注
-        else:
-            # 逻辑备注: 如果 API 调用成功且返回了图片数据列表
-            for sample_idx, img_data in enumerate(image_data_list):
-                # 逻辑备注: 在保存每个样本前检查停止信号
-                if stop_event and stop_event.is_set():
-                    logger.info(f"任务在保存图片 {sample_idx+1} 之前被停止。") # 功能性备注
-                    task_error_msg = "任务被用户停止"
-                    all_samples_successful = False # 标记为不完全成功
-                    break # 功能性备注: 跳出保存循环
-
-                # 功能性备注: 构造初始文件名 (多样本时添加序号)
-                current_filename_base = f"{filename_base}_{sample_idx+1}" if n_samples > 1 else filename_base
-                current_filename = f"{current_filename_base}{file_ext}"
-                target_path = None # 初始化 target_path
-                try:
-                    # 功能性备注: 清理文件名中的非法字符，替换为下划线
-                    safe_filename_base = re.sub(r'[\\/:"*?<>|]', '_', current_filename_base)
-                    safe_filename = f"{safe_filename_base}{file_ext}"
-                    initial_target_path = base_save_path.joinpath(safe_filename)
-
-                    # 逻辑备注: 检查路径是否合法 (防止路径穿越)
-                    if '..' in safe_filename or not initial_target_path.resolve().is_relative_to(base_save_path.resolve()):
-                        raise ValueError("检测到无效的文件名或路径穿越尝试。")
-
-                    # 逻辑备注: 检查并处理文件扩展名，强制使用常见图片格式
-                    if initial_target_path.suffix.lower() not in ['.png', '.jpg', '.jpeg', '.webp']:
-                        logger.warning(f"    - 文件扩展名 '{initial_target_path.suffix}' 非预期，将强制保存为 .png") # 逻辑备注
-                        initial_target_path = initial_target_path.with_suffix('.png')
-                        safe_filename_base = initial_target_path.stem # 更新基础名以匹配新扩展名
-                        file_ext = '.png' # 更新扩展名
-
-                    # --- 新增：检查文件是否存在并添加时间戳 ---
-                    target_path = initial_target_path
-                    while target_path.exists():
-                        timestamp = time.strftime("%Y%m%d_%H%M%S")
-                        new_filename = f"{safe_filename_base}_{timestamp}{file_ext}"
-                        target_path = base_save_path.joinpath(new_filename)
-                        logger.info(f"    - 文件 '{initial_target_path.name}' 已存在，尝试新文件名: {target_path.name}") # 功能性备注
-                        time.sleep(0.01) # 短暂等待，避免潜在的极低概率时间戳冲突
-                    # --- 检查结束 ---
-
-                    # 功能性备注: 保存图片到最终确定的路径
-                    logger.info(f"  [{api_type} Gen] 保存图片 {sample_idx+1}/{len(image_data_list)} -> {target_path}") # 功能性备注
-                    with open(target_path, 'wb') as f:
-                        f.write(img_data)
-                except Exception as save_e:
-                    # 逻辑备注: 保存文件时出错
-                    save_target_display = str(target_path) if target_path else f"目录 {base_save_path}"
-                    task_error_msg = f"错误: 保存图片 '{current_filename}' 到 '{save_target_display}' 时出错: {save_e}"
-                    logger.exception(f"  [{api_type} Gen] 严重错误: {task_error_msg}"); all_samples_successful = False; break # 逻辑备注
-            # 逻辑备注: 如果是因为停止信号跳出了保存循环
-            if stop_event and stop_event.is_set():
-                logger.info(f"图片保存循环因停止信号中断。") # 功能性备注
-                task_error_msg = "任务被用户停止" # 确保错误信息被设置
-
-        # --- 记录任务结果 ---
-        if all_samples_successful and image_data_list: # 必须 API 成功且所有样本保存成功
+    # --- 按脚本顺序汇总任务结果 ---
+    # 功能性备注: storage_rewrites 为 {完整 image 行: (原文件名, 新文件名)}，后处理改变了扩展名时更新 storage
+    lines_to_uncomment, storage_rewrites, results_log = _resumed_script_updates(resumed_tasks)
+    generated_count = 0; failed_count = 0; stopped_count = 0
+    for task, (status, task_error_msg, image_count) in zip(tasks_to_run, task_results):
+        if status == "success":
             generated_count += 1
-            log_msg = f"成功: {task['filename']} (生成 {len(image_data_list)}/{n_samples} 张并保存)"
+            log_msg = f"成功: {task['filename']} (生成 {image_count}/{n_samples} 张并保存)"
             results_log.append(log_msg)
             logger.info(f"  [{api_type} Gen] 任务成功: {log_msg}") # 功能性备注
             # 逻辑修改: 只有当任务原本是被注释的时候，才记录下来以便取消注释
             if task['is_commented']:
                 lines_to_uncomment.add(task['full_image_line']) # 使用带分号的完整行作为 key
+            if (new_storage := _script_storage_name(run_ctx, task)) != task['filename']:
+                storage_rewrites[task['full_image_line']] = (task['filename'], new_storage)
+        elif status == "stopped":
+            # 逻辑备注: 因停止信号未执行或被中断的任务，不计入日志
+            stopped_count += 1
         else:
             # 逻辑备注: 任务失败
             failed_count += 1
@@ -827,33 +1830,62 @@ def task_generate_images(api_helpers, api_type, shared_config, specific_config,
             results_log.append(log_msg)
             logger.error(f"  [{api_type} Gen] 任务失败: {log_msg}") # 逻辑备注
 
-        # 逻辑备注: 如果是因为停止信号导致任务失败或中断，则跳出主循环
-        if task_error_msg == "任务被用户停止":
-            break
-
     # --- 修改 KAG 脚本 (取消注释) ---
-    logger.info(f"[{api_type} Gen] 准备修改 KAG 脚本，取消 {len(lines_to_uncomment)} 个成功任务的注释...") # 功能性备注
-    modified_script_lines = []
-    uncommented_count = 0
-    for line in kag_script.splitlines():
-        trimmed_line = line.strip()
-        # 逻辑修改: 使用带分号的完整行来匹配需要取消注释的行
-        if trimmed_line in lines_to_uncomment:
-            # 逻辑备注: 如果当前行是记录的成功任务行，则取消注释
-            uncommented_line = line.lstrip(';').lstrip()
-            modified_script_lines.append(uncommented_line)
-            logger.info(f"  > 取消注释: {uncommented_line}") # 功能性备注
-            uncommented_count += 1
-        else:
-            # 逻辑备注: 否则保留原行
-            modified_script_lines.append(line)
-    modified_script = "\n".join(modified_script_lines)
-    logger.info(f"[{api_type} Gen] KAG 脚本修改完成，共取消注释 {uncommented_count} 个图片标签。") # 功能性备注
+    modified_script, _ = _apply_script_updates(kag_script, api_type, lines_to_uncomment, storage_rewrites)
 
     # --- 返回最终结果 ---
+    if postprocess_summary: results_log.append(postprocess_summary)
     final_message = f"{api_type} 图片生成完成。成功任务: {generated_count}, 失败任务: {failed_count}."
-    if task_error_msg == "任务被用户停止": # 逻辑备注: 如果是用户停止，修改最终消息
-        final_message = f"{api_type} 图片生成任务被用户停止。成功任务: {generated_count}, 中断/失败任务: {failed_count + (len(tasks_to_run) - generated_count - failed_count)}."
+    if resumed_tasks: final_message += f" 续传跳过已完成任务: {len(resumed_tasks)}."
+    if stopped_count or (stop_event and stop_event.is_set()): # 逻辑备注: 如果是用户停止，修改最终消息
+        final_message = f"{api_type} 图片生成任务被用户停止。成功任务: {generated_count}, 中断/失败任务: {failed_count + stopped_count}."
     logger.info(final_message) # 功能性备注
     # 功能性备注: 返回包含消息、详细日志和修改后脚本的字典
-    return {"message": final_message, "details": results_log, "modified_script": modified_script}, None
\ No newline at end of file
+    return {"message": final_message, "details": results_log, "modified_script": modified_script}, None
+
+# --- 推测生成 (步骤二结果 -> 图片，与步骤三并行) ---
+# 功能性备注: 步骤二输出的提示词标记 [NAI:名字|正面|负面] / [IMG:名字|正面|负面]
+_STEP2_PROMPT_TAG_PATTERN = re.compile(r'\[(NAI|IMG):([^|\]\n]+)\|([^|\]\n]*)\|([^\]\n]*)\]')
+
+def build_speculative_script(enhanced_text, image_prefix=""):
+    """
+    由步骤二结果构造与“步骤三 + 替换图片占位符”相同形式的图片任务脚本
+    (提示词注释行 + 注释掉的 image 标签，文件名按角色序号编排)。返回 (脚本, 任务数)。
+    """
+    lines = []
+    for match in _STEP2_PROMPT_TAG_PATTERN.finditer(enhanced_text or ""):
+        prompt_type, name, positive, negative = (group.strip() for group in match.groups())
+        lines.append(f"; {prompt_type} Prompt for {name}: Positive=[{positive}] Negative=[{negative}]")
+        lines.append(f"[INSERT_IMAGE_HERE:{name}]")
+    if not lines:
+        return "", 0
+    return replace_kag_placeholders("\n".join(lines), image_prefix)
+
+def task_speculative_generate_images(api_helpers, api_type, shared_config, specific_config, enhanced_text, image_prefix, generation_options, use_img2img_toggle, character_profiles, stop_event=None, progress_callback=None):
+    """
+    后台任务：在步骤三运行期间，按步骤二结果中的提示词提前生成图片。
+    图片使用步骤三脚本中将出现的文件名保存并记入生成日志；脚本就绪后由 bind_speculative_images 取消对应 image 标签的注释。
+    已在日志中完成的任务不会重复生成。
+    """
+    speculative_script, task_count = build_speculative_script(enhanced_text, image_prefix)
+    if not task_count:
+        return {"message": "推测生成: 步骤二结果中没有图片提示词标记。", "details": [], "modified_script": None}, None
+    logger.info(f"[{api_type} Gen] 推测生成: 由步骤二结果得到 {task_count} 个图片任务，与步骤三并行生成。") # 功能性备注
+    result, error = task_generate_images(
+        api_helpers, api_type, shared_config, specific_config, speculative_script, dict(generation_options, scope="resume"),
+        use_img2img_toggle, character_profiles, stop_event=stop_event, progress_callback=progress_callback)
+    if result:
+        result = dict(result, message=f"推测生成: {result['message']}", modified_script=None) # 逻辑备注: 推测脚本只用于生成，不写回界面
+    return result, error
+
+def bind_speculative_images(kag_script, api_type, shared_config):
+    """
+    把生成日志中已完成的图片 (推测生成或之前中断的批次) 绑定到 KAG 脚本：取消对应 image 标签的注释。
+    不能与同一保存目录的生成任务同时调用 (会清理写入中的临时文件)。返回 (修改后的脚本, 绑定的任务数)。
+    """
+    _, completed = _split_resumable_tasks(_parse_image_tasks(kag_script, api_type), shared_config.get("imageSaveDir"))
+    if not completed:
+        return kag_script, 0
+    lines_to_uncomment, storage_rewrites, _ = _resumed_script_updates(completed)
+    modified_script, _ = _apply_script_updates(kag_script, api_type, lines_to_uncomment, storage_rewrites)
+    return modified_script, len(completed)
@@ -0,0 +1,2 @@
+# __init__.py
+# 单元测试包 (在 24.0版本 目录下运行: python -m unittest discover tests，或 python -m pytest tests)。
@@ -0,0 +1,135 @@
+# tests/test_comfyui_workflow_template.py
+"""ComfyUI 工作流模板与补丁的单元测试 (纯逻辑，不需要 ComfyUI 服务器)"""
+import copy # 功能性备注: 导入 copy 用于保存模板的原始快照
+import unittest # 功能性备注: 导入 unittest 测试框架
+
+from api.comfyui_workflow_template import ComfyUIWorkflowTemplate, WorkflowPatch, fuse_workflows
+
+
+def _sample_workflow():
+    """最小的文生图工作流：模型加载 -> 提示词 -> 采样器 -> 解码 -> 保存"""
+    return {
+        "4": {"class_type": "CheckpointLoaderSimple", "inputs": {"ckpt_name": "base.safetensors"}, "_meta": {"title": "Checkpoint"}},
+        "6": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["4", 1]}, "_meta": {"title": "PositivePrompt"}},
+        "7": {"class_type": "CLIPTextEncode", "inputs": {"text": "", "clip": ["4", 1]}, "_meta": {"title": "NegativePrompt"}},
+        "5": {"class_type": "EmptyLatentImage", "inputs": {"width": 512, "height": 512, "batch_size": 1}, "_meta": {"title": "Latent"}},
+        "3": {"class_type": "KSampler", "inputs": {"seed": 0, "steps": 20, "model": ["4", 0], "positive": ["6", 0], "negative": ["7", 0], "latent_image": ["5", 0]}, "_meta": {"title": "MainSampler"}},
+        "8": {"class_type": "VAEDecode", "inputs": {"samples": ["3", 0], "vae": ["4", 2]}, "_meta": {"title": "Decode"}},
+        "9": {"class_type": "SaveImage", "inputs": {"filename_prefix": "kag", "images": ["8", 0]}, "_meta": {"title": "SaveOutputImage"}},
+    }
+
+_NODE_TITLES = {
+    "comfySamplerNodeTitle": "MainSampler", "comfyPositiveNodeTitle": "PositivePrompt",
+    "comfyOutputNodeTitle": "SaveOutputImage", "comfyLoraLoaderNodeTitle": "LoraLoader",
+}
+
+
+class WorkflowTemplateTest(unittest.TestCase):
+    def setUp(self):
+        self.workflow = _sample_workflow()
+        self.snapshot = copy.deepcopy(self.workflow)
+        self.template = ComfyUIWorkflowTemplate(self.workflow, _NODE_TITLES)
+
+    def test_resolves_titles_and_reports_missing(self):
+        self.assertEqual(self.template.node_id("comfySamplerNodeTitle"), "3")
+        self.assertEqual(self.template.find("Decode"), "8")
+        self.assertIsNone(self.template.node_id("comfyLoraLoaderNodeTitle"))
+        self.assertEqual(self.template.missing, {"comfyLoraLoaderNodeTitle": "LoraLoader"})
+
+    def test_patch_does_not_mutate_template(self):
+        patch = WorkflowPatch(self.template)
+        self.assertTrue(patch.set("comfySamplerNodeTitle", "seed", 42))
+        self.assertTrue(patch.set("comfyPositiveNodeTitle", "text", "1girl"))
+        self.assertTrue(patch.set_by_title("Latent", "width", 768))
+        built = patch.build()
+        self.assertEqual(built["3"]["inputs"]["seed"], 42)
+        self.assertEqual(built["6"]["inputs"]["text"], "1girl")
+        self.assertEqual(built["5"]["inputs"]["width"], 768)
+        self.assertEqual(self.workflow, self.snapshot)
+        # 逻辑备注: 被修改的节点及其 inputs 是新对象，未修改的节点与模板共享
+        self.assertIsNot(built["3"], self.workflow["3"])
+        self.assertIsNot(built["3"]["inputs"], self.workflow["3"]["inputs"])
+        self.assertIs(built["4"], self.workflow["4"])
+
+    def test_patches_are_independent(self):
+        first = WorkflowPatch(self.template); first.set("comfySamplerNodeTitle", "seed", 1)
+        second = WorkflowPatch(self.template); second.set("comfySamplerNodeTitle", "seed", 2)
+        first_built, second_built = first.build(), second.build()
+        self.assertEqual((first_built["3"]["inputs"]["seed"], second_built["3"]["inputs"]["seed"]), (1, 2))
+        self.assertEqual(self.template.build({})["3"]["inputs"]["seed"], 0)
+
+    def test_none_value_removes_input(self):
+        built = self.template.build({"5": {"batch_size": None}})
+        self.assertNotIn("batch_size", built["5"]["inputs"])
+        self.assertIn("batch_size", self.workflow["5"]["inputs"])
+
+    def test_set_on_missing_role_returns_false(self):
+        patch = WorkflowPatch(self.template)
+        self.assertFalse(patch.set("comfyLoraLoaderNodeTitle", "lora_name", "x"))
+        self.assertFalse(patch.set_by_title("NoSuchNode", "text", "x"))
+        self.assertEqual(patch.patches, {})
+
+
+class FuseWorkflowsTest(unittest.TestCase):
+    def setUp(self):
+        self.template = ComfyUIWorkflowTemplate(_sample_workflow(), _NODE_TITLES)
+
+    def _task_workflow(self, text, seed):
+        patch = WorkflowPatch(self.template)
+        patch.set("comfyPositiveNodeTitle", "text", text)
+        patch.set("comfySamplerNodeTitle", "seed", seed)
+        return patch.build()
+
+    def test_varying_nodes_and_downstream_are_duplicated_with_remapped_links(self):
+        workflows = [self._task_workflow("cat", 1), self._task_workflow("dog", 2)]
+        snapshots = copy.deepcopy(workflows)
+        fused, output_ids, id_maps = fuse_workflows(workflows, "9")
+        # 逻辑备注: 提示词、采样器不同；解码和保存节点虽然相同，但在其下游，也按任务复制
+        self.assertEqual(id_maps[0], {"3": "3", "6": "6", "8": "8", "9": "9"})
+        self.assertEqual(id_maps[1], {"3": "10", "6": "11", "8": "12", "9": "13"})
+        self.assertEqual(output_ids, ["9", "13"])
+        self.assertEqual(sorted(fused, key=int), ["3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13"])
+        # 逻辑备注: 复制的节点指向本任务的副本，指向共享节点 (模型、负面提示词、潜空间) 的连接不变
+        sampler_copy = fused["10"]["inputs"]
+        self.assertEqual(sampler_copy["positive"], ["11", 0])
+        self.assertEqual((sampler_copy["model"], sampler_copy["negative"], sampler_copy["latent_image"]), (["4", 0], ["7", 0], ["5", 0]))
+        self.assertEqual(sampler_copy["seed"], 2)
+        self.assertEqual(fused["11"]["inputs"], {"text": "dog", "clip": ["4", 1]})
+        self.assertEqual(fused["12"]["inputs"], {"samples": ["10", 0], "vae": ["4", 2]})
+        self.assertEqual(fused["13"]["inputs"]["images"], ["12", 0])
+        # 逻辑备注: 第一个任务保留原节点 ID 和连接
+        self.assertEqual(fused["3"]["inputs"]["positive"], ["6", 0])
+        self.assertEqual(fused["6"]["inputs"]["text"], "cat")
+        self.assertEqual(fused["9"]["inputs"]["images"], ["8", 0])
+        self.assertEqual(workflows, snapshots)
+
+    def test_identical_workflows_only_duplicate_output(self):
+        workflows = [self._task_workflow("cat", 1)] * 3
+        fused, output_ids, id_maps = fuse_workflows(workflows, "9")
+        self.assertEqual(output_ids, ["9", "10", "11"])
+        self.assertEqual(id_maps, [{"9": "9"}, {"9": "10"}, {"9": "11"}])
+        for output_id in output_ids:
+            self.assertEqual(fused[output_id]["inputs"]["images"], ["8", 0])
+        self.assertEqual(len(fused), len(workflows[0]) + 2)
+
+    def test_new_ids_skip_existing_non_sequential_ids(self):
+        base = _sample_workflow()
+        base["extra"] = {"class_type": "Note", "inputs": {}, "_meta": {"title": "Note"}}
+        base["12"] = {"class_type": "PreviewImage", "inputs": {"images": ["8", 0]}, "_meta": {"title": "Preview"}}
+        template = ComfyUIWorkflowTemplate(base, _NODE_TITLES)
+        workflows = []
+        for seed in (1, 2):
+            patch = WorkflowPatch(template); patch.set("comfySamplerNodeTitle", "seed", seed)
+            workflows.append(patch.build())
+        fused, output_ids, id_maps = fuse_workflows(workflows, "9")
+        # 逻辑备注: 采样器下游为 8、9、12，新 ID 从现有最大数字 ID 之后分配，不与任何现有节点冲突
+        self.assertEqual(set(id_maps[1]), {"3", "8", "9", "12"})
+        self.assertTrue(set(id_maps[1].values()).isdisjoint(base))
+        self.assertEqual(len(set(id_maps[1].values())), 4)
+        self.assertEqual(fused[id_maps[1]["12"]]["inputs"]["images"], [id_maps[1]["8"], 0])
+        self.assertIn("extra", fused)
+        self.assertEqual(output_ids[1], id_maps[1]["9"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+# tests/test_concurrency_controller.py
+"""自适应并发 (AIMD) 控制器与过载错误识别的单元测试"""
+import time # 功能性备注: 导入 time 库构造请求开始时间
+import unittest # 功能性备注: 导入 unittest 测试框架
+
+from core.concurrency_controller import AIMDController, is_overload_error
+
+
+class OverloadErrorTest(unittest.TestCase):
+    def test_http_overload_and_request_timeouts(self):
+        for message in (
+            "SD API 错误 (/sdapi/v1/txt2img, 状态码: 503)",
+            "NAI API 错误 (状态码: 429)",
+            "NAI API 网络错误: 请求超时 (超过 300 秒)。",
+            "ComfyUI 提交工作流时网络/HTTP错误 (无响应): HTTPConnectionPool(host='x', port=8188): Read timed out. (read timeout=30)",
+        ):
+            self.assertTrue(is_overload_error(message), message)
+
+    def test_completion_wait_timeouts_are_not_overload(self):
+        # 逻辑备注: prompt 仍在服务器上，不能按过载重新提交
+        for message in ("ComfyUI WebSocket 等待超时 (600秒)，未收到完成信号。", "ComfyUI 任务轮询超时 (600秒)。",
+                        "SD API 错误 (/sdapi/v1/txt2img, 状态码: 500)", "", None):
+            self.assertFalse(is_overload_error(message), message)
+
+
+class AIMDControllerTest(unittest.TestCase):
+    def test_additive_increase_up_to_maximum(self):
+        controller = AIMDController(initial=1, maximum=3)
+        for _ in range(10):
+            controller.on_success(time.time(), 1.0)
+        self.assertEqual(controller.current_limit, 3)
+
+    def test_overload_halves_once_per_batch(self):
+        controller = AIMDController(initial=4, maximum=4)
+        started_at = time.time() - 1
+        self.assertTrue(controller.on_overload(started_at))
+        self.assertEqual(controller.current_limit, 2)
+        # 逻辑备注: 同一批 (在上次减半前发出) 的其他失败不再重复减半
+        self.assertFalse(controller.on_overload(started_at))
+        self.assertEqual(controller.current_limit, 2)
+
+    def test_limit_never_drops_below_minimum(self):
+        controller = AIMDController(initial=1, maximum=4)
+        controller.on_overload(None); controller.on_overload(None)
+        self.assertEqual(controller.current_limit, 1)
+
+    def test_latency_above_baseline_decreases(self):
+        controller = AIMDController(initial=2, maximum=4, latency_tolerance=1.5)
+        controller.on_success(time.time(), 1.0)
+        limit_before = controller.current_limit
+        self.assertTrue(controller.on_success(time.time(), 5.0, concurrent=2))
+        self.assertLess(controller.current_limit, limit_before)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+# tests/test_generation_journal.py
+"""生成日志 (续传) 的单元测试：记录、读取与整理的往返"""
+import json # 功能性备注: 导入 json 库用于构造日志行
+import tempfile # 功能性备注: 导入 tempfile 创建临时保存目录
+import unittest # 功能性备注: 导入 unittest 测试框架
+from pathlib import Path # 功能性备注: 导入 Path 对象用于路径处理
+
+from core.generation_journal import GenerationJournal, file_sha256, task_journal_key
+
+
+def _task(filename, positive="1girl"):
+    return {"name": "A", "positive": positive, "negative": "", "filename": filename}
+
+
+class GenerationJournalTest(unittest.TestCase):
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.directory = Path(self._tmp.name)
+        self.journal = GenerationJournal(self.directory)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _write_image(self, name, data=b"png-data"):
+        (self.directory / name).write_bytes(data)
+        return name
+
+    def test_record_load_round_trip(self):
+        task = _task("a.png")
+        name = self._write_image("a.webp")
+        self.assertIsNone(self.journal.record(task, [name], seed=7, payload_hash="h", storage="a.webp", api_type="ComfyUI"))
+        entries = self.journal.load()
+        entry = entries[task_journal_key(task)]
+        self.assertEqual((entry["filename"], entry["storage"], entry["files"]), ("a.png", "a.webp", ["a.webp"]))
+        self.assertEqual(entry["sha256"], [file_sha256(self.directory / name)])
+        self.assertEqual((entry["seed"], entry["payload_hash"], entry["api"]), (7, "h", "ComfyUI"))
+
+    def test_latest_record_wins_and_compact_keeps_it(self):
+        task = _task("a.png")
+        self.journal.record(task, [self._write_image("a.png", b"first")])
+        self.journal.record(task, [self._write_image("a_2.png", b"second")])
+        self.journal.record(_task("b.png"), [self._write_image("b.png")])
+        entries = self.journal.load()
+        self.assertEqual(entries[task_journal_key(task)]["files"], ["a_2.png"])
+        self.journal.compact(entries)
+        self.assertEqual(len(self.journal.path.read_text(encoding="utf-8").splitlines()), 2)
+        self.assertEqual(self.journal.load(), entries)
+
+    def test_compact_drops_entries_not_passed(self):
+        kept, dropped = _task("a.png"), _task("b.png")
+        self.journal.record(kept, [self._write_image("a.png")])
+        self.journal.record(dropped, [self._write_image("b.png")])
+        entries = self.journal.load()
+        entries.pop(task_journal_key(dropped))
+        self.journal.compact(entries)
+        self.assertEqual(set(self.journal.load()), {task_journal_key(kept)})
+        self.assertFalse(self.journal.path.with_name(f"{self.journal.path.name}.tmp").exists())
+
+    def test_load_skips_truncated_and_invalid_lines(self):
+        task = _task("a.png")
+        self.journal.record(task, [self._write_image("a.png")])
+        with open(self.journal.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"key": "no-files", "files": []}) + "\n")
+            f.write('{"key":"half-written","files":["x.p') # 逻辑备注: 模拟崩溃时写了一半的最后一行
+        self.assertEqual(set(self.journal.load()), {task_journal_key(task)})
+
+    def test_missing_journal_and_missing_image(self):
+        self.assertEqual(self.journal.load(), {})
+        self.assertIsNotNone(self.journal.record(_task("a.png"), ["missing.png"]))
+        self.assertFalse(self.journal.path.exists())
+
+    def test_task_key_ignores_whitespace_changes(self):
+        self.assertEqual(task_journal_key(_task("a.png", "1girl,  smile")), task_journal_key(_task("a.png", " 1girl, smile ")))
+        self.assertNotEqual(task_journal_key(_task("a.png", "1girl")), task_journal_key(_task("a.png", "1boy")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -37,6 +37,15 @@ class ImageGenConfigTab(ctk.CTkFrame):
         self.sd_inpaint_area_names = list(self.sd_inpaint_area_options.keys())
         self.sd_resize_mode_options = {"Just resize": 0, "Crop and resize": 1, "Resize and fill": 2, "Just resize (latent upscale)": 3}
         self.sd_resize_mode_names = list(self.sd_resize_mode_options.keys())
+        self.sd_override_mode_options = {"批次内固定 (推荐)": "sticky", "请求后不恢复": "no_restore", "每次请求覆盖": "per_request"}
+        self.sd_override_mode_names = list(self.sd_override_mode_options.keys())
+        self.sd_server_save_mode_options = {"Base64 返回": "off", "本机服务器直接保存": "local", "总是服务器保存": "always"}
+        self.sd_server_save_mode_names = list(self.sd_server_save_mode_options.keys())
+        # 保存后处理输出格式映射
+        self.postprocess_format_options = {"沿用原格式": "keep", "PNG (优化)": "png", "WebP": "webp", "JPEG": "jpeg"}
+        self.postprocess_format_names = list(self.postprocess_format_options.keys())
+        self.postprocess_resize_mode_options = {"不缩放": "none", "适应 (fit)": "fit", "填充裁剪 (fill)": "fill", "补边 (pad)": "pad"}
+        self.postprocess_resize_mode_names = list(self.postprocess_resize_mode_options.keys())
 
         # 用于存储 ComfyUI 节点标题输入框控件的字典
         self.comfy_title_entries = {}
@@ -107,6 +116,13 @@ class ImageGenConfigTab(ctk.CTkFrame):
         sd_url_entry.bind("<FocusOut>", self.trigger_workflow_button_update) # 绑定失去焦点事件
         if help_btn := create_help_button(self.sd_webui_frame, "sd", "sdWebUiUrl"): help_btn.grid(row=sd_row, column=2, padx=(0, 10), pady=5, sticky="w")
         sd_row += 1
+        sd_endpoints_label = ctk.CTkLabel(self.sd_webui_frame, text="多节点列表:")
+        sd_endpoints_label.grid(row=sd_row, column=0, padx=(10,0), pady=5, sticky="w")
+        self.sd_endpoints_var = StringVar()
+        sd_endpoints_entry = ctk.CTkEntry(self.sd_webui_frame, textvariable=self.sd_endpoints_var, placeholder_text="可选，例如: http://host1:7860|2|2, http://host2:7860") # SD 多节点列表输入
+        sd_endpoints_entry.grid(row=sd_row, column=1, padx=5, pady=5, sticky="ew")
+        if help_btn := create_help_button(self.sd_webui_frame, "sd", "sdWebUiEndpoints"): help_btn.grid(row=sd_row, column=2, padx=(0, 10), pady=5, sticky="w")
+        sd_row += 1
         # SD 覆盖设置
         sd_override_frame = ctk.CTkFrame(self.sd_webui_frame, fg_color="transparent")
         sd_override_frame.grid(row=sd_row, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
@@ -125,6 +141,24 @@ class ImageGenConfigTab(ctk.CTkFrame):
         sd_override_vae_entry = ctk.CTkEntry(sd_override_frame, textvariable=self.sd_override_vae_var, placeholder_text="vae.safetensors 或 Automatic") # 覆盖 VAE 输入
         sd_override_vae_entry.grid(row=1, column=4, padx=(0,5), pady=2, sticky="ew")
         if help_btn := create_help_button(sd_override_frame, "sd", "sdOverrideVAE"): help_btn.grid(row=1, column=5, padx=(0,10), pady=2, sticky="w")
+        sd_override_mode_label = ctk.CTkLabel(sd_override_frame, text="应用方式:")
+        sd_override_mode_label.grid(row=2, column=0, padx=(0,5), pady=2, sticky="w")
+        self.sd_override_mode_var = StringVar(value=self.sd_override_mode_names[0])
+        sd_override_mode_combo = ctk.CTkComboBox(sd_override_frame, values=self.sd_override_mode_names, variable=self.sd_override_mode_var) # 覆盖设置应用方式选择
+        sd_override_mode_combo.grid(row=2, column=1, padx=(0,5), pady=2, sticky="ew")
+        if help_btn := create_help_button(sd_override_frame, "sd", "sdOverrideMode"): help_btn.grid(row=2, column=2, padx=(0,10), pady=2, sticky="w")
+        sd_server_save_mode_label = ctk.CTkLabel(sd_override_frame, text="图片传输:")
+        sd_server_save_mode_label.grid(row=3, column=0, padx=(0,5), pady=2, sticky="w")
+        self.sd_server_save_mode_var = StringVar(value=self.sd_server_save_mode_names[0])
+        sd_server_save_mode_combo = ctk.CTkComboBox(sd_override_frame, values=self.sd_server_save_mode_names, variable=self.sd_server_save_mode_var) # 图片传输方式选择
+        sd_server_save_mode_combo.grid(row=3, column=1, padx=(0,5), pady=2, sticky="ew")
+        if help_btn := create_help_button(sd_override_frame, "sd", "sdServerSaveMode"): help_btn.grid(row=3, column=2, padx=(0,10), pady=2, sticky="w")
+        sd_server_save_dir_label = ctk.CTkLabel(sd_override_frame, text="共享目录:")
+        sd_server_save_dir_label.grid(row=3, column=3, padx=(10,5), pady=2, sticky="w")
+        self.sd_server_save_dir_var = StringVar()
+        sd_server_save_dir_entry = ctk.CTkEntry(sd_override_frame, textvariable=self.sd_server_save_dir_var, placeholder_text="留空使用图片目录/.sd_server_output") # 服务器端保存目录输入
+        sd_server_save_dir_entry.grid(row=3, column=4, padx=(0,5), pady=2, sticky="ew")
+        if help_btn := create_help_button(sd_override_frame, "sd", "sdServerSaveDir"): help_btn.grid(row=3, column=5, padx=(0,10), pady=2, sticky="w")
         sd_row += 1
         # SD 高清修复设置
         sd_hr_frame = ctk.CTkFrame(self.sd_webui_frame, fg_color="transparent")
@@ -204,6 +238,30 @@ class ImageGenConfigTab(ctk.CTkFrame):
         comfy_url_entry.bind("<FocusOut>", self.trigger_workflow_button_update) # 绑定失去焦点事件
         if help_btn := create_help_button(self.comfyui_frame, "comfyui", "comfyapiUrl"): help_btn.grid(row=comfy_row, column=3, padx=(0, 10), pady=5, sticky="w")
         comfy_row += 1
+        # ComfyUI 多节点列表
+        comfy_endpoints_label = ctk.CTkLabel(self.comfyui_frame, text="多节点列表:")
+        comfy_endpoints_label.grid(row=comfy_row, column=0, padx=(10,0), pady=5, sticky="w")
+        self.comfy_endpoints_var = StringVar()
+        comfy_endpoints_entry = ctk.CTkEntry(self.comfyui_frame, textvariable=self.comfy_endpoints_var, placeholder_text="可选，例如: http://host1:8188|2|2, http://host2:8188") # Comfy 多节点列表输入
+        comfy_endpoints_entry.grid(row=comfy_row, column=1, columnspan=2, padx=5, pady=5, sticky="ew")
+        if help_btn := create_help_button(self.comfyui_frame, "comfyui", "comfyEndpoints"): help_btn.grid(row=comfy_row, column=3, padx=(0, 10), pady=5, sticky="w")
+        comfy_row += 1
+        # ComfyUI 每节点排队上限
+        comfy_max_queued_label = ctk.CTkLabel(self.comfyui_frame, text="每节点排队上限:")
+        comfy_max_queued_label.grid(row=comfy_row, column=0, padx=(10,0), pady=5, sticky="w")
+        self.comfy_max_queued_var = IntVar(value=2)
+        comfy_max_queued_entry = ctk.CTkEntry(self.comfyui_frame, textvariable=self.comfy_max_queued_var, width=60) # 排队上限输入
+        comfy_max_queued_entry.grid(row=comfy_row, column=1, padx=5, pady=5, sticky="w")
+        if help_btn := create_help_button(self.comfyui_frame, "comfyui", "comfyMaxQueuedPerServer"): help_btn.grid(row=comfy_row, column=3, padx=(0, 10), pady=5, sticky="w")
+        comfy_row += 1
+        # ComfyUI 融合提交任务数
+        comfy_fuse_label = ctk.CTkLabel(self.comfyui_frame, text="融合提交任务数:")
+        comfy_fuse_label.grid(row=comfy_row, column=0, padx=(10,0), pady=5, sticky="w")
+        self.comfy_fuse_count_var = IntVar(value=1)
+        comfy_fuse_entry = ctk.CTkEntry(self.comfyui_frame, textvariable=self.comfy_fuse_count_var, width=60) # 融合任务数输入
+        comfy_fuse_entry.grid(row=comfy_row, column=1, padx=5, pady=5, sticky="w")
+        if help_btn := create_help_button(self.comfyui_frame, "comfyui", "comfyFuseTaskCount"): help_btn.grid(row=comfy_row, column=3, padx=(0, 10), pady=5, sticky="w")
+        comfy_row += 1
         # ComfyUI Workflow File
         comfy_wf_label = ctk.CTkLabel(self.comfyui_frame, text="工作流文件:")
         comfy_wf_label.grid(row=comfy_row, column=0, padx=(10,0), pady=5, sticky="w")
@@ -219,6 +277,10 @@ class ImageGenConfigTab(ctk.CTkFrame):
         import_titles_button = ctk.CTkButton(button_frame_wf, text="导入标题", width=70, command=self.import_node_titles_from_workflow) # 导入标题按钮
         import_titles_button.pack(side="left", padx=(5,0))
         if help_btn := create_help_button(button_frame_wf, "comfyui", "comfyWorkflowFile"): help_btn.pack(side="left", padx=(5, 0))
+        self.comfy_preflight_var = BooleanVar(value=True)
+        comfy_preflight_check = ctk.CTkCheckBox(button_frame_wf, text="生成前预检", variable=self.comfy_preflight_var) # 预检开关
+        comfy_preflight_check.pack(side="left", padx=(10, 0))
+        if help_btn := create_help_button(button_frame_wf, "comfyui", "comfyPreflightEnabled"): help_btn.pack(side="left", padx=(5, 0))
         comfy_row += 1
         # ComfyUI 覆盖设置 (Checkpoint, VAE, LoRA)
         comfy_override_frame = ctk.CTkFrame(self.comfyui_frame, fg_color="transparent")
@@ -289,6 +351,7 @@ class ImageGenConfigTab(ctk.CTkFrame):
             # --- 新增结束 ---
             ("comfyFaceDetailerNodeTitle", "面部修复 (可选):", "OptionalFaceDetailer"),
             ("comfyTilingSamplerNodeTitle", "Tiling 节点 (可选):", "OptionalTilingSampler"),
+            ("comfyWebsocketSaveNodeTitle", "WS 保存图片 (可选):", ""),
         ]
 
         # 循环创建节点标题输入行
@@ -466,6 +529,76 @@ class ImageGenConfigTab(ctk.CTkFrame):
         save_img_debug_check = ctk.CTkCheckBox(debug_frame, text="保存图片生成调试输入?", variable=self.save_img_debug_var) # 图片调试开关
         save_img_debug_check.pack(side="left", padx=(0, 5))
         if help_btn := create_help_button(debug_frame, "image_gen_shared", "saveImageDebugInputs"): help_btn.pack(side="left", padx=(0, 20))
+        self.img2img_downscale_var = BooleanVar(value=True)
+        img2img_downscale_check = ctk.CTkCheckBox(debug_frame, text="缩小过大的参考图?", variable=self.img2img_downscale_var) # 图生图参考图缩小开关
+        img2img_downscale_check.pack(side="left", padx=(0, 5))
+        if help_btn := create_help_button(debug_frame, "image_gen_shared", "img2imgDownscaleInputs"): help_btn.pack(side="left", padx=(0, 20))
+        self.image_cache_enabled_var = BooleanVar(value=False)
+        image_cache_check = ctk.CTkCheckBox(debug_frame, text="启用图片缓存?", variable=self.image_cache_enabled_var) # 生成图片缓存开关
+        image_cache_check.pack(side="left", padx=(0, 5))
+        self.image_cache_max_mb_var = IntVar(value=1024)
+        image_cache_max_entry = ctk.CTkEntry(debug_frame, textvariable=self.image_cache_max_mb_var, width=70) # 缓存上限 (MB) 输入
+        image_cache_max_entry.pack(side="left", padx=(0, 2))
+        ctk.CTkLabel(debug_frame, text="MB").pack(side="left", padx=(0, 5))
+        if help_btn := create_help_button(debug_frame, "image_gen_shared", "imageCacheEnabled"): help_btn.pack(side="left", padx=(0, 20))
+        shared_row += 1
+        # 自适应并发设置
+        concurrency_frame = ctk.CTkFrame(shared_params_frame, fg_color="transparent")
+        concurrency_frame.grid(row=shared_row, column=0, columnspan=4, pady=(0, 5), sticky="w", padx=10)
+        self.adaptive_concurrency_var = BooleanVar(value=False)
+        adaptive_concurrency_check = ctk.CTkCheckBox(concurrency_frame, text="自适应并发?", variable=self.adaptive_concurrency_var) # 自适应并发开关
+        adaptive_concurrency_check.pack(side="left", padx=(0, 5))
+        if help_btn := create_help_button(concurrency_frame, "image_gen_shared", "adaptiveConcurrencyEnabled"): help_btn.pack(side="left", padx=(0, 20))
+        ctk.CTkLabel(concurrency_frame, text="上限:").pack(side="left", padx=(0, 2))
+        self.adaptive_max_concurrency_var = IntVar(value=4)
+        adaptive_max_entry = ctk.CTkEntry(concurrency_frame, textvariable=self.adaptive_max_concurrency_var, width=50) # 自适应并发上限输入
+        adaptive_max_entry.pack(side="left", padx=(0, 5))
+        if help_btn := create_help_button(concurrency_frame, "image_gen_shared", "adaptiveMaxConcurrency"): help_btn.pack(side="left", padx=(0, 20))
+        self.affinity_scheduling_var = BooleanVar(value=True)
+        affinity_scheduling_check = ctk.CTkCheckBox(concurrency_frame, text="按模型亲和性排序?", variable=self.affinity_scheduling_var) # 模型亲和性排序开关
+        affinity_scheduling_check.pack(side="left", padx=(0, 5))
+        if help_btn := create_help_button(concurrency_frame, "image_gen_shared", "affinitySchedulingEnabled"): help_btn.pack(side="left", padx=(0, 20))
+        shared_row += 1
+        # 保存后处理 (重新编码) 设置
+        postprocess_frame = ctk.CTkFrame(shared_params_frame, fg_color="transparent")
+        postprocess_frame.grid(row=shared_row, column=0, columnspan=4, pady=(0, 5), sticky="w", padx=10)
+        self.postprocess_enabled_var = BooleanVar(value=False)
+        postprocess_check = ctk.CTkCheckBox(postprocess_frame, text="保存后重新编码?", variable=self.postprocess_enabled_var) # 保存后处理开关
+        postprocess_check.pack(side="left", padx=(0, 5))
+        self.postprocess_format_var = StringVar(value=self.postprocess_format_names[0])
+        postprocess_format_combo = ctk.CTkComboBox(postprocess_frame, values=self.postprocess_format_names, variable=self.postprocess_format_var, width=120) # 输出格式选择
+        postprocess_format_combo.pack(side="left", padx=(0, 5))
+        if help_btn := create_help_button(postprocess_frame, "image_gen_shared", "postprocessEnabled"): help_btn.pack(side="left", padx=(0, 20))
+        ctk.CTkLabel(postprocess_frame, text="质量:").pack(side="left", padx=(0, 2))
+        self.postprocess_quality_var = IntVar(value=90)
+        postprocess_quality_entry = ctk.CTkEntry(postprocess_frame, textvariable=self.postprocess_quality_var, width=50) # WebP/JPEG 质量输入
+        postprocess_quality_entry.pack(side="left", padx=(0, 5))
+        if help_btn := create_help_button(postprocess_frame, "image_gen_shared", "postprocessQuality"): help_btn.pack(side="left", padx=(0, 20))
+        self.postprocess_strip_metadata_var = BooleanVar(value=True)
+        postprocess_strip_check = ctk.CTkCheckBox(postprocess_frame, text="去除元数据?", variable=self.postprocess_strip_metadata_var) # 去除元数据开关
+        postprocess_strip_check.pack(side="left", padx=(0, 5))
+        if help_btn := create_help_button(postprocess_frame, "image_gen_shared", "postprocessStripMetadata"): help_btn.pack(side="left", padx=(0, 20))
+        ctk.CTkLabel(postprocess_frame, text="进程数:").pack(side="left", padx=(0, 2))
+        self.postprocess_workers_var = IntVar(value=2)
+        postprocess_workers_entry = ctk.CTkEntry(postprocess_frame, textvariable=self.postprocess_workers_var, width=50) # 后处理进程数输入
+        postprocess_workers_entry.pack(side="left", padx=(0, 5))
+        if help_btn := create_help_button(postprocess_frame, "image_gen_shared", "postprocessWorkers"): help_btn.pack(side="left", padx=(0, 20))
+        shared_row += 1
+        # 保存后缩放到目标分辨率
+        resize_frame = ctk.CTkFrame(shared_params_frame, fg_color="transparent")
+        resize_frame.grid(row=shared_row, column=0, columnspan=4, pady=(0, 5), sticky="w", padx=10)
+        ctk.CTkLabel(resize_frame, text="保存后缩放:").pack(side="left", padx=(0, 5))
+        self.postprocess_resize_mode_var = StringVar(value=self.postprocess_resize_mode_names[0])
+        resize_mode_combo = ctk.CTkComboBox(resize_frame, values=self.postprocess_resize_mode_names, variable=self.postprocess_resize_mode_var, width=140) # 缩放方式选择
+        resize_mode_combo.pack(side="left", padx=(0, 5))
+        self.postprocess_target_width_var = IntVar(value=0)
+        target_width_entry = ctk.CTkEntry(resize_frame, textvariable=self.postprocess_target_width_var, width=60) # 目标宽度输入
+        target_width_entry.pack(side="left", padx=(0, 2))
+        ctk.CTkLabel(resize_frame, text="x").pack(side="left", padx=(0, 2))
+        self.postprocess_target_height_var = IntVar(value=0)
+        target_height_entry = ctk.CTkEntry(resize_frame, textvariable=self.postprocess_target_height_var, width=60) # 目标高度输入
+        target_height_entry.pack(side="left", padx=(0, 5))
+        if help_btn := create_help_button(resize_frame, "image_gen_shared", "postprocessResizeMode"): help_btn.pack(side="left", padx=(0, 20))
 
         # 功能性备注: 初始化共享种子输入框状态
         self._toggle_shared_seed_entry()
@@ -571,6 +704,8 @@ class ImageGenConfigTab(ctk.CTkFrame):
             sampler_id, sampler_node, sampler_title = find_first_node_by_type("Sampler")
             latent_id, _, latent_title = find_first_node_by_type("EmptyLatentImage")
             save_id, _, save_title = find_first_node_by_type("SaveImage")
+            ws_save_id, _, ws_save_title = find_first_node_by_type("SaveImageWebsocket")
+            if ws_save_id and ws_save_id == save_id: save_title = None # 只有 WebSocket 保存节点时不作为普通保存节点导入
             vae_decode_id, _, vae_decode_title = find_first_node_by_type("VAEDecode")
             lora_id, _, lora_title = find_first_node_by_type("LoraLoader")
             load_image_id, _, load_image_title = find_first_node_by_type("LoadImage")
@@ -657,6 +792,7 @@ class ImageGenConfigTab(ctk.CTkFrame):
             # --- 新增结束 ---
             update_ui("comfyFaceDetailerNodeTitle", face_detailer_title)
             update_ui("comfyTilingSamplerNodeTitle", tiling_title)
+            update_ui("comfyWebsocketSaveNodeTitle", ws_save_title)
 
             # 检查哪些标题未被导入，确保它们的颜色是默认色
             all_title_keys = set(self.comfy_title_entries.keys())
@@ -700,8 +836,14 @@ class ImageGenConfigTab(ctk.CTkFrame):
         # 加载 SD WebUI 独立配置
         sd_config = self.config_manager.load_config("sd")
         self.sd_url_var.set(sd_config.get("sdWebUiUrl", "http://127.0.0.1:7860"))
+        self.sd_endpoints_var.set(sd_config.get("sdWebUiEndpoints", ""))
         self.sd_override_model_var.set(sd_config.get("sdOverrideModel", ""))
         self.sd_override_vae_var.set(sd_config.get("sdOverrideVAE", ""))
+        override_mode = sd_config.get("sdOverrideMode", "sticky")
+        self.sd_override_mode_var.set(next((name for name, value in self.sd_override_mode_options.items() if value == override_mode), self.sd_override_mode_names[0]))
+        server_save_mode = sd_config.get("sdServerSaveMode", "off")
+        self.sd_server_save_mode_var.set(next((name for name, value in self.sd_server_save_mode_options.items() if value == server_save_mode), self.sd_server_save_mode_names[0])) # 加载图片传输方式
+        self.sd_server_save_dir_var.set(sd_config.get("sdServerSaveDir", "")) # 加载服务器端保存目录
         self.sd_enable_hr_var.set(bool(sd_config.get("sdEnableHR", False)))
         self.sd_hr_scale_var.set(float(sd_config.get("sdHRScale", 2.0)))
         self.sd_hr_upscaler_var.set(sd_config.get("sdHRUpscaler", "Latent"))
@@ -718,9 +860,13 @@ class ImageGenConfigTab(ctk.CTkFrame):
         # 加载 ComfyUI 独立配置
         comfy_config = self.config_manager.load_config("comfyui")
         self.comfy_url_var.set(comfy_config.get("comfyapiUrl", "http://127.0.0.1:8188"))
+        self.comfy_endpoints_var.set(comfy_config.get("comfyEndpoints", ""))
         self.comfy_workflow_file_var.set(comfy_config.get("comfyWorkflowFile", ""))
         self.comfy_ckpt_name_var.set(comfy_config.get("comfyCkptName", ""))
         self.comfy_vae_name_var.set(comfy_config.get("comfyVaeName", ""))
+        self.comfy_preflight_var.set(str(comfy_config.get("comfyPreflightEnabled", True)).lower() == 'true') # 加载预检开关
+        self.comfy_max_queued_var.set(int(comfy_config.get("comfyMaxQueuedPerServer", 2))) # 加载排队上限
+        self.comfy_fuse_count_var.set(int(comfy_config.get("comfyFuseTaskCount", 1))) # 加载融合任务数
         self.comfy_lora_name_var.set(comfy_config.get("comfyLoraName", ""))
         self.comfy_lora_strength_model_var.set(float(comfy_config.get("comfyLoraStrengthModel", 0.7)))
         self.comfy_lora_strength_clip_var.set(float(comfy_config.get("comfyLoraStrengthClip", 0.7)))
@@ -741,14 +887,30 @@ class ImageGenConfigTab(ctk.CTkFrame):
         self.shared_height_var.set(int(shared_config.get("height", 512)))
         self.shared_seed_var.set(int(shared_config.get("seed", -1)))
         # 功能性备注: 加载共享随机种子开关状态
-        self.shared_random_seed_var.set(bool(shared_config.get("sharedRandomSeed", False)))
+        self.shared_random_seed_var.set(str(shared_config.get("sharedRandomSeed", False)).lower() == 'true')
         self._toggle_shared_seed_entry() # 功能性备注: 根据加载的状态更新输入框启用/禁用
         self.shared_denoise_var.set(float(shared_config.get("denoisingStrength", 0.7)))
         self.shared_clipskip_var.set(int(shared_config.get("clipSkip", 1)))
         self.shared_maskblur_var.set(int(shared_config.get("maskBlur", 4)))
-        self.shared_restore_faces_var.set(bool(shared_config.get("restoreFaces", False)))
-        self.shared_tiling_var.set(bool(shared_config.get("tiling", False)))
-        self.save_img_debug_var.set(bool(shared_config.get("saveImageDebugInputs", False))) # 加载图片调试开关
+        self.shared_restore_faces_var.set(str(shared_config.get("restoreFaces", False)).lower() == 'true')
+        self.shared_tiling_var.set(str(shared_config.get("tiling", False)).lower() == 'true')
+        self.save_img_debug_var.set(str(shared_config.get("saveImageDebugInputs", False)).lower() == 'true') # 加载图片调试开关
+        self.img2img_downscale_var.set(str(shared_config.get("img2imgDownscaleInputs", True)).lower() == 'true') # 加载参考图缩小开关
+        self.image_cache_enabled_var.set(str(shared_config.get("imageCacheEnabled", False)).lower() == 'true') # 加载图片缓存开关
+        self.image_cache_max_mb_var.set(int(shared_config.get("imageCacheMaxMB", 1024))) # 加载图片缓存上限
+        self.adaptive_concurrency_var.set(str(shared_config.get("adaptiveConcurrencyEnabled", False)).lower() == 'true') # 加载自适应并发开关
+        self.adaptive_max_concurrency_var.set(int(shared_config.get("adaptiveMaxConcurrency", 4))) # 加载自适应并发上限
+        self.affinity_scheduling_var.set(str(shared_config.get("affinitySchedulingEnabled", True)).lower() == 'true') # 加载模型亲和性排序开关
+        self.postprocess_enabled_var.set(str(shared_config.get("postprocessEnabled", False)).lower() == 'true') # 加载保存后处理开关
+        postprocess_format = shared_config.get("postprocessFormat", "keep")
+        self.postprocess_format_var.set(next((name for name, value in self.postprocess_format_options.items() if value == postprocess_format), self.postprocess_format_names[0])) # 加载输出格式
+        self.postprocess_quality_var.set(int(shared_config.get("postprocessQuality", 90))) # 加载编码质量
+        self.postprocess_strip_metadata_var.set(str(shared_config.get("postprocessStripMetadata", True)).lower() == 'true') # 加载去除元数据开关
+        self.postprocess_workers_var.set(int(shared_config.get("postprocessWorkers", 2))) # 加载后处理进程数
+        resize_mode = shared_config.get("postprocessResizeMode", "none")
+        self.postprocess_resize_mode_var.set(next((name for name, value in self.postprocess_resize_mode_options.items() if value == resize_mode), self.postprocess_resize_mode_names[0])) # 加载缩放方式
+        self.postprocess_target_width_var.set(int(shared_config.get("postprocessTargetWidth", 0))) # 加载目标宽度
+        self.postprocess_target_height_var.set(int(shared_config.get("postprocessTargetHeight", 0))) # 加载目标高度
         # 安全地更新文本框内容
         if hasattr(self, 'shared_add_pos_textbox') and self.shared_add_pos_textbox.winfo_exists():
             self.shared_add_pos_textbox.delete("1.0", "end")
@@ -768,8 +930,12 @@ class ImageGenConfigTab(ctk.CTkFrame):
         # --- 收集 SD WebUI 独立配置 ---
         sd_config_data = {
             "sdWebUiUrl": self.sd_url_var.get().strip().rstrip('/'),
+            "sdWebUiEndpoints": self.sd_endpoints_var.get().strip(),
             "sdOverrideModel": self.sd_override_model_var.get().strip(),
             "sdOverrideVAE": self.sd_override_vae_var.get().strip(),
+            "sdOverrideMode": self.sd_override_mode_options.get(self.sd_override_mode_var.get(), "sticky"),
+            "sdServerSaveMode": self.sd_server_save_mode_options.get(self.sd_server_save_mode_var.get(), "off"),
+            "sdServerSaveDir": self.sd_server_save_dir_var.get().strip(),
             "sdEnableHR": self.sd_enable_hr_var.get(),
             "sdHRScale": self.sd_hr_scale_var.get(),
             "sdHRUpscaler": self.sd_hr_upscaler_var.get().strip(),
@@ -781,11 +947,19 @@ class ImageGenConfigTab(ctk.CTkFrame):
         }
 
         # --- 收集 ComfyUI 独立配置 ---
+        try: comfy_max_queued = int(self.comfy_max_queued_var.get()); assert comfy_max_queued >= 0
+        except: logger.warning(f"警告: 无效的排队上限 '{self.comfy_max_queued_var.get()}'"); comfy_max_queued = 2; self.comfy_max_queued_var.set(comfy_max_queued) # 使用 logging
+        try: comfy_fuse_count = int(self.comfy_fuse_count_var.get()); assert 1 <= comfy_fuse_count <= 16
+        except: logger.warning(f"警告: 无效的融合提交任务数 '{self.comfy_fuse_count_var.get()}'"); comfy_fuse_count = 1; self.comfy_fuse_count_var.set(comfy_fuse_count) # 使用 logging
         comfy_config_data = {
             "comfyapiUrl": self.comfy_url_var.get().strip().rstrip('/'),
+            "comfyEndpoints": self.comfy_endpoints_var.get().strip(),
             "comfyWorkflowFile": self.comfy_workflow_file_var.get().strip(),
             "comfyCkptName": self.comfy_ckpt_name_var.get().strip(),
             "comfyVaeName": self.comfy_vae_name_var.get().strip(),
+            "comfyPreflightEnabled": self.comfy_preflight_var.get(), # 收集预检开关
+            "comfyMaxQueuedPerServer": comfy_max_queued, # 收集排队上限
+            "comfyFuseTaskCount": comfy_fuse_count, # 收集融合任务数
             "comfyLoraName": self.comfy_lora_name_var.get().strip(),
             "comfyLoraStrengthModel": self.comfy_lora_strength_model_var.get(),
             "comfyLoraStrengthClip": self.comfy_lora_strength_clip_var.get(),
@@ -818,6 +992,18 @@ class ImageGenConfigTab(ctk.CTkFrame):
         except: logger.warning(f"警告: 无效的 CLIP Skip '{self.shared_clipskip_var.get()}'"); clip_skip = 1; self.shared_clipskip_var.set(clip_skip) # 使用 logging
         try: mask_blur = int(self.shared_maskblur_var.get()); assert mask_blur >= 0
         except: logger.warning(f"警告: 无效的蒙版模糊 '{self.shared_maskblur_var.get()}'"); mask_blur = 4; self.shared_maskblur_var.set(mask_blur) # 使用 logging
+        try: cache_max_mb = int(self.image_cache_max_mb_var.get()); assert cache_max_mb >= 0
+        except: logger.warning(f"警告: 无效的图片缓存上限 '{self.image_cache_max_mb_var.get()}'"); cache_max_mb = 1024; self.image_cache_max_mb_var.set(cache_max_mb) # 使用 logging
+        try: adaptive_max = int(self.adaptive_max_concurrency_var.get()); assert adaptive_max >= 1
+        except: logger.warning(f"警告: 无效的自适应并发上限 '{self.adaptive_max_concurrency_var.get()}'"); adaptive_max = 4; self.adaptive_max_concurrency_var.set(adaptive_max) # 使用 logging
+        try: postprocess_quality = int(self.postprocess_quality_var.get()); assert 1 <= postprocess_quality <= 100
+        except: logger.warning(f"警告: 无效的编码质量 '{self.postprocess_quality_var.get()}'"); postprocess_quality = 90; self.postprocess_quality_var.set(postprocess_quality) # 使用 logging
+        try: postprocess_workers = int(self.postprocess_workers_var.get()); assert postprocess_workers >= 1
+        except: logger.warning(f"警告: 无效的后处理进程数 '{self.postprocess_workers_var.get()}'"); postprocess_workers = 2; self.postprocess_workers_var.set(postprocess_workers) # 使用 logging
+        try: target_width = int(self.postprocess_target_width_var.get()); assert target_width >= 0
+        except: logger.warning(f"警告: 无效的目标宽度 '{self.postprocess_target_width_var.get()}'"); target_width = 0; self.postprocess_target_width_var.set(target_width) # 使用 logging
+        try: target_height = int(self.postprocess_target_height_var.get()); assert target_height >= 0
+        except: logger.warning(f"警告: 无效的目标高度 '{self.postprocess_target_height_var.get()}'"); target_height = 0; self.postprocess_target_height_var.set(target_height) # 使用 logging
         add_pos = ""; add_neg = ""
         # 安全地获取文本框内容
         if hasattr(self, 'shared_add_pos_textbox') and self.shared_add_pos_textbox.winfo_exists():
@@ -837,7 +1023,20 @@ class ImageGenConfigTab(ctk.CTkFrame):
             "tiling": self.shared_tiling_var.get(),
             "additionalPositivePrompt": add_pos,
             "additionalNegativePrompt": add_neg,
-            "saveImageDebugInputs": self.save_img_debug_var.get() # 收集图片调试开关状态
+            "saveImageDebugInputs": self.save_img_debug_var.get(), # 收集图片调试开关状态
+            "img2imgDownscaleInputs": self.img2img_downscale_var.get(), # 收集参考图缩小开关状态
+            "imageCacheEnabled": self.image_cache_enabled_var.get(), # 收集图片缓存开关状态
+            "imageCacheMaxMB": cache_max_mb, # 收集图片缓存上限
+            "adaptiveConcurrencyEnabled": self.adaptive_concurrency_var.get(), # 收集自适应并发开关状态
+            "adaptiveMaxConcurrency": adaptive_max, # 收集自适应并发上限
+            "affinitySchedulingEnabled": self.affinity_scheduling_var.get(), # 收集模型亲和性排序开关状态
+            "postprocessEnabled": self.postprocess_enabled_var.get(), # 收集保存后处理开关状态
+            "postprocessFormat": self.postprocess_format_options.get(self.postprocess_format_var.get(), "keep"), # 收集输出格式
+            "postprocessQuality": postprocess_quality, # 收集编码质量
+            "postprocessStripMetadata": self.postprocess_strip_metadata_var.get(), # 收集去除元数据开关状态
+            "postprocessWorkers": postprocess_workers, # 收集后处理进程数
+            "postprocessResizeMode": self.postprocess_resize_mode_options.get(self.postprocess_resize_mode_var.get(), "none"), # 收集缩放方式
+            "postprocessTargetWidth": target_width, "postprocessTargetHeight": target_height, # 收集目标分辨率
         }
 
         # 返回包含所有部分的字典
@@ -1,15 +1,18 @@
 # ui/media_selector_popup.py
 import customtkinter as ctk
 import logging
-from PIL import Image, ImageTk # 功能性备注: 导入 Pillow 库用于图像处理
 import os # 功能性备注: 导入 os 用于路径操作
-import re # 功能性备注: 导入 re 用于文本处理
+from core.media_dir_index import get_media_dir_index # 功能性备注: 导入共享的媒体目录索引
+from .thumbnail_service import get_thumbnail_service, DEFAULT_THUMBNAIL_SIZE # 功能性备注: 导入后台缩略图服务
 
 # 功能性备注: 获取当前模块的 logger 实例
 logger = logging.getLogger(__name__)
 
-# 功能性备注: 缩略图默认尺寸
-THUMBNAIL_SIZE = (128, 128)
+# 功能性备注: 缩略图默认尺寸 (与缩略图服务一致)
+THUMBNAIL_SIZE = DEFAULT_THUMBNAIL_SIZE
+# 功能性备注: 虚拟列表每行高度 (复选框高度 + 上下间距) 与初始行控件数
+LIST_ROW_HEIGHT = 28
+INITIAL_ROW_SLOTS = 20
 
 class MediaSelectorPopup(ctk.CTkToplevel):
     """用于选择图片或语音任务的弹窗 (带详情预览和过滤)""" # 功能性备注: 更新类描述
@@ -37,9 +40,15 @@ class MediaSelectorPopup(ctk.CTkToplevel):
         self.media_type = media_type
         self.save_dir = save_dir
         self.selected_ids = None
-        self.checkbox_vars = {}
+        self.selected_item_ids = set() # 功能性备注: 选择状态数据模型 (与行控件无关，过滤和滚动时保留)
+        self.filtered_items = [] # 功能性备注: 当前过滤条件下的任务列表
+        self.first_visible_index = 0 # 功能性备注: 虚拟列表第一行对应的 filtered_items 下标
+        self.row_slots = [] # 功能性备注: 可复用的行控件 [(CTkCheckBox, BooleanVar)]
+        self.slot_items = [] # 功能性备注: 每个行控件当前绑定的任务数据 (None 表示空行)
         self.current_detail_item_id = None
         self.current_detail_item_data = None # 功能性备注: 存储当前显示详情的完整数据
+        self.thumbnail_service = get_thumbnail_service() # 功能性备注: 共享的缩略图服务 (后台生成 + 缓存)
+        self._label_requests = {} # 功能性备注: {图片标签: 最新请求的图片路径}
 
         # --- 功能性备注: 状态变量 ---
         self.filter_var = ctk.StringVar(value="all") # 功能性备注: 列表过滤状态变量
@@ -83,10 +92,22 @@ class MediaSelectorPopup(ctk.CTkToplevel):
         ctk.CTkRadioButton(filter_frame, text="已生成", variable=self.filter_var, value="generated", command=self._render_items).pack(side="left", padx=3)
         ctk.CTkRadioButton(filter_frame, text="错误", variable=self.filter_var, value="error", command=self._render_items).pack(side="left", padx=3)
 
-        # 功能性备注: 任务列表滚动区域
-        self.scrollable_frame = ctk.CTkScrollableFrame(left_pane, label_text=f"选择要生成的 {media_type} 任务")
-        self.scrollable_frame.grid(row=1, column=0, sticky="nsew")
-        self.scrollable_frame.grid_columnconfigure(0, weight=1)
+        # 功能性备注: 任务列表区域 (虚拟列表：只为可见行创建控件，滚动时复用)
+        list_frame = ctk.CTkFrame(left_pane)
+        list_frame.grid(row=1, column=0, sticky="nsew")
+        list_frame.grid_rowconfigure(1, weight=1)
+        list_frame.grid_columnconfigure(0, weight=1)
+        self.list_title_label = ctk.CTkLabel(list_frame, text=f"选择要生成的 {media_type} 任务")
+        self.list_title_label.grid(row=0, column=0, columnspan=2, padx=5, pady=(5, 0), sticky="ew")
+        self.rows_frame = ctk.CTkFrame(list_frame, fg_color="transparent")
+        self.rows_frame.grid(row=1, column=0, padx=(5, 0), pady=5, sticky="nsew")
+        self.rows_frame.grid_columnconfigure(0, weight=1)
+        self.rows_frame.grid_propagate(False) # 逻辑备注: 区域大小由窗口决定，不随行控件数量变化 (避免尺寸变化循环触发刷新)
+        self.list_scrollbar = ctk.CTkScrollbar(list_frame, command=self._on_scrollbar)
+        self.list_scrollbar.grid(row=1, column=1, padx=(0, 5), pady=5, sticky="ns")
+        self.rows_frame.bind("<Configure>", self._on_rows_frame_resized)
+        self._bind_mousewheel(self.rows_frame)
+        self._ensure_row_slots(INITIAL_ROW_SLOTS)
 
         # --- 右侧: 详情显示区域 ---
         self.detail_pane = ctk.CTkFrame(self)
@@ -178,43 +199,111 @@ class MediaSelectorPopup(ctk.CTkToplevel):
             self.audio_text_display.grid(row=1, column=0, padx=10, pady=(0, 10), sticky="nsew")
 
     def _render_items(self):
-        """在滚动框架内渲染任务列表项 (根据过滤条件)"""
-        # 功能性备注: 清空旧内容
-        for widget in self.scrollable_frame.winfo_children():
-            widget.destroy()
-        self.checkbox_vars.clear()
-
-        # 功能性备注: 定义颜色映射
-        color_map = {"ready": "green", "generated": "orange", "error": "red"}
-        default_color = "gray"
-
-        # 功能性备注: 根据过滤条件筛选列表
+        """按过滤条件重新计算任务列表并刷新可见行 (只更新已有行控件，不重建)"""
+        # 功能性备注: 根据过滤条件筛选列表 (纯数据操作)
         current_filter = self.filter_var.get()
-        filtered_items = []
         if current_filter == "all":
-            filtered_items = self.original_items
+            self.filtered_items = list(self.original_items)
         else:
-            filtered_items = [item for item in self.original_items if item.get("status") == current_filter]
-
-        # 功能性备注: 遍历筛选后的任务项并创建 UI 元素
-        for idx, item in enumerate(filtered_items):
-            item_id = item.get("id", f"未知ID_{idx}")
-            item_name = item.get("name", "未知名称")
-            item_status = item.get("status", "error")
-            text_color = color_map.get(item_status, default_color)
-
-            # 功能性备注: 创建 Checkbox，并绑定命令以更新详情面板
+            self.filtered_items = [item for item in self.original_items if item.get("status") == current_filter]
+        self.first_visible_index = 0
+        self._refresh_rows()
+
+    def _ensure_row_slots(self, count):
+        """确保至少有 count 个可复用的行控件"""
+        while len(self.row_slots) < count:
+            slot_index = len(self.row_slots)
             var = ctk.BooleanVar()
             checkbox = ctk.CTkCheckBox(
-                self.scrollable_frame,
-                text=f"{item_name} - {item_id}",
-                variable=var,
-                text_color=text_color,
-                # 逻辑备注: 当 Checkbox 状态改变时，调用 _on_item_selected
-                command=lambda checked=var, item_data=item: self._on_item_selected(checked.get(), item_data)
+                self.rows_frame, text="", variable=var,
+                # 逻辑备注: 当 Checkbox 状态改变时，更新数据模型并显示详情
+                command=lambda index=slot_index: self._on_row_toggled(index)
             )
-            checkbox.grid(row=idx, column=0, padx=5, pady=2, sticky="w")
-            self.checkbox_vars[item_id] = var
+            checkbox.grid(row=slot_index, column=0, padx=5, pady=2, sticky="w")
+            checkbox.grid_remove()
+            self._bind_mousewheel(checkbox)
+            self.row_slots.append((checkbox, var))
+            self.slot_items.append(None)
+
+    def _visible_row_count(self):
+        """根据列表区域高度计算可容纳的行数"""
+        height = self.rows_frame.winfo_height()
+        if height <= 1: return len(self.row_slots) # 逻辑备注: 窗口尚未布局完成
+        return max(1, height // LIST_ROW_HEIGHT)
+
+    def _refresh_rows(self):
+        """把 filtered_items 中从 first_visible_index 开始的任务绑定到行控件上"""
+        # 功能性备注: 定义颜色映射
+        color_map = {"ready": "green", "generated": "orange", "error": "red"}
+        default_color = "gray"
+        visible_count = self._visible_row_count()
+        self._ensure_row_slots(visible_count)
+        total = len(self.filtered_items)
+        max_first = max(0, total - visible_count)
+        self.first_visible_index = min(max(0, self.first_visible_index), max_first)
+
+        for slot_index, (checkbox, var) in enumerate(self.row_slots):
+            item_index = self.first_visible_index + slot_index
+            if slot_index < visible_count and item_index < total:
+                item = self.filtered_items[item_index]
+                item_id = item.get("id", f"未知ID_{item_index}")
+                self.slot_items[slot_index] = item
+                checkbox.configure(text=f"{item.get('name', '未知名称')} - {item_id}",
+                                   text_color=color_map.get(item.get("status", "error"), default_color))
+                var.set(item_id in self.selected_item_ids)
+                checkbox.grid()
+            else:
+                self.slot_items[slot_index] = None
+                checkbox.grid_remove()
+
+        # 功能性备注: 更新滚动条位置
+        if total <= visible_count:
+            self.list_scrollbar.set(0.0, 1.0)
+        else:
+            self.list_scrollbar.set(self.first_visible_index / total, (self.first_visible_index + visible_count) / total)
+
+    def _scroll_to(self, first_index):
+        """滚动到指定的第一行 (越界时自动修正)"""
+        if first_index != self.first_visible_index:
+            self.first_visible_index = first_index
+            self._refresh_rows()
+
+    def _on_scrollbar(self, *args):
+        """滚动条回调 ('moveto', 比例) 或 ('scroll', 数量, 'units'/'pages')"""
+        if not args: return
+        visible_count = self._visible_row_count()
+        if args[0] == "moveto":
+            self._scroll_to(int(round(float(args[1]) * len(self.filtered_items))))
+        elif args[0] == "scroll":
+            step = visible_count if len(args) > 2 and args[2] == "pages" else 1
+            self._scroll_to(self.first_visible_index + int(args[1]) * step)
+
+    def _on_mousewheel(self, event):
+        """鼠标滚轮滚动列表 (Windows/macOS 使用 delta，Linux 使用 Button-4/5)"""
+        if getattr(event, "num", None) == 4 or getattr(event, "delta", 0) > 0:
+            self._scroll_to(self.first_visible_index - 3)
+        else:
+            self._scroll_to(self.first_visible_index + 3)
+        return "break"
+
+    def _bind_mousewheel(self, widget):
+        """为列表区域的控件绑定鼠标滚轮"""
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            widget.bind(sequence, self._on_mousewheel, add="+")
+
+    def _on_rows_frame_resized(self, event=None):
+        """列表区域大小变化时按新的可见行数刷新"""
+        self._refresh_rows()
+
+    def _on_row_toggled(self, slot_index):
+        """行控件的复选框被点击：更新数据模型"""
+        item_data = self.slot_items[slot_index] if slot_index < len(self.slot_items) else None
+        if not item_data or not item_data.get("id"): return
+        item_id = item_data.get("id")
+        is_checked = self.row_slots[slot_index][1].get()
+        if is_checked: self.selected_item_ids.add(item_id)
+        else: self.selected_item_ids.discard(item_id)
+        self._on_item_selected(is_checked, item_data)
 
     def _on_item_selected(self, is_checked, item_data):
         """当列表中的项目被选中或取消选中时调用"""
@@ -243,7 +332,8 @@ class MediaSelectorPopup(ctk.CTkToplevel):
                 self.pos_prompt_textbox.configure(state="normal"); self.pos_prompt_textbox.delete("1.0", "end"); self.pos_prompt_textbox.configure(state="disabled")
             if hasattr(self, 'neg_prompt_textbox'):
                 self.neg_prompt_textbox.configure(state="normal"); self.neg_prompt_textbox.delete("1.0", "end"); self.neg_prompt_textbox.configure(state="disabled")
-            # 重置图片标签
+            # 重置图片标签 (并丢弃尚未完成的缩略图请求)
+            self._label_requests.clear()
             if hasattr(self, 'ref_image_label'): self.ref_image_label.configure(image=None, text="无")
             if hasattr(self, 'mask_image_label'): self.mask_image_label.configure(image=None, text="无")
             if hasattr(self, 'generated_image_label'): self.generated_image_label.configure(image=None, text="未选择")
@@ -335,21 +425,11 @@ class MediaSelectorPopup(ctk.CTkToplevel):
 
             # 4. 更新已生成图像 (如果需要显示)
             if self.show_gen_image_var.get() and hasattr(self, 'generated_image_label'):
+                # 逻辑备注: 通过共享的目录索引查找已生成的文件 (原文件名 / 去掉序号 / _1)，不再逐个探测磁盘
                 generated_image_path = None
                 if self.save_dir and item_id:
-                    potential_path = os.path.join(self.save_dir, item_id)
-                    if os.path.exists(potential_path):
-                        generated_image_path = potential_path
-                    else:
-                        base_name, ext = os.path.splitext(item_id)
-                        base_name_no_num = re.sub(r'_\d+$', '', base_name)
-                        potential_base_path = os.path.join(self.save_dir, f"{base_name_no_num}{ext}")
-                        if os.path.exists(potential_base_path):
-                            generated_image_path = potential_base_path
-                        else:
-                            potential_num1_path = os.path.join(self.save_dir, f"{base_name_no_num}_1{ext}")
-                            if os.path.exists(potential_num1_path):
-                                generated_image_path = potential_num1_path
+                    if generated_name := get_media_dir_index(self.save_dir).find_asset(item_id):
+                        generated_image_path = os.path.join(self.save_dir, generated_name)
                 self._update_image_label(self.generated_image_label, generated_image_path, "未生成")
 
         elif self.media_type == 'audio':
@@ -359,56 +439,50 @@ class MediaSelectorPopup(ctk.CTkToplevel):
                 self.audio_text_display.configure(state="normal"); self.audio_text_display.delete("1.0", "end"); self.audio_text_display.insert("1.0", audio_text); self.audio_text_display.configure(state="disabled")
 
     def _update_image_label(self, label_widget, image_path, placeholder_text):
-        """辅助函数：加载图片、创建缩略图并更新 CTkLabel"""
-        # 功能性备注: 封装图片加载和标签更新逻辑
-        thumbnail_image = None
-        display_text = placeholder_text
-        if image_path and os.path.exists(image_path):
-            try:
-                img = Image.open(image_path)
-                img.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
-                if img.mode not in ['RGB', 'RGBA']: img = img.convert('RGBA')
-                thumbnail_image = ctk.CTkImage(light_image=img, dark_image=img, size=(img.width, img.height))
-                display_text = ""
-            except Exception as e:
-                logger.error(f"加载或创建缩略图失败: {image_path}, 错误: {e}")
-                display_text = "加载失败"
-                thumbnail_image = None
-        # 功能性备注: 更新标签
-        if label_widget and label_widget.winfo_exists(): # 逻辑备注: 增加控件存在性检查
-            label_widget.configure(image=thumbnail_image, text=display_text)
+        """辅助函数：通过后台缩略图服务更新 CTkLabel (未就绪时先显示占位文字)"""
+        # 功能性备注: 缩略图在后台线程生成并缓存，不在主线程打开原图
+        if not (label_widget and label_widget.winfo_exists()): return # 逻辑备注: 增加控件存在性检查
+        self._label_requests[label_widget] = image_path # 功能性备注: 记录该标签最新请求的图片，丢弃过期结果
+        if not (image_path and os.path.exists(image_path)):
+            label_widget.configure(image=None, text=placeholder_text)
+            return
+
+        def on_ready(thumbnail_image, error):
+            # 逻辑备注: 期间用户可能已切换到其他任务或关闭弹窗
+            if self._label_requests.get(label_widget) != image_path or not label_widget.winfo_exists(): return
+            label_widget.configure(image=thumbnail_image, text="" if thumbnail_image else "加载失败")
+
+        thumbnail_image = self.thumbnail_service.get(image_path, self, on_ready)
+        if thumbnail_image is not None:
+            label_widget.configure(image=thumbnail_image, text="")
+        else:
+            label_widget.configure(image=None, text="加载中...")
 
     # --- 底部按钮回调 (保持不变) ---
     def _select_all(self):
-        """选中所有当前可见的 Checkbox"""
+        """选中所有当前过滤出的任务"""
         # 功能性备注: 实现全选功能 (只选当前过滤出的)
-        current_filter = self.filter_var.get()
-        for item_id, var in self.checkbox_vars.items():
-            # 逻辑备注: 需要找到 item_id 对应的原始数据来判断 status
-            original_item = next((item for item in self.original_items if item.get("id") == item_id), None)
-            if original_item:
-                item_status = original_item.get("status")
-                if current_filter == "all" or item_status == current_filter:
-                    var.set(True)
+        self.selected_item_ids.update(item.get("id") for item in self.filtered_items if item.get("id"))
+        self._refresh_rows()
         # 逻辑备注: 全选后，默认显示最后一个项目的详情
-        filtered_items = [item for item in self.original_items if current_filter == "all" or item.get("status") == current_filter]
-        if filtered_items:
-            last_item_data = filtered_items[-1]
+        if self.filtered_items:
+            last_item_data = self.filtered_items[-1]
             self.current_detail_item_data = last_item_data
             self._update_details_pane()
 
     def _deselect_all(self):
-        """取消选中所有 Checkbox"""
+        """取消选中所有当前过滤出的任务"""
         # 功能性备注: 实现取消全选功能
-        for var in self.checkbox_vars.values():
-            var.set(False)
+        for item in self.filtered_items:
+            self.selected_item_ids.discard(item.get("id"))
+        self._refresh_rows()
         # 逻辑备注: 取消全选后，清空详情面板
         self._clear_details_pane()
 
     def _confirm_selection(self):
-        """确认选择，收集选中的 ID 并关闭窗口"""
-        # 功能性备注: 处理确认按钮点击事件
-        self.selected_ids = [item_id for item_id, var in self.checkbox_vars.items() if var.get()]
+        """确认选择，按原始顺序收集选中的 ID 并关闭窗口"""
+        # 功能性备注: 处理确认按钮点击事件 (切换过滤条件前选中的任务同样保留)
+        self.selected_ids = [item.get("id") for item in self.original_items if item.get("id") in self.selected_item_ids]
         logger.info(f"弹窗选择已确认，选中 {len(self.selected_ids)} 项。")
         self.destroy()
 
@@ -0,0 +1,160 @@
+# ui/thumbnail_service.py
+"""
+后台缩略图服务。
+缩略图在工作线程中生成 (打开原图 + LANCZOS 缩放)，结果写入磁盘缓存，键为 (路径, 修改时间, 文件大小, 尺寸)；
+主线程只保留少量 CTkImage 的内存 LRU。未就绪时调用方先显示占位文字，生成完成后通过回调在主线程更新控件。
+"""
+import customtkinter as ctk
+import hashlib # 功能性备注: 导入 hashlib 用于计算缓存文件名
+import os # 功能性备注: 导入 os 用于获取文件状态
+import queue # 功能性备注: 导入队列模块，工作线程通过队列把结果交回主线程
+import threading # 功能性备注: 导入线程模块用于在途请求同步
+from collections import OrderedDict # 功能性备注: 内存 LRU
+from concurrent.futures import ThreadPoolExecutor # 功能性备注: 缩略图生成线程池
+from pathlib import Path # 功能性备注: 导入 Path 对象用于路径处理
+from PIL import Image # 功能性备注: 导入 Pillow 库用于图像处理
+import logging # 功能性备注: 导入日志模块
+
+# 功能性备注: 获取当前模块的 logger 实例
+logger = logging.getLogger(__name__)
+
+# 功能性备注: 默认参数
+THUMBNAIL_CACHE_DIR = Path("cache") / "thumbnails"
+DEFAULT_THUMBNAIL_SIZE = (128, 128)
+DEFAULT_THUMBNAIL_WORKERS = 2
+DEFAULT_MEMORY_ITEMS = 64 # 功能性备注: 内存中保留的 CTkImage 数量
+MAX_DISK_ITEMS = 2000 # 功能性备注: 磁盘缓存文件数上限，超出时按修改时间删除最旧的
+POLL_INTERVAL_MS = 30 # 功能性备注: 主线程检查结果队列的间隔
+
+
+class ThumbnailService:
+    """缩略图生成线程池 + 磁盘缓存 + CTkImage 内存 LRU (get/回调需在 Tk 主线程调用)"""
+    def __init__(self, size=DEFAULT_THUMBNAIL_SIZE, cache_dir=THUMBNAIL_CACHE_DIR,
+                 max_workers=DEFAULT_THUMBNAIL_WORKERS, max_memory_items=DEFAULT_MEMORY_ITEMS):
+        self.size = tuple(size)
+        self.cache_dir = Path(cache_dir)
+        self.max_memory_items = max(1, int(max_memory_items))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="Thumbnail")
+        self._memory = OrderedDict() # 功能性备注: {缓存键: CTkImage}
+        self._waiters = {} # 功能性备注: {缓存键: [回调]}，同一图片的并发请求只生成一次
+        self._results = queue.Queue() # 功能性备注: (缓存键, PIL 图片或 None, 错误信息)
+        self._lock = threading.Lock()
+        self._polling_widget = None
+        self._executor.submit(self._prune_disk_cache)
+
+    def _cache_key(self, image_path):
+        """(路径, 修改时间, 大小, 尺寸) 的哈希；文件不存在时返回 None"""
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        raw = f"{os.path.abspath(image_path)}|{stat.st_mtime_ns}|{stat.st_size}|{self.size[0]}x{self.size[1]}"
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, image_path, widget, on_ready):
+        """
+        获取缩略图。内存中已有时直接返回 CTkImage；否则返回 None 并在后台生成，
+        完成后在主线程调用 on_ready(CTkImage 或 None, 错误信息)。widget 用于在主线程调度结果检查。
+        """
+        cache_key = self._cache_key(image_path)
+        if cache_key is None:
+            on_ready(None, "文件不存在")
+            return None
+        if cache_key in self._memory:
+            self._memory.move_to_end(cache_key)
+            return self._memory[cache_key]
+        with self._lock:
+            is_new = cache_key not in self._waiters
+            self._waiters.setdefault(cache_key, []).append(on_ready)
+        if is_new:
+            self._executor.submit(self._load_thumbnail, cache_key, image_path)
+        self._ensure_polling(widget)
+        return None
+
+    def _load_thumbnail(self, cache_key, image_path):
+        """工作线程：优先读取磁盘缓存，否则从原图生成并写入缓存"""
+        cache_file = self.cache_dir / f"{cache_key}.png"
+        try:
+            if cache_file.is_file():
+                with Image.open(cache_file) as cached:
+                    cached.load()
+                    self._results.put((cache_key, cached.copy(), None))
+                    return
+            with Image.open(image_path) as img:
+                img.thumbnail(self.size, Image.Resampling.LANCZOS)
+                thumb = img if img.mode in ('RGB', 'RGBA') else img.convert('RGBA')
+                thumb.load()
+                thumb = thumb.copy()
+            try:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                temp_file = cache_file.with_suffix(f".{threading.get_ident()}.tmp")
+                thumb.save(temp_file, format="PNG")
+                os.replace(temp_file, cache_file)
+            except OSError as save_e:
+                logger.warning(f"写入缩略图缓存失败: {save_e}") # 逻辑备注: 写缓存失败不影响显示
+            self._results.put((cache_key, thumb, None))
+        except Exception as e:
+            logger.error(f"加载或创建缩略图失败: {image_path}, 错误: {e}")
+            self._results.put((cache_key, None, str(e)))
+
+    def _ensure_polling(self, widget):
+        """在主线程定时检查结果队列 (有在途请求时)"""
+        if self._polling_widget is not None and self._polling_widget.winfo_exists():
+            return
+        self._polling_widget = widget
+        widget.after(POLL_INTERVAL_MS, self._poll)
+
+    def _poll(self):
+        """主线程：把生成完成的缩略图包装为 CTkImage 并回调"""
+        while True:
+            try:
+                cache_key, thumb, error = self._results.get_nowait()
+            except queue.Empty:
+                break
+            ctk_image = None
+            if thumb is not None:
+                ctk_image = ctk.CTkImage(light_image=thumb, dark_image=thumb, size=(thumb.width, thumb.height))
+                self._memory[cache_key] = ctk_image
+                self._memory.move_to_end(cache_key)
+                while len(self._memory) > self.max_memory_items:
+                    self._memory.popitem(last=False)
+            with self._lock:
+                callbacks = self._waiters.pop(cache_key, [])
+            for callback in callbacks:
+                try:
+                    callback(ctk_image, error)
+                except Exception as callback_e:
+                    logger.debug(f"缩略图回调出错 (控件可能已关闭): {callback_e}") # 逻辑备注
+        with self._lock:
+            has_pending = bool(self._waiters)
+        widget = self._polling_widget
+        if has_pending and widget is not None and widget.winfo_exists():
+            widget.after(POLL_INTERVAL_MS, self._poll)
+        else:
+            # 逻辑备注: 无在途请求或控件已关闭时停止轮询；关闭时丢弃旧回调，下次请求重新生成 (磁盘缓存仍有效)
+            self._polling_widget = None
+            if has_pending:
+                with self._lock:
+                    self._waiters.clear()
+
+    def _prune_disk_cache(self):
+        """后台清理：磁盘缓存文件数超过上限时删除最旧的文件"""
+        try:
+            files = sorted(self.cache_dir.glob("*.png"), key=lambda p: p.stat().st_mtime)
+        except OSError:
+            return
+        for old_file in files[:max(0, len(files) - MAX_DISK_ITEMS)]:
+            try:
+                old_file.unlink()
+            except OSError:
+                pass
+
+
+_service = None
+
+def get_thumbnail_service():
+    """获取全局共享的缩略图服务 (首次调用时创建)，多个弹窗共用内存与磁盘缓存"""
+    global _service
+    if _service is None:
+        _service = ThumbnailService()
+    return _service
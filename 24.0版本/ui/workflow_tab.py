@@ -19,6 +19,7 @@ from .workflow_tab_builder import WorkflowTabUIBuilder
 from .workflow_tab_controller import WorkflowTabController
 # 功能性备注: 导入新增的弹窗选择器
 from .media_selector_popup import MediaSelectorPopup
+from core.media_dir_index import get_media_dir_index # 功能性备注: 导入共享的媒体目录索引 (判断文件是否已生成)
 
 # 功能性备注: 获取当前模块的 logger 实例
 logger = logging.getLogger(__name__)
@@ -38,13 +39,15 @@ class WorkflowTab(ctk.CTkFrame):
         self.override_kag_temp_var = BooleanVar(value=False) # 是否覆盖 KAG 转换温度
         self.kag_temp_var = StringVar(value="0.1") # KAG 转换的覆盖温度值
         self.use_img2img_var = BooleanVar(value=False) # 是否启用图生图/内绘模式
-        self.img_gen_scope_var = StringVar(value="uncommented") # 图片生成范围 ('all', 'uncommented', 'commented', 'specific')
+        self.img_gen_scope_var = StringVar(value="uncommented") # 图片生成范围 ('all', 'uncommented', 'commented', 'resume', 'specific')
         self.specific_images_var = StringVar() # 指定的图片文件名 (逗号分隔)
         self.img_n_samples_var = IntVar(value=1) # 每个任务生成的图片数量
         self.audio_gen_scope_var = StringVar(value="uncommented") # 语音生成范围 ('all', 'uncommented', 'commented', 'specific')
         self.specific_speakers_var = StringVar() # 指定的语音占位符
         self.image_prefix_var = StringVar() # 手动替换图片占位符时使用的前缀
         self.audio_prefix_var = StringVar(value="cv_") # 语音生成时使用的文件名前缀
+        self.speculative_api_options = {"关闭": None, "NAI": "NAI", "SD WebUI": "SD WebUI", "ComfyUI": "ComfyUI"} # 推测生成使用的图片 API
+        self.speculative_api_var = StringVar(value="关闭") # 步骤三运行期间按步骤二结果推测生成图片
 
         # 功能性备注: 主滚动框架，容纳所有 UI 元素
         self.scrollable_frame = ctk.CTkScrollableFrame(self, fg_color="transparent")
@@ -196,7 +199,7 @@ class WorkflowTab(ctk.CTkFrame):
         self.controller.update_ui_element(self.widgets['generate_audio_button'], state="normal" if step4_ready and audio_ready else "disabled")
         self.controller.update_ui_element(self.widgets['save_ks_button'], state="normal" if step4_ready else "disabled")
         # 逻辑备注: 更新位于 main_app 中的停止按钮的状态
-        self.controller.update_ui_element(self.app.main_stop_button, state="normal" if task_running else "disabled")
+        self.controller.update_ui_element(self.app.main_stop_button, state="normal" if task_running or self.controller.speculative_running else "disabled")
 
     # 功能性备注: get_workflow_texts, set_workflow_texts, get_workflow_ui_state, set_workflow_ui_state 保持不变
     def get_workflow_texts(self):
@@ -234,7 +237,8 @@ class WorkflowTab(ctk.CTkFrame):
             "audio_gen_scope": self.audio_gen_scope_var.get(), # 逻辑修改: 保存新的范围值
             "specific_speakers": self.specific_speakers_var.get(),
             "image_prefix": self.image_prefix_var.get(),
-            "audio_prefix": self.audio_prefix_var.get()
+            "audio_prefix": self.audio_prefix_var.get(),
+            "speculative_api": self.speculative_api_var.get()
         }
 
     def set_workflow_ui_state(self, state_dict):
@@ -252,6 +256,8 @@ class WorkflowTab(ctk.CTkFrame):
         self.specific_speakers_var.set(state_dict.get("specific_speakers", ""))
         self.image_prefix_var.set(state_dict.get("image_prefix", ""))
         self.audio_prefix_var.set(state_dict.get("audio_prefix", "cv_"))
+        speculative_api = state_dict.get("speculative_api", "关闭")
+        self.speculative_api_var.set(speculative_api if speculative_api in self.speculative_api_options else "关闭")
         # 功能性备注: 根据恢复的状态更新依赖这些变量的 UI 控件的状态
         self.toggle_kag_temp_entry()
         self.toggle_specific_images_entry()
@@ -275,6 +281,9 @@ class WorkflowTab(ctk.CTkFrame):
                 # 逻辑备注: 获取共享图片保存目录
                 shared_img_config = self.app.get_image_gen_shared_config()
                 save_dir = shared_img_config.get('imageSaveDir')
+                # 功能性备注: 刷新保存目录索引 (目录未变化时不重新列出)，用于判断图片是否已存在
+                dir_index = get_media_dir_index(save_dir) if save_dir else None
+                if dir_index: dir_index.refresh()
                 # 逻辑备注: 解析图片任务，提取更多信息
                 pattern = re.compile(
                     r"^\s*(;\s*(?:NAI|IMG)\s+Prompt for\s*(.*?):\s*Positive=\[(.*?)\](?:\s*Negative=\[(.*?)\])?)\s*$\n"
@@ -296,8 +305,10 @@ class WorkflowTab(ctk.CTkFrame):
                     mask_image_path = profile_data.get("mask_path", "")
 
                     config_valid = name in character_profiles
+                    # 逻辑备注: 标签已取消注释，或保存目录中已有对应文件时视为已生成
+                    file_exists = bool(dir_index and dir_index.find_asset(filename))
                     status = "error"
-                    if config_valid: status = "ready" if is_commented else "generated"
+                    if config_valid: status = "generated" if (not is_commented or file_exists) else "ready"
 
                     items_with_status.append({
                         "id": filename, "name": name, "status": status,
@@ -311,7 +322,12 @@ class WorkflowTab(ctk.CTkFrame):
                     r"^\s*((;?)(\s*@playse\s+storage=\"(PLACEHOLDER_.*?)\".*?;\s*name=\"(.*?)\"))\s*$\n\s*(?:「(.*?)」|\（(.*?)\）)\[p\]",
                     re.MULTILINE | re.IGNORECASE
                 )
-                voice_map = self.app.get_gptsovits_config().get("character_voice_map", {})
+                gptsovits_config = self.app.get_gptsovits_config()
+                voice_map = gptsovits_config.get("character_voice_map", {})
+                audio_prefix = gptsovits_config.get("audioPrefix", "")
+                audio_save_dir = gptsovits_config.get("audioSaveDir")
+                audio_index = get_media_dir_index(audio_save_dir) if audio_save_dir else None
+                if audio_index: audio_index.refresh()
                 for match in pattern.finditer(kag_script):
                     is_commented = match.group(2) == ";"
                     placeholder = match.group(4).strip()
@@ -324,8 +340,12 @@ class WorkflowTab(ctk.CTkFrame):
                     if not placeholder: continue
 
                     config_valid = speaker_name in voice_map
+                    # 逻辑备注: 与语音生成任务相同的规则推算实际文件名，保存目录中已存在时视为已生成
+                    audio_exists = False
+                    if audio_index and (placeholder_match := re.match(r'PLACEHOLDER_(.*?)_(\d+)\.wav', placeholder)):
+                        audio_exists = audio_index.exists(f"{audio_prefix}{placeholder_match.group(1)}_{int(placeholder_match.group(2))}.wav")
                     status = "error"
-                    if config_valid: status = "ready" if is_commented else "generated"
+                    if config_valid: status = "generated" if (not is_commented or audio_exists) else "ready"
                     # 逻辑备注: 添加提取到的文本到字典
                     items_with_status.append({"id": placeholder, "name": speaker_name, "status": status, "text": text_to_speak})
             else:
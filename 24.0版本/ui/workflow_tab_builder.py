@@ -104,6 +104,16 @@ class WorkflowTabUIBuilder:
         # 功能性备注: 步骤三状态标签
         widgets['step3_status_label'] = ctk.CTkLabel(step3_controls, text="", text_color="gray", anchor="w") # 步骤三状态标签
         widgets['step3_status_label'].grid(row=0, column=11, sticky="ew", padx=(10, 0))
+        # 功能性备注: 推测生成 (步骤三运行期间按步骤二结果提前生成图片)
+        speculative_frame = ctk.CTkFrame(step3_controls, fg_color="transparent")
+        speculative_frame.grid(row=1, column=0, columnspan=12, sticky="ew", pady=(5, 0))
+        speculative_label = ctk.CTkLabel(speculative_frame, text="推测生成图片:")
+        speculative_label.pack(side="left", padx=(0, 5))
+        widgets['speculative_api_combo'] = ctk.CTkComboBox(speculative_frame, values=list(self.view.speculative_api_options.keys()), variable=self.view.speculative_api_var, width=110) # 推测生成 API 选择
+        widgets['speculative_api_combo'].pack(side="left", padx=(0, 2))
+        if help_btn := create_help_button(speculative_frame, "workflow_tab_ui", "speculative_image_gen"): help_btn.pack(side="left", padx=(0, 10)) # 推测生成帮助按钮
+        widgets['speculative_status_label'] = ctk.CTkLabel(speculative_frame, text="", text_color="gray", anchor="w") # 推测生成状态标签
+        widgets['speculative_status_label'].pack(side="left", fill="x", expand=True)
 
         # --- 步骤四: KAG 脚本结果 ---
         # 功能性备注: 创建步骤四的框架和控件
@@ -139,6 +149,8 @@ class WorkflowTabUIBuilder:
         widgets['img_uncommented_radio'].pack(side="left", padx=5)
         widgets['img_commented_radio'] = ctk.CTkRadioButton(img_scope_frame, text="已生成", variable=self.view.img_gen_scope_var, value="commented", command=self.view.toggle_specific_images_entry)
         widgets['img_commented_radio'].pack(side="left", padx=5)
+        widgets['img_resume_radio'] = ctk.CTkRadioButton(img_scope_frame, text="续传", variable=self.view.img_gen_scope_var, value="resume", command=self.view.toggle_specific_images_entry)
+        widgets['img_resume_radio'].pack(side="left", padx=5)
         if help_btn := create_help_button(img_scope_frame, "workflow_tab_ui", "img_gen_scope"): help_btn.pack(side="left", padx=(10, 5)) # 范围帮助按钮
 
         # 功能性备注: 图片指定行
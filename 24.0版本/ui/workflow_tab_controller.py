@@ -42,6 +42,10 @@ class WorkflowTabController:
         self.task_running = False # 功能性备注: 标记是否有后台任务正在运行
         self.result_queue = Queue() # 功能性备注: 用于线程通信的结果队列
         self.stop_event = threading.Event() # 功能性备注: 用于发送停止信号的事件对象
+        # 功能性备注: 推测生成 (步骤三运行期间按步骤二结果提前生成图片) 独立于 task_running，有自己的停止信号
+        self.speculative_running = False
+        self.speculative_stop_event = threading.Event()
+        self.speculative_api_type = None # 功能性备注: 推测生成使用的 API 类型 (结果尚未绑定到 KAG 脚本时保留)
 
     def update_ui_element(self, element, text=None, state=None, text_color=None, append=False):
         """安全地更新 UI 元素（标签、按钮、文本框）的状态和内容"""
@@ -69,7 +73,7 @@ class WorkflowTabController:
                 # 逻辑备注: 如果是停止按钮，其状态由 task_running 直接决定
                 # 逻辑修改: 停止按钮现在位于主应用中
                 if element == self.view.app.main_stop_button:
-                    actual_state = "normal" if self.task_running else "disabled"
+                    actual_state = "normal" if self.task_running or self.speculative_running else "disabled"
                 # 逻辑备注: 对于其他按钮，如果任务正在运行，则强制禁用
                 else:
                     actual_state = state if not self.task_running else "disabled"
@@ -92,6 +96,10 @@ class WorkflowTabController:
                 # 功能性备注: 获取任务结果信息
                 task_id, status, result_type, result_data, update_target, status_label = self.result_queue.get_nowait()
                 logger.debug(f"从队列收到结果: ID={task_id}, Status={status}, Type={result_type}") # 功能性备注
+                # 逻辑备注: 推测生成结束不影响 task_running (步骤三可能仍在运行)
+                if result_type == "speculative_done":
+                    self._on_speculative_done(status, result_data, status_label)
+                    continue
 
                 is_terminal = False # 功能性备注: 标记是否是任务终止状态
 
@@ -252,7 +260,7 @@ class WorkflowTabController:
         # 功能性备注: 启动后台任务的通用方法
         # 逻辑备注: 检查是否有任务正在运行
         if self.task_running:
-            messagebox.showwarning("任务进行中", "请等待当前任务完成。", parent=self.view); return
+            messagebox.showwarning("任务进行中", "请等待当前任务完成。", parent=self.view); return False
         logger.info(f"准备启动后台任务: {task_id} (流式提示: {is_stream_hint})") # 功能性备注
         # 功能性备注: 清除之前的停止信号
         self.stop_event.clear()
@@ -269,6 +277,7 @@ class WorkflowTabController:
         thread = threading.Thread(target=self._thread_wrapper, args=(task_func, task_id, update_target_widget, status_label_widget, args, is_stream_hint, self.stop_event), daemon=True)
         thread.start()
         logger.info(f"后台线程已启动: {task_id}") # 功能性备注
+        return True
 
     def _thread_wrapper(self, task_func, task_id, update_target_widget, status_label_widget, args, is_stream_hint, stop_event):
         """后台线程实际执行的包装函数"""
@@ -362,7 +371,12 @@ class WorkflowTabController:
             # --- 处理非 LLM 任务 (图片/语音生成) ---
             else:
                 # 逻辑备注: 传递 stop_event
-                result, error = task_func(*args, stop_event=stop_event)
+                if task_func is image_generation_tasks.task_generate_images:
+                    # 功能性备注: 图片生成任务通过回调报告进度和当前并发上限 (在工作线程中调用，经队列转给 UI)
+                    progress_callback = lambda text: self.result_queue.put((task_id, "processing", "task_update", text, None, status_label_widget))
+                    result, error = task_func(*args, stop_event=stop_event, progress_callback=progress_callback)
+                else:
+                    result, error = task_func(*args, stop_event=stop_event)
                 if stop_event.is_set(): raise StopIteration("任务在完成后被用户停止 (结果将被丢弃)") # 功能性备注: 调用后检查
                 status = "error" if error else "success"; result_data = error if error else result
                 self.result_queue.put((task_id, status, "non_stream", result_data, update_target_widget, status_label_widget))
@@ -468,7 +482,69 @@ class WorkflowTabController:
         task_id = f"步骤三 (BGM+KAG, {provider})"
         args = (self.view.api_helpers, self.view.app.prompt_templates, llm_config_for_step3, enhanced_text, provider)
         # 功能性备注: 在后台线程中运行任务 (步骤三总是非流式，由内部函数处理流式细节)
-        self.run_task_in_thread(None, task_id, self.view.widgets['kag_script_widget'], self.view.widgets['step3_status_label'], args=args, is_stream_hint=False) # is_stream_hint=False
+        if self.run_task_in_thread(None, task_id, self.view.widgets['kag_script_widget'], self.view.widgets['step3_status_label'], args=args, is_stream_hint=False): # is_stream_hint=False
+            # 功能性备注: 步骤二结果中的图片提示词已确定，按需在步骤三运行期间推测生成图片
+            self._start_speculative_generation(enhanced_text)
+
+    # --- 推测生成 (步骤三运行期间按步骤二结果提前生成图片) ---
+    def _start_speculative_generation(self, enhanced_text):
+        """按“推测生成”选项在独立线程中启动图片生成，结果在 KAG 脚本就绪后绑定"""
+        api_type = self.view.speculative_api_options.get(self.view.speculative_api_var.get())
+        if not api_type: return
+        if self.speculative_running:
+            logger.info("推测生成仍在进行，本次不再启动。"); return # 逻辑备注
+        config_getters = {"NAI": self.view.app.get_nai_config, "SD WebUI": self.view.app.get_sd_config, "ComfyUI": self.view.app.get_comfyui_config}
+        character_profiles = self.view.app.profiles_tab.character_profiles.copy() if getattr(self.view.app, 'profiles_tab', None) else {}
+        status_label = self.view.widgets.get('speculative_status_label')
+        progress_callback = lambda text: self.result_queue.put(("推测生成", "processing", "task_update", text, None, status_label))
+        args = (self.view.api_helpers, api_type, self.view.app.get_image_gen_shared_config(), config_getters[api_type](),
+                enhanced_text, self.view.image_prefix_var.get().strip(), {"n_samples": self.view.img_n_samples_var.get() or 1},
+                self.view.use_img2img_var.get(), character_profiles)
+        self.speculative_stop_event.clear()
+        self.speculative_running = True; self.speculative_api_type = api_type
+        self.update_ui_element(status_label, text=f"推测生成 ({api_type}): 处理中...", text_color="orange")
+        self.view.update_button_states()
+        thread = threading.Thread(target=self._speculative_thread, args=(args, progress_callback, status_label), daemon=True)
+        thread.start()
+        logger.info(f"推测生成线程已启动 ({api_type})。") # 功能性备注
+
+    def _speculative_thread(self, args, progress_callback, status_label):
+        """推测生成线程：结果以 speculative_done 消息交回 UI 线程"""
+        try:
+            result, error = image_generation_tasks.task_speculative_generate_images(*args, stop_event=self.speculative_stop_event, progress_callback=progress_callback)
+            self.result_queue.put(("推测生成", "error" if error else "success", "speculative_done", error or result, None, status_label))
+        except Exception as e:
+            logger.exception(f"推测生成线程发生未捕获错误: {e}") # 逻辑备注
+            self.result_queue.put(("推测生成", "error", "speculative_done", f"线程内部错误: {e}", None, status_label))
+
+    def _on_speculative_done(self, status, result_data, status_label):
+        """推测生成结束 (UI 线程)：更新状态，KAG 脚本已就绪时立即绑定结果"""
+        self.speculative_running = False
+        self.speculative_stop_event.clear()
+        message = result_data.get('message', '推测生成完成') if isinstance(result_data, dict) else f"推测生成失败: {result_data}"
+        if isinstance(result_data, dict):
+            logger.info("--- 推测生成 详细日志 ---"); [logger.info(line) for line in result_data.get("details", [])]; logger.info("--- 推测生成 日志结束 ---")
+        self.update_ui_element(status_label, text=message[:100], text_color="green" if status == "success" else "red")
+        if status != "success": self.speculative_api_type = None
+        self._bind_speculative_images()
+        self.view.update_button_states()
+
+    def _bind_speculative_images(self):
+        """把推测生成的图片绑定到 KAG 脚本 (推测生成和步骤三都已结束、脚本中已有 image 标签时)"""
+        api_type = self.speculative_api_type
+        if not api_type or self.speculative_running or self.task_running: return
+        kag_script = self.view.widgets['kag_script_widget'].get("1.0", "end-1c")
+        if '[image storage=' not in kag_script: return # 逻辑备注: 占位符尚未替换，替换后会再次调用
+        self.speculative_api_type = None
+        try:
+            modified_script, bound_count = image_generation_tasks.bind_speculative_images(kag_script, api_type, self.view.app.get_image_gen_shared_config())
+        except Exception as e:
+            logger.exception(f"绑定推测生成的图片时出错: {e}"); return # 逻辑备注
+        if bound_count:
+            self.update_ui_element(self.view.widgets['kag_script_widget'], text=modified_script, append=False)
+        status_label = self.view.widgets.get('speculative_status_label')
+        self.update_ui_element(status_label, text=f"已绑定 {bound_count} 个推测生成的图片任务。", text_color="green" if bound_count else "gray")
+        logger.info(f"推测生成: 已绑定 {bound_count} 个图片任务到 KAG 脚本。") # 功能性备注
 
     def _check_llm_readiness(self, provider):
         """检查指定 LLM 提供商的配置是否就绪"""
@@ -498,6 +574,9 @@ class WorkflowTabController:
         # 功能性备注: 初始化变量
         specific_config = None; shared_config = None; task_func = None; task_id_prefix = ""; gen_options = {}; args = (); character_profiles = {}
 
+        # 逻辑备注: 推测生成写入同一保存目录，结束前不启动图片生成
+        if api_type in ["NAI", "SD WebUI", "ComfyUI"] and self.speculative_running:
+            messagebox.showwarning("推测生成进行中", "推测生成仍在进行，请等待其完成 (完成后会自动绑定到 KAG 脚本)。", parent=self.view); return
         # 逻辑备注: 如果是图片生成任务，获取人物设定（主要用于图生图）
         if api_type in ["NAI", "SD WebUI", "ComfyUI"]:
             if hasattr(self.view.app, 'profiles_tab') and self.view.app.profiles_tab:
@@ -605,6 +684,8 @@ class WorkflowTabController:
                 self.update_ui_element(status_label, text=status_text, text_color=color)
                 # 功能性备注: 5秒后清空状态
                 self.view.after(5000, lambda: self.update_ui_element(status_label, text="", text_color="gray"))
+            # 功能性备注: 脚本中已有 image 标签，绑定推测生成的图片 (如有)
+            if replacements_made > 0: self._bind_speculative_images()
         except Exception as e:
             # 逻辑备注: 处理替换错误
             logger.exception(f"替换图片占位符时出错: {e}"); messagebox.showerror("替换错误", f"替换图片占位符时发生错误:\n{e}", parent=self.view) # 逻辑备注
@@ -688,6 +769,10 @@ class WorkflowTabController:
     def stop_current_task(self):
         """请求停止当前正在运行的后台任务"""
         # 功能性备注: 由“停止”按钮触发
+        if self.speculative_running:
+            logger.info("用户请求停止推测生成...") # 功能性备注
+            self.speculative_stop_event.set()
+            self.update_ui_element(self.view.widgets.get('speculative_status_label'), text="推测生成: 正在停止...", text_color="orange")
         if self.task_running:
             logger.info("用户请求停止当前任务...") # 功能性备注
             self.stop_event.set() # 功能性备注: 设置停止信号
@@ -709,5 +794,5 @@ class WorkflowTabController:
             else: # 逻辑备注: 如果找不到活动标签，更新主状态栏
                 if hasattr(self.view.app, 'status_label') and self.view.app.status_label.winfo_exists():
                     self.view.app.status_label.configure(text="正在停止任务...", text_color="orange")
-        else:
+        elif not self.speculative_running:
             logger.info("没有任务正在运行，忽略停止请求。") # 功能性备注